@@ -22,6 +22,13 @@ static const int SET_PHASE_DELAY = 13;
 static const int START_TRIGGER_GENERATION = 14;
 static const int STOP_TRIGGER_GENERATION = 15;
 
+// MCU - computer status (sent after each camera trigger, and on start/stop)
+// header (1 byte), trigger count (4 bytes), volume count (4 bytes), plane of the last trigger (2 bytes),
+// time of the last trigger (4 bytes, micros()), checksum (1 byte, sum of the other bytes)
+static const int STATUS_LENGTH = 16;
+static const byte STATUS_HEADER = 0xAA;
+byte buffer_tx[STATUS_LENGTH];
+
 /*
 // remote focus related variables
 bool remote_focus_trigger_enabled = false; // set to true to listen to optotune trigger output, only set by the computer
@@ -42,6 +49,7 @@ float remote_focus_liquid_lens_phase_delay = 0; // 0 to 1 for 0 to 90 degree
 float remote_focus_delay_us_due_to_phase_lag = 0;
 
 long remote_focus_current_volume_number = 0;   // increament at the beginning of the volume
+uint32_t remote_focus_trigger_count = 0; // camera triggers since the start
 int remote_focus_current_plane_number = 0;
 
 unsigned long remote_focus_timestamp_last_trigger_rising_edge;
@@ -113,13 +121,17 @@ void loop()
           remote_focus_trigger_enabled = true;
           remote_focus_current_plane_number = 0;
           remote_focus_current_volume_number = 0;
+          remote_focus_trigger_count = 0;
           remote_focus_trigger_interval_us = uint32_t( (1000000*1/float(remote_focus_liquid_lens_frequency))/remote_focus_number_of_planes_per_volume );
           Timer_Simulated_Liquid_Lens_Trigger.update(remote_focus_trigger_interval_us);
+          remote_focus_timestamp_last_trigger_rising_edge = micros();
+          send_status();
         } 
         else if(buffer_rx[0] == STOP_TRIGGER_GENERATION)
         {
           // digitalWrite(pin_led,LOW); //@@@
           remote_focus_trigger_enabled = false;
+          send_status();
         }
     }
   }
@@ -143,6 +155,8 @@ void loop()
     if(remote_focus_current_plane_number >= remote_focus_number_of_planes_per_volume)
       remote_focus_volume_started = false; // get ready for the next volume
     remote_focus_current_volume_number = remote_focus_current_volume_number + 1;
+    remote_focus_trigger_count = remote_focus_trigger_count + 1;
+    send_status();
   }
 
   // check if requested number of volumes have been started
@@ -160,6 +174,8 @@ void loop()
     remote_focus_current_plane_number = remote_focus_current_plane_number + 1;
     if(remote_focus_current_plane_number >= remote_focus_number_of_planes_per_volume)
       remote_focus_volume_started = false; // get ready for the next volume
+    remote_focus_trigger_count = remote_focus_trigger_count + 1;
+    send_status();
   }
   
   // turn the trigger pin to LOW
@@ -172,6 +188,31 @@ void loop()
   
 }
 
+void send_status()
+{
+  uint16_t plane = remote_focus_current_plane_number > 0 ? remote_focus_current_plane_number - 1 : 0;
+  buffer_tx[0] = STATUS_HEADER;
+  buffer_tx[1] = byte(remote_focus_trigger_count >> 24);
+  buffer_tx[2] = byte(remote_focus_trigger_count >> 16);
+  buffer_tx[3] = byte(remote_focus_trigger_count >> 8);
+  buffer_tx[4] = byte(remote_focus_trigger_count);
+  buffer_tx[5] = byte(uint32_t(remote_focus_current_volume_number) >> 24);
+  buffer_tx[6] = byte(uint32_t(remote_focus_current_volume_number) >> 16);
+  buffer_tx[7] = byte(uint32_t(remote_focus_current_volume_number) >> 8);
+  buffer_tx[8] = byte(uint32_t(remote_focus_current_volume_number));
+  buffer_tx[9] = byte(plane >> 8);
+  buffer_tx[10] = byte(plane);
+  buffer_tx[11] = byte(remote_focus_timestamp_last_trigger_rising_edge >> 24);
+  buffer_tx[12] = byte(remote_focus_timestamp_last_trigger_rising_edge >> 16);
+  buffer_tx[13] = byte(remote_focus_timestamp_last_trigger_rising_edge >> 8);
+  buffer_tx[14] = byte(remote_focus_timestamp_last_trigger_rising_edge);
+  byte checksum = 0;
+  for (int i = 0; i < STATUS_LENGTH - 1; i++)
+    checksum = checksum + buffer_tx[i];
+  buffer_tx[STATUS_LENGTH - 1] = checksum;
+  SerialUSB.write(buffer_tx, STATUS_LENGTH);
+}
+
 void ISR_liquid_lens_trigger_detected()
 {
   remote_focus_timestamp_liquid_lens_trigger_rising_edge = micros();
@@ -0,0 +1,238 @@
+# benchmarks of the tracking pipeline hot paths - runs with the simulated camera and microcontroller
+import os
+import sys
+import time
+import json
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+from datetime import datetime
+import numpy as np
+import cv2
+
+from control._def import *
+import control.core_headless as core_headless
+import control.utils.image_processing as image_processing
+import control.utils.PID as PID
+import control.utils.CSV_Tool as CSV_Tool
+import control.tracking as tracking
+import control.camera as camera
+import control.microcontroller as microcontroller
+import control.scene_simulation as scene_simulation
+from control.utils.phase_correlation import PDAFShiftEstimator
+from control.utils.focus_measure import FocusMeasureEngine
+
+FRAME_SIZES = [(640,480),(1400,1000),(2560,2048)]
+WORKING_RESOLUTIONS = [0.25,0.5,1.0]
+SEED = 0
+
+parser = argparse.ArgumentParser(description = "Benchmark the tracking pipeline. Results are written as JSON.")
+parser.add_argument("--output", help="Output file (default: benchmark_<commit>_<time>.json).", default = None)
+parser.add_argument("--filter", help="Only run the benchmarks whose name contains one of these strings.", nargs = '+', default = None)
+parser.add_argument("--repeat", help="Number of timed calls per benchmark.", type = int, default = 200)
+parser.add_argument("--warmup", help="Number of untimed calls before each benchmark.", type = int, default = 10)
+parser.add_argument("--quick", help="Only the smallest frame size and the default working resolution.", action = 'store_true')
+args = parser.parse_args()
+
+results = []
+
+def run(name, function, parameters = {}, repeat = None, warmup = None):
+    if args.filter is not None and not any(f in name for f in args.filter):
+        return
+    repeat = args.repeat if repeat is None else repeat
+    warmup = args.warmup if warmup is None else warmup
+    for i in range(warmup):
+        function()
+    t = np.zeros(repeat)
+    for i in range(repeat):
+        timestamp = time.perf_counter()
+        function()
+        t[i] = time.perf_counter() - timestamp
+    result = {'name':name, 'parameters':parameters, 'repeat':repeat,
+        'mean_ms':1000*t.mean(), 'median_ms':1000*np.median(t), 'p95_ms':1000*np.percentile(t,95), 'min_ms':1000*t.min(), 'max_ms':1000*t.max(),
+        'ops_per_s':1/t.mean() if t.mean() > 0 else None}
+    results.append(result)
+    print('{:<40} {:<45} median {:9.3f} ms   p95 {:9.3f} ms'.format(name, json.dumps(parameters), result['median_ms'], result['p95_ms']))
+
+def make_frames(width, height, n = 16):
+    # frames rendered by the simulated scene (seeded), with the stage at rest
+    trajectories = scene_simulation.OrganismTrajectories(seed = SEED)
+    scene = scene_simulation.SceneSimulation(width, height, trajectories = trajectories, log_ground_truth = False)
+    frames = [scene.render(i/CAMERAS[TRACKING]['fps'], i).copy() for i in range(n)]
+    scene.close()
+    return frames
+
+class FrameCycler():
+    def __init__(self, frames):
+        self.frames = frames
+        self.i = 0
+
+    def next(self):
+        frame = self.frames[self.i % len(self.frames)]
+        self.i = self.i + 1
+        return frame
+
+def resize(image, scaling):
+    return cv2.resize(image, (round(image.shape[1]*scaling), round(image.shape[0]*scaling)))
+
+def bench_image_processing(frame_sizes, working_resolutions):
+    lower = np.array([0,0,100],dtype='uint8')
+    upper = np.array([255,255,255],dtype='uint8')
+    for width, height in frame_sizes:
+        frames = make_frames(width, height)
+        for scaling in working_resolutions:
+            parameters = {'width':width, 'height':height, 'working_resolution':scaling}
+            cycler = FrameCycler([resize(frame, scaling) for frame in frames])
+            run('threshold_image', lambda: core_headless.threshold_image(cycler.next(), lower, upper), parameters)
+            thresholded = FrameCycler([255*np.array(core_headless.threshold_image(frame, lower, upper), dtype='uint8') for frame in cycler.frames])
+            run('find_centroid_basic_Rect', lambda: image_processing.find_centroid_basic_Rect(thresholded.next()), parameters)
+            bench_tracker(cycler, thresholded, parameters)
+
+def bench_stream_handler(frame_sizes, working_resolutions):
+    import control.core as core
+    for width, height in frame_sizes:
+        scene = scene_simulation.SceneSimulation(width, height, trajectories = scene_simulation.OrganismTrajectories(seed = SEED), log_ground_truth = False)
+        simulated_camera = camera.Camera_Simulation(width = width, height = height, scene = scene)
+        simulated_camera.start_streaming()
+        for scaling in working_resolutions:
+            parameters = {'width':width, 'height':height, 'working_resolution':scaling}
+            streamHandler = core.StreamHandler(camera = simulated_camera, crop_width = width, crop_height = height, working_resolution_scaling = scaling,
+                rotate_image_angle = CAMERAS[TRACKING]['rotate image angle'], flip_image = CAMERAS[TRACKING]['flip image'])
+            # preprocessing only - no display, saving or tracking
+            streamHandler.fps_display = 1e-6
+            simulated_camera.send_trigger()
+            run('StreamHandler.on_new_frame', lambda: streamHandler.on_new_frame(simulated_camera), parameters)
+            run('SceneSimulation.render', simulated_camera.send_trigger, parameters)
+        simulated_camera.close()
+
+def bench_tracker(cycler, thresholded, parameters):
+    trackers = {'nearest neighbour':'tracker.nearest_neighbour', 'csrt':'tracker.csrt', 'daSiamRPN':'tracker.daSiamRPN'}
+    for tracker_type, name in trackers.items():
+        if args.filter is not None and not any(f in name for f in args.filter):
+            continue
+        tracker = tracking.Tracker_Image()
+        if tracker_type == 'csrt' and 'csrt' not in tracker.OPENCV_OBJECT_TRACKERS:
+            continue
+        if tracker_type == 'daSiamRPN' and not hasattr(tracker, 'net'):
+            print('{:<40} skipped (model not available)'.format(name))
+            continue
+        tracker.update_tracker_type(tracker_type)
+        tracker.update_init_method('threshold')
+        tracker.searchArea = int(cycler.frames[0].shape[1]/Tracking.SEARCH_AREA_RATIO)
+        state = {'first':True}
+        def track():
+            i = cycler.i
+            objectFound, centroid, rect_pts = tracker.track(cycler.next(), thresholded.frames[i % len(thresholded.frames)], is_first_frame = state['first'])
+            state['first'] = not objectFound
+        try:
+            run(name, track, parameters)
+        except Exception as e:
+            print('{:<40} failed: {}'.format(name, e))
+
+def bench_pdaf(roi_sizes = [64,128,256,512]):
+    # shift between two crops of a rendered frame (PDAF ROI sizes are capped at 512 px)
+    import skimage.registration
+    frame = make_frames(1400, 1000, n = 1)[0]
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    shift = 7
+    for size in roi_sizes:
+        y0 = (frame.shape[0] - size)//2
+        x0 = (frame.shape[1] - size)//2
+        image1 = frame[y0:y0+size, x0:x0+size]
+        image2 = frame[y0:y0+size, x0+shift:x0+shift+size]
+        parameters = {'roi_size':size}
+        run('PDAF.skimage', lambda: skimage.registration.phase_cross_correlation(image1, image2, upsample_factor = 5, space = 'real'), parameters)
+        for method in ['projection','2d']:
+            estimator = PDAFShiftEstimator(shift_axis = 'X', method = method)
+            run('PDAF.' + method, lambda: estimator.estimate(image1, image2), parameters)
+
+def bench_focus_measure(frame_sizes):
+    # volumetric imaging focus measure: full plane (original) vs downsampled ROI
+    for (width, height) in frame_sizes:
+        image = make_frames(width, height, n = 1)[0]
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        parameters = {'width':width, 'height':height}
+        run('FocusMeasure.full_plane', lambda: image_processing.calculate_focus_measure(image), parameters)
+        roi = (width/2, height/2, min(VolumetricFocus.ROI_SIZE_DEFAULT, width), min(VolumetricFocus.ROI_SIZE_DEFAULT, height))
+        for metric in FocusMeasureEngine.METRICS:
+            engine = FocusMeasureEngine(metric = metric)
+            run('FocusMeasure.' + metric, lambda: engine.measure(image, roi), parameters)
+
+def bench_pid():
+    pid = PID.PID()
+    pid.initialize(0, 0)
+    rng = np.random.default_rng(SEED)
+    errors = rng.normal(0, 0.05, 1024)
+    state = {'i':0}
+    def update():
+        state['i'] = state['i'] + 1
+        pid.update(errors[state['i'] % len(errors)], state['i']/CAMERAS[TRACKING]['fps'])
+    run('PID.update', update)
+
+def bench_microcontroller():
+    if args.filter is not None and not any(f in 'Microcontroller.move_usteps' for f in args.filter):
+        return
+    mcu = microcontroller.Microcontroller_Simulation()
+    # small alternating moves so that the simulated stage stays in place
+    state = {'sign':1}
+    def move():
+        state['sign'] = -state['sign']
+        mcu.move_x_usteps(state['sign'])
+    run('Microcontroller.move_usteps', move)
+    mcu.close()
+
+def bench_savers(frame_sizes):
+    folder = tempfile.mkdtemp()
+    try:
+        internal_state = core_headless.InternalState()
+        # CSV rows
+        csv_register = CSV_Tool.CSV_Register(header = [SAVE_DATA + list(internal_state.data['imaging channels'])])
+        csv_register.file_directory = os.path.join(folder, 'track000.csv')
+        csv_register.start_write()
+        row = [[internal_state.data[key] for key in SAVE_DATA] + ['0000000.bmp' for key in internal_state.data['imaging channels']]]
+        run('TrackingDataSaver.write_line', lambda: csv_register.write_line(row))
+        csv_register.close()
+        # image writes (what the ImageSaver thread does for each image)
+        for width, height in frame_sizes:
+            frames = FrameCycler(make_frames(width, height, n = 4))
+            for image_format in ['bmp','tif','png']:
+                counter = {'i':0}
+                def write():
+                    counter['i'] = counter['i'] + 1
+                    cv2.imwrite(os.path.join(folder, '{:07d}'.format(counter['i'] % 100) + '.' + image_format), frames.next())
+                run('ImageSaver.write', write, {'width':width, 'height':height, 'format':image_format}, repeat = max(args.repeat//10,10), warmup = 2)
+    finally:
+        shutil.rmtree(folder)
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','--short','HEAD'], cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except:
+        return 'unknown'
+
+if __name__ == "__main__":
+
+    frame_sizes = FRAME_SIZES[:1] if args.quick else FRAME_SIZES
+    working_resolutions = [WORKING_RES_DEFAULT] if args.quick else WORKING_RESOLUTIONS
+    np.random.seed(SEED)
+    cv2.setRNGSeed(SEED)
+
+    bench_stream_handler(frame_sizes, working_resolutions)
+    bench_image_processing(frame_sizes, working_resolutions)
+    bench_pdaf([128] if args.quick else [64,128,256,512])
+    bench_focus_measure(frame_sizes)
+    bench_pid()
+    bench_microcontroller()
+    bench_savers(frame_sizes)
+
+    commit = get_commit()
+    output = args.output if args.output is not None else 'benchmark_' + commit + '_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.json'
+    with open(output,'w') as f:
+        json.dump({'commit':commit, 'timestamp':datetime.now().isoformat(), 'platform':platform.platform(), 'processor':platform.processor(),
+            'python':platform.python_version(), 'opencv':cv2.__version__, 'numpy':np.__version__, 'cpu_count':os.cpu_count(),
+            'tracking_config':TRACKING_CONFIG, 'seed':SEED, 'results':results}, f, indent = 4)
+    print('results written to ' + output)
@@ -77,6 +77,45 @@ class MicrocontrollerDef:
     CMD_LENGTH = 8
     N_BYTES_POS = 4
 
+class MicrocontrollerSimulationDef:
+    BAUDRATE = 2000000 # same as the actual controller
+    LATENCY_S = 0.001 # one-way USB latency
+    STATUS_RATE_HZ = 200 # rate at which the simulated MCU streams 24-byte status packets
+    LOOP_INTERVAL_S = 0.001 # update interval of the simulated stage dynamics
+
+class RateMeasurement:
+    TAU_S = 1.0 # time constant of the moving average of the inter-frame interval
+    PUBLISH_INTERVAL_S = 0.5 # rate at which measured fps are sent to the GUI
+    DROP_FACTOR = 1.5 # an interval longer than this times the expected interval counts as dropped frames
+
+class TriggerScheduling:
+    BUSY_WAIT_S = 0.001 # the trigger thread spins (instead of sleeping) for this long before each deadline; 0 to disable
+    MAX_SLEEP_S = 0.05 # longest sleep of the trigger thread, so that it stops promptly
+
+class LatencyTracing:
+    ENABLED = True
+    N_FRAMES = 4096 # size of the ring of per-frame timestamps
+    PERCENTILES = [50, 90, 99]
+    DISPLAY_UPDATE_INTERVAL_MS = 1000
+
+class TriggerControllerDef:
+    STATUS_LENGTH = 16 # status packet sent by the trigger controller after each camera trigger (and on start/stop)
+    STATUS_HEADER = 0xAA
+    N_TRIGGERS_KEPT = 1024 # triggers waiting to be matched to a camera frame
+    MATCH_TOLERANCE = 0.4 # a frame matches a trigger if its timestamp (less the trigger to frame latency) is within this fraction of the plane interval
+    MATCH_TOLERANCE_S_DEFAULT = 0.005 # ... before the plane interval is known
+    LATENCY_SMOOTHING = 0.05 # weight of each matched frame in the tracking of the trigger to frame latency
+    FRAME_LATENCY_S = None # expected trigger to frame timestamp latency (exposure + transfer); None: measured from the first frame
+    LATENCY_CHECK_FRAMES = 8 # the first matches are held until this many frames validate the latency they give
+    FRAME_TIMEOUT_S = 0.5 # a trigger without a frame this long after its expected frame is a missed frame
+    CLOCK_DRIFT_PPM = 50 # max drift between the controller and host clocks
+
+class TriggerControllerSimulationDef:
+    BAUDRATE = 2000000
+    LATENCY_S = 0.001 # one-way USB latency
+    LOOP_INTERVAL_S = 0.0002
+    CLOCK_DRIFT_PPM = 20 # drift of the simulated controller clock
+
 class Microcontroller2Def:
     MSG_LENGTH = 4
     CMD_LENGTH = 8
@@ -135,6 +174,38 @@ class PID_parameters:
     I_DEFAULT = 0
     D_DEFAULT = 0
 
+class PID_autotuning:
+    RELAY_AMPLITUDE_MM = 0.02 # correction (in mm) commanded per frame during the relay test
+    RELAY_HYSTERESIS_MM = 0.005
+    N_CYCLES = 6 # number of relay oscillation cycles to collect (the first cycle is discarded)
+    TIMEOUT_S = 30
+    RULE = 'Tyreus-Luyben' # 'Ziegler-Nichols' or 'Tyreus-Luyben'
+    RESULTS_FILE = 'pid_autotuning.json' # results are stored per machine configuration
+    # plant model used when tuning against Microcontroller_Simulation
+    SIMULATED_PLANT_DELAY_S = 0.05 # camera exposure + image processing latency
+    SIMULATED_PLANT_TIME_CONSTANT_S = 0.02 # stage response
+    SIMULATED_PLANT_NOISE_MM = 0.001 # centroid localization noise
+    SIMULATED_LOOP_RATE_HZ = 50
+
+class SimulatedScene:
+    N_ORGANISMS = 1
+    ORGANISM_LENGTH_UM = 200
+    ORGANISM_WIDTH_UM = 120
+    ORGANISM_INTENSITY = 180
+    SPEED_UM_S = 300 # rms speed per axis
+    PERSISTENCE_TIME_S = 2
+    DRIFT_UM_S = (0,100,0) # (in-plane axis 0, in-plane axis 1, focus axis), e.g. sedimentation
+    INITIAL_SPREAD_UM = 200
+    BACKGROUND = 20
+    NOISE_STD = 4
+    ILLUMINATION_DRIFT_AMPLITUDE = 0.1
+    ILLUMINATION_DRIFT_PERIOD_S = 30
+    DEPTH_OF_FIELD_UM = 10
+    N_BUFFERS = 4 # rendered frames reused in turn
+    N_NOISE_FRAMES = 4
+    SEED = 0
+    LOG_GROUND_TRUTH = True
+
 class PDAF:
     ROI_ratio_width_default = 2.5
     ROI_ratio_height_default = 2.5
@@ -142,6 +213,42 @@ class PDAF:
     y_offset_default = -41
     shift_to_distance_um_default = -5.0
 
+class PDAFShiftEstimation:
+    METHOD = 'projection' # 'projection' (1D, along PDAF_SHIFT_AXIS), '2d' or 'skimage' (reference implementation)
+    MAX_SHIFT_RATIO = 0.25 # shifts are searched up to this fraction of the ROI size
+    PERPENDICULAR_SEARCH_PX = 2 # '2d': search band half-width across the shift axis
+    WHITENING = 0.3 # 1: phase correlation (sharpest peak, noise sensitive), 0: cross-correlation
+    N_ITERATIONS = 3 # correlations with the window of the second image moved to the last estimate
+    MAX_CACHED_SHAPES = 16 # ROI shapes whose windows and FFT buffers are kept
+
+class PDAFCalibration:
+    Z_RANGE_UM = 100 # z sweep from -Z_RANGE_UM/2 to +Z_RANGE_UM/2 around the current (in focus) position
+    N_Z = 21
+    N_FRAMES_PER_POSITION = 3
+    SETTLE_TIME_S = 0.05 # wait after each z move
+    ROI_SIZE_PX = 256 # shift measurement ROI, in pixels of the working-resolution image (on the tracked object, or the image center)
+    MAX_ERROR = 0.5 # measurements with a larger PDAFShiftEstimator error are left out of the fit
+    CONFIDENCE_LEVEL = 0.95
+    RESULTS_FILE = 'pdaf_calibration.json' # results are stored per machine configuration and objective
+
+class OptotuneLens:
+    BAUDRATE = 115200
+    HANDSHAKE_TIMEOUT_S = 3 # the driver is ready some time after the port is opened - the handshake is retried until then
+    HANDSHAKE_RETRY_INTERVAL_S = 0.1
+    RESPONSE_TIMEOUT_S = 0.1
+    COMMAND_QUEUE_SIZE = 64 # commands waiting for the I/O thread (current setpoints are coalesced)
+
+class OptotuneLensSimulation:
+    LATENCY_S = 0.001 # one-way USB latency
+    RESPONSE_TIME_MS = 2.5 # time constant of the (first order) focal power response to the current
+
+class SynchronizedAcquisition:
+    ENABLED = False # fire the cameras in CHANNELS with one hardware trigger and pair their frames by trigger ID (feeds PDAF)
+    CHANNELS = ['DF1','DF2'] # cameras whose trigger inputs are wired to TRIGGER_OUTPUT_CHANNEL
+    TRIGGER_OUTPUT_CHANNEL = 0
+    PAIRING_WINDOW_S = 0.5 # frames still waiting for their partners after this long are dropped
+    TIMESTAMP_TOLERANCE_MS = 5 # frames with the same trigger ID but exposure timestamps further apart are not paired
+
 class LIMIT_CODE:
     X_POSITIVE = 0
     X_NEGATIVE = 1
@@ -209,6 +316,49 @@ STOP_TRIGGER_GENERATION = 15
 # Volumetric imaging
 VOLUMETRIC_IMAGING_NUMBER_OF_PLANES_PER_VOLUME_DEFAULT = 20
 
+class VolumetricZ:
+    LENS_TRIGGER_PHASE_DEG = -90 # phase of the lens current sinusoid at the rising edge of the lens trigger output (-90: lower current)
+    LENS_RESPONSE_DELAY_MS = 0 # delay of the focal power behind the lens current (lens and driver response)
+    UM_PER_MA = 1.0 # focal shift in the sample per mA of lens current - depends on the objective, to be calibrated
+    PLANE_ASSIGNMENT = 'timestamp' # 'timestamp': volume and plane from the frame timestamp (robust to dropped frames), 'frame_ID': frame_ID % planes per volume
+    ANCHOR_SMOOTHING = 0.05 # 'timestamp': weight of each frame in the tracking of the drift between the camera clock and the lens
+    RESAMPLE_UNIFORM = False # write volumes resampled to uniformly spaced z (from the first monotonic sweep of each volume)
+
+class VolumeBuffers:
+    N_BUFFERS = 4 # preallocated volume stacks: one being filled, the others held by the saver/display until they release them
+    MAX_BUFFER_SIZE_MB = 2048 # N_BUFFERS is reduced (not below 2) so that the pool stays below this size
+
+class VolumeWriting:
+    COMPRESSION = None # None, or a lossless TIFF compression (e.g. 'zlib'; 'zstd' and 'lzw' need imagecodecs)
+    COMPRESSION_LEVEL = 1
+    ROWS_PER_STRIP = 64 # compressed volumes: strips compressed in parallel by N_WORKERS threads
+    N_WORKERS = 4
+    MAX_FILE_SIZE_GB = 4 # a new BigTIFF file is started when the current one reaches this size
+    QUEUE_SIZE = 8 # volumes waiting to be written (they are held from the volume buffer pool)
+
+class VolumeProjection:
+    ENABLED = True # maximum, minimum and depth-coded projections of each volume, displayed once per volume instead of the planes
+    DEPTH_COLORMAP = 'JET' # OpenCV colormap (cv2.COLORMAP_<name>) of the plane of the maximum
+    SAVE = False # write the projections (mip.tif, min.tif, depth.tif) with the recorded volumes
+
+class VolumetricFocus:
+    METRIC = 'laplacian' # 'laplacian' (mean square of the Laplacian), 'variance', 'normalized_variance' or 'tenengrad'
+    FIT_MODEL = 'gaussian' # fit of the focus measure vs plane: 'gaussian', 'parabola' or 'centroid' (weighted mean over the half volume)
+    DOWNSAMPLING = 4 # the focus measure ROI is downsampled by this factor (INTER_AREA) before the metric
+    ROI_RATIO = 2 # ROI size relative to the bounding box of the tracked object
+    ROI_SIZE_DEFAULT = 256 # ROI size (pixels of the volumetric imaging plane) when no object is tracked
+    MIN_PLANES_FOR_ESTIMATE = 5 # the defocus can be reported before the end of the half volume from this many planes
+    PEAK_MARGIN = 0.2 # ... once the fitted peak is this far (normalized plane position) inside the planes acquired so far
+
+class LensFocus:
+    ENABLED = False # focus tracking with the liquid lens (the stage only offloads the lens), can be changed in the GUI
+    GAIN = 0.5 # fraction of the measured focus error corrected at each estimate (integral control of the lens current offset)
+    SIGN = 1 # set to -1 if a positive focus error needs a lower lens current
+    MAX_OFFSET_MA = 50 # range of the lens current offset (further limited by the lens current range)
+    OFFLOAD_START = 0.5 # the stage starts offloading the lens when the offset uses this fraction of its range ...
+    OFFLOAD_STOP = 0.2 # ... and stops when the offset is back below this fraction
+    MIN_UPDATE_MA = 0.05 # smaller offset changes are not sent to the lens driver
+
 class CMD_EXECUTION_STATUS:
     COMPLETED_WITHOUT_ERRORS = 0
     IN_PROGRESS = 1
@@ -336,6 +486,11 @@ class CAMERA:
     ROI_OFFSET_Y_DEFAULT = 0
     ROI_WIDTH_DEFAULT = 3000
     ROI_HEIGHT_DEFAULT = 3000
+    TIMESTAMP_TICK_FREQUENCY_DEFAULT = 1e9 # device timestamp unit when the camera does not report it (USB3 Vision: ns)
+    CLOCK_MAPPING_WINDOW = 256 # number of (device timestamp, host time) pairs used to map the device clock
+    CLOCK_MAPPING_REFIT_INTERVAL = 32 # frames between two updates of the clock drift estimate
+    USE_BUFFER_POOL = False # Daheng cameras: copy each frame from the driver at most once, into reusable buffers
+    BUFFER_POOL_SIZE = 16 # max number of free buffers kept for reuse (frames held by the savers are not in the pool)
 
 # print('-------------------')
 # print(CAMERA_PIXEL_SIZE_UM[CAMERAS['DF1']['sensor']])
@@ -362,6 +517,7 @@ MULTIPOINT_BF_SAVING_OPTION = 'Raw'
 # MULTIPOINT_BF_SAVING_OPTION = 'Green Channel Only'
 
 IMAGE_FORMAT = 'bmp'
+REPLAY_PREFETCH_FRAMES = 32 # number of frames read ahead by the replay camera
 CONTROLLER_VERSION = 'Arduino'
 
 ##########################################################
@@ -374,6 +530,7 @@ if config_files:
         exit()
     print('load machine-specific configuration')
     exec(open(config_files[0]).read())
+    MACHINE_CONFIGURATION = os.path.basename(config_files[0])
 else:
     print('machine-specifc configuration not present, the program will exit')
     exit()
@@ -456,10 +613,16 @@ elif TRACKING_CONFIG == 'XZ_Y':
 # track_obj_image_hrdware -> enable_image_tracking_from_hardware_button
 
 
+# frame ID of the tracking camera (from the device) of the frame each row was computed from
+INTERNAL_STATE_VARIABLES.append('Frame_ID')
+SAVE_DATA.append('Frame_ID')
+INITIAL_VALUES.update({'Frame_ID':-1})
+
 if TWO_CAMERA_PDAF:
-    INTERNAL_STATE_VARIABLES.extend(['track_focus_PDAF','PDAF_shift','PDAF_error'])
-    SAVE_DATA.extend(['track_focus_PDAF','PDAF_shift','PDAF_error'])
-    INITIAL_VALUES.update({'track_focus_PDAF':False,'PDAF_shift':float('nan'),'PDAF_error':float('nan')})
+    # PDAF_age: age (s) of the PDAF defocus used for the row, from the exposure time of its frames
+    INTERNAL_STATE_VARIABLES.extend(['track_focus_PDAF','PDAF_shift','PDAF_error','PDAF_age'])
+    SAVE_DATA.extend(['track_focus_PDAF','PDAF_shift','PDAF_error','PDAF_age'])
+    INITIAL_VALUES.update({'track_focus_PDAF':False,'PDAF_shift':float('nan'),'PDAF_error':float('nan'),'PDAF_age':float('nan')})
 
 if VOLUMETRIC_IMAGING:
     # to add variables to save
@@ -8,6 +8,61 @@ try:
 except:
     print('gxipy import error')
 from control._def import *
+from queue import Queue
+from threading import Thread
+
+class DeviceClock(object):
+    '''
+    Maps device timestamps (camera clock ticks) to the host monotonic clock (time.perf_counter).
+    A frame reaches the host some non-negative transfer/SDK delay after its device timestamp, so the
+    mapping follows the lower envelope of the (device time, host arrival time) pairs: the clock drift
+    (slope) is fitted over a window of recent frames and the offset is the smallest residual.
+    '''
+    def __init__(self,tick_frequency=CAMERA.TIMESTAMP_TICK_FREQUENCY_DEFAULT,window=CAMERA.CLOCK_MAPPING_WINDOW,refit_interval=CAMERA.CLOCK_MAPPING_REFIT_INTERVAL):
+        self.tick_frequency = tick_frequency
+        self.refit_interval = refit_interval
+        self.device_s = np.zeros(window)
+        self.host_s = np.zeros(window)
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.device_ticks_origin = None
+        self.device_ticks_last = None
+        self.host_origin = 0
+        self.slope = 1.0
+        self.offset = 0 # unit: s
+
+    def update(self,device_ticks,host_time):
+        # host_time: time.perf_counter() when the frame was received; returns the mapped device time
+        if self.device_ticks_last is not None and device_ticks < self.device_ticks_last:
+            # the device clock has been reset
+            self.reset()
+        if self.device_ticks_origin is None:
+            self.device_ticks_origin = device_ticks
+            self.host_origin = host_time
+        self.device_ticks_last = device_ticks
+        device_s = (device_ticks - self.device_ticks_origin)/self.tick_frequency
+        host_s = host_time - self.host_origin
+        i = self.n % len(self.device_s)
+        self.device_s[i] = device_s
+        self.host_s[i] = host_s
+        self.n = self.n + 1
+        if self.n == 1:
+            self.offset = host_s - device_s
+        else:
+            self.offset = min(self.offset,host_s - self.slope*device_s)
+            if self.n % self.refit_interval == 0:
+                n = min(self.n,len(self.device_s))
+                device_s_window = self.device_s[:n]
+                host_s_window = self.host_s[:n]
+                if device_s_window.max() - device_s_window.min() > 0:
+                    self.slope = np.polyfit(device_s_window,host_s_window,1)[0]
+                    self.offset = np.min(host_s_window - self.slope*device_s_window)
+        return self.to_host(device_ticks)
+
+    def to_host(self,device_ticks):
+        return self.host_origin + self.offset + self.slope*(device_ticks - self.device_ticks_origin)/self.tick_frequency
 
 class Camera(object):
 
@@ -30,7 +85,22 @@ class Camera(object):
         self.exposure_time = 0 # unit: ms
         self.analog_gain = 0
         self.frame_ID = -1
-        self.timestamp = 0
+        self.frame_ID_offset_hardware_trigger = 0
+        self.timestamp = 0 # exposure time from the device timestamp, on the time.time() scale
+
+        # device frame ID / timestamp of the last frame
+        self.frame_ID_device = None
+        self.frame_ID_device_offset = 0
+        self.timestamp_device = 0 # unit: device ticks
+        self.timestamp_monotonic = 0 # device timestamp mapped to time.perf_counter()
+        self.device_clock = DeviceClock()
+        self.monotonic_to_wall = time.time() - time.perf_counter()
+        # gaps in the device frame IDs (frames dropped by the camera, the driver or the callback)
+        self.n_frames_dropped = 0
+        self.last_frame_gap = 0
+
+        # reusable frame buffers (gxipy zero-copy path) - a frame's buffer is reused once all references to the frame are gone
+        self.buffer_pool = gx.BufferPool(CAMERA.BUFFER_POOL_SIZE) if CAMERA.USE_BUFFER_POOL else None
 
         self.image_locked = False
         self.current_frame = None
@@ -70,6 +140,9 @@ class Camera(object):
         else:
             self.camera = self.device_manager.open_device_by_sn(self.sn)
         self.is_color = self.camera.PixelColorFilter.is_implemented()
+        self.camera.set_buffer_pool(self.buffer_pool)
+        if self.camera.TimestampTickFrequency.is_implemented() and self.camera.TimestampTickFrequency.is_readable():
+            self.device_clock.tick_frequency = self.camera.TimestampTickFrequency.get()
         # self._update_image_improvement_params()
         # self.camera.register_capture_callback(self,self._on_frame_callback)
         if self.is_color:
@@ -96,6 +169,7 @@ class Camera(object):
             raise RuntimeError('Could not find any USB camera devices!')
         self.camera = self.device_manager.open_device_by_sn(sn)
         self.is_color = self.camera.PixelColorFilter.is_implemented()
+        self.camera.set_buffer_pool(self.buffer_pool)
         self._update_image_improvement_params()
 
         '''
@@ -265,8 +339,7 @@ class Camera(object):
         if numpy_image is None:
             return
         self.current_frame = numpy_image
-        self.frame_ID = self.frame_ID + 1 # @@@ read frame ID from the camera
-        self.timestamp = time.time()
+        self._update_frame_ID_and_timestamp(raw_image.get_frame_id(),raw_image.get_timestamp(),time.perf_counter())
         self.new_image_callback_external(self)
        
         # print(self.frame_ID)
@@ -274,6 +347,27 @@ class Camera(object):
         # self.frameID = self.frameID + 1
         # print(self.frameID)
     
+    def _update_frame_ID_and_timestamp(self,frame_ID_device,timestamp_device,host_time):
+        # frame_ID follows the device frame ID, so that dropped frames leave a gap
+        if self.frame_ID_device is None or frame_ID_device <= self.frame_ID_device:
+            # first frame, or the device counter restarted (e.g. stream off/on) - continue from the last frame ID
+            self.frame_ID_device_offset = frame_ID_device - (self.frame_ID + 1)
+            self.last_frame_gap = 0
+        else:
+            self.last_frame_gap = frame_ID_device - self.frame_ID_device - 1
+            if self.last_frame_gap > 0:
+                self.n_frames_dropped = self.n_frames_dropped + self.last_frame_gap
+                print(str(self.last_frame_gap) + ' frame(s) dropped before frame ' + str(frame_ID_device))
+        self.frame_ID_device = frame_ID_device
+        self.frame_ID = frame_ID_device - self.frame_ID_device_offset
+        self.timestamp_device = timestamp_device
+        if timestamp_device > 0:
+            self.timestamp_monotonic = self.device_clock.update(timestamp_device,host_time)
+        else:
+            # no device timestamp
+            self.timestamp_monotonic = host_time
+        self.timestamp = self.timestamp_monotonic + self.monotonic_to_wall
+
     def set_ROI(self,offset_x=None,offset_y=None,width=None,height=None):
         if offset_x is not None:
             self.ROI_offset_x = offset_x
@@ -368,9 +462,11 @@ class Camera(object):
 
 class Camera_Simulation(object):
 
-    def __init__(self,sn=None,width=1920,height=1080,framerate=30,color=False):
+    def __init__(self,sn=None,width=1920,height=1080,framerate=30,color=False,scene=None):
         self.height = height
         self.width = width
+        self.scene = scene # renders the frames if set (control.scene_simulation.SceneSimulation)
+        self.exposure_time = 0 # unit: ms
         self.sample = None
         self.samplelocked = False
         self.newsample = False
@@ -380,6 +476,17 @@ class Camera_Simulation(object):
         self.image_locked = False
         self.is_streaming = False
         self.is_color = color
+        self.frame_ID = 0
+        self.frame_ID_offset_hardware_trigger = 0
+        self.timestamp = 0
+        self.callback_is_enabled = False
+        self.callback_was_enabled_before_autofocus = False
+        self.callback_was_enabled_before_multipoint = False
+
+        # trigger input - hardware triggers (from the simulated microcontroller) are processed on the camera's own thread
+        self.hardware_trigger_queue = Queue()
+        self.hardware_trigger_thread = None
+        self.stop_signal_received = False
 
         self.GAIN_MAX = 480
         self.GAIN_MIN = 0
@@ -404,18 +511,25 @@ class Camera_Simulation(object):
         self.new_image_callback_external = function
 
     def enable_callback(self):
-        pass
+        self.callback_is_enabled = True
 
     def disable_callback(self):
-        pass
+        self.callback_is_enabled = False
 
     def open_by_sn(self,sn):
         pass
 
     def close(self):
-        pass
+        self.stop_signal_received = True
+        if self.hardware_trigger_thread is not None:
+            self.hardware_trigger_thread.join()
+        if self.scene is not None:
+            self.scene.close()
 
     def set_exposure_time(self,exposure_time):
+        self.exposure_time = exposure_time
+        if self.scene is not None:
+            self.scene.set_exposure_time(exposure_time)
         print('Set exposure time to: {}'.format(exposure_time))
 
     def update_camera_exposure_time(self):
@@ -437,19 +551,39 @@ class Camera_Simulation(object):
         pass
 
     def set_continuous_acquisition(self):
-        pass
+        self.trigger_mode = TriggerMode.CONTINUOUS
 
     def set_software_triggered_acquisition(self):
-        pass
+        self.trigger_mode = TriggerMode.SOFTWARE
 
     def set_hardware_triggered_acquisition(self):
-        pass
-
-    def send_trigger(self):
+        self.frame_ID_offset_hardware_trigger = self.frame_ID
+        self.trigger_mode = TriggerMode.HARDWARE
+        if self.hardware_trigger_thread is None:
+            self.hardware_trigger_thread = Thread(target=self.process_hardware_triggers, daemon=True)
+            self.hardware_trigger_thread.start()
+
+    def on_hardware_trigger(self,timestamp):
+        # trigger input line (see Microcontroller_Simulation.connect_trigger_input)
+        if self.trigger_mode == TriggerMode.HARDWARE:
+            self.hardware_trigger_queue.put(timestamp)
+
+    def process_hardware_triggers(self):
+        while not self.stop_signal_received:
+            try:
+                timestamp = self.hardware_trigger_queue.get(timeout=0.1)
+            except:
+                continue
+            self.send_trigger(timestamp)
+            self.hardware_trigger_queue.task_done()
+
+    def send_trigger(self,timestamp=None):
 
         self.frame_ID = self.frame_ID + 1
-        self.timestamp = time.time()
-        if self.frame_ID == 1:
+        self.timestamp = time.time() if timestamp is None else timestamp
+        if self.scene is not None:
+            self.current_frame = self.scene.render(self.timestamp,self.frame_ID)
+        elif self.frame_ID == 1:
             if(self.is_color == False):
                 self.current_frame = np.random.randint(50,size=(1080,1920),dtype=np.uint8)
                 # self.current_frame[800:1000,900:1100] = 200
@@ -464,7 +598,7 @@ class Camera_Simulation(object):
             self.current_frame = np.roll(self.current_frame,10,axis=1)
             pass 
             # self.current_frame = np.random.randint(255,size=(768,1024),dtype=np.uint8)
-        if self.new_image_callback_external is not None:
+        if self.new_image_callback_external is not None and self.callback_is_enabled:
             self.new_image_callback_external(self)
 
     # def send_trigger(self):
@@ -484,7 +618,8 @@ class Camera_Simulation(object):
     #         self.new_image_callback_external(self)
 
     def read_frame(self):
-        pass
+        # the frame rendered by the last send_trigger
+        return self.current_frame
 
     def _on_new_buffer(self, appsink):
         pass
@@ -8,6 +8,8 @@ from scipy import misc
 import cv2
 import os
 
+from control.camera import DeviceClock
+
 try:
     import gi
     gi.require_version("Gst", "1.0")
@@ -35,6 +37,19 @@ class Camera(object):
         self.is_streaming = False
         self.is_color = color
 
+        self.frame_ID = -1
+        self.timestamp = 0 # exposure time from the buffer timestamp, on the time.time() scale
+        # device frame ID (buffer offset) / timestamp (buffer pts) of the last frame
+        self.frame_ID_device = None
+        self.frame_ID_device_offset = 0
+        self.timestamp_device = 0 # unit: ns
+        self.timestamp_monotonic = 0 # buffer timestamp mapped to time.perf_counter()
+        self.device_clock = DeviceClock()
+        self.monotonic_to_wall = time.time() - time.perf_counter()
+        # gaps in the device frame IDs (frames dropped by the camera, the driver or the appsink)
+        self.n_frames_dropped = 0
+        self.last_frame_gap = 0
+
         self.GAIN_MAX = 480
         self.GAIN_MIN = 0
         self.GAIN_STEP = 10
@@ -114,7 +129,6 @@ class Camera(object):
         except GLib.Error as error:
             print("Error starting pipeline: {0}".format(err))#error?
             raise
-        self.frame_ID = 0
 
     def stop_streaming(self):
         self.pipeline.set_state(Gst.State.NULL)
@@ -151,14 +165,17 @@ class Camera(object):
             self.samplelocked = True
             try:
                 self.sample = self.appsink.get_property('last-sample')
+                host_time = time.perf_counter()
                 self._gstbuffer_to_opencv()
                 # print('new buffer read into RAM: ' + str(time.time())) #@@@
                 self.samplelocked = False
                 self.newsample = False
                 # gotimage reflects if a new image was triggered
                 self.gotimage = True
-                self.frame_ID = self.frame_ID + 1 # @@@ read frame ID from the camera
-                self.timestamp = time.time()
+                buf = self.sample.get_buffer()
+                frame_ID_device = buf.offset if buf.offset != Gst.BUFFER_OFFSET_NONE else None
+                timestamp_device = buf.pts if buf.pts != Gst.CLOCK_TIME_NONE else 0
+                self._update_frame_ID_and_timestamp(frame_ID_device,timestamp_device,host_time)
                 if self.new_image_callback_external is not None:
                     self.new_image_callback_external(self)
             except GLib.Error as error:
@@ -166,6 +183,32 @@ class Camera(object):
                 self.img_mat = None
         return Gst.FlowReturn.OK
 
+    def _update_frame_ID_and_timestamp(self,frame_ID_device,timestamp_device,host_time):
+        # same as camera.Camera: frame_ID follows the device frame ID, so that dropped frames leave a gap
+        if frame_ID_device is None:
+            # no frame number on the buffer
+            self.last_frame_gap = 0
+            self.frame_ID = self.frame_ID + 1
+        else:
+            if self.frame_ID_device is None or frame_ID_device <= self.frame_ID_device:
+                # first frame, or the device counter restarted (e.g. stream off/on) - continue from the last frame ID
+                self.frame_ID_device_offset = frame_ID_device - (self.frame_ID + 1)
+                self.last_frame_gap = 0
+            else:
+                self.last_frame_gap = frame_ID_device - self.frame_ID_device - 1
+                if self.last_frame_gap > 0:
+                    self.n_frames_dropped = self.n_frames_dropped + self.last_frame_gap
+                    print(str(self.last_frame_gap) + ' frame(s) dropped before frame ' + str(frame_ID_device))
+            self.frame_ID_device = frame_ID_device
+            self.frame_ID = frame_ID_device - self.frame_ID_device_offset
+        self.timestamp_device = timestamp_device
+        if timestamp_device > 0:
+            self.timestamp_monotonic = self.device_clock.update(timestamp_device,host_time)
+        else:
+            # no buffer timestamp
+            self.timestamp_monotonic = host_time
+        self.timestamp = self.timestamp_monotonic + self.monotonic_to_wall
+
     def _get_property(self, PropertyName):
         try:
             return CameraProperty(*self.source.get_tcam_property(PropertyName))
@@ -0,0 +1,263 @@
+import os
+import glob
+import time
+import cv2
+import numpy as np
+import pandas as pd
+from queue import Queue, Empty, Full
+from threading import Thread
+
+from control._def import *
+
+IMAGE_EXTENSIONS = ('bmp','tif','tiff','png','jpg')
+
+class Camera(object):
+    '''
+    Camera-compatible driver that streams a recorded experiment: either the image sequence
+    written by ImageSaver (base_path/experiment/channel/00000/0000000.bmp, BMP or TIFF), or
+    a video file. Frames are read ahead by a prefetch thread.
+    In software trigger mode each send_trigger delivers the next frame. In continuous mode a
+    playback thread delivers the frames following the recorded timestamps (realtime = True)
+    or as fast as the consumer can take them (realtime = False). The recorded timestamps are the
+    camera timestamps of the channel's timestamps.csv, or the Time of the track files.
+    '''
+    def __init__(self,path,imaging_channel=TRACKING,realtime=True,loop=False,prefetch=REPLAY_PREFETCH_FRAMES,color=False):
+        self.path = path
+        self.imaging_channel = imaging_channel
+        self.realtime = realtime
+        self.loop = loop
+        self.is_color = color
+        self.fps = CAMERAS[imaging_channel]['fps'] if imaging_channel in CAMERAS else 30
+
+        self.new_image_callback_external = None
+        self.callback_is_enabled = False
+        self.image_locked = False
+        self.current_frame = None
+        self.frame_ID = -1
+        self.timestamp = 0
+        self.timestamp_recorded = 0 # timestamp of the current frame in the recording
+        self.exposure_time = 0 # unit: ms
+        self.trigger_mode = None
+        self.is_streaming = False
+        self.n_triggers_dropped = 0
+
+        self.GAIN_MAX = 24
+        self.GAIN_MIN = 0
+        self.GAIN_STEP = 1
+        self.EXPOSURE_TIME_MS_MIN = 0.01
+        self.EXPOSURE_TIME_MS_MAX = 4000
+        self.strobe_delay_us = 0
+
+        self.is_video = os.path.isfile(path)
+        if self.is_video:
+            self.file_list = None
+            self.timestamps = None
+        else:
+            self.file_list, self.timestamps = self._index_image_sequence(path)
+            print('replay: ' + str(len(self.file_list)) + ' images found in ' + path)
+
+        self.queue = Queue(prefetch)
+        self.stop_signal_received = False
+        self.thread_prefetch = Thread(target=self.prefetch,daemon=True)
+        self.thread_prefetch.start()
+        self.thread_playback = None
+        self.stop_playback = False
+
+    def _index_image_sequence(self,path):
+        # path can be the experiment folder, the folder of one channel or a folder of images
+        if os.path.isdir(os.path.join(path,self.imaging_channel)):
+            image_folder = os.path.join(path,self.imaging_channel)
+            experiment_folder = path
+        else:
+            image_folder = path
+            experiment_folder = os.path.dirname(os.path.normpath(path))
+        file_list = []
+        for extension in IMAGE_EXTENSIONS:
+            file_list = file_list + glob.glob(os.path.join(image_folder,'**','*.' + extension),recursive=True)
+        file_list.sort(key=lambda f: (os.path.basename(f),f))
+
+        # recorded timestamps - from timestamps.csv written by ImageWriter (camera timestamps), else from the
+        # track files written by TrackingDataSaver (Time restarts at each track)
+        image_times = self._read_timestamps_file(os.path.join(image_folder,'timestamps.csv'))
+        time_offset = 0
+        track_files = sorted(glob.glob(os.path.join(experiment_folder,'track*.csv'))) if not image_times else []
+        for track_file in track_files:
+            try:
+                df = pd.read_csv(track_file)
+                df = df[df[self.imaging_channel].notna()]
+                for image_name, t in zip(df[self.imaging_channel],df['Time']):
+                    image_times[image_name] = t + time_offset
+                if len(df) > 0:
+                    time_offset = time_offset + df['Time'].max() + 1.0/self.fps
+            except:
+                pass
+        timestamps = []
+        t = 0
+        for f in file_list:
+            t = image_times.get(os.path.basename(f),t + 1.0/self.fps)
+            timestamps.append(t)
+        return file_list, timestamps
+
+    def _read_timestamps_file(self,path):
+        # image name -> camera timestamp, relative to the first image
+        if not os.path.isfile(path):
+            return {}
+        try:
+            df = pd.read_csv(path)
+            return dict(zip(df['image'],df['timestamp'] - df['timestamp'].min()))
+        except:
+            print('replay: cannot read ' + path)
+            return {}
+
+    def prefetch(self):
+        time_offset = 0
+        while self.stop_signal_received == False:
+            t_last = 0
+            for image, t in self._read_frames():
+                t_last = t + time_offset
+                if self._put((image,t_last)) == False:
+                    return
+            if self.loop:
+                time_offset = t_last + 1.0/self.fps
+            else:
+                self._put(None) # end of the recording
+                return
+
+    def _read_frames(self):
+        if self.is_video:
+            video = cv2.VideoCapture(self.path)
+            while True:
+                ret, image = video.read()
+                if ret == False:
+                    break
+                t = video.get(cv2.CAP_PROP_POS_MSEC)/1000
+                if self.is_color == False and image.ndim == 3:
+                    image = cv2.cvtColor(image,cv2.COLOR_BGR2GRAY)
+                yield image, t
+            video.release()
+        else:
+            for f, t in zip(self.file_list,self.timestamps):
+                image = cv2.imread(f,cv2.IMREAD_UNCHANGED)
+                if image is None:
+                    print('replay: cannot read ' + f)
+                    continue
+                if self.is_color == False and image.ndim == 3:
+                    image = cv2.cvtColor(image,cv2.COLOR_BGR2GRAY)
+                yield image, t
+
+    def _put(self,item):
+        while self.stop_signal_received == False:
+            try:
+                self.queue.put(item,timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _deliver(self,item):
+        if item is None:
+            print('replay: end of the recording')
+            return False
+        image, t = item
+        self.current_frame = image
+        self.frame_ID = self.frame_ID + 1
+        self.timestamp = time.time()
+        self.timestamp_recorded = t
+        if self.new_image_callback_external is not None and self.callback_is_enabled:
+            self.new_image_callback_external(self)
+        return True
+
+    def playback(self):
+        timestamp_start = None
+        t_start = None
+        while self.stop_playback == False:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except Empty:
+                continue
+            if item is not None and self.realtime:
+                if timestamp_start is None:
+                    timestamp_start = time.time()
+                    t_start = item[1]
+                delay = (item[1] - t_start) - (time.time() - timestamp_start)
+                if delay > 0:
+                    time.sleep(delay)
+            if self._deliver(item) == False:
+                return
+
+    def _start_playback(self):
+        if self.thread_playback is None and self.is_streaming and self.trigger_mode == TriggerMode.CONTINUOUS:
+            self.stop_playback = False
+            self.thread_playback = Thread(target=self.playback,daemon=True)
+            self.thread_playback.start()
+
+    def _stop_playback(self):
+        if self.thread_playback is not None:
+            self.stop_playback = True
+            self.thread_playback.join()
+            self.thread_playback = None
+
+    def open(self,index=0):
+        pass
+
+    def set_callback(self,function):
+        self.new_image_callback_external = function
+
+    def enable_callback(self):
+        self.callback_is_enabled = True
+
+    def disable_callback(self):
+        self.callback_is_enabled = False
+
+    def close(self):
+        self._stop_playback()
+        self.stop_signal_received = True
+        self.thread_prefetch.join()
+
+    def set_exposure_time(self,exposure_time):
+        self.exposure_time = exposure_time
+
+    def update_camera_exposure_time(self):
+        pass
+
+    def set_analog_gain(self,analog_gain):
+        pass
+
+    def get_awb_ratios(self):
+        pass
+
+    def set_wb_ratios(self, wb_r=None, wb_g=None, wb_b=None):
+        pass
+
+    def start_streaming(self):
+        self.is_streaming = True
+        self._start_playback()
+
+    def stop_streaming(self):
+        self._stop_playback()
+        self.is_streaming = False
+
+    def set_continuous_acquisition(self):
+        self.trigger_mode = TriggerMode.CONTINUOUS
+        self._start_playback()
+
+    def set_software_triggered_acquisition(self):
+        self._stop_playback()
+        self.trigger_mode = TriggerMode.SOFTWARE
+
+    def set_hardware_triggered_acquisition(self):
+        # there is no hardware to trigger the replay - deliver frames on send_trigger
+        self._stop_playback()
+        self.trigger_mode = TriggerMode.HARDWARE
+
+    def send_trigger(self):
+        try:
+            item = self.queue.get_nowait()
+        except Empty:
+            # prefetch has not caught up (or the recording ended), same as a camera that is not ready
+            self.n_triggers_dropped = self.n_triggers_dropped + 1
+            return
+        self._deliver(item)
+
+    def read_frame(self):
+        return self.current_frame
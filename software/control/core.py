@@ -10,8 +10,11 @@ from qtpy.QtGui import *
 
 from control._def import *
 import control.tracking as tracking
+import control.core_headless as core_headless
 import control.utils.image_processing as image_processing
 import control.utils.pol2color as pol2color
+from control.utils.rate_meter import RateMeter
+from control.utils.trigger_scheduler import TriggerScheduler
 
 from queue import Queue
 from threading import Thread, Lock
@@ -35,11 +38,14 @@ class StreamHandler(QObject):
     image_to_display = Signal(np.ndarray, str)
     thresh_image_to_display = Signal(np.ndarray)
     packet_image_to_write = Signal(np.ndarray, int, float)
-    packet_image_for_tracking = Signal(np.ndarray, np.ndarray)
+    packet_image_for_tracking = Signal(np.ndarray, np.ndarray, int, int, float)
+    packet_image_for_pairing = Signal(np.ndarray, str, int, float)
+    packet_image_for_PDAF = Signal(np.ndarray, str, int, float)
     signal_new_frame_received = Signal()
-    signal_fps = Signal(int)
+    signal_fps = Signal(float)
     signal_fps_display = Signal(float)
     signal_fps_save = Signal(str, float)
+    signal_frame_statistics = Signal(float, int)
     signal_working_resolution = Signal(int)
 
     '''
@@ -47,7 +53,10 @@ class StreamHandler(QObject):
     image_to_display ->ImageDisplayer.enque
     packet_image_to_write ->ImageSaver
     packet_image_for_tracking -> Tracking_controller.on_new_frame
+    packet_image_for_pairing (image, channel, trigger ID, timestamp) -> FramePairer.register_frame
+    packet_image_for_PDAF (ROI at native resolution, channel, trigger ID, timestamp) -> PDAFController.register_image_from_camera_1/2 or FramePairer.register_frame
     signal_new_frame_received -> microcontroller_Receiver.get_Data
+    signal_frame_statistics (inter-frame jitter in ms, number of dropped frames) -> CameraSettingsWidget
 
     Slots
     '''
@@ -80,16 +89,12 @@ class StreamHandler(QObject):
         self.handler_busy = False
 
         # for fps measurement
-        self.timestamp_last = 0
-        self.counter = 0
+        self.rate_meter_stream = RateMeter(detect_drops = True)
+        self.rate_meter_display = RateMeter()
+        self.rate_meter_save = RateMeter()
         self.fps_real = 0
-
         self.fps_display_real = 0
-        self.counter_display = 0
-        self.timestamp_last_display_real = 0
-
         self.fps_save_real = 0
-        self.counter_save = 0
 
         self.is_polarization_camera = is_polarization_camera
 
@@ -97,6 +102,17 @@ class StreamHandler(QObject):
         self.lower_HSV = np.array([0, 0, 100],dtype='uint8') 
         self.upper_HSV = np.array([255, 255, 255],dtype='uint8') 
 
+        # per-frame latency tracing (LatencyTracer) - set for the tracking stream
+        self.latency_tracer = None
+
+        # send every frame to the frame pairer (synchronized acquisition)
+        self.pairing_enabled = False
+
+        # PDAF frame tap: every frame, cropped at native resolution around the tracked object
+        self.PDAF_roi = None # (x_center, y_center, width, height) in pixels of the working-resolution image, None: off
+        self.PDAF_flip = (False, False) # (flipud, fliplr) of the frame, in which PDAF_roi is given
+        self.PDAF_scaling = 1.0 # native pixels per working-resolution pixel of the latest frame
+
     def start_recording(self):
         self.save_image_flag = True
         print('Starting Acquisition')
@@ -120,6 +136,10 @@ class StreamHandler(QObject):
         self.fps_save = fps
         print(self.fps_save)
 
+    def set_expected_fps(self,fps):
+        # frame rate set by the trigger (0: free running), for the detection of dropped frames
+        self.rate_meter_stream.set_expected_rate(fps)
+
     def set_crop(self,crop_width,height):
         self.crop_width = crop_width
         self.crop_height = crop_height
@@ -127,6 +147,20 @@ class StreamHandler(QObject):
     def set_working_resolution_scaling(self, working_resolution_scaling):
         self.working_resolution_scaling = working_resolution_scaling/100
 
+    def set_PDAF_roi(self, roi, flipud = False, fliplr = False):
+        # called by the PDAF controller when the tracked object moves - None stops the tap
+        self.PDAF_flip = (flipud, fliplr)
+        self.PDAF_roi = roi
+
+    def crop_PDAF_roi(self, image, roi):
+        x, y, w, h = [value*self.PDAF_scaling for value in roi]
+        flipud, fliplr = self.PDAF_flip
+        # copy the ROI only - the camera may reuse the frame buffer; None if the ROI is outside the frame
+        image_roi = image_processing.crop_roi(image, x, y, w, h, flipud, fliplr)
+        if image_roi.size == 0:
+            return None
+        return image_roi.copy()
+
     def set_image_thresholds(self, lower_HSV, upper_HSV):
         self.lower_HSV = lower_HSV
         self.upper_HSV = upper_HSV
@@ -138,50 +172,32 @@ class StreamHandler(QObject):
         self.invert_image_flag = flag
         
     def threshold_image(self, image_resized, color):
-        if(color):
-            thresh_image = cv2.cvtColor(image_resized, cv2.COLOR_BGR2GRAY)
-            image_resized = np.array(thresh_image, dtype='uint8')
-            thresh_image = image_processing.threshold_image_gray(image_resized, self.lower_HSV[2], self.upper_HSV[2])
-            # thresh_image = image_processing.threshold_image(image_resized,self.lower_HSV,self.upper_HSV)  #The threshold image as one channel
-            if(self.invert_image_flag==True):
-                thresh_image = 1 - thresh_image
-        else:
-            # print(self.lower_HSV[2])
-            # print(self.upper_HSV[2])
-            # img_bgr = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-            # print(max(image_resized))
-            # print(min(image_resized))
-            image_resized = np.array(image_resized, dtype='uint8')
-            thresh_image = image_processing.threshold_image_gray(image_resized, self.lower_HSV[2], self.upper_HSV[2])
-            if(self.invert_image_flag==True):
-                thresh_image = 1 - thresh_image
-
-        return thresh_image
+        return core_headless.threshold_image(image_resized, self.lower_HSV, self.upper_HSV, self.invert_image_flag, color)
 
     def get_real_stream_fps(self):
         # measure real fps
-        timestamp_now = round(time.time())
-        if timestamp_now == self.timestamp_last:
-            self.counter = self.counter+1
-        else:
-            self.timestamp_last = timestamp_now
-            self.fps_real = self.counter
-            self.counter = 0
+        if self.rate_meter_stream.tick():
+            self.fps_real = round(self.rate_meter_stream.get_rate(),1)
             # print('real camera fps is ' + str(self.fps_real))
             self.signal_fps.emit(self.fps_real)
+            # cameras that report device frame IDs count the dropped frames themselves
+            n_dropped = getattr(self.camera, 'n_frames_dropped', self.rate_meter_stream.n_dropped)
+            self.signal_frame_statistics.emit(self.rate_meter_stream.get_jitter_ms(), n_dropped)
 
     def get_real_display_fps(self):
         # measure real fps
-        timestamp_now = round(time.time())
-        if timestamp_now == self.timestamp_last_display_real:
-            self.counter_display = self.counter_display+1
-        else:
-            self.timestamp_last_display_real = timestamp_now
-            self.fps_display_real = self.counter_display
-            self.counter_display = 0
+        if self.rate_meter_display.tick():
+            self.fps_display_real = round(self.rate_meter_display.get_rate(),1)
             # print('real display fps is ' + str(self.fps_display_real))
             self.signal_fps_display.emit(self.fps_display_real)
 
+    def get_real_save_fps(self):
+        # measure real fps
+        if self.rate_meter_save.tick():
+            self.fps_save_real = round(self.rate_meter_save.get_rate(),1)
+            # Send the real save FPS to the recording widget.
+            self.signal_fps_save.emit(self.imaging_channel, self.fps_save_real)
+
 
     def on_new_frame(self, camera):
 
@@ -190,33 +206,16 @@ class StreamHandler(QObject):
         self.handler_busy = True
         self.signal_new_frame_received.emit() # self.liveController.turn_off_illumination()
 
+        trace_index = -1
+        if self.latency_tracer is not None and self.track_flag and self.imaging_channel == TRACKING:
+            trace_index = self.latency_tracer.begin_frame(camera.frame_ID)
+
         image = camera.current_frame
 
         # crop image
         image, self.image_width, self.image_height = image_processing.crop_image(image ,self.crop_width,self.crop_height)
 
-        if(self.rotate_image_angle != 0):
-            '''
-                # ROTATE_90_CLOCKWISE
-                # ROTATE_90_COUNTERCLOCKWISE
-            '''
-            if(self.rotate_image_angle == 90):
-                image = cv2.rotate(image,cv2.ROTATE_90_CLOCKWISE)
-            elif(self.rotate_image_angle == -90):
-                image = cv2.rotate(image,cv2.ROTATE_90_COUNTERCLOCKWISE)
-
-        if(self.flip_image is not None):
-            '''
-                flipcode = 0: flip vertically
-                flipcode > 0: flip horizontally
-                flipcode < 0: flip vertically and horizontally
-            '''
-            if(self.flip_image == 'Vertical'):
-                image = cv2.flip(image, 0)
-            elif(self.flip_image == 'Horizontal'):
-                image = cv2.flip(image, 1)
-            elif(self.flip_image == 'Both'):
-                image = cv2.flip(image, -1)
+        image = core_headless.rotate_flip_image(image, self.rotate_image_angle, self.flip_image)
         
         self.get_real_stream_fps()
 
@@ -235,9 +234,24 @@ class StreamHandler(QObject):
         time_now = time.time() 
         if self.track_flag and self.imaging_channel == TRACKING:
             # track is a blocking operation - it needs to be
-            self.packet_image_for_tracking.emit(image_resized, image_thresh)
+            if self.latency_tracer is not None:
+                self.latency_tracer.stamp(trace_index,'preprocessed')
+            self.packet_image_for_tracking.emit(image_resized, image_thresh, trace_index, camera.frame_ID, camera.timestamp)
             self.timestamp_last_track = time_now
 
+        # send image to the frame pairer - in hardware trigger mode the nth frame since the switch is from the nth trigger
+        trigger_ID = camera.frame_ID - getattr(camera,'frame_ID_offset_hardware_trigger',0)
+        if self.pairing_enabled:
+            self.packet_image_for_pairing.emit(image_resized, self.imaging_channel, trigger_ID, camera.timestamp)
+
+        # send the PDAF ROI of every frame, bypassing the display throttling
+        PDAF_roi = self.PDAF_roi
+        if PDAF_roi is not None:
+            self.PDAF_scaling = self.image_width/image_resized.shape[1]
+            image_roi = self.crop_PDAF_roi(image, PDAF_roi)
+            if image_roi is not None:
+                self.packet_image_for_PDAF.emit(image_roi, self.imaging_channel, trigger_ID, camera.timestamp)
+
         # send image to display
         time_now = time.time()
         if time_now - self.timestamp_last_display >= 1/self.fps_display:
@@ -255,13 +269,8 @@ class StreamHandler(QObject):
             if camera.is_color:
                 image = cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
             self.packet_image_to_write.emit(image, camera.frame_ID, self.camera.timestamp)
-            self.fps_save_real = round(1/(time_now - self.timestamp_last_save),1)
-             # Send the real display FPS to the live Controller widget.
-            self.signal_fps_save.emit(self.imaging_channel, self.fps_save_real)
-            self.counter_save = 0
+            self.get_real_save_fps()
             self.timestamp_last_save = time_now
-        else:
-            self.counter_save += 1
 
         self.handler_busy = False
         camera.image_locked = False
@@ -269,6 +278,9 @@ class StreamHandler(QObject):
 
 class LiveController(QObject):
 
+    signal_trigger_statistics = Signal(float, float, int) # achieved trigger fps, period jitter (ms), skipped triggers
+    signal_expected_fps = Signal(float) # frame rate set by the trigger, 0 in continuous acquisition
+
     def __init__(self,camera,microcontroller,control_illumination=False):
         QObject.__init__(self)
         self.camera = camera
@@ -283,17 +295,13 @@ class LiveController(QObject):
         self.illumination_on = False
 
         self.fps_trigger = FPS['trigger_software']['default']
-        self.timer_trigger_interval = (1/self.fps_trigger)*1000
 
-        self.timer_trigger = QTimer()
-        self.timer_trigger.setInterval(int(self.timer_trigger_interval))
-        self.timer_trigger.timeout.connect(self.trigger_acquisition)
+        # triggers are sent from the scheduler's thread
+        self.trigger_scheduler = TriggerScheduler(self.trigger_acquisition, self.fps_trigger, on_statistics = self.update_trigger_statistics)
 
         self.trigger_ID = -1
 
         self.fps_real = 0
-        self.counter = 0
-        self.timestamp_last = 0
 
         self.exposure_time_bfdf_preset = None
         self.exposure_time_fl_preset = None
@@ -349,29 +357,26 @@ class LiveController(QObject):
                 self.turn_on_illumination()
             self.trigger_ID = self.trigger_ID + 1
             self.camera.send_trigger()
-            # measure real fps
-            timestamp_now = round(time.time())
-            if timestamp_now == self.timestamp_last:
-                self.counter = self.counter+1
-            else:
-                self.timestamp_last = timestamp_now
-                self.fps_real = self.counter
-                self.counter = 0
-                # print('real trigger fps is ' + str(self.fps_real))
         elif self.trigger_mode == TriggerMode.HARDWARE:
             self.trigger_ID = self.trigger_ID + 1
             self.microcontroller.send_hardware_trigger(control_illumination=True,illumination_on_time_us=self.camera.exposure_time*1000)
 
+    def update_trigger_statistics(self, fps, jitter_ms, lateness_max_ms, n_skipped):
+        # measure real fps
+        self.fps_real = round(fps,1)
+        # print('real trigger fps is ' + str(self.fps_real))
+        self.signal_trigger_statistics.emit(self.fps_real, jitter_ms, n_skipped)
+
     def _start_triggerred_acquisition(self):
-        self.timer_trigger.start()
+        self.trigger_scheduler.start()
 
     def _set_trigger_fps(self,fps_trigger):
         self.fps_trigger = fps_trigger
-        self.timer_trigger_interval = (1/self.fps_trigger)*1000
-        self.timer_trigger.setInterval(int(self.timer_trigger_interval))
+        self.trigger_scheduler.set_fps(self.fps_trigger)
+        self.signal_expected_fps.emit(self.fps_trigger)
 
     def _stop_triggerred_acquisition(self):
-        self.timer_trigger.stop()
+        self.trigger_scheduler.stop()
 
     # trigger mode and settings
     def set_trigger_mode(self, mode):
@@ -391,6 +396,7 @@ class LiveController(QObject):
                 self._stop_triggerred_acquisition()
             self.camera.set_continuous_acquisition()
         self.trigger_mode = mode
+        self.signal_expected_fps.emit(0 if mode == TriggerMode.CONTINUOUS else self.fps_trigger)
 
     def set_trigger_fps(self,fps):
         if self.trigger_mode == TriggerMode.SOFTWARE or self.trigger_mode == TriggerMode.HARDWARE:
@@ -403,7 +409,7 @@ class LiveController(QObject):
         
         # temporarily stop live while changing mode
         if self.is_live is True:
-            self.timer_trigger.stop()
+            self.trigger_scheduler.stop()
             self.turn_off_illumination()
         
         self.mode = mode
@@ -420,7 +426,7 @@ class LiveController(QObject):
         # restart live 
         if self.is_live is True:
             self.turn_on_illumination()
-            self.timer_trigger.start()
+            self.trigger_scheduler.start()
 
     def get_trigger_mode(self):
         return self.trigger_mode
@@ -445,6 +451,155 @@ class LiveController(QObject):
                 self.turn_off_illumination()
 
 
+class SynchronizedLiveController(QObject):
+    '''
+    Live acquisition of several cameras from one hardware trigger. The cameras are set to hardware
+    triggered acquisition and their trigger inputs are wired to the same trigger output of the
+    microcontroller, so that each send_hardware_trigger exposes all of them; the trigger ID of a frame
+    is its frame ID counted from the switch to hardware trigger.
+    '''
+    signal_acquisition_started = Signal()
+    signal_acquisition_stopped = Signal()
+    signal_trigger_statistics = Signal(float, float, int) # achieved trigger fps, period jitter (ms), skipped triggers
+    signal_expected_fps = Signal(float) # frame rate set by the trigger
+
+    def __init__(self,cameras,microcontroller,trigger_output_ch=SynchronizedAcquisition.TRIGGER_OUTPUT_CHANNEL,control_illumination=False):
+        QObject.__init__(self)
+        self.cameras = cameras # {channel: camera}
+        self.microcontroller = microcontroller
+        self.trigger_output_ch = trigger_output_ch
+        self.control_illumination = control_illumination
+        self.is_live = False
+
+        self.fps_trigger = FPS['trigger_software']['default']
+        self.trigger_scheduler = TriggerScheduler(self.trigger_acquisition, self.fps_trigger, on_statistics = self.update_trigger_statistics)
+
+        self.trigger_ID = 0
+
+        self.fps_real = 0
+
+    def start_live(self):
+        self.is_live = True
+        for camera in self.cameras.values():
+            camera.start_streaming()
+            camera.set_hardware_triggered_acquisition()
+        # the illumination must cover the exposure of all the cameras
+        self.microcontroller.set_strobe_delay_us(max(camera.strobe_delay_us for camera in self.cameras.values()),self.trigger_output_ch)
+        self.trigger_ID = 0
+        self.signal_acquisition_started.emit()
+        self.signal_expected_fps.emit(self.fps_trigger)
+        self.trigger_scheduler.start()
+
+    def stop_live(self):
+        if self.is_live:
+            self.is_live = False
+            self.trigger_scheduler.stop()
+            for camera in self.cameras.values():
+                camera.set_software_triggered_acquisition()
+            self.signal_acquisition_stopped.emit()
+
+    def trigger_acquisition(self):
+        self.trigger_ID = self.trigger_ID + 1
+        illumination_on_time_us = max(camera.exposure_time for camera in self.cameras.values())*1000
+        self.microcontroller.send_hardware_trigger(control_illumination=self.control_illumination,illumination_on_time_us=illumination_on_time_us,trigger_output_ch=self.trigger_output_ch)
+
+    def update_trigger_statistics(self, fps, jitter_ms, lateness_max_ms, n_skipped):
+        self.fps_real = round(fps,1)
+        self.signal_trigger_statistics.emit(self.fps_real, jitter_ms, n_skipped)
+
+    def set_trigger_fps(self,fps_trigger):
+        self.fps_trigger = fps_trigger
+        self.trigger_scheduler.set_fps(self.fps_trigger)
+        self.signal_expected_fps.emit(self.fps_trigger)
+
+class FramePairer(QObject):
+    '''
+    Groups the frames of the synchronized cameras by trigger ID. A group is sent out once every channel
+    has delivered its frame, if the exposure timestamps agree within the tolerance; frames whose partners
+    do not arrive within the pairing window (or can no longer arrive) are dropped. When the timestamps
+    disagree (a camera missed a trigger), the frame is paired with a pending frame whose timestamp agrees,
+    and the trigger ID offset of its channel is adjusted so that the following frames pair again. Frames are
+    only paired between start() and stop(), i.e. while the cameras share the trigger.
+    '''
+    signal_paired_frames = Signal(tuple, int, float) # (frames in the order of channels), trigger ID, timestamp
+    signal_pairing_statistics = Signal(float, int, int, int) # pair rate, paired, unpaired frames, mismatched pairs
+
+    def __init__(self,channels=SynchronizedAcquisition.CHANNELS,pairing_window_s=SynchronizedAcquisition.PAIRING_WINDOW_S,timestamp_tolerance_ms=SynchronizedAcquisition.TIMESTAMP_TOLERANCE_MS):
+        QObject.__init__(self)
+        self.channels = list(channels)
+        self.pairing_window_s = pairing_window_s
+        self.timestamp_tolerance_ms = timestamp_tolerance_ms
+        self.lock = Lock()
+        self.rate_meter = RateMeter()
+        self.is_active = False
+        self.reset()
+
+    def start(self):
+        self.reset()
+        self.is_active = True
+
+    def stop(self):
+        self.is_active = False
+
+    def reset(self):
+        with self.lock:
+            self.pending = {} # trigger ID -> {channel: (image, timestamp, arrival time)}
+            self.ID_offsets = {channel:0 for channel in self.channels} # added to the trigger IDs of each channel
+            self.n_paired = 0
+            self.n_unpaired = 0
+            self.n_mismatched = 0
+
+    def set_timestamp_tolerance_ms(self,value):
+        self.timestamp_tolerance_ms = value
+
+    def _timestamps_agree(self,frames,timestamp):
+        return all(1000*abs(frame[1] - timestamp) <= self.timestamp_tolerance_ms for frame in frames.values())
+
+    def register_frame(self,image,channel,trigger_ID,timestamp):
+        if not self.is_active or channel not in self.channels:
+            return
+        paired = None
+        timestamp_now = time.time()
+        with self.lock:
+            ID = trigger_ID + self.ID_offsets[channel]
+            frames = self.pending.get(ID,{})
+            if channel in frames or not self._timestamps_agree(frames,timestamp):
+                # one camera missed a trigger (or counts from a different start)
+                self.n_mismatched = self.n_mismatched + 1
+                frames = {}
+            if len(frames) == 0:
+                # resynchronize: a pending frame of the other channels taken at the same time
+                for ID_pending, frames_pending in self.pending.items():
+                    if channel not in frames_pending and self._timestamps_agree(frames_pending,timestamp):
+                        self.ID_offsets[channel] = self.ID_offsets[channel] + ID_pending - ID
+                        ID = ID_pending
+                        break
+            # pending frames without this channel taken before this frame can no longer be completed
+            for ID_pending in [ID_pending for ID_pending, frames_pending in self.pending.items() if channel not in frames_pending
+                and max(frame[1] for frame in frames_pending.values()) < timestamp - self.timestamp_tolerance_ms/1000]:
+                self.n_unpaired = self.n_unpaired + len(self.pending.pop(ID_pending))
+            frames = self.pending.get(ID,{})
+            if channel in frames or not self._timestamps_agree(frames,timestamp):
+                # the slot holds frames taken after this one: this frame has no partner
+                self.n_unpaired = self.n_unpaired + 1
+            else:
+                frames[channel] = (image,timestamp,timestamp_now)
+                self.pending[ID] = frames
+            if len(frames) == len(self.channels):
+                del self.pending[ID]
+                timestamps = [frames[key][1] for key in self.channels]
+                paired = tuple(frames[key][0] for key in self.channels)
+                self.n_paired = self.n_paired + 1
+                # each camera delivers its frames in order - earlier triggers can no longer be completed
+                for ID_pending in [ID_pending for ID_pending in self.pending if ID_pending < ID]:
+                    self.n_unpaired = self.n_unpaired + len(self.pending.pop(ID_pending))
+            for ID_pending in [ID_pending for ID_pending, frames_pending in self.pending.items() if timestamp_now - min(frame[2] for frame in frames_pending.values()) > self.pairing_window_s]:
+                self.n_unpaired = self.n_unpaired + len(self.pending.pop(ID_pending))
+        if paired is not None:
+            self.signal_paired_frames.emit(paired,ID,min(timestamps))
+            if self.rate_meter.tick():
+                self.signal_pairing_statistics.emit(round(self.rate_meter.get_rate(),1),self.n_paired,self.n_unpaired,self.n_mismatched)
+
 class NavigationController(QObject):
 
     signal_x_mm = Signal(float)
@@ -9,21 +9,51 @@ from qtpy.QtWidgets import *
 from qtpy.QtGui import *
 
 import control.utils as utils
+import control.utils.image_processing as image_processing
+import control.core_headless as core_headless
 from control._def import *
 from control.core import *
 import control.tracking as tracking
+from control.utils.phase_correlation import PDAFShiftEstimator
+from control.utils.rate_meter import RateMeter
 
 from queue import Queue
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 import time
 import numpy as np
 import pyqtgraph as pg
 import cv2
+import json
+import scipy.stats
 from datetime import datetime
 
 import skimage # pip3 install -U scikit-image
 import skimage.registration
 
+def fit_shift_vs_defocus(z_um, shifts_px, confidence_level = PDAFCalibration.CONFIDENCE_LEVEL):
+    '''
+    Least-squares fit of shift = intercept + slope*z to all the measurements, with the confidence intervals
+    of the slope and the intercept (Student t). reliable: the slope interval does not include 0.
+    '''
+    z_um = np.asarray(z_um,dtype=float)
+    shifts_px = np.asarray(shifts_px,dtype=float)
+    n = len(z_um)
+    if n < 3 or np.ptp(z_um) == 0:
+        return None
+    A = np.column_stack([np.ones(n),z_um])
+    coefficients, residual_sum, rank, singular_values = np.linalg.lstsq(A,shifts_px,rcond=None)
+    intercept, slope = coefficients
+    residuals = shifts_px - A @ coefficients
+    variance = residuals @ residuals/(n - 2)
+    standard_errors = np.sqrt(variance*np.diag(np.linalg.inv(A.T @ A)))
+    t = scipy.stats.t.ppf(0.5 + confidence_level/2, n - 2)
+    total_sum = np.sum((shifts_px - shifts_px.mean())**2)
+    slope_ci = [slope - t*standard_errors[1], slope + t*standard_errors[1]]
+    return {'slope':float(slope), 'slope_ci':[float(v) for v in slope_ci],
+        'intercept':float(intercept), 'intercept_ci':[float(intercept - t*standard_errors[0]), float(intercept + t*standard_errors[0])],
+        'r2':float(1 - residuals @ residuals/total_sum) if total_sum > 0 else 0.0, 'n':n,
+        'reliable':bool(slope_ci[0] > 0 or slope_ci[1] < 0)}
+
 class PDAFController(QObject):
 
     # input: stream from camera 1, stream from camera 2
@@ -36,13 +66,12 @@ class PDAFController(QObject):
     signal_error = Signal(float)
     signal_image1 = Signal(np.ndarray)
     signal_image2 = Signal(np.ndarray)
+    signal_processing_statistics = Signal(float, float, float) # processing time (ms), skipped pairs (%), processed pairs/s
 
     def __init__(self,tracking_controller_in_plane):
         QObject.__init__(self)
-        self.registration_upsample_factor = 5
-        self.image1_received = False
-        self.image2_received = False
-        self.locked = False
+        self.registration_upsample_factor = 5 # for the skimage shift estimation
+        self.shift_estimator = PDAFShiftEstimator()
         self.tracking_controller_in_plane = tracking_controller_in_plane
         self.internal_state = self.tracking_controller_in_plane.internal_state # to do: add this directly to the input
         self.microcontroller = self.tracking_controller_in_plane.microcontroller # to do: add this directly to the input
@@ -55,108 +84,193 @@ class PDAFController(QObject):
         self.PDAF_calculation_enable = False
         self.PDAF_tracking_enable = False
 
-        self.scale_factor = 1.0 # for keeping the image size for PDAF calculation below 512 x 512 (for now)
+        self.scale_factor = 1.0 # ROI pixels per working-resolution pixel - native resolution, resized to keep the ROI below 512 x 512 (for now)
+
+        # ROI, in pixels of the working-resolution image
+        self.x = 0
+        self.y = 0
+        self.w = 0
+        self.h = 0
+        self.stream_handlers = None
+        self.timestamp_last_display = 0
 
         self.defocus_um_for_enable_tracking_min = -10000
         self.defocus_um_for_enable_tracking_max = 10000
 
-    def register_image_from_camera_1(self,image):
-        if(self.locked==True):
+        # latest ROI of each camera, and latest pair waiting for the PDAF thread
+        self.images_latest = [None,None]
+        self.pair = None
+        self.pair_lock = Lock()
+        self.new_pair_event = Event()
+        self.n_pairs_received = 0
+        self.n_pairs_skipped = 0 # pairs replaced by a newer one before they were processed
+        self.n_pairs_received_last_publish = 0
+        self.n_pairs_skipped_last_publish = 0
+        self.processing_time_ms = None
+        self.rate_meter = RateMeter()
+
+        self.stop_signal_received = False
+        self.thread = Thread(target=self.process_pairs)
+        self.thread.start()
+
+    def set_stream_handlers(self,streamHandler1,streamHandler2):
+        # the stream handlers crop the PDAF ROI from every frame (packet_image_for_PDAF)
+        self.stream_handlers = (streamHandler1,streamHandler2)
+
+    def update_roi(self,rect_pts=None):
+        # follows the tracked object (TrackingController.Rect_pt1_pt2), in pixels of the working-resolution image
+        centroid = self.tracking_controller_in_plane.centroid
+        if self.stream_handlers is None:
             return
-        self.image1 = np.copy(image)
-        self.image1_received = True
-        if(self.image2_received):
-            self.calculate_defocus()
-
-    def register_image_from_camera_2(self,image):
-        if(self.locked==True):
+        if self.PDAF_calculation_enable == False or centroid is None or rect_pts is None:
+            self.clear_roi()
             return
-        self.image2 = np.copy(image)
-        if PDAF_FLIPUD: 
-            self.image2 = np.flipud(self.image2)
-        if PDAF_FLIPLR:
-            self.image2 = np.fliplr(self.image2)
-        self.image2_received = True
-        if(self.image1_received):
-            self.calculate_defocus()
-
-    def calculate_defocus(self):
-        if self.tracking_controller_in_plane.centroid is not None and self.tracking_controller_in_plane.objectFound is True: 
-            self.locked = True
-            # cropping parameters
-            self.x = self.tracking_controller_in_plane.centroid[0]
-            self.y = self.tracking_controller_in_plane.centroid[1]
-            self.w = int(abs(self.tracking_controller_in_plane.rect_pts[0][0]-self.tracking_controller_in_plane.rect_pts[1][0])*self.ROI_ratio_width)
-            self.h = int(abs(self.tracking_controller_in_plane.rect_pts[0][1]-self.tracking_controller_in_plane.rect_pts[1][1])*self.ROI_ratio_height)
-            # crop
-            self.image1 = self.image1[max((self.y-int(self.h/2)),0):min(self.image1.shape[0],(self.y+int(self.h/2))),max(0,(self.x-int(self.w/2))):min(self.image1.shape[1],(self.x+int(self.w/2)))]
-            self.image2 = self.image2[max((self.y+self.offset_y-int(self.h/2)),0):min(self.image2.shape[0],(self.y+self.offset_y+int(self.h/2))),max(0,(self.x+self.offset_x-int(self.w/2))):min(self.image2.shape[1],(self.x+self.offset_x+int(self.w/2)))] 
+        self.x = centroid[0]
+        self.y = centroid[1]
+        self.w = int(abs(rect_pts[0][0]-rect_pts[1][0])*self.ROI_ratio_width)
+        self.h = int(abs(rect_pts[0][1]-rect_pts[1][1])*self.ROI_ratio_height)
+        self.stream_handlers[0].set_PDAF_roi((self.x,self.y,self.w,self.h))
+        # the offsets are in the flipped image of camera 2
+        self.stream_handlers[1].set_PDAF_roi((self.x+self.offset_x,self.y+self.offset_y,self.w,self.h),PDAF_FLIPUD,PDAF_FLIPLR)
+
+    def clear_roi(self):
+        if self.stream_handlers is not None:
+            for streamHandler in self.stream_handlers:
+                streamHandler.set_PDAF_roi(None)
+
+    def register_image_from_camera_1(self,image,channel=None,trigger_ID=-1,timestamp=None):
+        self._register_image(0,image,timestamp)
+
+    def register_image_from_camera_2(self,image,channel=None,trigger_ID=-1,timestamp=None):
+        self._register_image(1,image,timestamp)
+
+    def _register_image(self,index,image,timestamp):
+        # called from the camera threads (direct connection to the PDAF taps) - pairs the latest ROI of each camera
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.pair_lock:
+            self.images_latest[index] = (image,timestamp)
+            if self.images_latest[1-index] is None:
+                return
+            (image1,timestamp1),(image2,timestamp2) = self.images_latest
+            self.images_latest = [None,None]
+        self.submit_image_pair(image1,image2,min(timestamp1,timestamp2))
+
+    def register_image_pair(self,images,trigger_ID,timestamp):
+        # ROIs of camera 1 and 2 from the same hardware trigger (FramePairer)
+        self.submit_image_pair(images[0],images[1],timestamp)
+
+    def submit_image_pair(self,image1,image2,timestamp):
+        # hand the pair over to the PDAF thread; a pair that has not been picked up yet is replaced,
+        # so that the thread always works on the newest frames
+        if self.tracking_controller_in_plane.centroid is None or self.tracking_controller_in_plane.objectFound is not True:
+            # tracking has stopped - stop the taps until the next tracked frame
+            self.clear_roi()
+            return
+        with self.pair_lock:
+            if self.pair is not None:
+                self.n_pairs_skipped = self.n_pairs_skipped + 1
+            self.pair = (image1,image2,timestamp)
+            self.n_pairs_received = self.n_pairs_received + 1
+        self.new_pair_event.set()
+
+    def process_pairs(self):
+        while True:
+            # stop the thread if stop signal is received
+            if self.stop_signal_received:
+                return
+            if not self.new_pair_event.wait(timeout=0.1):
+                continue
+            with self.pair_lock:
+                self.new_pair_event.clear()
+                pair = self.pair
+                self.pair = None
+            if pair is None:
+                continue
+            timestamp_start = time.perf_counter()
             try:
-                # resize
-                if max(self.h,self.w) > 512:
-                    self.scale_factor = 512.0/max(self.h,self.w)
-                    # print('resize image ... ' + str(self.scale_factor))
-                    self.image1 = cv2.resize(self.image1,(int(self.image1.shape[1]*self.scale_factor),int(self.image1.shape[0]*self.scale_factor)))
-                    self.image2 = cv2.resize(self.image2,(int(self.image2.shape[1]*self.scale_factor),int(self.image2.shape[0]*self.scale_factor)))
-                    # self.image1 = cv2.resize(self.image1,None,self.scale_factor,self.scale_factor)
-                    # self.image2 = cv2.resize(self.image2,None,self.scale_factor,self.scale_factor)
-                else:
-                    self.scale_factor = 1.0
-                # send cropped images to display
-                self.signal_image1.emit(self.image1)
-                self.signal_image2.emit(self.image2)
-                # print(self.image1.shape)
-                # print((self.h,self.w))
-                # print('---')
-                # convert image to mono if the image is color:
-                if len(self.image1.shape) > 2:
-                    self.image1 = cv2.cvtColor(self.image1, cv2.COLOR_BGR2GRAY)
-                    self.image2 = cv2.cvtColor(self.image2, cv2.COLOR_BGR2GRAY)
-
-                if self.image1.shape[0] > 0.9*self.h*self.scale_factor and self.image1.shape[1] > 0.9*self.w*self.scale_factor and self.image1.shape == self.image2.shape and self.PDAF_calculation_enable:
-                    # calculate shift
-                    shift, error = self._compute_shift_from_image_pair()
-                    shift = shift/self.scale_factor
-                    # save result
-                    self.internal_state.data['PDAF_shift'] = shift
-                    self.internal_state.data['PDAF_error'] = error 
-                    # only output the defocus when calculation is reliable
-                    if error < 0.5:
-                        # self.signal_defocus_pixel_shift.emit(shift)
-                        self.defocus_um = shift*self.shift_to_distance_um
-                        self.signal_defocus_um_display.emit(self.defocus_um)
-                        self.signal_error.emit(error)
-                        # emit defocus for tracking
-                        if self.PDAF_tracking_enable and ( self.defocus_um >= self.defocus_um_for_enable_tracking_min ) and ( self.defocus_um <= self.defocus_um_for_enable_tracking_max):
-                            # self.signal_defocus_um_tracking.emit(self.defocus_um)
-                            self.tracking_controller_in_plane.track_focus = True
-                            self.tracking_controller_in_plane.focus_error = self.defocus_um/1000.0
-                        else:
-                            self.tracking_controller_in_plane.track_focus = False
-                            self.tracking_controller_in_plane.focus_error = 0
-            except:
-                pass
-            # get ready for the next calculation
-            self.image1_received = False
-            self.image2_received = False
-            self.locked = False
+                self.calculate_defocus(*pair)
+            except Exception as e:
+                print('PDAF error: ' + str(e))
+            timestamp_end = time.perf_counter()
+            self._update_processing_statistics(timestamp_end - timestamp_start,timestamp_end)
+
+    def _update_processing_statistics(self,processing_time,timestamp):
+        self.processing_time_ms = 1000*processing_time if self.processing_time_ms is None else self.processing_time_ms + 0.1*(1000*processing_time - self.processing_time_ms)
+        if self.rate_meter.tick(timestamp):
+            with self.pair_lock:
+                n_received = self.n_pairs_received - self.n_pairs_received_last_publish
+                n_skipped = self.n_pairs_skipped - self.n_pairs_skipped_last_publish
+                self.n_pairs_received_last_publish = self.n_pairs_received
+                self.n_pairs_skipped_last_publish = self.n_pairs_skipped
+            skip_rate = 100.0*n_skipped/n_received if n_received > 0 else 0
+            self.signal_processing_statistics.emit(self.processing_time_ms,skip_rate,self.rate_meter.get_rate(timestamp))
+
+    def calculate_defocus(self,image1,image2,timestamp):
+        # runs in the PDAF thread - the images are the ROIs at native resolution, camera 2 already flipped
+        native_scaling = self.stream_handlers[0].PDAF_scaling if self.stream_handlers is not None else 1.0
+        # ROIs clipped by the edge of the frame are not used
+        roi_complete = image1.shape[0] > 0.9*self.h*native_scaling and image1.shape[1] > 0.9*self.w*native_scaling and image1.shape == image2.shape
+        # resize
+        if max(image1.shape[0],image1.shape[1]) > 512:
+            resize_factor = 512.0/max(image1.shape[0],image1.shape[1])
+            image1 = cv2.resize(image1,(int(image1.shape[1]*resize_factor),int(image1.shape[0]*resize_factor)))
+            image2 = cv2.resize(image2,(int(image2.shape[1]*resize_factor),int(image2.shape[0]*resize_factor)))
         else:
-            pass
+            resize_factor = 1.0
+        # image pixels per working-resolution pixel, in which the shift is calibrated
+        self.scale_factor = native_scaling*resize_factor
+        # send cropped images to display
+        time_now = time.time()
+        if time_now - self.timestamp_last_display >= 1/FPS['display']['default']:
+            self.signal_image1.emit(image1)
+            self.signal_image2.emit(image2)
+            self.timestamp_last_display = time_now
+        # convert image to mono if the image is color:
+        if len(image1.shape) > 2:
+            image1 = cv2.cvtColor(image1, cv2.COLOR_BGR2GRAY)
+            image2 = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
+
+        if roi_complete and self.PDAF_calculation_enable:
+            # calculate shift
+            shift, error = self._compute_shift_from_image_pair(image1,image2)
+            shift = shift/self.scale_factor
+            # save result
+            self.internal_state.data['PDAF_shift'] = shift
+            self.internal_state.data['PDAF_error'] = error 
+            # only output the defocus when calculation is reliable
+            if error < 0.5:
+                # self.signal_defocus_pixel_shift.emit(shift)
+                self.defocus_um = shift*self.shift_to_distance_um
+                self.signal_defocus_um_display.emit(self.defocus_um)
+                self.signal_error.emit(error)
+                # emit defocus for tracking, tagged with the exposure time of the frames it was computed from
+                if self.PDAF_tracking_enable and ( self.defocus_um >= self.defocus_um_for_enable_tracking_min ) and ( self.defocus_um <= self.defocus_um_for_enable_tracking_max):
+                    # self.signal_defocus_um_tracking.emit(self.defocus_um)
+                    self.tracking_controller_in_plane.track_focus = True
+                    self.tracking_controller_in_plane.set_focus_error(self.defocus_um/1000.0,timestamp)
+                else:
+                    self.tracking_controller_in_plane.track_focus = False
+                    self.tracking_controller_in_plane.set_focus_error(0,timestamp)
 
-    def _compute_shift_from_image_pair(self):
+    def _compute_shift_from_image_pair(self,image1,image2):
         # method 1: calculate 2D cross correlation -> find peak or centroid
         '''
-        I1 = np.array(self.image1,dtype=np.int)
-        I2 = np.array(self.image2,dtype=np.int)
+        I1 = np.array(image1,dtype=np.int)
+        I2 = np.array(image2,dtype=np.int)
         I1 = I1 - np.mean(I1)
         I2 = I2 - np.mean(I2)
         xcorr = cv2.filter2D(I1,cv2.CV_32F,I2)
         cv2.imshow('xcorr',np.array(255*xcorr/np.max(xcorr),dtype=np.uint8))
         cv2.waitKey(15)  
         '''
+        # method 3: phase correlation along the PDAF shift axis (PDAFShiftEstimator)
+        if self.shift_estimator.method != 'skimage':
+            shift, error = self.shift_estimator.estimate(image1,image2)
+            # print('shift: ' + "{:.2f}".format(shift) + ', error: ' + "{:.2f}".format(error) ) # for debugging
+            return shift, error
         # method 2: use skimage.registration.phase_cross_correlation
-        shifts,error,phasediff = skimage.registration.phase_cross_correlation(self.image1,self.image2,upsample_factor=self.registration_upsample_factor,space='real')
-        print('shift: ' + str(shifts) + ', error: ' + "{:.2f}".format(error) ) # for debugging
+        shifts,error,phasediff = skimage.registration.phase_cross_correlation(image1,image2,upsample_factor=self.registration_upsample_factor,space='real')
+        # print('shift: ' + str(shifts) + ', error: ' + "{:.2f}".format(error) ) # for debugging
         if PDAF_SHIFT_AXIS == 'X':
             return shifts[1], error # shift[0] vs shift[1] depends on camera orientation
         else:
@@ -179,6 +293,8 @@ class PDAFController(QObject):
 
     def enable_caculation(self,enabled):
         self.PDAF_calculation_enable = enabled
+        if enabled == False:
+            self.clear_roi()
         print('PDAF calculation: ' + str(enabled))
 
     def enable_tracking(self,enabled):
@@ -202,7 +318,8 @@ class PDAFController(QObject):
         self.defocus_um_for_enable_tracking_max = value
 
     def close(self):
-        pass
+        self.stop_signal_received = True
+        self.thread.join()
 
 class TwoCamerasPDAFCalibrationController(QObject):
 
@@ -213,7 +330,10 @@ class TwoCamerasPDAFCalibrationController(QObject):
 
     z_pos = Signal(float)
 
-    def __init__(self,camera1,camera2,navigationController,liveController1,liveController2,configurationManager=None):
+    signal_calibration_status = Signal(str)
+    signal_calibration_finished = Signal(float,int,int) # shift_to_distance_um, x offset, y offset (pixels of the working-resolution image)
+
+    def __init__(self,camera1,camera2,navigationController,liveController1,liveController2,configurationManager=None,streamHandler1=None,streamHandler2=None,PDAFController=None,internal_state=None):
         QObject.__init__(self)
 
         self.camera1 = camera1
@@ -233,6 +353,17 @@ class TwoCamerasPDAFCalibrationController(QObject):
         self.experiment_ID = None
         self.base_path = None
 
+        # automated calibration of shift_to_distance_um and of the camera offsets
+        self.streamHandler1 = streamHandler1
+        self.streamHandler2 = streamHandler2
+        self.PDAFController = PDAFController
+        self.internal_state = internal_state
+        self.shift_estimator = PDAFShiftEstimator()
+        self.calibration_z_range_um = PDAFCalibration.Z_RANGE_UM
+        self.calibration_NZ = PDAFCalibration.N_Z
+        self.calibration_thread = None
+        self.calibration_results = self.load_calibration_results()
+
     def set_NX(self,N):
         self.NX = N
     def set_NY(self,N):
@@ -279,62 +410,45 @@ class TwoCamerasPDAFCalibrationController(QObject):
         
     def run_acquisition(self): # @@@ to do: change name to run_experiment
         print('start multipoint')
-        
-        # stop live
-        if self.liveController1.is_live:
-            self.liveController1.was_live_before_multipoint = True
-            self.liveController1.stop_live() # @@@ to do: also uncheck the live button
-        else:
-            self.liveController1.was_live_before_multipoint = False
-        # stop live
-        if self.liveController2.is_live:
-            self.liveController2.was_live_before_multipoint = True
-            self.liveController2.stop_live() # @@@ to do: also uncheck the live button
-        else:
-            self.liveController2.was_live_before_multipoint = False
-
-        # disable callback
-        if self.camera1.callback_is_enabled:
-            self.camera1.callback_was_enabled_before_multipoint = True
-            self.camera1.stop_streaming()
-            self.camera1.disable_callback()
-            self.camera1.start_streaming() # @@@ to do: absorb stop/start streaming into enable/disable callback - add a flag is_streaming to the camera class
-        else:
-            self.camera1.callback_was_enabled_before_multipoint = False
-        # disable callback
-        if self.camera2.callback_is_enabled:
-            self.camera2.callback_was_enabled_before_multipoint = True
-            self.camera2.stop_streaming()
-            self.camera2.disable_callback()
-            self.camera2.start_streaming() # @@@ to do: absorb stop/start streaming into enable/disable callback - add a flag is_streaming to the camera class
-        else:
-            self.camera2.callback_was_enabled_before_multipoint = False
+        self._stop_live_and_callbacks()
 
         for self.time_point in range(self.Nt):
             self._run_multipoint_single()
 
-        # re-enable callback
-        if self.camera1.callback_was_enabled_before_multipoint:
-            self.camera1.stop_streaming()
-            self.camera1.enable_callback()
-            self.camera1.start_streaming()
-            self.camera1.callback_was_enabled_before_multipoint = False
-        # re-enable callback
-        if self.camera2.callback_was_enabled_before_multipoint:
-            self.camera2.stop_streaming()
-            self.camera2.enable_callback()
-            self.camera2.start_streaming()
-            self.camera2.callback_was_enabled_before_multipoint = False
-
-        if self.liveController1.was_live_before_multipoint:
-            self.liveController1.start_live()
-        if self.liveController2.was_live_before_multipoint:
-            self.liveController2.start_live()
+        self._restore_live_and_callbacks()
 
         # emit acquisitionFinished signal
         self.acquisitionFinished.emit()
         QApplication.processEvents()
 
+    def _stop_live_and_callbacks(self):
+        # frames are triggered and read one by one
+        for liveController in (self.liveController1,self.liveController2):
+            if liveController.is_live:
+                liveController.was_live_before_multipoint = True
+                liveController.stop_live() # @@@ to do: also uncheck the live button
+            else:
+                liveController.was_live_before_multipoint = False
+        for camera in (self.camera1,self.camera2):
+            if camera.callback_is_enabled:
+                camera.callback_was_enabled_before_multipoint = True
+                camera.stop_streaming()
+                camera.disable_callback()
+                camera.start_streaming() # @@@ to do: absorb stop/start streaming into enable/disable callback - add a flag is_streaming to the camera class
+            else:
+                camera.callback_was_enabled_before_multipoint = False
+
+    def _restore_live_and_callbacks(self):
+        for camera in (self.camera1,self.camera2):
+            if camera.callback_was_enabled_before_multipoint:
+                camera.stop_streaming()
+                camera.enable_callback()
+                camera.start_streaming()
+                camera.callback_was_enabled_before_multipoint = False
+        for liveController in (self.liveController1,self.liveController2):
+            if liveController.was_live_before_multipoint:
+                liveController.start_live()
+
     def _run_multipoint_single(self):
         # for each time point, create a new folder
         current_path = os.path.join(self.base_path,self.experiment_ID,str(self.time_point))
@@ -394,3 +508,161 @@ class TwoCamerasPDAFCalibrationController(QObject):
         
         # move z back
         self.navigationController.move_z_usteps(-self.deltaZ_usteps*(self.NZ-1))
+
+    def set_calibration_z_range_um(self,value):
+        self.calibration_z_range_um = value
+
+    def set_calibration_NZ(self,N):
+        self.calibration_NZ = N
+
+    def start_calibration(self):
+        if self.calibration_thread is not None and self.calibration_thread.is_alive():
+            print('PDAF calibration already in progress')
+            return
+        self.calibration_thread = Thread(target=self.run_calibration, daemon=True)
+        self.calibration_thread.start()
+
+    def run_calibration(self):
+        '''
+        Steps z through calibration_z_range_um around the current position, which should be in focus.
+        The camera offsets are measured first by registering the full frames at the current position.
+        At each z, N_FRAMES_PER_POSITION pairs of ROIs are captured (the ROIs are cropped at capture, the
+        shifts computed in one batch after the sweep), then shift = intercept + slope*z is fitted to all
+        the measurements.
+        '''
+        objective = self.internal_state.data['Objective'] if self.internal_state is not None else DEFAULT_OBJECTIVE
+        self.signal_calibration_status.emit('PDAF calibration (' + str(objective) + ') ...')
+        mm_per_ustep = SCREW_PITCH_Z_MM/(self.navigationController.z_microstepping*FULLSTEPS_PER_REV_Z)
+        z_usteps = np.round(np.linspace(-self.calibration_z_range_um/2,self.calibration_z_range_um/2,self.calibration_NZ)/1000/mm_per_ustep).astype(int)
+        z_um = 1000*z_usteps*mm_per_ustep
+        z_samples = []
+        rois = []
+        self._stop_live_and_callbacks()
+        position_usteps = 0
+        try:
+            # camera offsets, at the current position
+            image1, image2 = self._capture_pair()
+            offset_x, offset_y = self._register_full_frames(image1,image2)
+            roi = self._get_calibration_roi(image1,offset_x,offset_y)
+            # sweep
+            for k in range(len(z_usteps)):
+                self._move_z_usteps(z_usteps[k] - position_usteps)
+                position_usteps = z_usteps[k]
+                for i in range(PDAFCalibration.N_FRAMES_PER_POSITION):
+                    image1, image2 = self._capture_pair()
+                    rois.append(self._crop_calibration_rois(image1,image2,roi))
+                    z_samples.append(z_um[k])
+                self.signal_calibration_status.emit('PDAF calibration: z = ' + '{:.1f}'.format(z_um[k]) + ' um (' + str(k+1) + '/' + str(len(z_usteps)) + ')')
+        except Exception as e:
+            print('PDAF calibration error: ' + str(e))
+            self.signal_calibration_status.emit('PDAF calibration failed')
+            return
+        finally:
+            self._move_z_usteps(-position_usteps)
+            self._restore_live_and_callbacks()
+
+        # shifts, in pixels of the working-resolution image
+        shifts, errors = self._compute_shifts(rois)
+        shifts = shifts/roi[4]
+        valid = np.isfinite(shifts) & (errors < PDAFCalibration.MAX_ERROR)
+        fit = fit_shift_vs_defocus(np.array(z_samples)[valid],shifts[valid])
+        if fit is None or fit['reliable'] == False:
+            print('PDAF calibration: no significant dependence of the shift on z (' + str(np.count_nonzero(valid)) + ' valid measurements)')
+            self.signal_calibration_status.emit('PDAF calibration failed - no shift vs z')
+            return
+        # defocus_um = shift*shift_to_distance_um is the z move that brings the object back to zero shift, applied
+        # by the tracking controller as move_z_usteps(TRACKING_MOVEMENT_SIGN*correction)
+        focus_sign = TRACKING_MOVEMENT_SIGN_Z if TRACKING_CONFIG == 'XY_Z' else TRACKING_MOVEMENT_SIGN_Y
+        shift_to_distance_um = -focus_sign/fit['slope']
+        shift_to_distance_um_ci = sorted([-focus_sign/fit['slope_ci'][0],-focus_sign/fit['slope_ci'][1]])
+        print('PDAF calibration ' + str(objective) + ': shift_to_distance_um = ' + '{:.3f}'.format(shift_to_distance_um) + ' ' + str(shift_to_distance_um_ci) +
+            ', offsets = (' + '{:.1f}'.format(offset_x) + ', ' + '{:.1f}'.format(offset_y) + '), R^2 = ' + '{:.3f}'.format(fit['r2']))
+        self.calibration_results.setdefault(MACHINE_CONFIGURATION,{})[objective] = {'shift_to_distance_um':shift_to_distance_um,
+            'shift_to_distance_um_ci':shift_to_distance_um_ci, 'x_offset':offset_x, 'y_offset':offset_y, 'slope_px_per_um':fit['slope'],
+            'slope_ci':fit['slope_ci'], 'intercept_px':fit['intercept'], 'intercept_ci':fit['intercept_ci'], 'r2':fit['r2'], 'n':fit['n'],
+            'confidence_level':PDAFCalibration.CONFIDENCE_LEVEL, 'z_range_um':self.calibration_z_range_um, 'roi_size_px':roi[2],
+            'timestamp':datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        self.save_calibration_results()
+        self.signal_calibration_status.emit('PDAF calibration (' + str(objective) + ') done')
+        self.signal_calibration_finished.emit(shift_to_distance_um,int(round(offset_x)),int(round(offset_y)))
+
+    def _move_z_usteps(self,usteps):
+        if usteps == 0:
+            return
+        self.navigationController.move_z_usteps(usteps)
+        timestamp_start = time.time()
+        while self.navigationController.microcontroller.is_busy() and time.time() - timestamp_start < 5:
+            time.sleep(0.005)
+        time.sleep(PDAFCalibration.SETTLE_TIME_S)
+
+    def _capture_pair(self):
+        # software-triggered frames of both cameras, cropped and rotated/flipped like their streams
+        images = []
+        for camera, streamHandler in ((self.camera1,self.streamHandler1),(self.camera2,self.streamHandler2)):
+            camera.send_trigger()
+            image = camera.read_frame()
+            image, width, height = image_processing.crop_image(image,streamHandler.crop_width,streamHandler.crop_height)
+            images.append(core_headless.rotate_flip_image(image,streamHandler.rotate_image_angle,streamHandler.flip_image))
+        return images
+
+    def _to_gray(self,image):
+        return cv2.cvtColor(image,cv2.COLOR_RGB2GRAY) if len(image.shape) > 2 else image
+
+    def _register_full_frames(self,image1,image2):
+        # offsets of camera 2 relative to camera 1 (the PDAF ROI of camera 2 is at x + x_offset, y + y_offset), at working resolution
+        image1 = self._to_gray(image1)
+        image2 = self._to_gray(image_processing.crop_roi(image2,image2.shape[1]/2,image2.shape[0]/2,image2.shape[1],image2.shape[0],PDAF_FLIPUD,PDAF_FLIPLR))
+        scaling = self.streamHandler1.working_resolution_scaling
+        image1 = cv2.resize(image1,(round(image1.shape[1]*scaling),round(image1.shape[0]*scaling)),interpolation=cv2.INTER_AREA)
+        image2 = cv2.resize(image2,(image1.shape[1],image1.shape[0]),interpolation=cv2.INTER_AREA)
+        # cross-correlation of the mean-subtracted frames - phase normalization is dominated by noise on smooth images
+        image1 = image1.astype(np.float32) - image1.mean()
+        image2 = image2.astype(np.float32) - image2.mean()
+        shifts,error,phasediff = skimage.registration.phase_cross_correlation(image1,image2,upsample_factor=10,space='real',normalization=None)
+        return -float(shifts[1]), -float(shifts[0])
+
+    def _get_calibration_roi(self,image1,offset_x,offset_y):
+        # (x, y, width, height, native pixels per working-resolution pixel), in pixels of the working-resolution image
+        scaling = image1.shape[1]/round(image1.shape[1]*self.streamHandler1.working_resolution_scaling)
+        tracking_controller = self.PDAFController.tracking_controller_in_plane if self.PDAFController is not None else None
+        if tracking_controller is not None and tracking_controller.objectFound and tracking_controller.centroid is not None:
+            x, y = tracking_controller.centroid
+        else:
+            x, y = image1.shape[1]/scaling/2, image1.shape[0]/scaling/2
+        return (x, y, PDAFCalibration.ROI_SIZE_PX, PDAFCalibration.ROI_SIZE_PX, scaling, offset_x, offset_y)
+
+    def _crop_calibration_rois(self,image1,image2,roi):
+        x, y, w, h, scaling, offset_x, offset_y = roi
+        roi1 = image_processing.crop_roi(image1,x*scaling,y*scaling,w*scaling,h*scaling)
+        roi2 = image_processing.crop_roi(image2,(x+offset_x)*scaling,(y+offset_y)*scaling,w*scaling,h*scaling,PDAF_FLIPUD,PDAF_FLIPLR)
+        return self._to_gray(roi1).copy(), self._to_gray(roi2).copy()
+
+    def _compute_shifts(self,rois):
+        # all the ROIs have the same shape - the estimator reuses its windows and FFT buffers
+        shifts = np.full(len(rois),np.nan)
+        errors = np.full(len(rois),np.inf)
+        for i, (roi1, roi2) in enumerate(rois):
+            if roi1.shape == roi2.shape and roi1.size > 0:
+                shifts[i], errors[i] = self.shift_estimator.estimate(roi1,roi2)
+        return shifts, errors
+
+    def get_saved_calibration(self,objective):
+        try:
+            result = self.calibration_results[MACHINE_CONFIGURATION][objective]
+            return result['shift_to_distance_um'], int(round(result['x_offset'])), int(round(result['y_offset']))
+        except KeyError:
+            return None
+
+    def load_calibration_results(self):
+        try:
+            with open(PDAFCalibration.RESULTS_FILE,'r') as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def save_calibration_results(self):
+        try:
+            with open(PDAFCalibration.RESULTS_FILE,'w') as f:
+                json.dump(self.calibration_results,f,indent=4)
+        except:
+            print('failed to save PDAF calibration results')
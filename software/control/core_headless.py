@@ -0,0 +1,1146 @@
+'''
+Qt-free tracking core: camera -> preprocessing -> tracker -> PID -> microcontroller -> savers.
+Components notify plain Python callbacks (add_callback(event,function)) instead of emitting Qt signals,
+so tracking can run without a QApplication (headless acquisition boxes, benchmarks, worker processes).
+The Qt classes in core_tracking subclass these and forward the callbacks to their signals.
+'''
+import os
+import time
+import numpy as np
+import cv2
+import pandas as pd
+from queue import Queue
+from threading import Thread, Lock
+from datetime import datetime
+
+from control._def import *
+import control.tracking as tracking
+import control.utils.image_processing as image_processing
+import control.utils.PID as PID
+import control.utils.CSV_Tool as CSV_Tool
+import control.latency_tracing as latency_tracing
+from control.utils.rate_meter import RateMeter
+from control.utils.trigger_scheduler import TriggerScheduler
+
+class CallbackRegistry(object):
+    '''
+    Callbacks are called synchronously in the thread that notifies the event.
+    '''
+    EVENTS = ()
+
+    def _init_callbacks(self):
+        self.callbacks = {event:[] for event in self.EVENTS}
+
+    def add_callback(self,event,function):
+        self.callbacks[event].append(function)
+
+    def remove_callback(self,event,function):
+        if function in self.callbacks[event]:
+            self.callbacks[event].remove(function)
+
+    def _notify(self,event,*args):
+        for function in self.callbacks[event]:
+            function(*args)
+
+def get_pixel_size_um(objective,imaging_channel=TRACKING):
+    return CAMERA_PIXEL_SIZE_UM[CAMERAS[imaging_channel]['sensor']] / ( TUBE_LENS_MM[imaging_channel] / (OBJECTIVES[objective]['tube_lens_f_mm']/OBJECTIVES[objective]['magnification']) )
+
+def rotate_flip_image(image,rotate_image_angle=0,flip_image=None):
+    if(rotate_image_angle == 90):
+        image = cv2.rotate(image,cv2.ROTATE_90_CLOCKWISE)
+    elif(rotate_image_angle == -90):
+        image = cv2.rotate(image,cv2.ROTATE_90_COUNTERCLOCKWISE)
+    elif(rotate_image_angle == 180):
+        image = cv2.rotate(image,cv2.ROTATE_180)
+    # flipcode = 0: flip vertically, > 0: flip horizontally, < 0: flip vertically and horizontally
+    if(flip_image == 'Vertical'):
+        image = cv2.flip(image, 0)
+    elif(flip_image == 'Horizontal'):
+        image = cv2.flip(image, 1)
+    elif(flip_image == 'Both'):
+        image = cv2.flip(image, -1)
+    return image
+
+def threshold_image(image_resized,lower_HSV,upper_HSV,invert=False,color=False):
+    # returns a 0/1 mask
+    if(color):
+        image_resized = cv2.cvtColor(image_resized, cv2.COLOR_BGR2GRAY)
+    image_resized = np.array(image_resized, dtype='uint8')
+    thresh_image = image_processing.threshold_image_gray(image_resized, lower_HSV[2], upper_HSV[2])
+    if(invert):
+        thresh_image = 1 - thresh_image
+    return thresh_image
+
+class Navigation(object):
+    '''
+    Headless counterpart of core.NavigationController (microstepping settings and relative moves).
+    '''
+    def __init__(self,microcontroller):
+        self.microcontroller = microcontroller
+        self.x_microstepping = MICROSTEPPING_DEFAULT_X
+        self.y_microstepping = MICROSTEPPING_DEFAULT_Y
+        self.z_microstepping = MICROSTEPPING_DEFAULT_Z
+        self.theta_microstepping = MICROSTEPPING_DEFAULT_THETA
+
+    def move_x_usteps(self,usteps):
+        self.microcontroller.move_x_usteps(int(usteps))
+
+    def move_y_usteps(self,usteps):
+        self.microcontroller.move_y_usteps(int(usteps))
+
+    def move_z_usteps(self,usteps):
+        self.microcontroller.move_z_usteps(int(usteps))
+
+class InternalState():
+    '''
+    This holds an up-to date internal state of GUI variables as well as Data from microcontroller
+    '''
+    def __init__(self):
+        self.data = {key:[] for key in INTERNAL_STATE_VARIABLES}
+        self.initialise_internalState()
+
+    def initialise_internalState(self):
+        # This assigns the default values for the internal state.
+        for key in INTERNAL_STATE_VARIABLES:
+            self.data[key] = INITIAL_VALUES[key]
+        print(self.data)
+
+class TrackingCore(CallbackRegistry):
+    '''
+    Events
+    centroid (np.ndarray): detected object centroid, in pixels of the working-resolution image
+    rect_pts (np.ndarray): bounding box of the object
+    track_lost: the object was lost, image tracking has been disabled
+    tracking_updated: the internal state has been updated with the latest frame
+    save_data: the latest internal state should be saved (Acquisition is on)
+    tracking_fps (float)
+    roi_bbox_requested: the ROI used to initialize the tracker should be set with tracker_image.set_roi_bbox
+    '''
+    EVENTS = ('centroid','rect_pts','track_lost','tracking_updated','save_data','tracking_fps','roi_bbox_requested')
+
+    def __init__(self, navigationController, microcontroller, internal_state, color = False):
+        self._init_callbacks()
+        self.navigationController = navigationController
+        self.microcontroller = microcontroller
+        self.internal_state = internal_state
+        self.image = None
+
+        # Focus Tracker type
+        self.track_focus = False
+        # For testing
+        self.image_tracking_enabled = False
+        self.objectFound = False
+
+        self.centroid = None
+        self.rect_pts = None
+
+        self.tracking_setpoint_image = None
+        self.image_center = None
+        self.image_width = None
+        self.image_offset = np.array([0,0])
+
+        # Create a tracking object that does the image-based tracking
+        self.tracker_image = tracking.Tracker_Image()
+
+        # PID controller for each axis
+        self.pid_controller_x = PID.PID()
+        self.pid_controller_y = PID.PID()
+        self.pid_controller_z = PID.PID()
+
+        # when set, the relay of the auto-tuner replaces the PID output of the axis being tuned
+        self.pid_autotuner = None
+
+        self.stage_tracking_enabled = None
+        self.tracking_frame_counter = None
+
+        #Time
+        self.t0 = time.time()           #Time begin the first time we click on the start_tracking button
+        self.Time = None
+        self.Frame_ID = -1 # frame ID of the tracking camera
+
+        self.focus_error = 0 # for focus tracking; this variable is accessed by other objects
+        self.focus_error_timestamp = None # exposure time of the frames the focus error was computed from
+        self.focus_error_age = None # unit: s, age of the focus error when it was used for the latest frame
+        self.lens_focus_controller = None # LiquidLensFocusController, when the liquid lens corrects the focus
+
+        self.X_image = None # unit: mm
+        self.Y_image = None # unit: mm
+        self.Z_image = None # unit: mm
+
+        self.X_stage = None # unit: mm
+        self.Y_stage = None # unit: mm
+        self.Z_stage = None # unit: mm
+        self.Theta_stage = None # unit: rad
+
+        # X, Y, Z represents the physical locations of the object - stage position + object offset in the image
+        self.X = None # unit: mm
+        self.Y = None # unit: mm
+        self.Z = None # unit: mm
+
+        self.current_radius = None # unit: mm
+
+        # Subset of INTERNAL_STATE_MODEL that is updated by Tracking_Controller (self)
+        self.internal_state_vars = ['Time','X_image', 'Z_image', 'X', 'Y', 'Z', 'Frame_ID']
+
+        # For fps measurement
+        self.rate_meter = RateMeter()
+        self.fps_real = 0
+
+        self.pixel_size_um_raw = None
+        self.image_resizing_factor = None
+        self.pixel_size_um_scaled = None
+
+        # per-frame latency tracing (LatencyTracer), shared with the stream handler and the microcontroller
+        self.latency_tracer = None
+
+    def on_new_frame(self, image, thresholded_image = None, trace_index = -1, frame_ID = -1, timestamp = None):
+
+        self.image = image
+        # update elapsed time - from the exposure time of the frame when the camera provides it
+        if timestamp is None:
+            timestamp = time.time()
+        elif self.tracking_frame_counter == 0:
+            # the first frame of a track can be exposed before the track was started
+            self.t0 = min(self.t0, timestamp)
+        self.Time = timestamp - self.t0
+        self.Frame_ID = frame_ID
+        if self.focus_error_timestamp is not None:
+            self.focus_error_age = timestamp - self.focus_error_timestamp
+            if TWO_CAMERA_PDAF:
+                self.internal_state.data['PDAF_age'] = self.focus_error_age
+        self._update_image_center_width()
+        self.stage_tracking_enabled = self.internal_state.data['stage_tracking_enabled']
+
+        # check if it's a new track [or if the object being tracked was lost - removed in this update]
+        if self.tracking_frame_counter == 0:
+            is_first_frame = True
+        else:
+            is_first_frame = False
+
+        # get stage position - to add z
+        self._get_stage_position(is_first_frame=is_first_frame)
+        # note that for XTheta-Y tracking, Z_stage is calculated with the previous self.current_radius
+        # which is available post first frame (for the first frame, set z = 0)
+
+        # track the object in the image
+        self.objectFound, self.centroid, self.rect_pts = self.tracker_image.track(image, thresholded_image, is_first_frame = is_first_frame)
+        if self.latency_tracer is not None:
+            self.latency_tracer.stamp(trace_index,'tracked')
+
+        # check if tracking object in the image was successful, if not, terminated the track
+        if self.objectFound:
+            self.tracking_frame_counter += 1
+        else:
+            # tracking failed, stop tracking
+            self.internal_state.data['image_tracking_enabled'] = False
+            self._notify('track_lost')
+            return
+
+        # the detected object position for display
+        self._notify('centroid',self.centroid)
+        self._notify('rect_pts',self.rect_pts)
+
+        # find the object's position relative to the tracking set point on the image
+        in_plane_position_error_pixel = self.centroid - self.tracking_setpoint_image
+        in_plane_position_error_mm = in_plane_position_error_pixel*self.pixel_size_um_scaled/1000
+
+        # assign in-plane position error based on the tracking configuration
+        if TRACKING_CONFIG == 'XTheta_Y' or TRACKING_CONFIG == 'XZ_Y':
+            x_error_mm = in_plane_position_error_mm[0]
+            z_error_mm = in_plane_position_error_mm[1]
+            # self.focus_error is updated by the focus tracking controller
+            y_error_mm = self.focus_error
+            # get position of the object in the image
+            self.X_image = (self.centroid[0]-self.image_center[0])*self.pixel_size_um_scaled/1000
+            self.Z_image = (self.centroid[1]-self.image_center[1])*self.pixel_size_um_scaled/1000
+            # get position of the object in the lab frame
+            self.X = self.X_stage + self.X_image
+            self.Y = self.Y_stage # can include the offset calculated from focus tracking controller later
+            self.Z = self.Z_stage + self.Z_image
+            if TRACKING_CONFIG == 'XTheta_Y':
+                self.current_radius = Chamber.R_HOME + self.X
+        elif TRACKING_CONFIG == 'XY_Z':
+            x_error_mm = in_plane_position_error_mm[0]
+            y_error_mm = in_plane_position_error_mm[1]
+            z_error_mm = self.focus_error
+            # self.focus_error is updated by the focus tracking controller
+            # get position of the object in the image
+            self.X_image = (self.centroid[0]-self.image_center[0])*self.pixel_size_um_scaled/1000
+            self.Y_image = (self.centroid[1]-self.image_center[1])*self.pixel_size_um_scaled/1000
+            # get position of the object in the lab frame
+            self.X = self.X_stage + self.X_image
+            self.Y = self.Y_stage + self.Y_image
+            self.Z = self.Z_stage # can include the offset calculated from focus tracking controller later
+
+        # stage tracking
+        if self.stage_tracking_enabled:
+
+            # get PID calculation result
+            x_correction_mm,y_correction_mm,z_correction_mm = self._get_PID_feedback(x_error_mm,y_error_mm,z_error_mm,is_first_frame)
+            if self.latency_tracer is not None:
+                self.latency_tracer.stamp(trace_index,'pid')
+                # the microcontroller stamps the commands sent for this frame
+                self.latency_tracer.set_active_frame(trace_index)
+
+            # get motion commands
+            x_correction_usteps = int(x_correction_mm/(SCREW_PITCH_X_MM/FULLSTEPS_PER_REV_X/self.navigationController.x_microstepping))
+            y_correction_usteps = int(y_correction_mm/(SCREW_PITCH_Y_MM/FULLSTEPS_PER_REV_Y/self.navigationController.y_microstepping))
+            if TRACKING_CONFIG == 'XTheta_Y':
+                z_correction_theta = z_correction_mm/self.current_radius
+                z_correction_usteps = int(z_correction_theta/(2*np.pi/GEAR_RATIO_THETA/FULLSTEPS_PER_REV_THETA/self.navigationController.theta_microstepping))
+            else:
+                z_correction_usteps = int(z_correction_mm/(SCREW_PITCH_Z_MM/FULLSTEPS_PER_REV_Z/self.navigationController.z_microstepping))
+
+            # send motion commands
+            if TRACKING_CONFIG == 'XY_Z':
+                self.microcontroller.move_x_usteps(TRACKING_MOVEMENT_SIGN_X*x_correction_usteps)
+                self.microcontroller.move_y_usteps(TRACKING_MOVEMENT_SIGN_Y*y_correction_usteps)
+                self.microcontroller.move_z_usteps(TRACKING_MOVEMENT_SIGN_Z*z_correction_usteps) # can move to the focus tracking controller
+            elif TRACKING_CONFIG == 'XZ_Y':
+                self.microcontroller.move_x_usteps(TRACKING_MOVEMENT_SIGN_X*x_correction_usteps) # in-plane axis 0
+                self.microcontroller.move_y_usteps(TRACKING_MOVEMENT_SIGN_Z*z_correction_usteps) # in-plane axis 1
+                self.microcontroller.move_z_usteps(TRACKING_MOVEMENT_SIGN_Y*y_correction_usteps) # focus axis - can move to the focus tracking controller
+            elif TRACKING_CONFIG == 'XTheta_Y':
+                self.microcontroller.move_x_usteps(TRACKING_MOVEMENT_SIGN_X*x_correction_usteps) # in-plane axis 0
+                self.microcontroller.move_y_usteps(TRACKING_MOVEMENT_SIGN_Z*z_correction_usteps) # in-plane axis 1
+                self.microcontroller.move_z_usteps(TRACKING_MOVEMENT_SIGN_Y*y_correction_usteps) # focus axis - can move to the focus tracking controller
+            if self.latency_tracer is not None:
+                self.latency_tracer.set_active_frame(-1)
+
+        # update the internal states
+        self.update_internal_state()
+        self._notify('tracking_updated')
+
+        # save data
+        if self.internal_state.data['Acquisition'] == True:
+            self._notify('save_data')
+
+        self._measure_tracking_fps()
+
+    def _measure_tracking_fps(self):
+        # measure real fps
+        if self.rate_meter.tick():
+            self.fps_real = round(self.rate_meter.get_rate(),1)
+            self._notify('tracking_fps',self.fps_real)
+
+    def _get_stage_position(self,is_first_frame):
+        self.X_stage = self.internal_state.data['X_stage']
+        self.Y_stage = self.internal_state.data['Y_stage']
+        if TRACKING_CONFIG == 'XTheta_Y':
+            if is_first_frame:
+                self.Z_stage = 0
+                self.Theta_stage = self.internal_state.data['Theta_stage']
+            else:
+                delta_theta = self.internal_state.data['Theta_stage'] - self.Theta_stage
+                self.Theta_stage = self.internal_state.data['Theta_stage']
+                self.Z_stage = self.Z_stage + self.current_radius*delta_theta
+        else:
+            self.Z_stage = self.internal_state.data['Z_stage']
+
+    def _get_PID_feedback(self,x_error_mm,y_error_mm,z_error_mm,is_first_frame):
+        if is_first_frame:
+            self.pid_controller_x.initialize(x_error_mm,self.Time)
+            self.pid_controller_y.initialize(y_error_mm,self.Time)
+            self.pid_controller_z.initialize(z_error_mm,self.Time)
+            x_correction_mm = 0
+            y_correction_mm = 0
+            z_correction_mm = 0
+        else:
+            x_correction_mm = self.pid_controller_x.update(x_error_mm,self.Time)
+            y_correction_mm = self.pid_controller_y.update(y_error_mm,self.Time)
+            z_correction_mm = self.pid_controller_z.update(z_error_mm,self.Time)
+        pid_autotuner = self.pid_autotuner
+        if pid_autotuner is not None:
+            if pid_autotuner.axis == 'X':
+                x_correction_mm = pid_autotuner.update(x_error_mm,self.Time)
+            elif pid_autotuner.axis == 'Y':
+                y_correction_mm = pid_autotuner.update(y_error_mm,self.Time)
+            elif pid_autotuner.axis == 'Z':
+                z_correction_mm = pid_autotuner.update(z_error_mm,self.Time)
+        return x_correction_mm,y_correction_mm,z_correction_mm
+
+    def set_pid_autotuner(self, pid_autotuner):
+        self.pid_autotuner = pid_autotuner
+
+    # called before a new track is started
+    def reset_track(self):
+        self.tracking_frame_counter = 0
+        self.objectFound = False
+        self.tracker_image.reset()
+        self.t0 = time.time()
+
+    # Image related functions
+    def _update_image_center_width(self):
+        if(self.image is not None):
+            self.image_center, self.image_width = image_processing.get_image_center_width(self.image)
+            self._set_search_area()
+            self._update_tracking_setpoint() # The tracking set point is modified since it depends on the image center.
+
+    def _update_tracking_setpoint(self):
+        if(self.image_center is not None):
+            self.tracking_setpoint_image = self.image_center + self.image_offset
+
+    def _update_image_offset(self, new_image_offset):
+        self.image_offset = new_image_offset
+        self._update_tracking_setpoint()
+
+    def update_image_offset(self, new_image_offset):
+        self._update_image_offset(new_image_offset)
+
+    def update_roi_bbox(self):
+        self._notify('roi_bbox_requested')
+
+    def _set_search_area(self):
+        self.tracker_image.searchArea = int(self.image_width/Tracking.SEARCH_AREA_RATIO)
+
+    def set_cropped_image_size(self, new_ratio):
+        pass
+
+    def get_latest_attr_value(self, key):
+        temp = getattr(self, key)
+        return temp[-1]
+
+    def update_internal_state(self):
+        for key in self.internal_state_vars:
+            if(key in INTERNAL_STATE_VARIABLES):
+                self.internal_state.data[key] = getattr(self,key)
+            else:
+                print('>>>>>>' + key)
+                raise NameError('Key not found in Internal State')
+
+    def set_focus_error(self, focus_error, timestamp = None):
+        # timestamp: exposure time (time.time() scale) of the frames the focus error was measured on
+        self.focus_error_timestamp = timestamp
+        if self.lens_focus_controller is not None and self.lens_focus_controller.enabled:
+            # the liquid lens corrects the focus error, the stage only offloads the lens
+            focus_error = self.lens_focus_controller.update(focus_error, timestamp)
+        self.focus_error = focus_error
+
+    def send_focus_tracking(self, focus_tracking_flag):
+        self.microcontroller.send_focus_tracking_command(focus_tracking_flag)
+
+    def update_pixel_size(self, pixel_size_um):
+        self.pixel_size_um = pixel_size_um
+
+    def update_image_resizing_factor(self,image_resizing_factor):
+        self.image_resizing_factor = image_resizing_factor
+        print('update tracking image resizing factor to ' + str(self.image_resizing_factor))
+        self.pixel_size_um_scaled = self.pixel_size_um/self.image_resizing_factor
+
+class LiquidLensFocusController(CallbackRegistry):
+    '''
+    Fast focus loop on the liquid lens: the focus errors (volumetric defocus or PDAF, through
+    TrackingCore.set_focus_error) shift the lens current by an offset (integral control), and the stage
+    only offloads the lens when the offset nears the end of its range (with hysteresis), or when it saturates.
+    Stands in for the lens (start_scanning, set_current_mA, stop_scanning) so that the offset is applied on top
+    of the sweep or the DC current set by the volumetric imaging controller.
+
+    Events
+    lens_offset (float, bool): offset (mA) applied to the lens current, whether the stage is offloading the lens
+    '''
+    EVENTS = ('lens_offset',)
+
+    def __init__(self, liquid_lens):
+        self._init_callbacks()
+        self.liquid_lens = liquid_lens
+        self.lock = Lock()
+        self.enabled = LensFocus.ENABLED
+        # current set by the volumetric imaging controller
+        self.current_mA_min = 0
+        self.current_mA_max = 0
+        self.frequency_Hz = 0
+        self.flag_scanning = False
+        self.offset_mA = 0
+        self.offset_mA_sent = None
+        self.offloading = False
+        self.offload_error_mm = 0
+        self.focus_error_timestamp = None
+
+    # lens interface
+    def start_scanning(self, current_mA_min, current_mA_max, frequency_Hz):
+        with self.lock:
+            self.current_mA_min = current_mA_min
+            self.current_mA_max = current_mA_max
+            self.frequency_Hz = frequency_Hz
+            self.flag_scanning = True
+            self._clip_offset()
+            self.liquid_lens.start_scanning(current_mA_min + self.offset_mA, current_mA_max + self.offset_mA, frequency_Hz)
+            self.offset_mA_sent = self.offset_mA
+
+    def set_current_mA(self, value):
+        with self.lock:
+            self.current_mA_min = value
+            self.current_mA_max = value
+            self.flag_scanning = False
+            self._clip_offset()
+            self.liquid_lens.set_current_mA(value + self.offset_mA)
+            self.offset_mA_sent = self.offset_mA
+
+    def stop_scanning(self):
+        self.set_current_mA(0)
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        if not enabled:
+            self.reset()
+
+    def reset(self):
+        # back to the current set by the volumetric imaging controller
+        with self.lock:
+            self.offset_mA = 0
+            self.offloading = False
+            self.offload_error_mm = 0
+            self.focus_error_timestamp = None
+            self._apply_offset()
+        self._notify('lens_offset', 0, False)
+
+    def get_offset_range_mA(self):
+        offset_min = max(-LensFocus.MAX_OFFSET_MA, self.liquid_lens.current_range_min - self.current_mA_min)
+        offset_max = min(LensFocus.MAX_OFFSET_MA, self.liquid_lens.current_range_max - self.current_mA_max)
+        return min(offset_min, 0), max(offset_max, 0)
+
+    def update(self, focus_error_mm, timestamp = None):
+        # called with every focus error estimate, returns the focus error left for the stage
+        with self.lock:
+            if timestamp is not None and self.focus_error_timestamp is not None and timestamp <= self.focus_error_timestamp:
+                # older than the estimate already applied
+                return self.offload_error_mm
+            self.focus_error_timestamp = timestamp
+            correction_mA = -LensFocus.SIGN*focus_error_mm*1000/VolumetricZ.UM_PER_MA
+            offset_mA = self.offset_mA + LensFocus.GAIN*correction_mA
+            offset_min, offset_max = self.get_offset_range_mA()
+            self.offset_mA = float(np.clip(offset_mA, offset_min, offset_max))
+            # part of the correction the lens cannot make
+            saturation_mA = offset_mA - self.offset_mA
+            # fraction of the range used on the side of the offset
+            if self.offset_mA >= 0:
+                usage = self.offset_mA/offset_max if offset_max > 0 else 1
+            else:
+                usage = self.offset_mA/offset_min if offset_min < 0 else 1
+            if usage >= LensFocus.OFFLOAD_START:
+                self.offloading = True
+            elif usage <= LensFocus.OFFLOAD_STOP:
+                self.offloading = False
+            offload_mA = saturation_mA + (self.offset_mA if self.offloading else 0)
+            self.offload_error_mm = -LensFocus.SIGN*offload_mA*VolumetricZ.UM_PER_MA/1000
+            self._apply_offset()
+            offset_mA, offloading, offload_error_mm = self.offset_mA, self.offloading, self.offload_error_mm
+        self._notify('lens_offset', offset_mA, offloading)
+        return offload_error_mm
+
+    def _clip_offset(self):
+        offset_min, offset_max = self.get_offset_range_mA()
+        self.offset_mA = float(np.clip(self.offset_mA, offset_min, offset_max))
+
+    def _apply_offset(self):
+        if self.offset_mA_sent is not None and abs(self.offset_mA - self.offset_mA_sent) < LensFocus.MIN_UPDATE_MA:
+            return
+        if self.flag_scanning:
+            self.liquid_lens.set_scan_currents_mA(self.current_mA_min + self.offset_mA, self.current_mA_max + self.offset_mA)
+        else:
+            self.liquid_lens.set_current_mA(self.current_mA_min + self.offset_mA)
+        self.offset_mA_sent = self.offset_mA
+
+class StateUpdaterCore(CallbackRegistry):
+    '''
+    Events
+    stage_position (dict): axis ('X','Y','Z' or 'Theta') -> position (mm or rad) of the axes read in this update
+    joystick_button_pressed
+    stage_tracking_status_changed
+    '''
+    EVENTS = ('stage_position','joystick_button_pressed','stage_tracking_status_changed')
+
+    def __init__(self,navigationController,internal_state):
+        self._init_callbacks()
+        self.navigationController = navigationController
+        self.internal_state = internal_state
+
+    # call back function
+    def read_microcontroller(self,microcontroller):
+        # get the stage positions in usteps or encoder counts
+        x_pos, y_pos, z_pos, _ = microcontroller.get_pos()
+        positions = {}
+
+        # assign the readings to the correct axes and convert the unit to mm or rad
+        # x axis is the same across configurations
+        if USE_ENCODER_X:
+            x_pos_mm = x_pos*ENCODER_SIGN_X*ENCODER_STEP_SIZE_X_MM
+        else:
+            x_pos_mm = x_pos*STAGE_POS_SIGN_X*(SCREW_PITCH_X_MM/(self.navigationController.x_microstepping*FULLSTEPS_PER_REV_X))
+        self.internal_state.data['X_stage'] = x_pos_mm
+        positions['X'] = x_pos_mm
+
+        # Y/Z or Y/Theta depend on the microscope configuration
+        # XY_Z
+        if TRACKING_CONFIG == 'XY_Z':
+            # Y axis
+            if USE_ENCODER_Y:
+                y_pos_mm = y_pos*ENCODER_SIGN_Y*ENCODER_STEP_SIZE_Y_MM
+            else:
+                y_pos_mm = y_pos*STAGE_POS_SIGN_Y*(SCREW_PITCH_Y_MM/(self.navigationController.y_microstepping*FULLSTEPS_PER_REV_Y))
+            self.internal_state.data['Y_stage'] = y_pos_mm
+            positions['Y'] = y_pos_mm
+            # Z axis (focus axis)
+            if USE_ENCODER_Z:
+                z_pos_mm = z_pos*ENCODER_SIGN_Z*ENCODER_STEP_SIZE_Z_MM
+            else:
+                z_pos_mm = z_pos*STAGE_POS_SIGN_Z*(SCREW_PITCH_Z_MM/(self.navigationController.z_microstepping*FULLSTEPS_PER_REV_Z))
+            self.internal_state.data['Z_stage'] = z_pos_mm
+            positions['Z'] = z_pos_mm
+        # XZ_Y
+        elif TRACKING_CONFIG == 'XZ_Y':
+            # Z axis
+            if USE_ENCODER_Z: # microcontroller y-axis is connected to the z-stage;
+                # right now encoder axis refers to the actual axis. May need to change it for it to match the motor axis naming.
+                # in the next update, to avoid confusion, use axis_1, axis_2 and axis_3 to refer these axes (for different configs)
+                z_pos_mm = y_pos*ENCODER_SIGN_Z*ENCODER_STEP_SIZE_Z_MM
+            else:
+                z_pos_mm = y_pos*STAGE_POS_SIGN_Y*(SCREW_PITCH_Y_MM/(self.navigationController.y_microstepping*FULLSTEPS_PER_REV_Y))
+            self.internal_state.data['Z_stage'] = z_pos_mm
+            positions['Z'] = z_pos_mm
+            # Y axis (focus axis)
+            if USE_ENCODER_Y: # microcontroller z-axis is connected to the y-stage
+                y_pos_mm = z_pos*ENCODER_SIGN_Y*ENCODER_STEP_SIZE_Y_MM
+            else:
+                y_pos_mm = z_pos*STAGE_POS_SIGN_Z*(SCREW_PITCH_Z_MM/(self.navigationController.z_microstepping*FULLSTEPS_PER_REV_Z))
+            self.internal_state.data['Y_stage'] = y_pos_mm
+            positions['Y'] = y_pos_mm
+        # XTheta_Y
+        elif TRACKING_CONFIG == 'XTheta_Y':
+            # Y axis (focus axis)
+            if USE_ENCODER_Y: # microcontroller z-axis is connected to the y-stage
+                y_pos_mm = z_pos*ENCODER_SIGN_Y*ENCODER_STEP_SIZE_Y_MM
+            else:
+                y_pos_mm = z_pos*STAGE_POS_SIGN_Z*(SCREW_PITCH_Z_MM/(self.navigationController.z_microstepping*FULLSTEPS_PER_REV_Z))
+            self.internal_state.data['Y_stage'] = y_pos_mm
+            positions['Y'] = y_pos_mm
+            # Theta axis
+            if USE_ENCODER_THETA:
+                theta_pos_rad = y_pos*ENCODER_SIGN_THETA*ENCODER_STEP_SIZE_THETA/GEAR_RATIO_THETA
+            else:
+                theta_pos_rad = y_pos*STAGE_POS_SIGN_Y*(2*np.pi)/(FULLSTEPS_PER_REV_Y*self.navigationController.y_microstepping*GEAR_RATIO_THETA)
+            self.internal_state.data['Theta_stage'] = theta_pos_rad
+            positions['Theta'] = theta_pos_rad
+
+        self._notify('stage_position',positions)
+
+        # read push-buttons and switches
+        if microcontroller.signal_joystick_button_pressed_event:
+            self._notify('joystick_button_pressed')
+            print('joystick button pressed')
+            microcontroller.signal_joystick_button_pressed_event = False
+        if USE_HARDWARE_SWITCH:
+            if microcontroller.switch_state != self.internal_state.data['stage_tracking_enabled']:
+                self.internal_state.data['stage_tracking_enabled'] = microcontroller.switch_state
+                self._notify('stage_tracking_status_changed')
+
+class TrackingDataWriter(CallbackRegistry):
+    '''
+    Writes the internal state to track###.csv (one file per track) in a background thread.
+    '''
+    EVENTS = ('start_saving_image',)
+
+    def __init__(self, internal_state):
+        self._init_callbacks()
+        self.internal_state = internal_state
+        self.base_path = './'
+        self.experiment_ID = ''
+        self.queueLen = 10
+        self.queue = Queue(self.queueLen) # max 10 items in the queue
+        self.saveDataNames = SAVE_DATA
+        self.saveDataNames_imageChannels = None
+
+        # Update Data fields with no:of imaging channels
+        self.update_imaging_channels()
+        self.DataToQueue = {key:[] for key in self.saveDataNames + self.internal_state.data['imaging channels']}
+
+        self.DataToSave_dict = None
+        self.DataToSave = []
+        self.current_image_name = {key:[] for key in self.internal_state.data['imaging channels']}
+
+        # Use a counter
+        self.counter = 0
+        self.stop_signal_received = False
+        self.thread = Thread(target=self.process_queue)
+        self.thread.start()
+        self.exp_folder_created = False
+
+    def process_queue(self):
+        while True:
+            # stop the thread if stop signal is received
+            if self.stop_signal_received:
+                return
+            # process the queue
+            try:
+                self.DataToSave_dict = self.queue.get(timeout=0.1)
+                self.DataToSave = [self.DataToSave_dict[key] for key in self.DataToSave_dict.keys()]
+                # Register the data to a CSV file
+                self.csv_register.write_line([self.DataToSave])
+                self.counter = self.counter + 1
+                self.queue.task_done()
+            except:
+                pass
+
+    def enqueue(self):
+        # Get the most recent internal state values
+        for key in self.saveDataNames:
+            self.DataToQueue[key] = self.internal_state.data[key]
+
+        # Get the most recent image name values
+        for key in self.internal_state.data['imaging channels']:
+            self.DataToQueue[key] = self.current_image_name[key]
+            # Reset the current image name
+            self.current_image_name[key] = ''
+        try:
+            # the queue holds a copy, DataToQueue is updated again on the next frame
+            self.queue.put_nowait(dict(self.DataToQueue))
+        except:
+            print('Data queue full, current cycle data not saved')
+
+    def close(self):
+        self.stop_signal_received = True
+        self.thread.join()
+        self.csv_register.close()
+
+    def set_base_path(self,path):
+        '''
+        Base path needs to be set for the data first since we always save metadata even
+        without saving images in "Tracking Mode".
+
+        In "Recording Mode" the base path would be set by the image-saver function
+        '''
+        self.base_path = path
+        # Update internal state
+        self.internal_state.data['base_path'] = path
+
+    def start_new_experiment(self):
+        '''
+        This is called when a new Acquisition is started.
+        '''
+        print('Starting new experiment...')
+        # generate unique experiment ID
+        if(self.internal_state.data['Acquisition']==True):
+            print('Creating folders...')
+            self.experiment_ID_with_timestamp = self.experiment_ID + '_' + datetime.now().strftime('%Y-%m-%d %H-%M-%-S')
+            self.internal_state.data['experimentID_with_timestamp'] = self.experiment_ID_with_timestamp
+            # create a new folder to hold current experiment data
+            try:
+                os.mkdir(os.path.join(self.base_path, self.experiment_ID_with_timestamp))
+                self.exp_folder_created = True
+            except:
+                pass
+            # Create and store metadata file
+            self.create_metadata_file()
+        # reset the counter
+        self.track_counter = 0
+        self.start_new_track()
+
+    def update_experiment_ID(self,experiment_ID):
+        # temporary solution for the volumetric recording to use the experiment ID entered in the GUI
+        self.experiment_ID = experiment_ID
+        self.internal_state.data['experimentID'] = self.experiment_ID
+        print('[update the experiment ID to ' + self.experiment_ID + ']')
+
+    def start_new_track(self):
+        '''
+        Function is called when the track button is pressed. If 'Acquisition' button is also pressed
+        this will save a new track file. Within a given Experiment Acquisition, each track button
+        press creates a new track file.
+        '''
+        print('Starting new track...')
+
+        # If a current track file is open then close it
+        self.csv_register.close()
+
+        if(self.internal_state.data['Acquisition']==True and self.exp_folder_created):
+            file_name = os.path.join(self.base_path, self.experiment_ID_with_timestamp, 'track{:03d}.csv'.format(self.track_counter))
+            print(file_name)
+            #Update the track counter
+            self.track_counter += 1
+            # If the file doesnt exist then create it
+            if not os.path.exists(file_name):
+                self.csv_register.file_directory= file_name
+                self.csv_register.start_write()
+                print('Created new file {}'.format(file_name))
+                # Set the stop_signal flag so data saving can begin.
+                if(self.stop_signal_received == True):
+                    self.stop_signal_received = False
+                    print('Starting data saver again...')
+
+    def create_metadata_file(self):
+        config_file = os.path.join(self.base_path, self.experiment_ID_with_timestamp, 'metadata.csv')
+        df = pd.DataFrame({'Objective':[self.internal_state.data['Objective']],
+                           'Local time':[datetime.now().strftime('%Y-%m-%d, %H:%M:%S.%f')]})
+        df.to_csv(config_file)
+
+    # Function sets the image names for all the imaging channels
+    def setImageName(self, image_channel, image_name):
+        self.current_image_name[image_channel] = image_name
+
+    def update_imaging_channels(self):
+        '''
+        Call this function to change the number of image name fields.
+        This can only be called when an Acquisition is not in progress.
+        '''
+        imaging_channels = self.internal_state.data['imaging channels']
+        if(self.internal_state.data['Acquisition'] == False):
+            self.saveDataNames_imageChannels = self.saveDataNames + [channel for channel in imaging_channels]
+            # Update the headers of the CSV register
+            self.csv_register = CSV_Tool.CSV_Register(header = [self.saveDataNames_imageChannels])
+        else:
+            print('Cannot change imaging channels when Acquisition is in progress!')
+
+class ImageWriter(CallbackRegistry):
+    '''
+    Writes the images of one imaging channel to base_path/experiment/imaging_channel/#####/#######.ext
+    in a background thread, and the camera frame ID and timestamp of each image to imaging_channel/timestamps.csv.
+    Events
+    image_saved (str, str): imaging channel, image file name
+    stop_recording
+    '''
+    EVENTS = ('image_saved','stop_recording')
+
+    def __init__(self, internal_state, imaging_channel = None, image_format='bmp', rotate_image_angle = 0, flip_image = None):
+        self._init_callbacks()
+        self.internal_state = internal_state
+        # imaging-channel that is using this ImageSaver object
+        self.imaging_channel = imaging_channel
+
+        self.base_path = './'
+        self.experiment_ID = ''
+        self.image_format = image_format
+        self.max_num_image_per_folder = 1000
+        self.queue = Queue(10) # max 10 items in the queue
+        self.image_lock = Lock()
+        self.stop_signal_received = False
+
+        self.thread = Thread(target=self.process_queue)
+        # Start a thread for saving images
+        self.thread.start()
+        print('Started image saver thread')
+
+        self.counter = 0
+        self.folder_counter = 0
+        self.recording_start_time = 0
+        self.recording_time_limit = -1
+        self.timestamps_file = None
+
+    def process_queue(self):
+        while True:
+            # stop the thread if stop signal is received
+            if self.stop_signal_received:
+                return
+            # process the queue
+            try:
+                [image,frame_ID,timestamp] = self.queue.get(timeout=0.1)
+                self.image_lock.acquire(True)
+                folder_ID = int(self.counter/self.max_num_image_per_folder)
+                # The file names should be unique for gravity machine
+                file_ID = self.counter
+                # create a new folder (base_path/imaging_channel/subFolderID/fileID)
+                if file_ID == 0 or int(self.counter%self.max_num_image_per_folder)==0:
+                    folder_images = os.path.join(self.base_path, self.experiment_ID_with_timestamp, self.imaging_channel, '{:05d}'.format(folder_ID))
+                    os.mkdir(folder_images)
+
+                image_file_name = '{:07d}'.format(file_ID) + '.' + self.image_format
+                saving_path = os.path.join(folder_images, image_file_name)
+
+                # Notify the image name so the data saver can save it along with the stage positions
+                self._notify('image_saved', self.imaging_channel, image_file_name)
+
+                # Save the image
+                cv2.imwrite(saving_path,image)
+                if self.timestamps_file is not None:
+                    self.timestamps_file.write(image_file_name + ',' + str(frame_ID) + ',' + '{:.6f}'.format(timestamp) + '\n')
+                self.counter = self.counter + 1
+                self.queue.task_done()
+                self.image_lock.release()
+            except:
+                pass
+
+    def enqueue(self,image, frame_ID, timestamp):
+        try:
+            # the queue holds its own copy: the camera may reuse the frame buffer before the image is written
+            # (Camera_Simulation renders the scene into SimulatedScene.N_BUFFERS rotating buffers)
+            self.queue.put_nowait([image.copy(),frame_ID,timestamp])
+            # when using self.queue.put(str_), program can be slowed down despite multithreading because of the block and the GIL
+        except:
+            print('imageSaver queue is full, image discarded')
+
+    def set_base_path(self,path = None):
+        '''
+        Base path needs to be set by the DataSaver first since we always save metadata and timestamps
+        even when not tracking
+        '''
+        if(path is not None):
+            self.base_path = path
+            # Update internal state
+            self.internal_state.data['base_path'] = path
+        else:
+            self.base_path = self.internal_state.data['base_path']
+
+    def start_saving_images(self):
+        self.counter = 0
+        self.folder_counter = 0
+        self.recording_start_time = 0
+        self.recording_time_limit = -1
+
+        # Creates the folders for storing images
+        self.experiment_ID_with_timestamp = self.internal_state.data['experimentID_with_timestamp']
+
+        print(self.base_path)
+        print(self.experiment_ID_with_timestamp)
+        print(self.imaging_channel)
+        # create a new folder for each imaging channel
+        os.makedirs(os.path.join(self.base_path, self.experiment_ID_with_timestamp, self.imaging_channel))
+        print('Created folder for {} channel'.format(self.imaging_channel))
+        # images of the previous recording still in the queue go to the previous timestamps file
+        self.queue.join()
+        self._close_timestamps_file()
+        self.timestamps_file = open(os.path.join(self.base_path, self.experiment_ID_with_timestamp, self.imaging_channel, 'timestamps.csv'), 'w')
+        self.timestamps_file.write('image,frame_ID,timestamp\n')
+
+    def _close_timestamps_file(self):
+        if self.timestamps_file is not None:
+            self.timestamps_file.close()
+            self.timestamps_file = None
+
+    def set_recording_time_limit(self,time_limit):
+        self.recording_time_limit = time_limit
+
+    def close(self):
+        self.queue.join()
+        self.stop_signal_received = True
+        self.thread.join()
+        self._close_timestamps_file()
+
+class TrackingEngine(CallbackRegistry):
+    '''
+    Headless equivalent of the GUI: one camera per imaging channel, the microcontroller and the savers.
+    Frames are preprocessed in the camera callback thread and tracked in a worker thread, which gets the latest
+    frame only, so that a slow tracker step does not delay the next trigger (the camera callback runs in the
+    trigger thread for software triggered cameras).
+    Events
+    frame (str, np.ndarray, np.ndarray or None): imaging channel, working-resolution image, thresholded image (tracking channel only)
+    tracking_started
+    tracking_stopped
+    The tracking events (centroid, track_lost, ...) are available from engine.trackingCore.
+    '''
+    EVENTS = ('frame','tracking_started','tracking_stopped')
+
+    def __init__(self, cameras, microcontroller, internal_state = None, objective = None, working_resolution_scaling = WORKING_RES_DEFAULT,
+        trigger_mode = TriggerMode.SOFTWARE, fps_trigger = None, fps_save = None, image_format = IMAGE_FORMAT, rotate_flip = None):
+        self._init_callbacks()
+        # cameras: {imaging channel: camera}, the tracking channel is TRACKING
+        self.cameras = cameras
+        self.imaging_channels = list(cameras.keys())
+        self.microcontroller = microcontroller
+        self.internal_state = internal_state if internal_state is not None else InternalState()
+        self.internal_state.data['imaging channels'] = self.imaging_channels
+        self.trigger_mode = trigger_mode
+        self.fps_trigger = fps_trigger if fps_trigger is not None else FPS['trigger_software']['default']
+        self.fps_save = fps_save # None: save every frame
+        self.working_resolution_scaling = working_resolution_scaling
+        # {imaging channel: (rotate image angle, flip image)}; defaults to the camera configuration
+        self.rotate_flip = rotate_flip if rotate_flip is not None else {}
+        self.timestamp_last_save = {channel:0 for channel in self.imaging_channels}
+        self.save_image_flag = False
+        self.recording_channels = []
+        self.track_flag = False
+
+        # image thresholding parameters (see StreamHandler)
+        self.lower_HSV = np.array([0, 0, 100],dtype='uint8')
+        self.upper_HSV = np.array([255, 255, 255],dtype='uint8')
+        self.invert_image_flag = False
+
+        self.navigation = Navigation(self.microcontroller)
+        self.microcontroller.configure_actuators()
+        self.stateUpdater = StateUpdaterCore(self.navigation, self.internal_state)
+        self.microcontroller.set_callback(self.stateUpdater.read_microcontroller)
+        self.trackingCore = TrackingCore(self.navigation, self.microcontroller, self.internal_state)
+        self.trackingDataWriter = TrackingDataWriter(self.internal_state)
+        self.imageWriter = {channel:ImageWriter(self.internal_state, imaging_channel = channel, image_format = image_format) for channel in self.imaging_channels}
+
+        # wiring (the Qt connections of gui_tracking)
+        self.trackingCore.add_callback('save_data',self.trackingDataWriter.enqueue)
+        self.trackingCore.add_callback('track_lost',self.stop_tracking)
+        self.stateUpdater.add_callback('joystick_button_pressed',self.toggle_tracking)
+        for channel in self.imaging_channels:
+            self.imageWriter[channel].add_callback('image_saved',self.trackingDataWriter.setImageName)
+
+        if objective is None:
+            # same as the objective dropdown of LiveControlWidget
+            objective = DEFAULT_OBJECTIVE if DEFAULT_OBJECTIVE in OBJECTIVES else list(OBJECTIVES.keys())[0]
+        self.set_objective(objective)
+
+        # per-frame latency tracing, from the camera callback to the acknowledgement of the motion commands
+        self.latencyTracer = latency_tracing.LatencyTracer() if LatencyTracing.ENABLED else None
+        self.trackingCore.latency_tracer = self.latencyTracer
+        self.microcontroller.latency_tracer = self.latencyTracer
+
+        # replaces the QTimer of LiveController
+        self.trigger_scheduler = TriggerScheduler(self.trigger_acquisition, self.fps_trigger)
+
+        # tracking worker - a frame waiting to be tracked is replaced by the next one
+        self.tracking_queue = Queue(1)
+        self.n_frames_not_tracked = 0
+        self.stop_signal_received = False
+        self.tracking_thread = Thread(target=self.process_tracking_queue)
+        self.tracking_thread.start()
+
+    def set_objective(self, objective):
+        self.internal_state.data['Objective'] = objective
+        self.trackingCore.update_pixel_size(get_pixel_size_um(objective))
+        self.trackingCore.update_image_resizing_factor(self.working_resolution_scaling)
+
+    def set_image_thresholds(self, lower_HSV, upper_HSV):
+        self.lower_HSV = lower_HSV
+        self.upper_HSV = upper_HSV
+
+    def start(self):
+        for channel in self.imaging_channels:
+            camera = self.cameras[channel]
+            if self.trigger_mode == TriggerMode.CONTINUOUS:
+                camera.set_continuous_acquisition()
+            elif self.trigger_mode == TriggerMode.HARDWARE:
+                camera.set_hardware_triggered_acquisition()
+            else:
+                camera.set_software_triggered_acquisition()
+            camera.set_callback(lambda camera, channel=channel: self.on_new_frame(channel, camera))
+            camera.enable_callback()
+            camera.start_streaming()
+        if self.trigger_mode != TriggerMode.CONTINUOUS:
+            self.trigger_scheduler.start()
+
+    def trigger_acquisition(self):
+        # called by the trigger scheduler at fps_trigger
+        for channel in self.imaging_channels:
+            if self.trigger_mode == TriggerMode.SOFTWARE:
+                self.cameras[channel].send_trigger()
+        if self.trigger_mode == TriggerMode.HARDWARE:
+            self.microcontroller.send_hardware_trigger(control_illumination=True,illumination_on_time_us=self.cameras[TRACKING].exposure_time*1000)
+
+    def on_new_frame(self, channel, camera):
+        camera.image_locked = True
+        trace_index = -1
+        if channel == TRACKING and self.track_flag and self.latencyTracer is not None:
+            trace_index = self.latencyTracer.begin_frame(camera.frame_ID)
+        image = camera.current_frame
+        rotate_image_angle, flip_image = self.rotate_flip.get(channel,(CAMERAS[channel]['rotate image angle'],CAMERAS[channel]['flip image']))
+        image = rotate_flip_image(image, rotate_image_angle, flip_image)
+
+        image_resized = None
+        image_thresh = None
+        if channel == TRACKING:
+            image_width = image.shape[1]
+            image_resized = cv2.resize(image, (round(image_width*self.working_resolution_scaling), round(image.shape[0]*self.working_resolution_scaling)))
+            image_thresh = 255*np.array(threshold_image(image_resized, self.lower_HSV, self.upper_HSV, self.invert_image_flag, camera.is_color), dtype = 'uint8')
+            if self.track_flag:
+                if self.latencyTracer is not None:
+                    self.latencyTracer.stamp(trace_index,'preprocessed')
+                self._enqueue_tracking([image_resized, image_thresh, trace_index, camera.frame_ID, camera.timestamp])
+
+        self._notify('frame', channel, image_resized, image_thresh)
+
+        time_now = time.time()
+        if self.save_image_flag and channel in self.recording_channels and (self.fps_save is None or time_now - self.timestamp_last_save[channel] >= 1/self.fps_save):
+            if camera.is_color:
+                image = cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
+            self.imageWriter[channel].enqueue(image, camera.frame_ID, camera.timestamp)
+            self.timestamp_last_save[channel] = time_now
+        camera.image_locked = False
+
+    def _enqueue_tracking(self, frame):
+        try:
+            self.tracking_queue.put_nowait(frame)
+        except:
+            # the tracker is still busy - replace the waiting frame
+            try:
+                self.tracking_queue.get_nowait()
+                self.tracking_queue.task_done()
+                self.n_frames_not_tracked = self.n_frames_not_tracked + 1
+            except:
+                pass
+            try:
+                self.tracking_queue.put_nowait(frame)
+            except:
+                self.n_frames_not_tracked = self.n_frames_not_tracked + 1
+
+    def process_tracking_queue(self):
+        while True:
+            if self.stop_signal_received:
+                return
+            try:
+                [image_resized, image_thresh, trace_index, frame_ID, timestamp] = self.tracking_queue.get(timeout=0.1)
+            except:
+                continue
+            try:
+                if self.track_flag:
+                    self.trackingCore.on_new_frame(image_resized, image_thresh, trace_index, frame_ID, timestamp)
+            except:
+                print('error occurred during tracking')
+            finally:
+                self.tracking_queue.task_done()
+
+    def start_tracking(self, new_track = True):
+        # frames queued before the start of the track are not tracked
+        while not self.tracking_queue.empty():
+            try:
+                self.tracking_queue.get_nowait()
+                self.tracking_queue.task_done()
+            except:
+                break
+        self.internal_state.data['image_tracking_enabled'] = True
+        if self.trackingCore.tracker_image.init_method == 'roi':
+            self.trackingCore.update_roi_bbox()
+        self.trackingCore.reset_track()
+        if new_track:
+            self.trackingDataWriter.start_new_track()
+        self.track_flag = True
+        self._notify('tracking_started')
+
+    def stop_tracking(self):
+        self.track_flag = False
+        self.internal_state.data['image_tracking_enabled'] = False
+        self._notify('tracking_stopped')
+
+    def toggle_tracking(self):
+        if self.track_flag:
+            self.stop_tracking()
+        else:
+            self.start_tracking()
+
+    def set_stage_tracking(self, enabled):
+        self.internal_state.data['stage_tracking_enabled'] = enabled
+
+    def start_recording(self, base_path, experiment_ID = '', channels = None, track = True):
+        # same sequence as RecordingWidget.toggle_recording
+        self.trackingDataWriter.set_base_path(base_path)
+        self.trackingDataWriter.update_experiment_ID(experiment_ID)
+        self.internal_state.data['Acquisition'] = True
+        self.trackingDataWriter.start_new_experiment()
+        if track:
+            # start_new_experiment has opened track000.csv
+            self.start_tracking(new_track = False)
+        self.recording_channels = list(channels) if channels is not None else self.imaging_channels
+        for channel in self.recording_channels:
+            self.imageWriter[channel].set_base_path(base_path)
+            self.imageWriter[channel].start_saving_images()
+        self.save_image_flag = True
+
+    def stop_recording(self):
+        self.save_image_flag = False
+        self.internal_state.data['Acquisition'] = False
+
+    def close(self):
+        self.stop_tracking()
+        self.stop_recording()
+        self.trigger_scheduler.stop()
+        for channel in self.imaging_channels:
+            self.cameras[channel].disable_callback()
+            self.cameras[channel].close()
+            self.imageWriter[channel].close()
+        self.stop_signal_received = True
+        self.tracking_thread.join()
+        self.trackingDataWriter.close()
+        self.microcontroller.close()
@@ -0,0 +1,241 @@
+# set QT_API environment variable
+import os
+os.environ["QT_API"] = "pyqt5"
+import qtpy
+
+# qt libraries
+from qtpy.QtCore import *
+from qtpy.QtWidgets import *
+from qtpy.QtGui import *
+
+from control._def import *
+
+from collections import deque
+from threading import Thread
+import time
+import json
+import numpy as np
+from datetime import datetime
+
+# error axis (as used by TrackingController) -> motor axis
+if TRACKING_CONFIG == 'XY_Z':
+    MOTOR_AXIS = {'X':'x', 'Y':'y', 'Z':'z'}
+else:
+    # XZ_Y and XTheta_Y: in-plane axis 1 is driven by motor y, the focus axis by motor z
+    # (for XTheta_Y the theta stage is approximated as a linear axis in the simulated plant)
+    MOTOR_AXIS = {'X':'x', 'Y':'z', 'Z':'y'}
+
+class RelayFeedbackTuner():
+    '''
+    Relay feedback (Astrom-Hagglund) identification of the ultimate gain Ku and ultimate period Tu.
+    The relay replaces the PID output: +amplitude when the error is above +hysteresis and
+    -amplitude when it is below -hysteresis. The loop then settles into a limit cycle whose
+    amplitude and period give Ku = 4*d/(pi*sqrt(a^2-h^2)) and Tu.
+    '''
+    def __init__(self, amplitude = PID_autotuning.RELAY_AMPLITUDE_MM, hysteresis = PID_autotuning.RELAY_HYSTERESIS_MM, n_cycles = PID_autotuning.N_CYCLES):
+        self.amplitude = amplitude
+        self.hysteresis = hysteresis
+        self.n_cycles = n_cycles
+        self.output = None
+        self.switch_times = [] # times of the -/+ relay transitions
+        self.cycle_amplitudes = []
+        self.error_max = -np.inf
+        self.error_min = np.inf
+        self.is_finished = False
+
+    def update(self, error, t):
+        if self.output is None:
+            self.output = self.amplitude if error >= 0 else -self.amplitude
+        if self.output > 0 and error < -self.hysteresis:
+            self.output = -self.amplitude
+        elif self.output < 0 and error > self.hysteresis:
+            self.output = self.amplitude
+            # a full cycle is complete
+            if len(self.switch_times) > 0:
+                self.cycle_amplitudes.append((self.error_max-self.error_min)/2)
+            self.switch_times.append(t)
+            self.error_max = -np.inf
+            self.error_min = np.inf
+            if len(self.switch_times) > self.n_cycles:
+                self.is_finished = True
+        self.error_max = max(self.error_max,error)
+        self.error_min = min(self.error_min,error)
+        return self.output
+
+    def get_ultimate_gain_and_period(self):
+        # discard the first cycle which contains the transient
+        periods = np.diff(self.switch_times)[1:]
+        amplitudes = np.array(self.cycle_amplitudes[1:])
+        if len(periods) == 0:
+            return None, None
+        a = np.mean(amplitudes)
+        a = np.sqrt(max(a**2 - self.hysteresis**2,1e-12))
+        Ku = 4*self.amplitude/(np.pi*a)
+        Tu = np.mean(periods)
+        return Ku, Tu
+
+    def get_PID_gains(self, rule = PID_autotuning.RULE):
+        Ku, Tu = self.get_ultimate_gain_and_period()
+        if Ku is None:
+            return None
+        if rule == 'Ziegler-Nichols':
+            P = 0.6*Ku
+            Ti = Tu/2
+            Td = Tu/8
+        else:
+            # Tyreus-Luyben - less aggressive, less overshoot
+            P = Ku/2.2
+            Ti = 2.2*Tu
+            Td = Tu/6.3
+        # PID.update integrates Ki*error*dt and differentiates Kd*derror/dt
+        return P, P/Ti, P*Td
+
+class SimulatedPlant():
+    '''
+    Plant model for tuning against Microcontroller_Simulation: the object is stationary,
+    the tracking error is the target minus the stage position, seen through a first-order lag
+    (stage response), a dead time (exposure + image processing) and localization noise.
+    '''
+    def __init__(self, delay_s = PID_autotuning.SIMULATED_PLANT_DELAY_S, time_constant_s = PID_autotuning.SIMULATED_PLANT_TIME_CONSTANT_S, noise_mm = PID_autotuning.SIMULATED_PLANT_NOISE_MM):
+        self.delay_s = delay_s
+        self.time_constant_s = time_constant_s
+        self.noise_mm = noise_mm
+        self.target_mm = None
+        self.stage_pos_mm_filtered = None
+        self.timestamp_last = None
+        self.buffer = deque()
+
+    def get_error(self, stage_pos_mm, t):
+        if self.target_mm is None:
+            self.target_mm = stage_pos_mm
+            self.stage_pos_mm_filtered = stage_pos_mm
+            self.timestamp_last = t
+        dt = t - self.timestamp_last
+        self.timestamp_last = t
+        alpha = dt/(self.time_constant_s + dt) if (self.time_constant_s + dt) > 0 else 1
+        self.stage_pos_mm_filtered = self.stage_pos_mm_filtered + alpha*(stage_pos_mm - self.stage_pos_mm_filtered)
+        self.buffer.append((t,self.target_mm - self.stage_pos_mm_filtered))
+        # dead time - return the latest sample that is at least delay_s old
+        while len(self.buffer) > 1 and self.buffer[1][0] <= t - self.delay_s:
+            self.buffer.popleft()
+        return self.buffer[0][1] + self.noise_mm*np.random.randn()
+
+class PIDAutoTuningController(QObject):
+
+    signal_tuning_finished = Signal(str,float,float,float) # axis, P, I, D
+    signal_tuning_status = Signal(str)
+
+    def __init__(self, trackingController, navigationController, microcontroller, simulation = False):
+        QObject.__init__(self)
+        self.trackingController = trackingController
+        self.navigationController = navigationController
+        self.microcontroller = microcontroller
+        self.simulation = simulation
+        self.rule = PID_autotuning.RULE
+        self.axis = None
+        self.tuner = None
+        self.timestamp_start = None
+        self.thread = None
+        self.results = self.load_results()
+
+    def set_rule(self, rule):
+        self.rule = rule
+
+    def start_tuning(self, axis):
+        if self.tuner is not None:
+            print('PID auto-tuning already in progress')
+            return
+        self.axis = axis
+        self.tuner = RelayFeedbackTuner()
+        self.timestamp_start = time.time()
+        self.signal_tuning_status.emit('auto-tuning ' + axis)
+        print('start PID auto-tuning for axis ' + axis)
+        if self.simulation:
+            self.thread = Thread(target=self._run_with_simulated_plant, daemon=True)
+            self.thread.start()
+        else:
+            # the relay replaces the PID output of the axis in TrackingController, tracking needs to be on
+            self.trackingController.set_pid_autotuner(self)
+
+    def stop_tuning(self):
+        self.trackingController.set_pid_autotuner(None)
+        self.tuner = None
+
+    # called by TrackingController in place of the PID feedback for self.axis
+    def update(self, error_mm, t):
+        tuner = self.tuner
+        if tuner is None:
+            return 0
+        output = tuner.update(error_mm, t)
+        if tuner.is_finished:
+            self._finish(tuner)
+        elif time.time() - self.timestamp_start > PID_autotuning.TIMEOUT_S:
+            print('PID auto-tuning timed out - no sustained oscillation')
+            self.signal_tuning_status.emit('auto-tuning timed out')
+            self.stop_tuning()
+            return 0
+        return output
+
+    def _finish(self, tuner):
+        self.stop_tuning()
+        Ku, Tu = tuner.get_ultimate_gain_and_period()
+        gains = tuner.get_PID_gains(self.rule)
+        if gains is None:
+            self.signal_tuning_status.emit('auto-tuning failed')
+            return
+        P, I, D = gains
+        print('PID auto-tuning ' + self.axis + ': Ku = ' + str(Ku) + ', Tu = ' + str(Tu) + ' s -> P = ' + str(P) + ', I = ' + str(I) + ', D = ' + str(D))
+        self.results.setdefault(MACHINE_CONFIGURATION,{})[self.axis] = {'P':P, 'I':I, 'D':D, 'Ku':Ku, 'Tu':Tu, 'rule':self.rule,
+            'simulation':self.simulation, 'timestamp':datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+        self.save_results()
+        self.signal_tuning_status.emit('auto-tuning ' + self.axis + ' done')
+        self.signal_tuning_finished.emit(self.axis,P,I,D)
+
+    def _run_with_simulated_plant(self):
+        plant = SimulatedPlant()
+        motor = MOTOR_AXIS[self.axis]
+        dt = 1.0/PID_autotuning.SIMULATED_LOOP_RATE_HZ
+        t0 = time.time()
+        while self.tuner is not None:
+            t = time.time() - t0
+            error_mm = plant.get_error(self._get_stage_position_mm(motor), t)
+            correction_mm = self.update(error_mm, t)
+            usteps = int(round(correction_mm/self._get_mm_per_ustep(motor)))*self._get_sign(motor)
+            getattr(self.navigationController,'move_' + motor + '_usteps')(usteps)
+            time.sleep(dt)
+
+    def _get_mm_per_ustep(self, motor):
+        pitch = {'x':SCREW_PITCH_X_MM, 'y':SCREW_PITCH_Y_MM, 'z':SCREW_PITCH_Z_MM}[motor]
+        fullsteps = {'x':FULLSTEPS_PER_REV_X, 'y':FULLSTEPS_PER_REV_Y, 'z':FULLSTEPS_PER_REV_Z}[motor]
+        microstepping = getattr(self.navigationController, motor + '_microstepping')
+        return pitch/(fullsteps*microstepping)
+
+    def _get_sign(self, motor):
+        # sign that makes a positive correction increase the reported stage position
+        return {'x':STAGE_MOVEMENT_SIGN_X*STAGE_POS_SIGN_X, 'y':STAGE_MOVEMENT_SIGN_Y*STAGE_POS_SIGN_Y, 'z':STAGE_MOVEMENT_SIGN_Z*STAGE_POS_SIGN_Z}[motor]
+
+    def _get_stage_position_mm(self, motor):
+        x_pos, y_pos, z_pos, _ = self.microcontroller.get_pos()
+        pos = {'x':x_pos*STAGE_POS_SIGN_X, 'y':y_pos*STAGE_POS_SIGN_Y, 'z':z_pos*STAGE_POS_SIGN_Z}[motor]
+        return pos*self._get_mm_per_ustep(motor)
+
+    def get_saved_gains(self, axis):
+        try:
+            result = self.results[MACHINE_CONFIGURATION][axis]
+            return result['P'], result['I'], result['D']
+        except KeyError:
+            return None
+
+    def load_results(self):
+        try:
+            with open(PID_autotuning.RESULTS_FILE,'r') as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def save_results(self):
+        try:
+            with open(PID_autotuning.RESULTS_FILE,'w') as f:
+                json.dump(self.results,f,indent=4)
+        except:
+            print('failed to save PID auto-tuning results')
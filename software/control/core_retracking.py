@@ -0,0 +1,199 @@
+'''
+Offline re-tracking of recorded experiments (folders written by TrackingDataSaver and ImageSaver).
+Each track (track###.csv and its images) is one task; tasks are distributed over a process pool,
+each worker keeps its own Tracker_Image and streams the images of one track at a time.
+'''
+import os
+import glob
+import time
+import numpy as np
+import cv2
+import pandas as pd
+import multiprocessing
+import traceback
+
+from control._def import *
+import control.tracking as tracking
+import control.utils.image_processing as image_processing
+import control.core_headless as core_headless
+
+# tracker names accepted by the tool -> Tracker_Image.tracker_type
+# any type that is not an OpenCV or neural-net tracker falls back to nearest-neighbour on the thresholded image
+TRACKER_TYPES = {'threshold':'nearest neighbour', 'csrt':'csrt', 'daSiamRPN':'daSiamRPN'}
+
+RESULT_COLUMNS = ['object_found','centroid_x_px','centroid_y_px','bbox_x_px','bbox_y_px','bbox_w_px','bbox_h_px']
+
+class RetrackingParameters():
+    def __init__(self, tracker = 'threshold', init_method = 'threshold', roi_bbox = None, imaging_channel = TRACKING,
+        working_resolution_scaling = WORKING_RES_DEFAULT, threshold_lower = 100, threshold_upper = 255, invert = False, output_folder = 'retracked'):
+        self.tracker = tracker
+        self.init_method = init_method
+        self.roi_bbox = roi_bbox # x, y, w, h in pixels of the working-resolution image
+        self.imaging_channel = imaging_channel
+        self.working_resolution_scaling = working_resolution_scaling
+        self.threshold_lower = threshold_lower
+        self.threshold_upper = threshold_upper
+        self.invert = invert
+        self.output_folder = output_folder
+
+def find_tracks(experiment_folders):
+    tracks = []
+    for experiment_folder in experiment_folders:
+        track_files = sorted(glob.glob(os.path.join(experiment_folder,'track*.csv')))
+        if len(track_files) == 0:
+            print('no track file found in ' + experiment_folder)
+        for track_file in track_files:
+            tracks.append((experiment_folder,track_file))
+    return tracks
+
+def get_pixel_size_um(experiment_folder, imaging_channel):
+    # objective from the metadata written at the start of the experiment
+    objective = None
+    try:
+        objective = pd.read_csv(os.path.join(experiment_folder,'metadata.csv'))['Objective'][0]
+    except:
+        pass
+    if objective not in OBJECTIVES:
+        objective = DEFAULT_OBJECTIVE if DEFAULT_OBJECTIVE in OBJECTIVES else list(OBJECTIVES.keys())[0]
+        print('objective not found in the metadata of ' + experiment_folder + ', using ' + objective)
+    return core_headless.get_pixel_size_um(objective, imaging_channel)
+
+def index_images(experiment_folder, imaging_channel):
+    # image name -> path (images are saved in subfolders of 1000)
+    image_paths = {}
+    for path in glob.glob(os.path.join(experiment_folder,imaging_channel,'*','*')):
+        image_paths[os.path.basename(path)] = path
+    return image_paths
+
+# one tracker per worker process, created by the pool initializer
+tracker_image = None
+
+def init_worker(parameters):
+    # only the selected tracker is built (the neural net is not loaded for threshold/csrt runs)
+    global tracker_image
+    tracker_image = tracking.Tracker_Image(tracker_type = TRACKER_TYPES.get(parameters.tracker,parameters.tracker))
+
+def retrack(task):
+    # a failing track is reported, the other tracks of the batch continue
+    experiment_folder, track_file, parameters = task
+    try:
+        return _retrack(experiment_folder, track_file, parameters) + (None,)
+    except Exception:
+        return track_file, os.getpid(), 0, 0, traceback.format_exc()
+
+def _retrack(experiment_folder, track_file, parameters):
+    global tracker_image
+    if tracker_image is None:
+        init_worker(parameters)
+    tracker_image.update_tracker_type(TRACKER_TYPES.get(parameters.tracker,parameters.tracker))
+    tracker_image.update_init_method(parameters.init_method)
+    if parameters.roi_bbox is not None:
+        tracker_image.set_roi_bbox(parameters.roi_bbox)
+    tracker_image.reset()
+
+    channel = parameters.imaging_channel
+    df = pd.read_csv(track_file)
+    if channel not in df.columns:
+        print(track_file + ': no ' + channel + ' column')
+        return track_file, os.getpid(), 0, 0
+    # only the rows with an image can be re-tracked
+    df = df[df[channel].notna() & (df[channel].astype(str) != '') & (df[channel].astype(str) != '[]')].reset_index(drop=True)
+    image_paths = index_images(experiment_folder, channel)
+    pixel_size_mm = get_pixel_size_um(experiment_folder, channel)/parameters.working_resolution_scaling/1000
+    lower = np.array([0,0,parameters.threshold_lower],dtype='uint8')
+    upper = np.array([255,255,parameters.threshold_upper],dtype='uint8')
+
+    results = np.full((len(df),len(RESULT_COLUMNS)),np.nan)
+    image_center = None
+    is_first_frame = True
+    n_frames = 0
+    timestamp_start = time.time()
+    for i, image_name in enumerate(df[channel]):
+        path = image_paths.get(str(image_name))
+        if path is None:
+            continue
+        image = cv2.imread(path,cv2.IMREAD_UNCHANGED)
+        if image is None:
+            continue
+        is_color = image.ndim == 3
+        image = cv2.resize(image,(round(image.shape[1]*parameters.working_resolution_scaling),round(image.shape[0]*parameters.working_resolution_scaling)))
+        image_thresh = 255*np.array(core_headless.threshold_image(image,lower,upper,parameters.invert,is_color),dtype='uint8')
+        if image_center is None:
+            image_center, image_width = image_processing.get_image_center_width(image)
+            tracker_image.searchArea = int(image_width/Tracking.SEARCH_AREA_RATIO)
+        n_frames = n_frames + 1
+        if is_first_frame and parameters.init_method != 'roi' and not image_processing.find_centroid_basic_Rect(image_thresh)[0]:
+            # nothing to initialize the tracker with - try again on the next frame
+            results[i,0] = 0
+            continue
+        objectFound, centroid, rect_pts = tracker_image.track(image, image_thresh, is_first_frame = is_first_frame)
+        if objectFound and centroid is not None:
+            is_first_frame = False
+            bbox = tracker_image.bbox
+            results[i] = [1,centroid[0],centroid[1],bbox[0],bbox[1],bbox[2],bbox[3]]
+        else:
+            # re-initialize on the next frame
+            results[i,0] = 0
+            is_first_frame = True
+    elapsed = time.time() - timestamp_start
+
+    # output table - same columns as the recorded track, with the object position in the image replaced
+    df_out = df.copy()
+    x_image = (results[:,1] - (image_center[0] if image_center is not None else 0))*pixel_size_mm
+    y_image = (results[:,2] - (image_center[1] if image_center is not None else 0))*pixel_size_mm
+    if TRACKING_CONFIG == 'XY_Z':
+        columns_image = {'X_image':x_image, 'Y_image':y_image}
+        columns_lab = {'X':('X_stage','X_image'), 'Y':('Y_stage','Y_image')}
+    else:
+        columns_image = {'X_image':x_image, 'Z_image':y_image}
+        columns_lab = {'X':('X_stage','X_image'), 'Z':('Z_stage','Z_image')}
+    for key, value in columns_image.items():
+        df_out[key] = value
+    for key, (key_stage, key_image) in columns_lab.items():
+        if key in df_out.columns and key_stage in df_out.columns:
+            df_out[key] = df_out[key_stage] + df_out[key_image]
+    for j, key in enumerate(RESULT_COLUMNS):
+        df_out[key] = results[:,j]
+    df_out['object_found'] = df_out['object_found'].fillna(0).astype(bool)
+
+    output_folder = os.path.join(experiment_folder, parameters.output_folder)
+    os.makedirs(output_folder, exist_ok = True)
+    df_out.to_csv(os.path.join(output_folder, os.path.basename(track_file)), index = False)
+    return track_file, os.getpid(), n_frames, elapsed
+
+def retrack_experiments(experiment_folders, parameters, n_workers = None, maxtasksperchild = None):
+    tasks = [(experiment_folder, track_file, parameters) for experiment_folder, track_file in find_tracks(experiment_folders)]
+    if len(tasks) == 0:
+        return {}
+    if n_workers is None:
+        n_workers = min(multiprocessing.cpu_count(), len(tasks))
+    worker_stats = {} # pid -> [n_frames, elapsed]
+    failed_tracks = []
+    def report(result):
+        track_file, pid, n_frames, elapsed, error = result
+        if error is not None:
+            failed_tracks.append(track_file)
+            print('[worker ' + str(pid) + '] ' + track_file + ' failed:\n' + error)
+            return
+        stats = worker_stats.setdefault(pid,[0,0])
+        stats[0] = stats[0] + n_frames
+        stats[1] = stats[1] + elapsed
+        fps = n_frames/elapsed if elapsed > 0 else 0
+        print('[worker ' + str(pid) + '] ' + track_file + ': ' + str(n_frames) + ' frames, ' + str(round(fps,1)) + ' fps')
+    if n_workers == 1:
+        init_worker(parameters)
+        for task in tasks:
+            report(retrack(task))
+    else:
+        # spawn - CUDA (DaSiamRPN) and OpenCV do not survive a fork
+        context = multiprocessing.get_context('spawn')
+        # imap_unordered with chunksize 1: each worker holds the images of one track at most
+        with context.Pool(n_workers, initializer = init_worker, initargs = (parameters,), maxtasksperchild = maxtasksperchild) as pool:
+            for result in pool.imap_unordered(retrack, tasks, chunksize = 1):
+                report(result)
+    if len(failed_tracks) > 0:
+        print(str(len(failed_tracks)) + ' of ' + str(len(tasks)) + ' tracks failed: ' + ', '.join(failed_tracks))
+    print('frames/second per worker:')
+    for pid, (n_frames, elapsed) in worker_stats.items():
+        print('  worker ' + str(pid) + ': ' + str(n_frames) + ' frames, ' + str(round(n_frames/elapsed if elapsed > 0 else 0,1)) + ' fps')
+    return worker_stats
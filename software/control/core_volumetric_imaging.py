@@ -12,6 +12,8 @@ import control.utils as utils
 from control._def import *
 from control.core import *
 import control.tracking as tracking
+from control.utils.rate_meter import RateMeter
+from control.utils.focus_measure import FocusMeasureEngine, IncrementalFocusFit
 
 from queue import Queue
 from threading import Thread, Lock
@@ -26,6 +28,220 @@ from pathlib import Path
 
 import tifffile as tif
 
+class VolumeBufferPool:
+    '''
+    Preallocated volume stacks for VolumetricImagingStreamHandler. The stream handler fills one stack; when the
+    volume is complete, the stack is handed off to its consumers (saver, display) and comes back to the pool when
+    all of them have released it, so a stack is never overwritten while it is being saved or displayed. When no
+    stack is free, the volume is dropped and counted in n_overflows.
+    '''
+    def __init__(self, n_buffers = VolumeBuffers.N_BUFFERS, max_size_MB = VolumeBuffers.MAX_BUFFER_SIZE_MB):
+        self.n_buffers = n_buffers
+        self.max_size_MB = max_size_MB
+        self.lock = Lock()
+        self.shape = None
+        self.dtype = None
+        self.n_allocated = 0
+        self.free_buffers = []
+        self.n_owners = {} # id(stack) -> number of consumers that still hold the stack
+        self.n_volumes = 0
+        self.n_overflows = 0
+
+    def configure(self, shape, dtype):
+        # (re)allocate the stacks when the volume shape changes - stacks of the old shape are not taken back
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        with self.lock:
+            if shape == self.shape and dtype == self.dtype:
+                return
+            self.shape = shape
+            self.dtype = dtype
+            self.n_owners = {}
+            size_MB = np.prod(shape)*dtype.itemsize/1e6
+            self.n_allocated = int(min(self.n_buffers, max(self.max_size_MB//max(size_MB,1e-6), 2)))
+            self.free_buffers = [np.empty(shape, dtype = dtype) for i in range(self.n_allocated)]
+            print('volume buffer pool: ' + str(self.n_allocated) + ' stacks of ' + str(shape) + ' (' + str(round(self.n_allocated*size_MB)) + ' MB)')
+
+    def acquire(self):
+        # a free stack, or None (overflow) when all stacks are held by the consumers
+        with self.lock:
+            if len(self.free_buffers) == 0:
+                self.n_overflows += 1
+                return None
+            return self.free_buffers.pop()
+
+    def hand_off(self, stack, n_consumers):
+        # transfer the ownership of a completed stack to n_consumers, each of which will call release(stack)
+        with self.lock:
+            self.n_volumes += 1
+            if n_consumers > 0:
+                self.n_owners[id(stack)] = n_consumers
+                return
+        self._recycle(stack)
+
+    def release(self, stack):
+        with self.lock:
+            n_owners = self.n_owners.get(id(stack))
+            if n_owners is None:
+                return
+            if n_owners > 1:
+                self.n_owners[id(stack)] = n_owners - 1
+                return
+            del self.n_owners[id(stack)]
+        self._recycle(stack)
+
+    def _recycle(self, stack):
+        with self.lock:
+            if stack.shape == self.shape and stack.dtype == self.dtype and len(self.free_buffers) + len(self.n_owners) < self.n_allocated:
+                self.free_buffers.append(stack)
+
+class VolumeProjector:
+    '''
+    Maximum (MIP), minimum and depth-coded projections of a volume, updated as the planes arrive with fixed
+    buffers (the running projections and the plane index of the maximum). The depth-coded projection is the
+    color of the plane of the maximum (VolumeProjection.DEPTH_COLORMAP) scaled by the MIP, as an RGB image
+    (planes beyond the 256th get the color of the last one).
+    '''
+    def __init__(self, colormap = VolumeProjection.DEPTH_COLORMAP):
+        self.colormap = getattr(cv2, 'COLORMAP_' + colormap)
+        self.shape = None
+        self.number_of_planes = 0
+        self.n_planes_added = 0
+
+    def reset(self, shape, dtype, number_of_planes):
+        if shape != self.shape or dtype != self.mip.dtype:
+            self.shape = shape
+            self.mip = np.zeros(shape, dtype = dtype)
+            self.min = np.zeros(shape, dtype = dtype)
+            self.depth = np.zeros(shape, dtype = np.uint8)
+            self.mask = np.zeros(shape, dtype = bool)
+        if number_of_planes != self.number_of_planes:
+            self.number_of_planes = number_of_planes
+            # RGB color of each plane, as a cv2.LUT table
+            n = min(number_of_planes, 256)
+            colors = cv2.applyColorMap(np.linspace(0, 255, n).astype(np.uint8).reshape(-1,1), self.colormap)
+            self.depth_lut = np.empty((256,1,3), dtype = np.uint8)
+            self.depth_lut[:n] = cv2.cvtColor(colors, cv2.COLOR_BGR2RGB)
+            self.depth_lut[n:] = self.depth_lut[n-1]
+        self.n_planes_added = 0
+
+    def add_plane(self, plane, plane_ID):
+        if plane.ndim == 3:
+            plane = cv2.cvtColor(plane, cv2.COLOR_RGB2GRAY)
+        if self.n_planes_added == 0:
+            np.copyto(self.mip, plane)
+            np.copyto(self.min, plane)
+            self.depth.fill(min(plane_ID, 255))
+        else:
+            np.greater(plane, self.mip, out = self.mask)
+            np.copyto(self.depth, min(plane_ID, 255), where = self.mask)
+            np.maximum(self.mip, plane, out = self.mip)
+            np.minimum(self.min, plane, out = self.min)
+        self.n_planes_added += 1
+
+    def get_projections(self):
+        # copies, the buffers are reused for the next volume
+        brightness = cv2.convertScaleAbs(self.mip, alpha = 255/max(float(self.mip.max()), 1))
+        depth_coded = cv2.LUT(cv2.cvtColor(self.depth, cv2.COLOR_GRAY2RGB), self.depth_lut)
+        cv2.multiply(depth_coded, cv2.cvtColor(brightness, cv2.COLOR_GRAY2RGB), dst = depth_coded, scale = 1/255)
+        return self.mip.copy(), self.min.copy(), depth_coded
+
+class LensSweepModel:
+    '''
+    Lens current (and focal position) of the volumetric imaging planes. The liquid lens current is a sinusoid
+    between current_mA_min and current_mA_max at frequency_Hz, with phase VolumetricZ.LENS_TRIGGER_PHASE_DEG at
+    the lens trigger output; the trigger controller fires plane 0 phase_delay/90 of a quarter period after the lens
+    trigger, and the other planes one period/number_of_planes apart. The current of a plane is taken at the middle
+    of its exposure, delayed by the lens response (VolumetricZ.LENS_RESPONSE_DELAY_MS). current_mA_offset is the
+    shift of the sweep by the focus tracking with the lens (LiquidLensFocusController).
+    '''
+    def __init__(self):
+        self.current_mA_offset = 0
+        self.configure(0,0,0,0,VOLUMETRIC_IMAGING_NUMBER_OF_PLANES_PER_VOLUME_DEFAULT)
+
+    def configure(self, current_mA_min, current_mA_max, frequency_Hz, phase_delay, number_of_planes, exposure_time_ms = 0):
+        self.current_mA_center = (current_mA_max + current_mA_min)/2
+        self.current_mA_amplitude = (current_mA_max - current_mA_min)/2
+        self.frequency_Hz = frequency_Hz
+        self.phase_delay = phase_delay
+        self.number_of_planes = number_of_planes
+        self.exposure_time_ms = exposure_time_ms
+        self.anchor = None # timestamp of plane 0 of volume 0
+
+    def is_scanning(self):
+        return self.frequency_Hz > 0 and self.number_of_planes > 0
+
+    def get_current_mA(self, t):
+        # lens current seen by the sample t seconds after the lens trigger
+        if not self.is_scanning():
+            return self.current_mA_center + self.current_mA_offset + 0*np.asarray(t, dtype = float)
+        t = np.asarray(t, dtype = float) - VolumetricZ.LENS_RESPONSE_DELAY_MS/1000
+        return self.current_mA_center + self.current_mA_offset + self.current_mA_amplitude*np.sin(2*np.pi*self.frequency_Hz*t + np.radians(VolumetricZ.LENS_TRIGGER_PHASE_DEG))
+
+    def get_plane_currents_mA(self):
+        if not self.is_scanning():
+            return np.full(self.number_of_planes, self.current_mA_center + self.current_mA_offset)
+        period = 1/self.frequency_Hz
+        t = (period/4)*(self.phase_delay/90) + np.arange(self.number_of_planes)*period/self.number_of_planes + self.exposure_time_ms/2000
+        return self.get_current_mA(t)
+
+    def get_plane_z_um(self):
+        # relative to the center of the sweep
+        return (self.get_plane_currents_mA() - self.current_mA_center)*VolumetricZ.UM_PER_MA
+
+    def get_plane_z_normalized(self):
+        # -1 at the low end of the sweep, 1 at its high end
+        if self.current_mA_amplitude == 0:
+            return np.linspace(-1, 1, self.number_of_planes)
+        return (self.get_plane_currents_mA() - self.current_mA_center - self.current_mA_offset)/self.current_mA_amplitude
+
+    def get_z_um(self, z_normalized):
+        # distance from the center of the sweep of a normalized plane position
+        return z_normalized*self.current_mA_amplitude*VolumetricZ.UM_PER_MA
+
+    def assign(self, timestamp):
+        # volume and plane of a frame from its exposure timestamp, relative to the first frame (plane 0 of volume 0);
+        # the anchor follows the drift between the camera clock and the lens
+        if self.anchor is None:
+            self.anchor = timestamp
+            return 0, 0
+        period = 1/self.frequency_Hz
+        plane_interval = period/self.number_of_planes
+        elapsed = timestamp - self.anchor
+        volume_ID = int(np.floor((elapsed + plane_interval/2)/period))
+        plane_ID = int(np.clip(round((elapsed - volume_ID*period)/plane_interval), 0, self.number_of_planes - 1))
+        self.anchor = self.anchor + VolumetricZ.ANCHOR_SMOOTHING*(elapsed - volume_ID*period - plane_ID*plane_interval)
+        return volume_ID, plane_ID
+
+def resample_volume_uniform(image_stack, z):
+    '''
+    Resample the longest monotonic sweep of a volume (planes at z) to as many uniformly spaced planes, by linear
+    interpolation between the two nearest planes. Returns the resampled stack and its z (increasing).
+    '''
+    # longest run of planes with z strictly increasing or strictly decreasing
+    directions = np.sign(np.diff(np.asarray(z, dtype = float)))
+    start, n, direction = 0, 1, 0
+    run_start = 0
+    for i in range(len(directions)):
+        if i > 0 and directions[i] != directions[i-1]:
+            run_start = i
+        if directions[i] != 0 and i + 2 - run_start > n:
+            start, n, direction = run_start, i + 2 - run_start, directions[i]
+    if direction == 0:
+        return image_stack[:1].copy(), np.asarray(z[:1], dtype = float)
+    z_sweep = np.asarray(z[start:start+n], dtype = float)
+    planes = np.arange(start, start + n)
+    if direction < 0:
+        z_sweep = z_sweep[::-1]
+        planes = planes[::-1]
+    z_uniform = np.linspace(z_sweep[0], z_sweep[-1], n)
+    resampled = np.empty((n,) + image_stack.shape[1:], dtype = image_stack.dtype)
+    for i, z_i in enumerate(z_uniform):
+        j = int(np.clip(np.searchsorted(z_sweep, z_i) - 1, 0, n - 2))
+        weight = float(np.clip((z_i - z_sweep[j])/(z_sweep[j+1] - z_sweep[j]), 0, 1))
+        cv2.addWeighted(image_stack[planes[j]], 1 - weight, image_stack[planes[j+1]], weight, 0, dst = resampled[i])
+    return resampled, z_uniform
+
 # case 1: no scanning, high speed only - set current_min and current_max to be the same
 # case 2: with liquid lens scanning
 
@@ -33,6 +249,7 @@ class VolumetricImagingController(QObject):
 
     signal_volumetric_imaging_stopped = Signal()
     signal_trigger_mode = Signal(str)
+    signal_lens_offset = Signal(float) # lens current offset (mA) of the focus tracking with the lens
 
     def __init__(self,camera,trigger_controller,liquid_lens,volumetricImagingStreamHandler,volumetricImagingImageSaver,internal_state):
         QObject.__init__(self)
@@ -42,6 +259,7 @@ class VolumetricImagingController(QObject):
         self.internal_state = internal_state
         self.trigger_controller = trigger_controller
         self.liquid_lens = liquid_lens
+        self.lens_focus_controller = None
         
         self.current_mA_min = 0
         self.current_mA_max = 0
@@ -58,6 +276,8 @@ class VolumetricImagingController(QObject):
 
         # make connections
         self.volumetricImagingStreamHandler.signal_volumetric_imaging_completed.connect(self.slot_volumetric_imaging_completed)
+        if hasattr(self.trigger_controller,'register_frame'):
+            self.volumetricImagingStreamHandler.frame_verifier = self.trigger_controller
         
     def start_volumetric_imaging(self):
         # set camera to hardware trigger if liquid lens scanning frequency is non-zero
@@ -74,8 +294,17 @@ class VolumetricImagingController(QObject):
         self.number_of_requested_frames = self.number_of_planes_per_volume * self.number_of_requested_volumes
 
         # update the StreamHandler
+        if self.frequency_Hz > 0:
+            self.volumetricImagingStreamHandler.set_lens_sweep(self.current_mA_min,self.current_mA_max,self.frequency_Hz,self.phase_delay,self.camera.exposure_time)
+        else:
+            self.volumetricImagingStreamHandler.set_lens_sweep(self.current_mA_static,self.current_mA_static,0,0,self.camera.exposure_time)
+        self.volumetricImagingStreamHandler.set_expected_fps(self.frequency_Hz*self.number_of_planes_per_volume)
         self.volumetricImagingStreamHandler.flag_volumetric_imaging_started = True # used for detecting the first frame after hardware trigger
         self.volumetricImagingStreamHandler.number_of_requested_frames = self.number_of_requested_frames
+        if self.frequency_Hz > 0:
+            self.volumetricImagingImageSaver.set_liquid_lens_settings(self.current_mA_min,self.current_mA_max,self.frequency_Hz,self.phase_delay)
+        else:
+            self.volumetricImagingImageSaver.set_liquid_lens_settings(self.current_mA_static,self.current_mA_static,0,0)
         if self.flag_record_acquisition:
             self.volumetricImagingImageSaver.start_a_new_folder()
             self.volumetricImagingStreamHandler.start_recording()
@@ -89,6 +318,9 @@ class VolumetricImagingController(QObject):
         self.trigger_controller.set_number_of_requested_volumes(self.number_of_requested_volumes)
         self.trigger_controller.set_frequency_Hz(self.frequency_Hz)
         self.trigger_controller.set_phase_delay(self.phase_delay)
+        if hasattr(self.trigger_controller,'set_frame_ID_origin'):
+            # the frames are matched to the triggers by frame ID
+            self.trigger_controller.set_frame_ID_origin(self.camera.frame_ID)
         self.trigger_controller.start_trigger_generation()
 
         # update the flag
@@ -96,19 +328,27 @@ class VolumetricImagingController(QObject):
 
     def stop_volumetric_imaging(self):
         self.volumetricImagingStreamHandler.stop_recording()
+        self.volumetricImagingImageSaver.finish_recording()
         self.volumetricImagingStreamHandler.reset()
         self.trigger_controller.stop_trigger_generation()
         # self.camera.set_continuous_acquisition()
         self.signal_trigger_mode.emit(TriggerMode.CONTINUOUS)
         self.liquid_lens.set_current_mA(self.current_mA_static)
         self.flag_volumetric_imaging_started= False
+        self.print_trigger_statistics()
 
     def slot_volumetric_imaging_completed(self):
         self.flag_volumetric_imaging_started = False
+        self.volumetricImagingImageSaver.finish_recording()
         # self.camera.set_continuous_acquisition()
         self.signal_trigger_mode.emit(TriggerMode.CONTINUOUS)
         self.liquid_lens.set_current_mA(self.current_mA_static)
         self.signal_volumetric_imaging_stopped.emit()
+        self.print_trigger_statistics()
+
+    def print_trigger_statistics(self):
+        if hasattr(self.trigger_controller,'get_frame_statistics'):
+            print('volumetric imaging triggers: ' + str(self.trigger_controller.get_frame_statistics()))
 
     def set_liquid_lens_scanning_current_min(self,value):
         print('set current min to ' + str(value))
@@ -151,11 +391,15 @@ class VolumetricImagingController(QObject):
     def stop_recording(self):
         self.flag_record_acquisition = False
         self.volumetricImagingStreamHandler.stop_recording()
+        self.volumetricImagingImageSaver.finish_recording()
 
     def set_phase_delay(self,phase_delay):
         print('update phase delay to ' + str(phase_delay) + ' degree')
         self.phase_delay = phase_delay
         self.trigger_controller.set_phase_delay(phase_delay)
+        self.volumetricImagingStreamHandler.set_phase_delay(phase_delay)
+        if self.frequency_Hz > 0:
+            self.volumetricImagingImageSaver.set_liquid_lens_settings(self.current_mA_min,self.current_mA_max,self.frequency_Hz,self.phase_delay)
 
     def enable_focus_measure_calculation(self,enabled):
         self.volumetricImagingStreamHandler.flag_calculate_focus_measure = enabled
@@ -163,6 +407,18 @@ class VolumetricImagingController(QObject):
     def enable_focus_tracking(self,enabled):
         self.volumetricImagingStreamHandler.flag_focus_tracking = enabled
 
+    def set_lens_focus_controller(self,lens_focus_controller):
+        # the lens current is then set through the focus controller, which adds its offset
+        self.lens_focus_controller = lens_focus_controller
+        self.liquid_lens = lens_focus_controller
+        self.lens_focus_controller.add_callback('lens_offset',self.volumetricImagingStreamHandler.set_lens_current_offset)
+        self.lens_focus_controller.add_callback('lens_offset',lambda offset_mA,offloading:self.signal_lens_offset.emit(offset_mA))
+
+    def enable_lens_focus_tracking(self,enabled):
+        if self.lens_focus_controller is not None:
+            print('focus tracking with the liquid lens ' + ('enabled' if enabled else 'disabled'))
+            self.lens_focus_controller.set_enabled(enabled)
+
     def close(self):
         pass
 
@@ -172,17 +428,20 @@ class VolumetricImagingStreamHandler(QObject):
     packet_image_for_array_display = Signal(np.ndarray, int)
     # packet_image_to_write = Signal(np.ndarray, int, int, float)
     # packet_image_stack_to_write = Signal(np.ndarray, int)
-    packet_image_to_write = Signal(np.ndarray, int)
+    packet_image_to_write = Signal(np.ndarray, int, float, np.ndarray) # volume, frame ID of its last plane, timestamp of its first plane, lens current (mA) of its planes
     packet_image_stack_to_display = Signal(np.ndarray)
+    packet_projections = Signal(np.ndarray, np.ndarray, np.ndarray, int) # MIP, min projection, depth-coded projection, frame ID of the last plane
+    packet_projections_to_write = Signal(tuple, int, float) # (MIP, min projection, depth-coded projection), frame ID of the last plane, timestamp of the first plane
     signal_new_frame_received = Signal()
     signal_volumetric_imaging_completed = Signal() 
     signal_focus_measure_plot = Signal(np.ndarray,np.ndarray)
     signal_defocus = Signal(float)
 
     # not used - for compatability with standard stream handler
-    signal_fps = Signal(int)
+    signal_fps = Signal(float)
     signal_fps_display = Signal(float)
     signal_fps_save = Signal(str, float)
+    signal_frame_statistics = Signal(float, int)
 
     def __init__(self, tracking_controller, crop_width=Acquisition.CROP_WIDTH, crop_height=Acquisition.CROP_HEIGHT, display_resolution_scaling=1, imaging_channel = 'volumetric imaging', rotate_image_angle = 0, flip_image = None):
         QObject.__init__(self)
@@ -198,6 +457,7 @@ class VolumetricImagingStreamHandler(QObject):
         self.frame_ID_offset = None
         self.frame_ID = None
         self.plane_ID = None
+        self.frame_verifier = None # TriggerController (register_frame), when it reports its triggers
         
         self.number_of_planes_per_volume = VOLUMETRIC_IMAGING_NUMBER_OF_PLANES_PER_VOLUME_DEFAULT
         self.number_of_requested_frames = None
@@ -216,12 +476,29 @@ class VolumetricImagingStreamHandler(QObject):
         self.handler_busy = False
 
         # for fps measurement
-        self.timestamp_last = 0
-        self.counter = 0
+        self.rate_meter = RateMeter(detect_drops = True)
         self.fps_real = 0
 
+        # preallocated volume stacks, handed off to the saver/display when a volume is complete
+        self.volume_buffer_pool = VolumeBufferPool()
+        self.image_stack = None # stack being filled
+        self.volume_timestamp = 0 # exposure time of the first plane of the stack being filled
+        self.volume_ID_dropped = None # volume dropped because no stack was free
+        self.volume_projector = VolumeProjector() if VolumeProjection.ENABLED else None
+        self.volume_ID = None
+        self.flag_volume_completed = False # the stack and projections of volume_ID have been sent
+        self.last_frame_ID_of_volume = None
+
+        # lens current of the planes
+        self.lens_sweep_model = LensSweepModel()
+        self.plane_currents_mA = self.lens_sweep_model.get_plane_currents_mA()
+
         # for focus tracking
         self.tracking_controller = tracking_controller
+        self.focus_measure_engine = FocusMeasureEngine()
+        self.focus_fit = IncrementalFocusFit()
+        self.focus_roi_relative = None # (x_center, y_center, width, height) of the focus measure ROI, as fractions of the tracking image
+        self.flag_defocus_reported = False # the defocus of the current sweep has been reported
 
     def set_display_fps(self,fps):
         self.fps_display = fps
@@ -234,10 +511,87 @@ class VolumetricImagingStreamHandler(QObject):
         self.display_resolution_scaling = display_resolution_scaling/100
         print(self.display_resolution_scaling)
 
+    def set_focus_roi(self,rect_pts):
+        # follows the tracked object (TrackingController.Rect_pt1_pt2) - the volumetric imaging and tracking fields of view are assumed to coincide
+        image = self.tracking_controller.image
+        centroid = self.tracking_controller.centroid
+        if rect_pts is None or image is None or centroid is None:
+            self.focus_roi_relative = None
+            return
+        height, width = image.shape[0], image.shape[1]
+        self.focus_roi_relative = (centroid[0]/width, centroid[1]/height,
+            abs(rect_pts[1][0]-rect_pts[0][0])*VolumetricFocus.ROI_RATIO/width, abs(rect_pts[1][1]-rect_pts[0][1])*VolumetricFocus.ROI_RATIO/height)
+
+    def clear_focus_roi(self):
+        self.focus_roi_relative = None
+
+    def get_focus_roi(self,image_width,image_height):
+        # focus measure ROI in pixels of the cropped plane - centered when no object is tracked
+        roi = self.focus_roi_relative
+        if roi is None:
+            size = VolumetricFocus.ROI_SIZE_DEFAULT
+            return (image_width/2,image_height/2,min(size,image_width),min(size,image_height))
+        return (roi[0]*image_width,roi[1]*image_height,roi[2]*image_width,roi[3]*image_height)
+
+    def report_defocus(self,timestamp):
+        self.flag_defocus_reported = True
+        self.defocus = self.focus_fit.get_peak()
+        if self.defocus is None:
+            # no maximum in the fit - fall back to the focus measure weighted mean of the planes acquired so far
+            n = self.plane_ID + 1
+            self.defocus = np.sum(np.multiply(self.focus_measure_index[:n],self.focus_measure[:n]))/max(np.sum(self.focus_measure[:n]),np.finfo(float).tiny)
+        self.defocus = float(np.clip(self.defocus,-1,1))
+        self.signal_defocus.emit(self.defocus)
+        # the defocus is relative to the sweep: scale it with the sweep amplitude and the focal shift per mA
+        defocus_um = self.lens_sweep_model.get_z_um(self.defocus)
+        print('defocus: ' + str(self.defocus) + ' (' + str(round(defocus_um,2)) + ' um) from ' + str(self.plane_ID+1) + ' planes')
+        # focus tracking
+        if self.flag_focus_tracking:
+            self.tracking_controller.track_focus = True
+            self.tracking_controller.set_focus_error(-defocus_um/1000,timestamp)
+        else:
+            self.tracking_controller.track_focus = False
+            self.tracking_controller.set_focus_error(0)
+
+    def set_expected_fps(self,fps):
+        # frame rate set by the trigger controller (0: free running), for the detection of dropped frames
+        self.rate_meter.set_expected_rate(fps)
+
+    def set_lens_sweep(self,current_mA_min,current_mA_max,frequency_Hz,phase_delay,exposure_time_ms=0):
+        self.lens_sweep_model.configure(current_mA_min,current_mA_max,frequency_Hz,phase_delay,self.number_of_planes_per_volume,exposure_time_ms)
+        self.update_plane_positions()
+
+    def set_phase_delay(self,phase_delay):
+        self.lens_sweep_model.phase_delay = phase_delay
+        self.update_plane_positions()
+
+    def set_lens_current_offset(self,offset_mA,offloading=False):
+        # the sweep has been shifted by the focus tracking with the lens
+        self.lens_sweep_model.current_mA_offset = offset_mA
+        self.update_plane_positions()
+
+    def update_plane_positions(self):
+        # lens current of each plane, and plane positions of the focus measure (normalized, -1 to 1)
+        self.lens_sweep_model.number_of_planes = self.number_of_planes_per_volume
+        self.plane_currents_mA = self.lens_sweep_model.get_plane_currents_mA()
+        self.focus_measure_num_points = min(int(np.ceil(self.number_of_planes_per_volume/2))+1,self.number_of_planes_per_volume)
+        if self.lens_sweep_model.is_scanning():
+            self.focus_measure_index = self.lens_sweep_model.get_plane_z_normalized()[:self.focus_measure_num_points]
+        else:
+            self.focus_measure_index = np.linspace(-1,1,self.focus_measure_num_points)
+
     def reset(self):
         self.flag_first_image = True
         self.frame_ID_offset = None
         self.flag_volumetric_imaging_started = False
+        # the partially filled stack goes back to the pool
+        if self.image_stack is not None:
+            self.volume_buffer_pool.hand_off(self.image_stack,0)
+            self.image_stack = None
+
+    def release_volume(self,image_stack):
+        # called by the consumers of packet_image_to_write/packet_image_stack_to_display when they are done with a stack
+        self.volume_buffer_pool.release(image_stack)
 
     def on_new_frame(self, camera):
 
@@ -267,16 +621,45 @@ class VolumetricImagingStreamHandler(QObject):
         if self.flag_volumetric_imaging_started and self.flag_first_image:
             self.flag_first_image = False
             self.frame_ID_offset = camera.frame_ID
-            self.focus_measure_num_points = min(int(np.ceil(self.number_of_planes_per_volume/2))+1,self.number_of_planes_per_volume)
-            self.focus_measure_index = np.linspace(-1,1,self.focus_measure_num_points)
+            self.volume_ID = None
+            self.lens_sweep_model.anchor = None
+            self.update_plane_positions()
             self.focus_measure = np.zeros(self.focus_measure_num_points)
-            self.image_stack = np.empty([self.number_of_planes_per_volume,image_height,image_width]).astype(np.uint8)
+            self.volume_buffer_pool.configure((self.number_of_planes_per_volume,)+image_cropped.shape,image_cropped.dtype)
 
         # set frame ID - when self.frame_ID_offset is None, it means volumetric imaging has stopped
         if self.frame_ID_offset is not None:
             self.frame_ID = camera.frame_ID - self.frame_ID_offset
-            self.plane_ID = self.frame_ID%self.number_of_planes_per_volume
-            self.image_stack[self.plane_ID,:,:] = image_cropped
+            # check the frame against the triggers reported by the trigger controller
+            if self.frame_verifier is not None and self.flag_volumetric_imaging_started:
+                self.frame_verifier.register_frame(camera.frame_ID,camera.timestamp)
+            if VolumetricZ.PLANE_ASSIGNMENT == 'timestamp' and self.lens_sweep_model.is_scanning():
+                volume_ID, self.plane_ID = self.lens_sweep_model.assign(camera.timestamp)
+            else:
+                volume_ID, self.plane_ID = divmod(self.frame_ID,self.number_of_planes_per_volume)
+            flag_new_volume = volume_ID != self.volume_ID
+            if flag_new_volume:
+                # a volume whose last plane was not received is handed off when the next one starts
+                if self.volume_ID is not None and self.flag_volumetric_imaging_started and self.flag_volume_completed == False:
+                    self.complete_volume()
+                self.volume_ID = volume_ID
+                self.flag_volume_completed = False
+            self.last_frame_ID_of_volume = self.frame_ID
+            if self.flag_volume_completed:
+                # extra frame of a volume that has been handed off (timestamp jitter)
+                pass
+            elif self.image_stack is None and self.volume_ID_dropped != volume_ID:
+                self.volume_timestamp = camera.timestamp
+                self.image_stack = self.volume_buffer_pool.acquire()
+                if self.image_stack is None:
+                    self.volume_ID_dropped = volume_ID
+                    print('no free volume buffer, volume ' + str(volume_ID) + ' dropped (' + str(self.volume_buffer_pool.n_overflows) + ' dropped so far)')
+            if self.image_stack is not None:
+                self.image_stack[self.plane_ID] = image_cropped
+            if self.volume_projector is not None and self.flag_volume_completed == False:
+                if flag_new_volume or self.volume_projector.n_planes_added == 0:
+                    self.volume_projector.reset(image_cropped.shape[:2],image_cropped.dtype,self.number_of_planes_per_volume)
+                self.volume_projector.add_plane(image_cropped,self.plane_ID)
         else:
             self.frame_ID = camera.frame_ID
 
@@ -284,38 +667,26 @@ class VolumetricImagingStreamHandler(QObject):
 
         # calculate focus measure when volumetric imaging is enabled
         if self.flag_calculate_focus_measure and self.frame_ID_offset is not None:
+            if flag_new_volume:
+                self.focus_fit.reset()
+                self.flag_defocus_reported = False
             if self.plane_ID < self.focus_measure_num_points: 
-                # calculate focus measure
-                self.focus_measure[self.plane_ID] = image_processing.calculate_focus_measure(image_cropped)
+                # calculate focus measure (on the ROI around the tracked object) and update the fit of focus measure vs plane
+                self.focus_measure[self.plane_ID] = self.focus_measure_engine.measure(image_cropped,self.get_focus_roi(image_cropped.shape[1],image_cropped.shape[0]))
+                self.focus_fit.add(self.focus_measure_index[self.plane_ID],self.focus_measure[self.plane_ID])
+                # report the defocus as soon as the fitted peak is bracketed by the planes acquired so far
+                if self.flag_defocus_reported == False and self.focus_fit.n >= VolumetricFocus.MIN_PLANES_FOR_ESTIMATE and self.focus_fit.is_peak_bracketed(VolumetricFocus.PEAK_MARGIN):
+                    self.report_defocus(camera.timestamp)
             if self.plane_ID == self.focus_measure_num_points-1:
                 self.signal_focus_measure_plot.emit(self.focus_measure_index,self.focus_measure)
-                # calculate defocus
-                self.defocus = np.sum(np.multiply(self.focus_measure_index,self.focus_measure))/np.sum(self.focus_measure)
-                self.signal_defocus.emit(self.defocus)
-                print('defocus: ' + str(self.defocus) + ' sum of focus measure: ' + str(np.sum(self.focus_measure)) )
-                # focus tracking
-                if self.flag_focus_tracking:
-                    self.tracking_controller.track_focus = True
-                    self.tracking_controller.focus_error = self.defocus*(-1)
-                    # to do: add an adjustable scaling factor - this scaling factor depends on the liquid lens scan amplitude and objective being used
-                else:
-                    self.tracking_controller.track_focus = False
-                    self.tracking_controller.focus_error = 0
-
-        # check if camera has registered requested number of frames
-        if self.flag_volumetric_imaging_started and self.number_of_requested_frames!=0 and self.frame_ID>=(self.number_of_requested_frames-1):
-            self.reset()
-            self.signal_volumetric_imaging_completed.emit()
+                if self.flag_defocus_reported == False:
+                    self.report_defocus(camera.timestamp)
 
         # measure real fps
-        timestamp_now = round(time.time())
-        if timestamp_now == self.timestamp_last:
-            self.counter = self.counter+1
-        else:
-            self.timestamp_last = timestamp_now
-            self.fps_real = self.counter
-            self.counter = 0
+        if self.rate_meter.tick():
+            self.fps_real = round(self.rate_meter.get_rate(),1)
             self.signal_fps.emit(self.fps_real)
+            self.signal_frame_statistics.emit(self.rate_meter.get_jitter_ms(), self.rate_meter.n_dropped)
 
         # send image to display
         time_now = time.time()
@@ -324,12 +695,13 @@ class VolumetricImagingStreamHandler(QObject):
             self.image_to_display.emit(image_cropped)
             self.timestamp_last_display = time_now
 
-        # send image to array display
+        # send image to array display (the volume is displayed with its projections)
         # time_now = time.time()
         # if time_now-self.timestamp_last_array_display >= 1/5:
             # self.packet_image_for_array_display.emit(image_cropped,self.plane_ID)
             # self.timestamp_last_array_display = time_now
-        self.packet_image_for_array_display.emit(image_cropped,self.plane_ID)
+        if self.receivers(self.packet_image_for_array_display) > 0:
+            self.packet_image_for_array_display.emit(image_cropped,self.plane_ID)
 
         '''
         # send image to write
@@ -339,16 +711,39 @@ class VolumetricImagingStreamHandler(QObject):
             self.packet_image_to_write.emit(image_cropped,camera.frame_ID,self.plane_ID,camera.timestamp)
         '''
 
-        # send the image stack to display/save
-        if self.flag_volumetric_imaging_started and self.plane_ID == self.number_of_planes_per_volume-1:
-            # save z-stack
-            if self.flag_save_images:
-                self.packet_image_to_write.emit(self.image_stack,self.frame_ID)
-            self.packet_image_stack_to_display.emit(self.image_stack)
+        # send the image stack and its projections to display/save
+        if self.flag_volumetric_imaging_started and self.frame_ID_offset is not None and self.plane_ID == self.number_of_planes_per_volume-1 and self.flag_volume_completed == False:
+            self.complete_volume()
+
+        # check if camera has registered requested number of frames (after the last volume has been handed off)
+        if self.flag_volumetric_imaging_started and self.number_of_requested_frames!=0 and self.frame_ID>=(self.number_of_requested_frames-1):
+            self.reset()
+            self.signal_volumetric_imaging_completed.emit()
 
         self.handler_busy = False
         camera.image_locked = False
 
+    def complete_volume(self):
+        self.flag_volume_completed = True
+        if self.image_stack is not None:
+            # hand the stack off to the saver and the display - each of them calls release_volume when done with it
+            image_stack = self.image_stack
+            self.image_stack = None
+            flag_display = self.receivers(self.packet_image_stack_to_display) > 0
+            self.volume_buffer_pool.hand_off(image_stack,int(self.flag_save_images)+int(flag_display))
+            # save z-stack
+            if self.flag_save_images:
+                self.packet_image_to_write.emit(image_stack,self.last_frame_ID_of_volume,self.volume_timestamp,self.plane_currents_mA)
+            if flag_display:
+                self.packet_image_stack_to_display.emit(image_stack)
+        # projections, once per volume
+        if self.volume_projector is not None and self.volume_projector.n_planes_added > 0:
+            projections = self.volume_projector.get_projections()
+            self.volume_projector.n_planes_added = 0
+            self.packet_projections.emit(*projections,self.last_frame_ID_of_volume)
+            if self.flag_save_images and VolumeProjection.SAVE:
+                self.packet_projections_to_write.emit(projections,self.last_frame_ID_of_volume,self.volume_timestamp)
+
     def start_recording(self):
         self.flag_save_images = True
 
@@ -359,9 +754,19 @@ class VolumetricImagingStreamHandler(QObject):
         pass
 
 class VolumetricImagingImageSaver(QObject):
+    '''
+    Appends the volumes to BigTIFF files (base_path/experiment_ID/volumes_#####.tif, a new file every
+    VolumeWriting.MAX_FILE_SIZE_GB) from a background thread, and writes one row per volume to volumes.csv:
+    file, index of the volume in the file, volume ID, frame ID of its last plane, timestamp of its first plane
+    and the liquid lens settings, and planes.csv with the lens current and z of the planes (a new table whenever
+    they change; with VolumetricZ.RESAMPLE_UNIFORM, the uniformly spaced planes written). Uncompressed volumes are stored contiguously (one series of shape
+    (volumes, planes, height, width) per file); with VolumeWriting.COMPRESSION, each volume is a series of
+    its own, with its strips compressed by VolumeWriting.N_WORKERS threads.
+    '''
 
     stop_recording = Signal()
     imageName = Signal(str, str)
+    signal_volume_released = Signal(np.ndarray) # the stack has been written (or discarded) - connect to VolumetricImagingStreamHandler.release_volume
 
     def __init__(self,internal_state,image_format='tif'):
         QObject.__init__(self)
@@ -369,14 +774,24 @@ class VolumetricImagingImageSaver(QObject):
         self.image_format = image_format
         self.base_path = './'
         self.experiment_ID = ''
-        self.max_num_image_per_folder = 1000
-        self.queue = Queue(200) # max 200 items in the queue
+        self.compression = VolumeWriting.COMPRESSION
+        self.n_workers = VolumeWriting.N_WORKERS
+        self.max_file_size = VolumeWriting.MAX_FILE_SIZE_GB*1e9
+        self.queue = Queue(VolumeWriting.QUEUE_SIZE)
         self.image_lock = Lock()
         self.stop_signal_received = False
+        self.tiff_writer = None
+        self.projection_writers = {} # 'mip', 'min', 'depth' -> TiffWriter
+        self.index_file = None
+        self.plane_currents_mA = None # lens current of the planes of the last volume written
+        self.flag_resample_uniform = VolumetricZ.RESAMPLE_UNIFORM
+        self.file_counter = 0
+        self.volume_counter_in_file = 0
+        self.file_size = 0
         self.thread = Thread(target=self.process_queue)
         self.thread.start()
         self.counter = 0
-        self.liquid_lens_settings = ''
+        self.liquid_lens_settings = (0,0,0,0) # current_mA_min, current_mA_max, frequency_Hz, phase_delay
 
     def process_queue(self):
         while True:
@@ -384,52 +799,146 @@ class VolumetricImagingImageSaver(QObject):
             if self.stop_signal_received:
                 return
             # process the queue
-            if self.queue.empty() == False:
-                try:
-                    [image,frame_ID] = self.queue.get(timeout=0.1)
-                    self.image_lock.acquire(True)
-                    folder_ID = int(self.counter/self.max_num_image_per_folder)
-                    file_ID = int(self.counter%self.max_num_image_per_folder)
-                    # create a new folder
-                    if file_ID == 0:
-                        os.mkdir(os.path.join(self.base_path,self.experiment_ID,str(folder_ID)))
-                    saving_path = os.path.join(self.base_path,self.experiment_ID,str(folder_ID),str(file_ID) + '_' + str(frame_ID) + '.tif')
-                    tif.imwrite(saving_path, image, imagej=True)
-                    # cv2.imwrite(saving_path,image)
-                    self.counter = self.counter + 1
-                    self.queue.task_done()
-                    self.image_lock.release()
-                except:
-                    print('error occurred during processing image saving')
-                    pass
-            else:
-                time.sleep(0.001)
-                            
-    def enqueue(self,image,frame_ID):
+            try:
+                [image,frame_ID,timestamp,plane_currents_mA] = self.queue.get(timeout=0.1)
+            except:
+                continue
+            try:
+                self.image_lock.acquire(True)
+                if image is None:
+                    # end of a recording
+                    self._close_files()
+                elif isinstance(image,tuple):
+                    self._write_projections(image)
+                else:
+                    self._write_volume(image,frame_ID,timestamp,plane_currents_mA)
+            except:
+                print('error occurred during processing image saving')
+            finally:
+                self.image_lock.release()
+                self.queue.task_done()
+                if isinstance(image,np.ndarray):
+                    self.signal_volume_released.emit(image)
+
+    def _write_projections(self,projections):
+        # one contiguous series per projection, in the order of the volumes in volumes.csv
+        for name,projection in zip(('mip','min','depth'),projections):
+            if name not in self.projection_writers:
+                self.projection_writers[name] = tif.TiffWriter(os.path.join(self.base_path,self.experiment_ID,name + '.tif'),bigtiff=True)
+            self.projection_writers[name].write(projection,contiguous=True,photometric='rgb' if projection.ndim == 3 else 'minisblack')
+
+    def _write_volume(self,image,frame_ID,timestamp,plane_currents_mA):
+        if self.flag_resample_uniform:
+            image,plane_currents_mA = resample_volume_uniform(image,plane_currents_mA)
+        # start a new file when the current one is full
+        if self.tiff_writer is not None and self.file_size + image.nbytes > self.max_file_size:
+            self._close_tiff_writer()
+        if self.tiff_writer is None:
+            self.file_name = 'volumes_' + '{:05d}'.format(self.file_counter) + '.tif'
+            self.tiff_writer = tif.TiffWriter(os.path.join(self.base_path,self.experiment_ID,self.file_name),bigtiff=True)
+            self.file_counter = self.file_counter + 1
+            self.volume_counter_in_file = 0
+            self.file_size = 0
+        if self.index_file is None:
+            # appended to when volumes arrive after the end of the recording
+            index_path = os.path.join(self.base_path,self.experiment_ID,'volumes.csv')
+            flag_new_index = not os.path.exists(index_path)
+            self.index_file = open(index_path,'a')
+            if flag_new_index:
+                self.index_file.write('file,volume_in_file,volume_ID,frame_ID,timestamp,current_mA_min,current_mA_max,frequency_Hz,phase_delay\n')
+        if self.compression is None:
+            self.tiff_writer.write(image,contiguous=True,photometric='minisblack')
+        else:
+            self.tiff_writer.write(image,photometric='minisblack',compression=self.compression,compressionargs={'level':VolumeWriting.COMPRESSION_LEVEL},
+                rowsperstrip=VolumeWriting.ROWS_PER_STRIP,maxworkers=self.n_workers)
+        self.index_file.write(self.file_name + ',' + str(self.volume_counter_in_file) + ',' + str(self.counter) + ',' + str(frame_ID) + ',' + '{:.6f}'.format(timestamp) + ','
+            + ','.join(str(setting) for setting in self.liquid_lens_settings) + '\n')
+        self.index_file.flush()
+        # lens current and z of the planes, from this volume on
+        if self.plane_currents_mA is None or not np.array_equal(plane_currents_mA,self.plane_currents_mA):
+            self.plane_currents_mA = np.array(plane_currents_mA)
+            self._write_planes(self.counter,plane_currents_mA)
+        self.file_size = self.file_size + image.nbytes
+        self.volume_counter_in_file = self.volume_counter_in_file + 1
+        self.counter = self.counter + 1
+
+    def _write_planes(self,volume_ID,plane_currents_mA):
+        path = os.path.join(self.base_path,self.experiment_ID,'planes.csv')
+        flag_new_file = not os.path.exists(path)
+        with open(path,'a') as f:
+            if flag_new_file:
+                f.write('from_volume_ID,plane,current_mA,z_um\n')
+            center = (self.liquid_lens_settings[0] + self.liquid_lens_settings[1])/2
+            for plane,current_mA in enumerate(plane_currents_mA):
+                f.write(str(volume_ID) + ',' + str(plane) + ',' + '{:.4f}'.format(current_mA) + ',' + '{:.4f}'.format((current_mA - center)*VolumetricZ.UM_PER_MA) + '\n')
+
+    def _close_tiff_writer(self):
+        if self.tiff_writer is not None:
+            self.tiff_writer.close()
+            self.tiff_writer = None
+
+    def _close_files(self):
+        self._close_tiff_writer()
+        for writer in self.projection_writers.values():
+            writer.close()
+        self.projection_writers = {}
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+    def enqueue(self,image,frame_ID,timestamp,plane_currents_mA):
         try:
-            self.queue.put_nowait([image,frame_ID])
+            self.queue.put_nowait([image,frame_ID,timestamp,plane_currents_mA])
             # when using self.queue.put(str_), program can be slowed down despite multithreading because of the block and the GIL
         except:
             print('imageSaver queue is full, image discarded')
+            self.signal_volume_released.emit(image)
+
+    def enqueue_projections(self,projections,frame_ID,timestamp):
+        try:
+            self.queue.put_nowait([projections,frame_ID,timestamp,None])
+        except:
+            print('imageSaver queue is full, projections discarded')
+
+    def finish_recording(self):
+        # the files are closed after the volumes already in the queue have been written
+        try:
+            self.queue.put([None,-1,0,None],timeout=1)
+        except:
+            print('imageSaver queue is full, the volume files will be closed with the next recording')
+
+    def set_liquid_lens_settings(self,current_mA_min,current_mA_max,frequency_Hz,phase_delay):
+        # written to volumes.csv with the volumes enqueued from now on
+        self.liquid_lens_settings = (current_mA_min,current_mA_max,frequency_Hz,phase_delay)
 
     def set_base_path(self,path):
         self.base_path = path
 
     def start_a_new_folder(self,experiment_ID=''):
+        # volumes of the previous recording still in the queue go to the previous files
+        self.queue.join()
         # generate unique experiment ID
         if 'experiment_ID' in self.internal_state.data.keys():
-            self.experiment_ID = self.internal_state.data['experiment_ID'] + '_3D[' + datetime.now().strftime('%Y-%m-%d %H-%M-%-S.%f') + ']' 
+            new_experiment_ID = self.internal_state.data['experiment_ID'] + '_3D[' + datetime.now().strftime('%Y-%m-%d %H-%M-%-S.%f') + ']' 
         else:
             self.internal_state.data['experiment_ID'] = self.experiment_ID
-            self.experiment_ID = experiment_ID + '_' + datetime.now().strftime('%Y-%m-%d %H-%M-%-S.%f') + '_3D'
+            new_experiment_ID = experiment_ID + '_' + datetime.now().strftime('%Y-%m-%d %H-%M-%-S.%f') + '_3D'
         # create a new folder
         try:
-            os.mkdir(os.path.join(self.base_path,self.experiment_ID))
+            os.mkdir(os.path.join(self.base_path,new_experiment_ID))
         except:
             print('making a new folder failed')
             pass
-        # reset the counter
-        self.counter = 0
+        # switch to the new folder and reset the counters at once, so that no volume is written with the
+        # volume ID or file name of the previous recording
+        with self.image_lock:
+            self._close_files()
+            self.experiment_ID = new_experiment_ID
+            self.file_counter = 0
+            self.volume_counter_in_file = 0
+            self.file_size = 0
+            self.plane_currents_mA = None
+            self.counter = 0
 
     # not used - for compatability with standard stream handler
     def set_recording_time_limit(self,time_limit):
@@ -439,7 +948,49 @@ class VolumetricImagingImageSaver(QObject):
         self.queue.join()
         self.stop_signal_received = True
         self.thread.join()
+        self._close_files()
+
+
+class VolumeProjectionDisplayWindow(QMainWindow):
 
+    def __init__(self, window_title=''):
+        super().__init__()
+        self.setWindowTitle(window_title)
+        self.setWindowFlags(self.windowFlags() | Qt.CustomizeWindowHint)
+        self.setWindowFlags(self.windowFlags() & ~Qt.WindowCloseButtonHint)
+        self.widget = QWidget()
+
+        # interpret image data as row-major instead of col-major
+        pg.setConfigOptions(imageAxisOrder='row-major')
+
+        self.sub_windows = []
+        layout = QGridLayout()
+        for i,title in enumerate(['maximum intensity','minimum intensity','depth coded']):
+            self.sub_windows.append(pg.GraphicsLayoutWidget())
+            self.sub_windows[i].view = self.sub_windows[i].addViewBox(enableMouse=True)
+            self.sub_windows[i].img = pg.ImageItem(border='w')
+            self.sub_windows[i].view.setAspectLocked(True)
+            self.sub_windows[i].view.addItem(self.sub_windows[i].img)
+            layout.addWidget(QLabel(title), 0, i)
+            layout.addWidget(self.sub_windows[i], 1, i)
+        self.widget.setLayout(layout)
+        self.setCentralWidget(self.widget)
+        self.shape = None
+
+        # set window size
+        desktopWidget = QDesktopWidget();
+        width = int(min(desktopWidget.width()*0.9,1500))
+        self.setFixedSize(width,int(width/3)+50)
+
+    def display_projections(self,mip,min_projection,depth_coded,frame_ID=-1):
+        self.sub_windows[0].img.setImage(mip,autoLevels=False)
+        self.sub_windows[1].img.setImage(min_projection,autoLevels=False)
+        self.sub_windows[2].img.setImage(depth_coded,autoLevels=False)
+        # the view range only needs to change with the image size
+        if mip.shape != self.shape:
+            self.shape = mip.shape
+            for sub_window in self.sub_windows:
+                sub_window.view.autoRange(padding=0)
 
 class ImageArrayDisplayWindow(QMainWindow):
 
@@ -21,13 +21,16 @@ import control.widgets_volumetric_imaging as widgets_volumetric_imaging
 import control.camera as camera_Daheng
 import control.core as core
 import control.core_tracking as core_tracking
+import control.core_headless as core_headless
+import control.core_pid_tuning as core_pid_tuning
+import control.latency_tracing as latency_tracing
 if VOLUMETRIC_IMAGING:
 	import control.core_volumetric_imaging as core_volumetric_imaging
 import control.microcontroller as microcontroller
 
 class GUI(QMainWindow):
 
-	def __init__(self, simulation = False, *args, **kwargs):
+	def __init__(self, simulation = False, replay_path = None, replay_realtime = True, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		
 		self.setWindowTitle('Squid-tracking v3.0')
@@ -49,10 +52,29 @@ class GUI(QMainWindow):
 		#------------------------------------------------------------------
 		self.internal_state = core_tracking.InternalState()
 
-		if simulation is True:
-			# Define a camera object for each unique image-stream.
-			self.camera = {key:camera_Daheng.Camera_Simulation() for key in self.imaging_channels}
+		self.replayed_channels = []
+		if replay_path is not None:
+			# stream a recorded experiment (or a video file for the tracking channel) with a simulated stage
+			import control.camera_replay as camera_replay
 			self.microcontroller = microcontroller.Microcontroller_Simulation()
+			self.camera = {}
+			for key in self.imaging_channels:
+				if os.path.isdir(os.path.join(replay_path,key)) or (key == TRACKING and not os.path.isdir(os.path.join(replay_path,TRACKING))):
+					self.camera[key] = camera_replay.Camera(replay_path, imaging_channel = key, realtime = replay_realtime, color = CAMERAS[key]['is_color'])
+					self.replayed_channels.append(key)
+				else:
+					self.camera[key] = camera_Daheng.Camera_Simulation(width = CAMERAS[key]['px_format'][0], height = CAMERAS[key]['px_format'][1])
+		elif simulation is True:
+			self.microcontroller = microcontroller.Microcontroller_Simulation()
+			# Define a camera object for each unique image-stream, all imaging the same simulated organisms.
+			import control.scene_simulation as scene_simulation
+			trajectories = scene_simulation.OrganismTrajectories()
+			self.camera = {}
+			for key in self.imaging_channels:
+				width, height = CAMERAS[key]['px_format']
+				scene = scene_simulation.SceneSimulation(width, height, microcontroller = self.microcontroller, trajectories = trajectories, 
+					flip_image = CAMERAS[key]['flip image'], imaging_channel = key, log_ground_truth = SimulatedScene.LOG_GROUND_TRUTH and key == TRACKING)
+				self.camera[key] = camera_Daheng.Camera_Simulation(width = width, height = height, scene = scene)
 		else:
 			self.camera = {}
 			for key in self.imaging_channels:
@@ -78,8 +100,13 @@ class GUI(QMainWindow):
 					is_polarization = False
 			else:
 				is_polarization = False
+			if key in self.replayed_channels:
+				# recorded images are already rotated and flipped
+				rotate_image_angle, flip_image = 0, None
+			else:
+				rotate_image_angle, flip_image = CAMERAS[key]['rotate image angle'], CAMERAS[key]['flip image']
 			self.streamHandler[key] = core.StreamHandler(camera = self.camera[key], crop_width = CAMERAS[key]['px_format'][0], crop_height= CAMERAS[key]['px_format'][1], imaging_channel = key, 
-                rotate_image_angle = CAMERAS[key]['rotate image angle'], flip_image = CAMERAS[key]['flip image'], is_polarization_camera = is_polarization)
+                rotate_image_angle = rotate_image_angle, flip_image = flip_image, is_polarization_camera = is_polarization)
 			# load image saver
 			self.imageSaver[key] = core_tracking.ImageSaver(self.internal_state, imaging_channel = key, image_format = IMAGE_FORMAT)
 
@@ -89,6 +116,12 @@ class GUI(QMainWindow):
 		self.microcontroller.set_callback(self.stateUpdater.read_microcontroller)
 		self.trackingController = core_tracking.TrackingController(self.navigationController,self.microcontroller,self.internal_state)
 		self.trackingDataSaver = core_tracking.TrackingDataSaver(self.internal_state)
+		self.pidAutoTuningController = core_pid_tuning.PIDAutoTuningController(self.trackingController,self.navigationController,self.microcontroller,simulation=simulation)
+		# per-frame latency tracing: camera callback -> preprocessing -> tracker -> PID -> serial write -> acknowledgement
+		self.latencyTracer = latency_tracing.LatencyTracer() if LatencyTracing.ENABLED else None
+		self.streamHandler[TRACKING].latency_tracer = self.latencyTracer
+		self.trackingController.latency_tracer = self.latencyTracer
+		self.microcontroller.latency_tracer = self.latencyTracer
 		
 		#------------------------------------------------------------------
 		# load widgets
@@ -97,10 +130,12 @@ class GUI(QMainWindow):
 		self.liveControlWidget = widgets.LiveControlWidget(self.streamHandler[TRACKING],self.liveController, self.internal_state)
 		self.navigationWidget = widgets_tracking.NavigationWidget(self.navigationController, self.internal_state)
 		self.trackingControlWidget = widgets_tracking.TrackingControllerWidget(self.streamHandler[TRACKING], self.trackingController, self.trackingDataSaver, self.internal_state, self.imageDisplayWindow[TRACKING], self.microcontroller)
-		self.PID_Group_Widget = widgets_tracking.PID_Group_Widget(self.trackingController)
+		self.PID_Group_Widget = widgets_tracking.PID_Group_Widget(self.trackingController,self.pidAutoTuningController)
 		self.recordingControlWidget = widgets.RecordingWidget(self.streamHandler,self.imageSaver, self.internal_state, self.trackingDataSaver, self.imaging_channels)			
 		self.plotWidget = widgets.dockAreaPlot(self.internal_state)
 		self.ledMatrixControlWidget = widgets.LEDMatrixControlWidget(self.microcontroller)
+		if self.latencyTracer is not None:
+			self.latencyWidget = widgets_tracking.LatencyWidget(self.latencyTracer)
 		
 		self.liveSettings_Tab = QTabWidget()
 		self.liveSettings_Tab.addTab(self.liveControlWidget, 'Live controller')
@@ -117,6 +152,7 @@ class GUI(QMainWindow):
 			self.streamHandler[channel].packet_image_to_write.connect(self.imageSaver[channel].enqueue)
 			self.imageSaver[channel].imageName.connect(self.trackingDataSaver.setImageName)
 			self.streamHandler[channel].signal_fps_save.connect(self.recordingControlWidget.update_save_fps)
+			self.liveController[channel].signal_expected_fps.connect(self.streamHandler[channel].set_expected_fps)
 
 		# Connections that involve only the tracking image stream
 		self.streamHandler[TRACKING].thresh_image_to_display.connect(self.imageDisplayWindow_ThresholdedImage.display_image)
@@ -133,6 +169,7 @@ class GUI(QMainWindow):
 
 		for channel in self.imaging_channels:
 			self.streamHandler[channel].signal_fps.connect(self.cameraSettingsWidget[channel].update_stream_fps)
+			self.streamHandler[channel].signal_frame_statistics.connect(self.cameraSettingsWidget[channel].update_frame_statistics)
 		self.trackingController.get_roi_bbox.connect(self.imageDisplayWindow[TRACKING].send_bbox)
 		self.imageDisplayWindow[TRACKING].roi_bbox.connect(self.trackingController.tracker_image.set_roi_bbox)
 		self.trackingControlWidget.show_roi.connect(self.imageDisplayWindow[TRACKING].toggle_ROI_selector)
@@ -176,13 +213,37 @@ class GUI(QMainWindow):
 		thresholded_image_dock.addWidget(self.imageDisplayWindow_ThresholdedImage.widget)	
 		'''		
 
+		#-----------------------------------------------------------------------------------------------
+		# Synchronized acquisition
+		#-----------------------------------------------------------------------------------------------
+		if SynchronizedAcquisition.ENABLED:
+			self.synchronizedLiveController = core.SynchronizedLiveController({key:self.camera[key] for key in SynchronizedAcquisition.CHANNELS},self.microcontroller)
+			self.framePairer = core.FramePairer()
+			self.synchronizedAcquisitionWidget = widgets.SynchronizedAcquisitionWidget(self.synchronizedLiveController,self.framePairer,self.liveController)
+			for key in SynchronizedAcquisition.CHANNELS:
+				# simulated cameras: wire their trigger input to the simulated microcontroller
+				if hasattr(self.microcontroller,'connect_trigger_input') and hasattr(self.camera[key],'on_hardware_trigger'):
+					self.microcontroller.connect_trigger_input(self.camera[key].on_hardware_trigger,SynchronizedAcquisition.TRIGGER_OUTPUT_CHANNEL)
+				self.synchronizedLiveController.signal_expected_fps.connect(self.streamHandler[key].set_expected_fps)
+				if TWO_CAMERA_PDAF:
+					# pair the PDAF ROIs (see PDAF below)
+					self.streamHandler[key].packet_image_for_PDAF.connect(self.framePairer.register_frame)
+				else:
+					self.streamHandler[key].pairing_enabled = True
+					self.streamHandler[key].packet_image_for_pairing.connect(self.framePairer.register_frame)
+			self.synchronizedLiveController.signal_acquisition_started.connect(self.framePairer.start)
+			self.synchronizedLiveController.signal_acquisition_stopped.connect(self.framePairer.stop)
+			self.framePairer.signal_pairing_statistics.connect(self.synchronizedAcquisitionWidget.update_pairing_statistics)
+
 		#-----------------------------------------------------------------------------------------------
 		# PDAF
 		#-----------------------------------------------------------------------------------------------
 		if TWO_CAMERA_PDAF:
 			import control.core_PDAF as core_PDAF
 			self.PDAFController = core_PDAF.PDAFController(self.trackingController)
-			self.PDAFControllerWidget = widgets_tracking.PDAFControllerWidget(self.PDAFController)
+			self.PDAFCalibrationController = core_PDAF.TwoCamerasPDAFCalibrationController(self.camera['DF1'],self.camera['DF2'],self.navigationController,self.liveController['DF1'],self.liveController['DF2'],
+				streamHandler1=self.streamHandler['DF1'],streamHandler2=self.streamHandler['DF2'],PDAFController=self.PDAFController,internal_state=self.internal_state)
+			self.PDAFControllerWidget = widgets_tracking.PDAFControllerWidget(self.PDAFController,self.PDAFCalibrationController)
 			self.imageDisplayWindow['PDAF_image1'] = core.ImageDisplayWindow(key + ' Display', DrawCrossHairs = True) 
 			self.imageDisplayWindow['PDAF_image2'] = core.ImageDisplayWindow(key + ' Display', DrawCrossHairs = True) 
 			# add docked imaged display
@@ -192,9 +253,17 @@ class GUI(QMainWindow):
 			PDAF_image2_dock = dock.Dock('PDAF_image2', autoOrientation = False)
 			image_display_dockArea.addDock(PDAF_image2_dock, 'right', PDAF_image1_dock)
 			PDAF_image2_dock.addWidget(self.imageDisplayWindow['PDAF_image2'].widget)
-			# make connections
-			self.streamHandler['DF1'].image_to_display.connect(self.PDAFController.register_image_from_camera_1) 
-			self.streamHandler['DF2'].image_to_display.connect(self.PDAFController.register_image_from_camera_2) 
+			# make connections - the stream handlers send the ROI around the tracked object from every frame
+			self.PDAFController.set_stream_handlers(self.streamHandler['DF1'],self.streamHandler['DF2'])
+			self.trackingController.Rect_pt1_pt2.connect(self.PDAFController.update_roi)
+			self.trackingController.signal_stop_tracking.connect(self.PDAFController.clear_roi)
+			if SynchronizedAcquisition.ENABLED:
+				# ROIs of DF1 and DF2 from the same trigger
+				self.framePairer.signal_paired_frames.connect(self.PDAFController.register_image_pair)
+			else:
+				# direct connections: the ROIs are handed over to the PDAF thread from the camera threads
+				self.streamHandler['DF1'].packet_image_for_PDAF.connect(self.PDAFController.register_image_from_camera_1,Qt.DirectConnection)
+				self.streamHandler['DF2'].packet_image_for_PDAF.connect(self.PDAFController.register_image_from_camera_2,Qt.DirectConnection)
 			self.PDAFController.signal_image1.connect(self.imageDisplayWindow['PDAF_image1'].display_image)
 			self.PDAFController.signal_image2.connect(self.imageDisplayWindow['PDAF_image2'].display_image)
 
@@ -204,10 +273,15 @@ class GUI(QMainWindow):
 		import control.trigger_controller as trigger_controller
 		import control.optotune_lens as optotune_lens
 		if VOLUMETRIC_IMAGING:
-			self.liquid_lens = optotune_lens.optotune_lens()
+			if simulation:
+				self.liquid_lens = optotune_lens.optotune_lens_Simulation()
+			else:
+				self.liquid_lens = optotune_lens.optotune_lens()
 			if USE_SEPARATE_TRIGGER_CONTROLLER:
 				if simulation:
 					self.trigger_controller = trigger_controller.TriggerController_Simulation(TRIGGERCONTROLLER_SERIAL_NUMBER) 
+					if hasattr(self.camera['volumetric imaging'],'on_hardware_trigger'):
+						self.trigger_controller.connect_trigger_input(self.camera['volumetric imaging'].on_hardware_trigger)
 				else:
 					self.trigger_controller = trigger_controller.TriggerController(TRIGGERCONTROLLER_SERIAL_NUMBER) 
 			else:
@@ -216,24 +290,33 @@ class GUI(QMainWindow):
 			self.VolumetricImagingImageSaver = core_volumetric_imaging.VolumetricImagingImageSaver(self.internal_state)
 			self.volumetricImagingController = core_volumetric_imaging.VolumetricImagingController(self.camera['volumetric imaging'],
 				self.trigger_controller,self.liquid_lens,self.volumetricImagingStreamHandler,self.VolumetricImagingImageSaver,self.internal_state)
+			# focus tracking with the liquid lens (volumetric or PDAF focus errors), the stage offloads the lens
+			self.lensFocusController = core_headless.LiquidLensFocusController(self.liquid_lens)
+			self.volumetricImagingController.set_lens_focus_controller(self.lensFocusController)
+			self.trackingController.lens_focus_controller = self.lensFocusController
+			self.trackingController.signal_stop_tracking.connect(self.lensFocusController.reset)
 			self.volumetricImagingWidget = widgets_volumetric_imaging.VolumetricImagingWidget(self.volumetricImagingController)
 			self.streamHandler['volumetric imaging'] = self.volumetricImagingStreamHandler
 			self.imageSaver['volumetric imaging'].close()
 			self.imageSaver['volumetric imaging'] = self.VolumetricImagingImageSaver
 			self.focusMeasureDisplayWindow = widgets_volumetric_imaging.FocusMeasureDisplayWindow()
 			self.focusMeasureDisplayWindow.show()
-			self.imageArrayDisplayWindow = core_volumetric_imaging.ImageArrayDisplayWindow() 
-			self.imageArrayDisplayWindow.show()
-			self.volumetricImagingStreamHandler.packet_image_for_array_display.connect(self.imageArrayDisplayWindow.display_image)
+			self.volumeProjectionDisplayWindow = core_volumetric_imaging.VolumeProjectionDisplayWindow('Volume Projections')
+			self.volumeProjectionDisplayWindow.show()
+			self.volumetricImagingStreamHandler.packet_projections.connect(self.volumeProjectionDisplayWindow.display_projections)
+			self.volumetricImagingStreamHandler.packet_projections_to_write.connect(self.VolumetricImagingImageSaver.enqueue_projections)
 			self.volumetricImagingStreamHandler.signal_focus_measure_plot.connect(self.focusMeasureDisplayWindow.plotWidget.plot)
 			if simulation == False:
 				# in simulation mode, do not change camera trigger mode (for now) or no new image would be delivered, as the trigger timer is in the livecontroller
 				# to do: add a tigger timer in the simulation camera object for simulating hardware trigger
 				self.volumetricImagingController.signal_trigger_mode.connect(self.cameraSettingsWidget['volumetric imaging'].set_trigger_mode)
 			self.volumetricImagingStreamHandler.signal_defocus.connect(self.volumetricImagingWidget.display_defocus.display)
+			self.trackingController.Rect_pt1_pt2.connect(self.volumetricImagingStreamHandler.set_focus_roi)
+			self.trackingController.signal_stop_tracking.connect(self.volumetricImagingStreamHandler.clear_focus_roi)
 			self.streamHandler['volumetric imaging'].signal_new_frame_received.connect(self.liveController[channel].on_new_frame)
 			self.streamHandler['volumetric imaging'].image_to_display.connect(self.imageDisplayWindow[channel].display_image)
 			self.streamHandler['volumetric imaging'].packet_image_to_write.connect(self.imageSaver[channel].enqueue)
+			self.imageSaver['volumetric imaging'].signal_volume_released.connect(self.volumetricImagingStreamHandler.release_volume,Qt.DirectConnection)
 			self.imageSaver['volumetric imaging'].imageName.connect(self.trackingDataSaver.setImageName)
 			self.streamHandler['volumetric imaging'].signal_fps_save.connect(self.recordingControlWidget.update_save_fps)
 
@@ -244,11 +327,15 @@ class GUI(QMainWindow):
 		# self.SettingsTab.addTab(self.PID_Group_Widget, 'PID')
 		if TWO_CAMERA_PDAF:
 			self.SettingsTab.addTab(self.PDAFControllerWidget, 'PDAF')
+		if SynchronizedAcquisition.ENABLED:
+			self.SettingsTab.addTab(self.synchronizedAcquisitionWidget, 'Synchronized Acquisition')
 		if VOLUMETRIC_IMAGING:
 			self.SettingsTab.addTab(self.volumetricImagingWidget, 'Volumetric Imaging')
 		self.SettingsTab.addTab(self.navigationWidget, 'Stage Control')
 		self.SettingsTab.addTab(self.ledMatrixControlWidget, 'LED Matrix')
 		self.SettingsTab.addTab(self.plotWidget, 'Plots')
+		if self.latencyTracer is not None:
+			self.SettingsTab.addTab(self.latencyWidget, 'Latency')
 
 		layout_left = QVBoxLayout()
 		layout_left.addWidget(self.liveSettings_Tab)
@@ -277,6 +364,9 @@ class GUI(QMainWindow):
 			self.camera[channel].set_callback(self.streamHandler[channel].on_new_frame)
 			self.camera[channel].enable_callback()
 			self.camera[channel].start_streaming()
+		for channel in self.replayed_channels:
+			# replay in continuous mode so that the recorded timestamps (or max speed) set the frame rate
+			self.cameraSettingsWidget[channel].set_trigger_mode(TriggerMode.CONTINUOUS)
 		self.image_window.show()
 
 	# @@@ TO DO
@@ -299,19 +389,23 @@ class GUI(QMainWindow):
 			QMessageBox.No, QMessageBox.Yes)
 		if reply == QMessageBox.Yes:
 			self.image_window.close()
+			if SynchronizedAcquisition.ENABLED:
+				self.synchronizedLiveController.stop_live()
 			for key in self.imaging_channels:
 				self.liveController[key].stop_live()
 				self.camera[key].close()
 				self.imageSaver[key].close()
 				self.imageDisplayWindow[key].close()
 			if TWO_CAMERA_PDAF:
+				self.PDAFController.close()
 				self.imageDisplayWindow['PDAF_image1'].close()
 				self.imageDisplayWindow['PDAF_image2'].close()
 			if VOLUMETRIC_IMAGING and USE_SEPARATE_TRIGGER_CONTROLLER:
 				self.trigger_controller.close()
 			if VOLUMETRIC_IMAGING:
+				self.liquid_lens.close()
 				self.focusMeasureDisplayWindow.close()
-				self.imageArrayDisplayWindow.close()
+				self.volumeProjectionDisplayWindow.close()
 			self.trackingDataSaver.close()
 			self.imageDisplayWindow_ThresholdedImage.close()
 			self.microcontroller.close()
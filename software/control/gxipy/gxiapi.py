@@ -3,6 +3,8 @@
 # -*-mode:python ; tab-width:4 -*- ex:set tabstop=4 shiftwidth=4 expandtab: -*-
 
 import numpy
+import threading
+import weakref
 from control.gxipy.gxwrapper import *
 from control.gxipy.dxwrapper import *
 from control.gxipy.gxidef import *
@@ -927,7 +929,8 @@ class Buffer:
         return self.data_array
 
     def get_numpy_array(self):
-        numpy_array = numpy.array(self.data_array)
+        # view of the ctypes array (no copy)
+        numpy_array = numpy.frombuffer(self.data_array, dtype=numpy.ubyte)
         return numpy_array
 
     def get_length(self):
@@ -952,6 +955,7 @@ class Device:
         self.__py_capture_callback = None
         self.__CaptureCallBack = None
         self.__user_param = None
+        self.__buffer_pool = None
 
         # ---------------Device Information Section--------------------------
         self.DeviceVendorName = StringFeature(self.__dev_handle, GxFeatureID.STRING_DEVICE_VENDOR_NAME)
@@ -1204,6 +1208,16 @@ class Device:
         self.__py_offline_callback()
 
 
+    def set_buffer_pool(self, buffer_pool):
+        """
+        :brief      Images delivered by the capture callback and get_image use buffers of this pool (see BufferPool)
+        :param      buffer_pool:    BufferPool object, None: allocate a new buffer for each image
+        :return:    none
+        """
+        self.__buffer_pool = buffer_pool
+        for data_stream in self.data_stream:
+            data_stream.buffer_pool = buffer_pool
+
     def register_capture_callback(self, user_param, cap_call):
         """
         :brief      Register the capture event callback function.
@@ -1240,7 +1254,7 @@ class Device:
         frame_data.frame_id = capture_data.contents.frame_id
         frame_data.timestamp = capture_data.contents.timestamp
         frame_data.buf_id = capture_data.contents.frame_id
-        image = RawImage(frame_data)
+        image = RawImage(frame_data, self.__buffer_pool)
         self.__py_capture_callback(self.__user_param, image)
 
 
@@ -1306,6 +1320,7 @@ class DataStream:
         self.StreamDeliveredPacketCount = IntFeature(self.__dev_handle, GxFeatureID.INT_DELIVERED_PACKET_COUNT)
         self.payload_size = 0
         self.acquisition_flag = False
+        self.buffer_pool = None
 
     def set_payload_size(self, payload_size):
         self.payload_size = payload_size
@@ -1351,7 +1366,7 @@ class DataStream:
         frame_data = GxFrameData()
         frame_data.image_size = self.payload_size
         frame_data.image_buf = None
-        image = RawImage(frame_data)
+        image = RawImage(frame_data, self.buffer_pool)
 
         status = gx_get_image(self.__dev_handle, image.frame_data, timeout)
         if status == GxStatusList.SUCCESS:
@@ -1609,12 +1624,58 @@ class StatusProcessor:
             print(error_message)
 
 
+class BufferPool:
+    """
+    Reusable image buffers for the zero-copy path of RawImage and RGBImage (opt-in, see Device.set_buffer_pool).
+    acquire() hands out a ctypes array that does not own its memory; the memory goes back to the pool when the
+    last object referring to that array (the image object, numpy arrays and their views) has been released,
+    so consumers only need to drop their references to a frame.
+    """
+    def __init__(self, max_free_buffers=4):
+        self.max_free_buffers = max_free_buffers
+        self.__free_buffers = {}    # size -> list of buffers
+        self.__lock = threading.Lock()
+        self.allocated_count = 0
+        self.reused_count = 0
+
+    def acquire(self, size):
+        """
+        :brief      Get a buffer of size bytes
+        :param      size:   buffer size
+        :return:    ctypes c_ubyte array
+        """
+        with self.__lock:
+            free_buffers = self.__free_buffers.get(size)
+            if free_buffers:
+                buffer = free_buffers.pop()
+                self.reused_count += 1
+            else:
+                buffer = (c_ubyte * size)()
+                self.allocated_count += 1
+        lease = (c_ubyte * size).from_address(addressof(buffer))
+        weakref.finalize(lease, self.__release, buffer)
+        return lease
+
+    def __release(self, buffer):
+        with self.__lock:
+            free_buffers = self.__free_buffers.setdefault(len(buffer), [])
+            if len(free_buffers) < self.max_free_buffers:
+                free_buffers.append(buffer)
+
+    def get_free_buffer_count(self):
+        with self.__lock:
+            return sum(len(free_buffers) for free_buffers in self.__free_buffers.values())
+
+
 class RGBImage:
-    def __init__(self, frame_data):
+    def __init__(self, frame_data, buffer_pool=None):
         self.frame_data = frame_data
 
         if self.frame_data.image_buf is not None:
             self.__image_array = string_at(self.frame_data.image_buf, self.frame_data.image_size)
+        elif buffer_pool is not None:
+            self.__image_array = buffer_pool.acquire(self.frame_data.image_size)
+            self.frame_data.image_buf = addressof(self.__image_array)
         else:
             self.__image_array = (c_ubyte * self.frame_data.image_size)()
             self.frame_data.image_buf = addressof(self.__image_array)
@@ -1675,15 +1736,32 @@ class RGBImage:
 
 
 class RawImage:
-    def __init__(self, frame_data):
+    def __init__(self, frame_data, buffer_pool=None):
         self.frame_data = frame_data
+        self.__buffer_pool = buffer_pool
 
         if self.frame_data.image_buf is not None:
-            self.__image_array = string_at(self.frame_data.image_buf, self.frame_data.image_size)
+            if buffer_pool is None:
+                self.__image_array = string_at(self.frame_data.image_buf, self.frame_data.image_size)
+            else:
+                # zero-copy path: the driver buffer is copied (once, into a pooled buffer) only if the raw data
+                # is requested - conversions read the driver buffer directly. The driver buffer is only valid
+                # in the capture callback, so the raw data has to be requested there.
+                self.__image_array = None
+        elif buffer_pool is not None:
+            self.__image_array = buffer_pool.acquire(self.frame_data.image_size)
+            self.frame_data.image_buf = addressof(self.__image_array)
         else:
             self.__image_array = (c_ubyte * self.frame_data.image_size)()
             self.frame_data.image_buf = addressof(self.__image_array)
 
+    def __get_image_array(self):
+        if self.__image_array is None:
+            self.__image_array = self.__buffer_pool.acquire(self.frame_data.image_size)
+            memmove(self.__image_array, self.frame_data.image_buf, self.frame_data.image_size)
+            self.frame_data.image_buf = addressof(self.__image_array)
+        return self.__image_array
+
     def __get_bit_depth(self, pixel_format):
         """
         :brief      Calculate pixel depth based on pixel format
@@ -1798,7 +1876,7 @@ class RawImage:
         frame_data.timestamp = self.frame_data.timestamp
         # frame_data.buf_id = self.frame_data.buf_id
         frame_data.image_buf = None
-        image_raw8 = RawImage(frame_data)
+        image_raw8 = RawImage(frame_data, self.__buffer_pool)
 
         status = dx_raw16_to_raw8(self.frame_data.image_buf, image_raw8.frame_data.image_buf,
                                   self.frame_data.width, self.frame_data.height, valid_bits)
@@ -1830,7 +1908,7 @@ class RawImage:
         frame_data.timestamp = raw8_image.frame_data.timestamp
         # frame_data.buf_id = self.frame_data.buf_id
         frame_data.image_buf = None
-        image_rgb = RGBImage(frame_data)
+        image_rgb = RGBImage(frame_data, self.__buffer_pool)
 
         status = dx_raw8_to_rgb24(raw8_image.frame_data.image_buf, image_rgb.frame_data.image_buf,
                                   raw8_image.frame_data.width, raw8_image.frame_data.height,
@@ -1927,10 +2005,10 @@ class RawImage:
         image_size = self.frame_data.width * self.frame_data.height
 
         if self.frame_data.pixel_format & PIXEL_BIT_MASK == GX_PIXEL_8BIT:
-            image_np = numpy.frombuffer(self.__image_array, dtype=numpy.ubyte, count=image_size).\
+            image_np = numpy.frombuffer(self.__get_image_array(), dtype=numpy.ubyte, count=image_size).\
                 reshape(self.frame_data.height, self.frame_data.width)
         elif self.frame_data.pixel_format & PIXEL_BIT_MASK == GX_PIXEL_16BIT:
-            image_np = numpy.frombuffer(self.__image_array, dtype=numpy.uint16, count=image_size).\
+            image_np = numpy.frombuffer(self.__get_image_array(), dtype=numpy.uint16, count=image_size).\
                 reshape(self.frame_data.height, self.frame_data.width)
         else:
             image_np = None
@@ -1942,7 +2020,7 @@ class RawImage:
         :brief      get Raw data
         :return:    raw data[string]
         """
-        image_str = string_at(self.__image_array, self.frame_data.image_size)
+        image_str = string_at(self.__get_image_array(), self.frame_data.image_size)
         return image_str
 
     def save_raw(self, file_path):
@@ -1957,7 +2035,7 @@ class RawImage:
 
         try:
             fp = open(file_path, "wb")
-            fp.write(self.__image_array)
+            fp.write(self.__get_image_array())
             fp.close()
         except Exception as error:
             raise UnexpectedError("RawImage.save_raw:%s" % error)
@@ -0,0 +1,96 @@
+'''
+Per-frame latency tracing from the camera callback to the motor command acknowledgement.
+Each frame gets a row in a fixed-size ring; the stages of the tracking pipeline stamp the row with
+time.perf_counter() (monotonic). The microcontroller stamps the row of the frame whose motion
+command it wrote, and the row of the frame whose command id comes back in a status packet.
+'''
+import time
+import numpy as np
+from threading import Lock
+
+from control._def import *
+
+STAGES = ['camera_callback','preprocessed','tracked','pid','command_written','ack_received']
+
+class LatencyTracer(object):
+
+    def __init__(self, n_frames = LatencyTracing.N_FRAMES):
+        self.n_frames = n_frames
+        self.timestamps = np.full((n_frames,len(STAGES)),np.nan)
+        self.frame_IDs = np.full(n_frames,-1,dtype=np.int64)
+        self.counter = 0 # number of frames traced
+        self.lock = Lock()
+        # row of the frame that is sending motion commands, set by the tracking controller
+        self.active_index = -1
+        # command id -> row, for the commands waiting for their acknowledgement
+        self.pending_acks = {}
+
+    def begin_frame(self, frame_ID):
+        # called from the camera callback - returns the row for the following stamps
+        timestamp = time.perf_counter()
+        with self.lock:
+            index = self.counter % self.n_frames
+            self.counter = self.counter + 1
+            self.timestamps[index] = np.nan
+            self.timestamps[index,0] = timestamp
+            self.frame_IDs[index] = frame_ID
+        return index
+
+    def stamp(self, index, stage):
+        if index >= 0:
+            self.timestamps[index,STAGES.index(stage)] = time.perf_counter()
+
+    def set_active_frame(self, index):
+        self.active_index = index
+
+    def on_command_sent(self, cmd_id):
+        # called by the microcontroller after a command has been written to the serial port
+        index = self.active_index
+        if index >= 0:
+            self.stamp(index,'command_written')
+            # command ids wrap around at 256 - a newer command with the same id replaces the old one
+            self.pending_acks[cmd_id] = index
+
+    def on_packet_received(self, cmd_id):
+        # called by the microcontroller for each status packet; the first packet that echoes the
+        # command id of a traced command is its acknowledgement
+        index = self.pending_acks.pop(cmd_id,None)
+        if index is not None:
+            self.stamp(index,'ack_received')
+
+    def get_latencies_ms(self):
+        # latency of each stage relative to the camera callback, one row per traced frame (oldest first)
+        with self.lock:
+            n = min(self.counter,self.n_frames)
+            start = self.counter % self.n_frames if self.counter > self.n_frames else 0
+            order = (np.arange(n) + start) % self.n_frames
+            timestamps = self.timestamps[order].copy()
+            frame_IDs = self.frame_IDs[order].copy()
+        return frame_IDs, 1000*(timestamps - timestamps[:,:1])
+
+    def get_percentiles(self, percentiles = LatencyTracing.PERCENTILES):
+        # {stage: [percentiles in ms, number of frames]} - frames that did not reach a stage are left out
+        frame_IDs, latencies = self.get_latencies_ms()
+        result = {}
+        for i, stage in enumerate(STAGES[1:],1):
+            values = latencies[:,i]
+            values = values[~np.isnan(values)]
+            if len(values) > 0:
+                result[stage] = [list(np.percentile(values,percentiles)),len(values)]
+            else:
+                result[stage] = [[np.nan]*len(percentiles),0]
+        return result
+
+    def dump(self, path):
+        frame_IDs, latencies = self.get_latencies_ms()
+        header = ','.join(['frame_ID'] + [stage + ' (ms)' for stage in STAGES[1:]])
+        data = np.column_stack([frame_IDs,latencies[:,1:]])
+        np.savetxt(path,data,delimiter=',',header=header,comments='',fmt=['%d'] + ['%.3f']*(len(STAGES)-1))
+        print('latency trace of ' + str(len(frame_IDs)) + ' frames written to ' + path)
+
+    def reset(self):
+        with self.lock:
+            self.timestamps[:] = np.nan
+            self.frame_IDs[:] = -1
+            self.counter = 0
+            self.pending_acks = {}
@@ -5,14 +5,11 @@ import serial.tools.list_ports
 import time
 import numpy as np
 import threading
+from collections import deque
 from crc import CrcCalculator, Crc8
 
 from control._def import *
 
-from qtpy.QtCore import *
-from qtpy.QtWidgets import *
-from qtpy.QtGui import *
-
 # add user to the dialout group to avoid the need to use sudo
 
 # done (7/20/2021) - remove the time.sleep in all functions (except for __init__) to 
@@ -24,6 +21,34 @@ from qtpy.QtGui import *
 class Microcontroller():    
     def __init__(self,version='Arduino Due',sn=None,parent=None):
         self.serial = None
+        self._init_state()
+
+        print('connecting to controller based on ' + version)
+
+        if version =='Arduino Due':
+            controller_ports = [p.device for p in serial.tools.list_ports.comports() if 'Arduino Due' == p.description] # autodetect - based on Deepak's code
+        else:
+            if sn is not None:
+                controller_ports = [ p.device for p in serial.tools.list_ports.comports() if sn == p.serial_number]
+            else:
+                if sys.platform == 'win32':
+                    controller_ports = [ p.device for p in serial.tools.list_ports.comports() if p.manufacturer == 'Microsoft']
+                else:
+                    controller_ports = [ p.device for p in serial.tools.list_ports.comports() if p.manufacturer == 'Teensyduino']
+
+        if not controller_ports:
+            raise IOError("no controller found")
+        if len(controller_ports) > 1:
+            print('multiple controller found - using the first')
+        
+        self.serial = serial.Serial(controller_ports[0],2000000)
+        time.sleep(0.2)
+        print('controller connected')
+
+        self._start_reading()
+
+    def _init_state(self):
+        # shared with Microcontroller_Simulation
         self.platform_name = platform.system()
         self.tx_buffer_length = MicrocontrollerDef.CMD_LENGTH
         self.rx_buffer_length = MicrocontrollerDef.MSG_LENGTH
@@ -49,33 +74,16 @@ class Microcontroller():
         self.crc_calculator = CrcCalculator(Crc8.CCITT,table_based=True)
         self.retry = 0
 
-        print('connecting to controller based on ' + version)
-
-        if version =='Arduino Due':
-            controller_ports = [p.device for p in serial.tools.list_ports.comports() if 'Arduino Due' == p.description] # autodetect - based on Deepak's code
-        else:
-            if sn is not None:
-                controller_ports = [ p.device for p in serial.tools.list_ports.comports() if sn == p.serial_number]
-            else:
-                if sys.platform == 'win32':
-                    controller_ports = [ p.device for p in serial.tools.list_ports.comports() if p.manufacturer == 'Microsoft']
-                else:
-                    controller_ports = [ p.device for p in serial.tools.list_ports.comports() if p.manufacturer == 'Teensyduino']
-
-        if not controller_ports:
-            raise IOError("no controller found")
-        if len(controller_ports) > 1:
-            print('multiple controller found - using the first')
-        
-        self.serial = serial.Serial(controller_ports[0],2000000)
-        time.sleep(0.2)
-        print('controller connected')
-
+    def _start_reading(self):
+        # after the serial link is open
         self.new_packet_callback_external = None
+        self.latency_tracer = None
+        # commands are sent from the GUI, tracking and trigger threads
+        self.send_command_lock = threading.Lock()
         self.terminate_reading_received_packet_thread = False
         self.thread_read_received_packet = threading.Thread(target=self.read_received_packet, daemon=True)
         self.thread_read_received_packet.start()
-        
+
     def close(self):
         self.terminate_reading_received_packet_thread = True
         self.thread_read_received_packet.join()
@@ -594,21 +602,25 @@ class Microcontroller():
         self.set_pin_level(MCU_PINS.AF_LASER,0)
 
     def send_command(self,command):
-        self._cmd_id = (self._cmd_id + 1)%256
-        command[0] = self._cmd_id
-        command[-1] = self.crc_calculator.calculate_checksum(command[:-1])
-        self.serial.write(command)
-        self.mcu_cmd_execution_in_progress = True
-        self.last_command = command
-        self.timeout_counter = 0
-        self.last_command_timestamp = time.time()
-        self.retry = 0
+        with self.send_command_lock:
+            self._cmd_id = (self._cmd_id + 1)%256
+            command[0] = self._cmd_id
+            command[-1] = self.crc_calculator.calculate_checksum(command[:-1])
+            self.serial.write(command)
+            self.mcu_cmd_execution_in_progress = True
+            self.last_command = command
+            self.timeout_counter = 0
+            self.last_command_timestamp = time.time()
+            self.retry = 0
+            if self.latency_tracer is not None:
+                self.latency_tracer.on_command_sent(self._cmd_id)
 
     def resend_last_command(self):
-        self.serial.write(self.last_command)
-        self.mcu_cmd_execution_in_progress = True
-        self.timeout_counter = 0
-        self.retry = self.retry + 1
+        with self.send_command_lock:
+            self.serial.write(self.last_command)
+            self.mcu_cmd_execution_in_progress = True
+            self.timeout_counter = 0
+            self.retry = self.retry + 1
 
     def read_received_packet(self):
         while self.terminate_reading_received_packet_thread == False:
@@ -644,6 +656,8 @@ class Microcontroller():
             '''
             self._cmd_id_mcu = msg[0]
             self._cmd_execution_status = msg[1]
+            if self.latency_tracer is not None:
+                self.latency_tracer.on_packet_received(self._cmd_id_mcu)
             if (self._cmd_id_mcu == self._cmd_id) and (self._cmd_execution_status == CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS):
                 if self.mcu_cmd_execution_in_progress == True:
                     self.mcu_cmd_execution_in_progress = False
@@ -730,404 +744,272 @@ class Microcontroller():
         cmd[2] = int(factor)
         self.send_command(cmd)
 
-class Microcontroller_Simulation():
-    def __init__(self,parent=None):
-        self.serial = None
-        self.platform_name = platform.system()
-        self.tx_buffer_length = MicrocontrollerDef.CMD_LENGTH
-        self.rx_buffer_length = MicrocontrollerDef.MSG_LENGTH
-
-        self._cmd_id = 0
-        self._cmd_id_mcu = None # command id of mcu's last received command 
-        self._cmd_execution_status = None
-        self.mcu_cmd_execution_in_progress = False
-
-        self.x_pos = 0 # unit: microstep or encoder resolution
-        self.y_pos = 0 # unit: microstep or encoder resolution
-        self.z_pos = 0 # unit: microstep or encoder resolution
-        self.theta_pos = 0 # unit: microstep or encoder resolution
-        self.button_and_switch_state = 0
-        self.joystick_button_pressed = 0
-        self.signal_joystick_button_pressed_event = False
-        self.switch_state = 0
-
-         # for simulation
-        self.timestamp_last_command = time.time() # for simulation only
-        self._mcu_cmd_execution_status = None
-        self.timer_update_command_execution_status = QTimer()
-        self.timer_update_command_execution_status.timeout.connect(self._simulation_update_cmd_execution_status)
-
-        self.new_packet_callback_external = None
-        self.terminate_reading_received_packet_thread = False
-        self.thread_read_received_packet = threading.Thread(target=self.read_received_packet, daemon=True)
-        self.thread_read_received_packet.start()
+class Microcontroller_Simulation(Microcontroller):
+    '''
+    Uses the same command encoding and packet parsing as Microcontroller, but talks to a
+    simulated MCU (Stage_Simulation) through a simulated serial link (Serial_Simulation)
+    so that stage dynamics and communication delays show up in simulation mode.
+    '''
+    def __init__(self,parent=None,status_rate_Hz=MicrocontrollerSimulationDef.STATUS_RATE_HZ,latency_s=MicrocontrollerSimulationDef.LATENCY_S,baudrate=MicrocontrollerSimulationDef.BAUDRATE):
+        self._init_state()
+        self.serial = Serial_Simulation(baudrate=baudrate,latency_s=latency_s)
+        self.stage_simulation = Stage_Simulation(self.serial,status_rate_Hz=status_rate_Hz)
+        print('connected to simulated controller')
+        self._start_reading()
 
-        self.crc_calculator = CrcCalculator(Crc8.CCITT,table_based=True)
+    def connect_trigger_input(self,callback,trigger_output_ch=0):
+        # wire a simulated camera's trigger input (callback(timestamp)) to a trigger output
+        self.stage_simulation.trigger_outputs.setdefault(trigger_output_ch,[]).append(callback)
 
     def close(self):
         self.terminate_reading_received_packet_thread = True
         self.thread_read_received_packet.join()
+        self.stage_simulation.close()
+        self.serial.close()
 
-    def reset(self):
-        self._cmd_id = 0
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.RESET
-        self.send_command(cmd)
-
-    def initialize_drivers(self):
-        self._cmd_id = 0
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.INITIALIZE
-        self.send_command(cmd)
-        print('initialize the drivers') # debug
-
-    def move_x_usteps(self,usteps):
-        self.x_pos = self.x_pos + STAGE_MOVEMENT_SIGN_X*usteps
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': move x')
-
-    def move_x_to_usteps(self,usteps):
-        self.x_pos = usteps
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': move x to')
-
-    def move_y_usteps(self,usteps):
-        self.y_pos = self.y_pos + STAGE_MOVEMENT_SIGN_Y*usteps
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': move y')
-
-    def move_y_to_usteps(self,usteps):
-        self.y_pos = usteps
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': move y to')
-
-    def move_z_usteps(self,usteps):
-        self.z_pos = self.z_pos + STAGE_MOVEMENT_SIGN_Z*usteps
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': move z')
-
-    def move_z_to_usteps(self,usteps):
-        self.z_pos = usteps
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': move z to')
-
-    def move_theta_usteps(self,usteps):
-        self.theta_pos = self.theta_pos + usteps
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-
-    def home_x(self):
-        self.x_pos = 0
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': home x')
-
-    def home_y(self):
-        self.y_pos = 0
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': home y')
-
-    def home_z(self):
-        self.z_pos = 0
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': home z')
-
-    def home_xy(self):
-        self.x_pos = 0
-        self.y_pos = 0
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': home xy')
-
-    def home_theta(self):
-        self.theta_pos = 0
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-
-    def zero_x(self):
-        self.x_pos = 0
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': zero x')
-
-    def zero_y(self):
-        self.y_pos = 0
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': zero y')
+class Serial_Simulation():
+    '''
+    pyserial-like link between the host and the simulated MCU. Data written by either side becomes
+    readable only after it has been shifted out at the set baudrate (10 bits per byte, transfers in
+    the same direction are serialized) and after the one-way USB latency. As with pyserial, read() waits
+    up to timeout seconds for the requested bytes (None: returns what has arrived).
+    '''
+    def __init__(self,baudrate=MicrocontrollerSimulationDef.BAUDRATE,latency_s=MicrocontrollerSimulationDef.LATENCY_S,timeout=None):
+        self.baudrate = baudrate
+        self.latency_s = latency_s
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.host_to_mcu = deque() # (arrival time, data)
+        self.mcu_to_host = deque() # (arrival time, data)
+        self.host_to_mcu_line_free_time = 0
+        self.mcu_to_host_line_free_time = 0
+        self.rx_buffer = bytearray() # bytes that have arrived at the host
+
+    def _transmit(self,queue,data,line_free_time):
+        t_sent = max(time.time(),line_free_time) + len(data)*10/self.baudrate
+        queue.append((t_sent+self.latency_s,bytes(data)))
+        return t_sent
+
+    def _receive(self,queue):
+        received = []
+        timestamp_now = time.time()
+        while queue and queue[0][0] <= timestamp_now:
+            received.append(queue.popleft()[1])
+        return received
+
+    # host side
+    def write(self,data):
+        with self.lock:
+            self.host_to_mcu_line_free_time = self._transmit(self.host_to_mcu,data,self.host_to_mcu_line_free_time)
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            for data in self._receive(self.mcu_to_host):
+                self.rx_buffer.extend(data)
+            n = len(self.rx_buffer)
+        if n == 0:
+            # Microcontroller.read_received_packet polls in_waiting - avoid spinning a core in simulation
+            time.sleep(0.0002)
+        return n
+
+    def read(self,size=1):
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+            while self.in_waiting < size and time.time() < deadline:
+                time.sleep(0.0002)
+        with self.lock:
+            data = bytes(self.rx_buffer[:size])
+            del self.rx_buffer[:size]
+        return data
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self._receive(self.mcu_to_host)
+            self.rx_buffer.clear()
 
-    def zero_z(self):
-        self.z_pos = 0
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': zero z')
+    def close(self):
+        pass
 
-    def zero_theta(self):
-        self.theta_pos = 0
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
+    # mcu side
+    def mcu_write(self,data):
+        with self.lock:
+            self.mcu_to_host_line_free_time = self._transmit(self.mcu_to_host,data,self.mcu_to_host_line_free_time)
 
-    def configure_stage_pid(self, axis, transitions_per_revolution, flip_direction=False):
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.CONFIGURE_STAGE_PID
-        cmd[2] = axis
-        cmd[3] = int(flip_direction)
-        payload = self._int_to_payload(transitions_per_revolution,2)
-        cmd[4] = (payload >> 8) & 0xff
-        cmd[5] = payload & 0xff
-        self.send_command(cmd)
+    def mcu_read(self):
+        with self.lock:
+            return self._receive(self.host_to_mcu)
 
-    def turn_on_stage_pid(self, axis):
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.ENABLE_STAGE_PID
-        cmd[2] = axis
-        self.send_command(cmd)
-
-    def turn_off_stage_pid(self, axis):
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.DISABLE_STAGE_PID
-        cmd[2] = axis
-        self.send_command(cmd)
+class Stage_Simulation():
+    '''
+    Simulated MCU firmware. Executes the commands received over a Serial_Simulation link, moves the
+    axes with trapezoidal velocity profiles limited by the max velocity and acceleration (set by
+    configure_actuators), and streams 24-byte status packets with encoder-quantized positions.
+    '''
+    def __init__(self,serial,status_rate_Hz=MicrocontrollerSimulationDef.STATUS_RATE_HZ,loop_interval_s=MicrocontrollerSimulationDef.LOOP_INTERVAL_S):
+        self.serial = serial
+        self.status_interval_s = 1.0/status_rate_Hz
+        self.loop_interval_s = loop_interval_s
+        self.crc_calculator = CrcCalculator(Crc8.CCITT,table_based=True)
 
-    def set_lim(self,limit_code,usteps):
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
+        # axes are indexed by AXIS.X, AXIS.Y, AXIS.Z and AXIS.THETA
+        self.pos = np.zeros(4) # unit: microstep
+        self.target = np.zeros(4) # unit: microstep
+        self.velocity = np.zeros(4) # unit: microstep/s
+        self.microstepping = [MICROSTEPPING_DEFAULT_X,MICROSTEPPING_DEFAULT_Y,MICROSTEPPING_DEFAULT_Z,MICROSTEPPING_DEFAULT_THETA]
+        self.fullsteps_per_rev = [FULLSTEPS_PER_REV_X,FULLSTEPS_PER_REV_Y,FULLSTEPS_PER_REV_Z,FULLSTEPS_PER_REV_THETA]
+        self.screw_pitch_mm = [SCREW_PITCH_X_MM,SCREW_PITCH_Y_MM,SCREW_PITCH_Z_MM,2*np.pi/GEAR_RATIO_THETA] # theta: rad per motor revolution
+        self.max_velocity_mm = [MAX_VELOCITY_X_mm,MAX_VELOCITY_Y_mm,MAX_VELOCITY_Z_mm,np.pi/GEAR_RATIO_THETA]
+        self.max_acceleration_mm = [MAX_ACCELERATION_X_mm,MAX_ACCELERATION_Y_mm,MAX_ACCELERATION_Z_mm,10*np.pi/GEAR_RATIO_THETA]
+        self.use_encoder = [USE_ENCODER_X,USE_ENCODER_Y,USE_ENCODER_Z,USE_ENCODER_THETA]
+        self.encoder_step_size = [ENCODER_STEP_SIZE_X_MM*ENCODER_SIGN_X*STAGE_POS_SIGN_X,ENCODER_STEP_SIZE_Y_MM*ENCODER_SIGN_Y*STAGE_POS_SIGN_Y,
+            ENCODER_STEP_SIZE_Z_MM*ENCODER_SIGN_Z*STAGE_POS_SIGN_Z,ENCODER_STEP_SIZE_THETA*ENCODER_SIGN_THETA*STAGE_POS_SIGN_THETA]
+
+        self.cmd_id = 0
+        self.cmd_execution_status = CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS
+        self.motion_in_progress = False
+
+        # trigger output channel -> trigger inputs of the cameras wired to it
+        self.trigger_outputs = {}
+
+        self.terminate_thread = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
-    def configure_motor_driver(self,axis,microstepping,current_rms,I_hold):
-        # current_rms in mA
-        # I_hold 0.0-1.0
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.CONFIGURE_STEPPER_DRIVER
-        cmd[2] = axis
-        if microstepping == 1:
-            cmd[3] = 0
-        elif microstepping == 256:
-            cmd[3] = 255 # max of uint8 is 255 - will be changed to 255 after received by the MCU
+    def close(self):
+        self.terminate_thread = True
+        self.thread.join()
+
+    def run(self):
+        timestamp_last = time.time()
+        timestamp_last_status = timestamp_last
+        while self.terminate_thread == False:
+            for data in self.serial.mcu_read():
+                self._execute_command(data)
+            timestamp_now = time.time()
+            self._update_motion(timestamp_now - timestamp_last)
+            timestamp_last = timestamp_now
+            if self.motion_in_progress and not np.any(self.velocity) and np.all(self.pos == self.target):
+                self.motion_in_progress = False
+                self.cmd_execution_status = CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS
+            if timestamp_now - timestamp_last_status >= self.status_interval_s:
+                timestamp_last_status = timestamp_now
+                self.serial.mcu_write(self._get_status_packet())
+            time.sleep(self.loop_interval_s)
+
+    def _get_mm_per_ustep(self,axis):
+        return self.screw_pitch_mm[axis]/(self.fullsteps_per_rev[axis]*self.microstepping[axis])
+
+    def _execute_command(self,cmd):
+        self.cmd_id = cmd[0]
+        if self.crc_calculator.calculate_checksum(cmd[:-1]) != cmd[-1]:
+            self.cmd_execution_status = CMD_EXECUTION_STATUS.CMD_CHECKSUM_ERROR
+            return
+        self.cmd_execution_status = CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS
+        cmd_type = cmd[1]
+        if cmd_type in (CMD_SET.MOVE_X,CMD_SET.MOVE_Y,CMD_SET.MOVE_Z,CMD_SET.MOVE_THETA):
+            axis = cmd_type - CMD_SET.MOVE_X
+            self.target[axis] = self.target[axis] + self._payload_to_int(cmd[2:6],4)
+            self._start_motion()
+        elif cmd_type in (CMD_SET.MOVETO_X,CMD_SET.MOVETO_Y,CMD_SET.MOVETO_Z):
+            axis = cmd_type - CMD_SET.MOVETO_X
+            self.target[axis] = self._payload_to_int(cmd[2:6],4)
+            self._start_motion()
+        elif cmd_type == CMD_SET.HOME_OR_ZERO:
+            axes = [AXIS.X,AXIS.Y] if cmd[2] == AXIS.XY else [cmd[2]]
+            for axis in axes:
+                if cmd[3] == HOME_OR_ZERO.ZERO:
+                    self.pos[axis] = 0
+                    self.target[axis] = 0
+                else:
+                    # the home switch is placed at the origin
+                    self.target[axis] = 0
+            if cmd[3] != HOME_OR_ZERO.ZERO:
+                self._start_motion()
+        elif cmd_type == CMD_SET.SET_MAX_VELOCITY_ACCELERATION:
+            axis = cmd[2]
+            self.max_velocity_mm[axis] = ((cmd[3] << 8) + cmd[4])/100
+            self.max_acceleration_mm[axis] = ((cmd[5] << 8) + cmd[6])/10
+        elif cmd_type == CMD_SET.SET_LEAD_SCREW_PITCH:
+            axis = cmd[2]
+            self.screw_pitch_mm[axis] = ((cmd[3] << 8) + cmd[4])/1000
+        elif cmd_type == CMD_SET.CONFIGURE_STEPPER_DRIVER:
+            axis = cmd[2]
+            # keep the position in mm when the microstepping changes
+            microstepping = {0:1,255:256}.get(cmd[3],cmd[3])
+            scale = microstepping/self.microstepping[axis]
+            self.pos[axis] = self.pos[axis]*scale
+            self.target[axis] = self.target[axis]*scale
+            self.microstepping[axis] = microstepping
+        elif cmd_type == CMD_SET.SEND_HARDWARE_TRIGGER:
+            # one pulse on the output fires all the cameras wired to it
+            timestamp = time.time()
+            for callback in self.trigger_outputs.get(cmd[2] & 0x7f,[]):
+                callback(timestamp)
+        # all other commands complete upon reception
+
+    def _start_motion(self):
+        self.motion_in_progress = True
+        self.cmd_execution_status = CMD_EXECUTION_STATUS.IN_PROGRESS
+
+    def _update_motion(self,dt):
+        for axis in range(4):
+            remaining = self.target[axis] - self.pos[axis]
+            v = self.velocity[axis]
+            if remaining == 0 and v == 0:
+                continue
+            v_max = self.max_velocity_mm[axis]/self._get_mm_per_ustep(axis)
+            a_max = self.max_acceleration_mm[axis]/self._get_mm_per_ustep(axis)
+            direction = np.sign(remaining)
+            stopping_distance = v*v/(2*a_max)
+            if v*direction < 0 or stopping_distance < abs(remaining):
+                # accelerate toward the target (or reverse)
+                v = np.clip(v + direction*a_max*dt,-v_max,v_max)
+            else:
+                # decelerate
+                v = v - np.sign(v)*min(abs(v),a_max*dt)
+            pos = self.pos[axis] + v*dt
+            # arrive at the target (a real stepper stops on a whole step)
+            if (self.target[axis] - pos)*direction <= 0 or (v == 0 and abs(remaining) < 1):
+                pos = self.target[axis]
+                v = 0
+            self.pos[axis] = pos
+            self.velocity[axis] = v
+
+    def _get_reported_position(self,axis):
+        if self.use_encoder[axis]:
+            # quantized to the encoder resolution
+            return int(round(self.pos[axis]*self._get_mm_per_ustep(axis)/self.encoder_step_size[axis]))
         else:
-            cmd[3] = microstepping
-        cmd[4] = current_rms >> 8
-        cmd[5] = current_rms & 0xff
-        cmd[6] = int(I_hold*255)
-        self.send_command(cmd)
-
-    def set_max_velocity_acceleration(self,axis,velocity,acceleration):
-        # velocity: max 65535/100 mm/s
-        # acceleration: max 65535/10 mm/s^2
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.SET_MAX_VELOCITY_ACCELERATION
-        cmd[2] = axis
-        cmd[3] = int(velocity*100) >> 8
-        cmd[4] = int(velocity*100) & 0xff
-        cmd[5] = int(acceleration*10) >> 8
-        cmd[6] = int(acceleration*10) & 0xff
-        self.send_command(cmd)
-
-    def set_leadscrew_pitch(self,axis,pitch_mm):
-        # pitch: max 65535/1000 = 65.535 (mm)
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.SET_LEAD_SCREW_PITCH
-        cmd[2] = axis
-        cmd[3] = int(pitch_mm*1000) >> 8
-        cmd[4] = int(pitch_mm*1000) & 0xff
-        self.send_command(cmd)
-
-    def set_limit_switch_polarity(self,axis,polarity):
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.SET_LIM_SWITCH_POLARITY
-        cmd[2] = axis
-        cmd[3] = polarity
-        self.send_command(cmd)
-
-    def configure_actuators(self):
-        # lead screw pitch
-        self.set_leadscrew_pitch(AXIS.X,SCREW_PITCH_X_MM)
-        self.wait_till_operation_is_completed()
-        self.set_leadscrew_pitch(AXIS.Y,SCREW_PITCH_Y_MM)
-        self.wait_till_operation_is_completed()
-        self.set_leadscrew_pitch(AXIS.Z,SCREW_PITCH_Z_MM)
-        self.wait_till_operation_is_completed()
-        # stepper driver (microstepping,rms current and I_hold)
-        self.configure_motor_driver(AXIS.X,MICROSTEPPING_DEFAULT_X,X_MOTOR_RMS_CURRENT_mA,X_MOTOR_I_HOLD)
-        self.wait_till_operation_is_completed()
-        self.configure_motor_driver(AXIS.Y,MICROSTEPPING_DEFAULT_Y,Y_MOTOR_RMS_CURRENT_mA,Y_MOTOR_I_HOLD)
-        self.wait_till_operation_is_completed()
-        self.configure_motor_driver(AXIS.Z,MICROSTEPPING_DEFAULT_Z,Z_MOTOR_RMS_CURRENT_mA,Z_MOTOR_I_HOLD)
-        self.wait_till_operation_is_completed()
-        # max velocity and acceleration
-        self.set_max_velocity_acceleration(AXIS.X,MAX_VELOCITY_X_mm,MAX_ACCELERATION_X_mm)
-        self.wait_till_operation_is_completed()
-        self.set_max_velocity_acceleration(AXIS.Y,MAX_VELOCITY_Y_mm,MAX_ACCELERATION_Y_mm)
-        self.wait_till_operation_is_completed()
-        self.set_max_velocity_acceleration(AXIS.Z,MAX_VELOCITY_Z_mm,MAX_ACCELERATION_Z_mm)
-        self.wait_till_operation_is_completed()
-        # home switch
-        self.set_limit_switch_polarity(AXIS.X,X_HOME_SWITCH_POLARITY)
-        self.wait_till_operation_is_completed()
-        self.set_limit_switch_polarity(AXIS.Y,Y_HOME_SWITCH_POLARITY)
-        self.wait_till_operation_is_completed()
-        self.set_limit_switch_polarity(AXIS.Z,Z_HOME_SWITCH_POLARITY)
-        self.wait_till_operation_is_completed()
-
-    def analog_write_onboard_DAC(self,dac,value):
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.ANALOG_WRITE_ONBOARD_DAC
-        cmd[2] = dac
-        cmd[3] = (value >> 8) & 0xff
-        cmd[4] = value & 0xff
-        self.send_command(cmd)
-
-    def configure_dac80508_refdiv_and_gain(self, div, gains):
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.SET_DAC80508_REFDIV_GAIN
-        cmd[2] = div
-        cmd[3] = gains
-        self.send_command(cmd)
-
-    def read_received_packet(self):
-        while self.terminate_reading_received_packet_thread == False:
-            # only for simulation - update the command execution status
-            if time.time() - self.timestamp_last_command > 0.05: # in the simulation, assume all the operation takes 0.05s to complete
-                if self._mcu_cmd_execution_status !=  CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS:
-                    self._mcu_cmd_execution_status = CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS
-                    print('   mcu command ' + str(self._cmd_id) + ' complete')
-
-            # read and parse message
-            msg=[]
-            for i in range(self.rx_buffer_length):
-                msg.append(0)
-
-            msg[0] = self._cmd_id
-            msg[1] = self._mcu_cmd_execution_status
+            return int(self.pos[axis])
+
+    def _get_status_packet(self):
+        '''
+        - command ID (1 byte)
+        - execution status (1 byte)
+        - X pos (4 bytes)
+        - Y pos (4 bytes)
+        - Z pos (4 bytes)
+        - Theta (4 bytes)
+        - buttons and switches (1 byte)
+        - reserved (4 bytes)
+        - CRC (1 byte)
+        '''
+        msg = bytearray(MicrocontrollerDef.MSG_LENGTH)
+        msg[0] = self.cmd_id
+        msg[1] = self.cmd_execution_status
+        for axis in range(4):
+            payload = self._get_reported_position(axis)
+            if payload < 0:
+                payload = 2**32 + payload
+            msg[2+4*axis:6+4*axis] = int(payload).to_bytes(MicrocontrollerDef.N_BYTES_POS,'big')
+        msg[-1] = self.crc_calculator.calculate_checksum(msg[:-1])
+        return msg
 
-            self._cmd_id_mcu = msg[0]
-            self._cmd_execution_status = msg[1]
-            if (self._cmd_id_mcu == self._cmd_id) and (self._cmd_execution_status == CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS):
-                self.mcu_cmd_execution_in_progress = False
-            # print('mcu_cmd_execution_in_progress: ' + str(self.mcu_cmd_execution_in_progress))
-            
-            # self.x_pos = utils.unsigned_to_signed(msg[2:6],MicrocontrollerDef.N_BYTES_POS) # unit: microstep or encoder resolution
-            # self.y_pos = utils.unsigned_to_signed(msg[6:10],MicrocontrollerDef.N_BYTES_POS) # unit: microstep or encoder resolution
-            # self.z_pos = utils.unsigned_to_signed(msg[10:14],MicrocontrollerDef.N_BYTES_POS) # unit: microstep or encoder resolution
-            # self.theta_pos = utils.unsigned_to_signed(msg[14:18],MicrocontrollerDef.N_BYTES_POS) # unit: microstep or encoder resolution
-            
-            self.button_and_switch_state = msg[18]
-
-            if self.new_packet_callback_external is not None:
-                self.new_packet_callback_external(self)
-
-            time.sleep(0.005) # simulate MCU packet transmission interval
-
-    def turn_on_illumination(self):
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': turn on illumination')
-
-    def turn_off_illumination(self):
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': turn off illumination')
-
-    def set_illumination(self,illumination_source,intensity):
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': set illumination')
-
-    def set_illumination_led_matrix(self,illumination_source,r,g,b):
-        cmd = bytearray(self.tx_buffer_length)
-        self.send_command(cmd)
-        print('   mcu command ' + str(self._cmd_id) + ': set illumination (led matrix)')
-
-    def send_hardware_trigger(self,control_illumination=False,illumination_on_time_us=0,trigger_output_ch = 0):
-        illumination_on_time_us = int(illumination_on_time_us)
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.SEND_HARDWARE_TRIGGER
-        cmd[2] = (control_illumination<<7) + trigger_output_ch # MSB: whether illumination is controlled
-        cmd[3] = illumination_on_time_us >> 24
-        cmd[4] = (illumination_on_time_us >> 16) & 0xff
-        cmd[5] = (illumination_on_time_us >> 8) & 0xff
-        cmd[6] = illumination_on_time_us & 0xff
-        self.send_command(cmd)
-
-    def set_strobe_delay_us(self, strobe_delay_us, camera_channel=0):
-        print('set strobe delay')
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.SET_STROBE_DELAY
-        cmd[2] = camera_channel
-        cmd[3] = strobe_delay_us >> 24
-        cmd[4] = (strobe_delay_us >> 16) & 0xff
-        cmd[5] = (strobe_delay_us >> 8) & 0xff
-        cmd[6] = strobe_delay_us & 0xff
-        self.send_command(cmd)
-
-    def get_pos(self):
-        return self.x_pos, self.y_pos, self.z_pos, self.theta_pos
-
-    def get_button_and_switch_state(self):
-        return self.button_and_switch_state
-
-    def set_callback(self,function):
-        self.new_packet_callback_external = function
-
-    def is_busy(self):
-        return self.mcu_cmd_execution_in_progress
-
-    def set_pin_level(self,pin,level):
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.SET_PIN_LEVEL
-        cmd[2] = pin
-        cmd[3] = level
-        self.send_command(cmd)
-
-    def turn_on_AF_laser(self):
-        self.set_pin_level(MCU_PINS.AF_LASER,1)
-
-    def turn_off_AF_laser(self):
-        self.set_pin_level(MCU_PINS.AF_LASER,0)
-
-    def send_command(self,command):
-        self._cmd_id = (self._cmd_id + 1)%256
-        command[0] = self._cmd_id
-        command[-1] = self.crc_calculator.calculate_checksum(command[:-1])
-        self.mcu_cmd_execution_in_progress = True
-        # for simulation
-        self._mcu_cmd_execution_status = CMD_EXECUTION_STATUS.IN_PROGRESS
-        # self.timer_update_command_execution_status.setInterval(2000)
-        # self.timer_update_command_execution_status.start()
-        # print('start timer')
-        # timer cannot be started from another thread
-        self.timestamp_last_command = time.time()
-
-    def _simulation_update_cmd_execution_status(self):
-        # print('simulation - MCU command execution finished')
-        # self._mcu_cmd_execution_status = CMD_EXECUTION_STATUS.COMPLETED_WITHOUT_ERRORS
-        # self.timer_update_command_execution_status.stop()
-        pass # timer cannot be started from another thread
-
-    def wait_till_operation_is_completed(self, TIMEOUT_LIMIT_S=5):
-        timestamp_start = time.time()
-        while self.is_busy():
-            time.sleep(0.02)
-            if time.time() - timestamp_start > TIMEOUT_LIMIT_S:
-                print('Error - microcontroller timeout, the program will exit')
-                sys.exit(0)
-
-    def set_dac80508_scaling_factor_for_illumination(self, illumination_intensity_factor):
-        if illumination_intensity_factor > 1:
-            illumination_intensity_factor = 1
-
-        if illumination_intensity_factor < 0:
-            illumination_intensity_factor = 0.01
-
-        factor = illumination_intensity_factor * 100
-        cmd = bytearray(self.tx_buffer_length)
-        cmd[1] = CMD_SET.SET_ILLUMINATION_INTENSITY_FACTOR
-        cmd[2] = factor
-        self.send_command(cmd)
+    def _payload_to_int(self,payload,number_of_bytes):
+        signed = 0
+        for i in range(number_of_bytes):
+            signed = signed + int(payload[i])*(256**(number_of_bytes-1-i))
+        if signed >= 256**number_of_bytes/2:
+            signed = signed - 256**number_of_bytes
+        return signed
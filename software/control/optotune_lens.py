@@ -9,31 +9,22 @@ import serial
 import platform
 import sys
 import time
+import threading
 import numpy as np
 import warnings
 import serial.tools.list_ports
+from collections import deque
 from control._def import *
+from control.microcontroller import Serial_Simulation
 
 class optotune_lens:
 	# A class for serial control of optotune liquid lens
+	# Commands are queued and sent by an I/O thread, so the callers (GUI, focus tracking) never wait on the serial port.
+	# Current setpoints are coalesced: if several are waiting, only the latest is sent.
 
 	def __init__(self, freq = 0, amp = 0, offset = 0):
 
-		self.serialconn = None
-		self.lensConnected = False
-
-		self.freq = freq
-		self.amp = amp
-		self.offset = offset
-
-		# Scale factor to translate an amplitude (in microns) to a lower and upper value of current (in 12 bit int -4096 to 4096)
-		self.current_to_code_scalling_factor = 292.84/4095 # 292.84 mA for code 4095
-		self.current_range_min = -250
-		self.current_range_max = 250
-		self.op_range_min = -2
-		self.op_range_max = 3
-
-		self.current_mA = 0
+		self._init_state(freq, amp, offset)
 
 		# Auto-detect the lens-driver
 		for p in serial.tools.list_ports.comports():
@@ -52,53 +43,150 @@ class optotune_lens:
 		else:
 			print('Optotune lens driver found!')
 			self.lensConnected = True
-			self.serialconn = serial.Serial(lens_ports[0],115200)
-			self.serialconn.close()
-			self.serialconn.open()
-			time.sleep(2.0)
+			self.serialconn = serial.Serial(lens_ports[0],OptotuneLens.BAUDRATE,timeout=OptotuneLens.RESPONSE_TIMEOUT_S)
 			print('Serial Connection Open')
 
-			# Establish Connection to the lens driver
-			ok = self.handshake()
+		# the handshake is done by the I/O thread
+		self._start_io_thread()
 
-			if(ok):
-				self.default_mode = "Sinusoid"
-				self.mode = self.default_mode
-				self.freq = freq
-				self.amp = amp
-				self.offset = offset
+	def _init_state(self, freq, amp, offset):
 
-			else:
+		self.serialconn = None
+		self.lensConnected = False
+		self.handshake_done = False
+
+		self.freq = freq
+		self.amp = amp
+		self.offset = offset
+
+		# Scale factor to translate an amplitude (in microns) to a lower and upper value of current (in 12 bit int -4096 to 4096)
+		self.current_to_code_scalling_factor = 292.84/4095 # 292.84 mA for code 4095
+		self.current_range_min = -250
+		self.current_range_max = 250
+		self.op_range_min = -2
+		self.op_range_max = 3
+
+		self.current_mA = 0
+		self.current_mA_readback = None # updated by the I/O thread after request_current_readback()
+
+		self.default_mode = "Sinusoid"
+		self.mode = self.default_mode
+
+		# commands waiting for the I/O thread: (command with CRC, response length, name)
+		self.command_queue = deque()
+		self.command_lock = threading.Lock()
+		self.new_command_event = threading.Event()
+		self.stop_signal_received = False
+
+		self.n_commands_sent = 0
+		self.n_setpoints_coalesced = 0
+		self.n_commands_dropped = 0
+		self.n_timeouts = 0
+		self.n_crc_errors = 0
+
+	def _start_io_thread(self):
+		self.thread = threading.Thread(target=self.process_commands)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def close(self):
+		self.stop_signal_received = True
+		self.new_command_event.set()
+		self.thread.join()
+		if self.serialconn is not None:
+			self.serialconn.close()
+
+	def process_commands(self):
+		if self.lensConnected:
+			# Establish Connection to the lens driver
+			if not self.handshake():
 				warnings.warn("Connection to lens driver not successful")
-		
+				self.lensConnected = False
+		while True:
+			if self.stop_signal_received:
+				return
+			if not self.new_command_event.wait(timeout=0.1):
+				continue
+			with self.command_lock:
+				self.new_command_event.clear()
+				commands = list(self.command_queue)
+				self.command_queue.clear()
+			for command, response_length, name in commands:
+				if self.stop_signal_received:
+					return
+				response = self.execute(command, response_length, name)
+				if response is not None:
+					self.parse_response(response, command, name)
+
+	def enqueue(self, command, response_length = 0, name = '', coalesce = False):
+		with self.command_lock:
+			if coalesce and self.command_queue and self.command_queue[-1][2] == name:
+				# replace the setpoint that has not been sent yet
+				self.command_queue[-1] = (command, response_length, name)
+				self.n_setpoints_coalesced = self.n_setpoints_coalesced + 1
+			elif len(self.command_queue) >= OptotuneLens.COMMAND_QUEUE_SIZE:
+				self.n_commands_dropped = self.n_commands_dropped + 1
+				print('lens command queue full, ' + name + ' discarded')
+				return
+			else:
+				self.command_queue.append((command, response_length, name))
+			self.new_command_event.set()
 
-	def sendData(self, data):
-		if(self.lensConnected):
-			self.serialconn.write(data)
-		else:
-			pass
-
-	def recData(self, nBytes):
-		if(self.lensConnected):
-			data = bytearray(nBytes)
-			for i in range(nBytes):
-				data[i] = ord(self.serialconn.read())
-			return data
-		else:
+	def execute(self, command, response_length, name):
+		# called from the I/O thread, returns the response if it is complete and its CRC is valid
+		if not self.handshake_done:
+			return None
+		try:
+			self.serialconn.write(command)
+			self.n_commands_sent = self.n_commands_sent + 1
+			if response_length == 0:
+				return None
+			response = self.serialconn.read(response_length)
+		except:
+			print('lens driver: error sending ' + name)
 			return None
+		if len(response) < response_length:
+			self.n_timeouts = self.n_timeouts + 1
+			print('lens driver: no response to ' + name)
+			self.serialconn.reset_input_buffer()
+			return None
+		# the CRC over the data and its (little endian) CRC bytes is 0, the response ends with \r\n
+		if self.calculate_crc(response[:-2]) != 0 or response[-2:] != b'\r\n':
+			self.n_crc_errors = self.n_crc_errors + 1
+			print('lens driver: invalid response to ' + name)
+			self.serialconn.reset_input_buffer()
+			return None
+		return response
 
-	def handshake(self):
+	def parse_response(self, response, command, name):
+		if name == 'mode':
+			if response[0] == command[0] and response[1:3] == command[2:4]:
+				print('Mode set successfully to : {}'.format(chr(response[1])))
+			else:
+				print('lens driver: unexpected response to mode ' + chr(command[2]))
+		elif name == 'current_readback':
+			code = (response[1] << 8) + response[2]
+			if code > 32767:
+				code = code - 65536
+			self.current_mA_readback = code*self.current_to_code_scalling_factor
 
+	def handshake(self):
+		# the driver is ready some time after the port is opened - retry instead of waiting a fixed time
 		start_cmd = bytearray("Start", 'utf-8')
-		self.sendData(start_cmd)
-		rec_data = self.recData(7)
-		print(rec_data)
-		if(rec_data == bytearray(b'Ready\r\n')):
-			print('Handshaking complete')
-			return True
-		else:
-			print('Failed to connect to lens driver')
-			return False
+		t_start = time.time()
+		while time.time() - t_start < OptotuneLens.HANDSHAKE_TIMEOUT_S and not self.stop_signal_received:
+			self.serialconn.write(start_cmd)
+			rec_data = self.serialconn.read(7)
+			if(rec_data == bytearray(b'Ready\r\n')):
+				# drop the answers to earlier attempts
+				time.sleep(OptotuneLens.HANDSHAKE_RETRY_INTERVAL_S)
+				self.serialconn.reset_input_buffer()
+				print('Handshaking complete')
+				self.handshake_done = True
+				return True
+			time.sleep(OptotuneLens.HANDSHAKE_RETRY_INTERVAL_S)
+		print('Failed to connect to lens driver')
+		return False
 
 	def split_int_4byte(self, number):
 		byte0 = (number >> 24) & 0xFF
@@ -131,6 +219,12 @@ class optotune_lens:
 		self.sendProperty("UpperCurr",current_mA_max/self.current_to_code_scalling_factor)
 		self.sendProperty("LowerCurr",current_mA_min/self.current_to_code_scalling_factor)
 		self.sendProperty("Freq",frequency_Hz)
+		print('start scanning liquid lens: {} to {} mA, {} Hz'.format(current_mA_min, current_mA_max, frequency_Hz))
+
+	def set_scan_currents_mA(self,current_mA_min,current_mA_max):
+		# shifts the sweep without restarting it (focus tracking with the lens)
+		self.sendProperty("UpperCurr",current_mA_max/self.current_to_code_scalling_factor)
+		self.sendProperty("LowerCurr",current_mA_min/self.current_to_code_scalling_factor)
 
 	# new function - 2021
 	def stop_scanning(self):
@@ -140,10 +234,17 @@ class optotune_lens:
 	def set_current_mA(self,value):
 		self.current_mA = value
 		current_code = self.current_mA/self.current_to_code_scalling_factor
-		self.mode = "DC"
-		self.sendMode()
+		if self.mode != "DC":
+			self.mode = "DC"
+			self.sendMode()
 		self.sendCurrent(current_code)
 
+	def request_current_readback(self):
+		# the current read back from the driver is stored in self.current_mA_readback
+		cmd = bytearray(4)
+		cmd[0], cmd[1] = ord('A'),ord('r')
+		self.enqueue(self.addcrcCheckSum(cmd), 7, 'current_readback')
+
 	def changeMode(self, mode):
 		self.mode = mode
 		self.sendMode()
@@ -174,29 +275,14 @@ class optotune_lens:
 		elif self.mode == "Tringular":
 			cmd[2] = ord('T')
 
-		# print('Sent data without crc bytes: {}'.format(cmd))
-		cmd_crc = self.addcrcCheckSum(cmd)
-		# print('Sent data with crc bytes: {}'.format(cmd_crc))
-		self.sendData(cmd_crc)
-
-		if(self.lensConnected):
-			rec_data = self.recData(7)
-			rec_string = bytearray(3)
-			rec_string[0], rec_string[1], rec_string[2] = cmd_crc[0],cmd_crc[2], cmd_crc[3]
-			check = self.calculate_crc(rec_data[:5])
-			if(rec_data[:3] == rec_string and check==0 ):
-				print('Mode set successfully to : {}'.format(self.mode))
-		else:
-			pass
-
+		# the driver replies M, mode, A, CRC, \r\n (checked by the I/O thread)
+		self.enqueue(self.addcrcCheckSum(cmd), 7, 'mode')
 
 	def sendCurrent(self, value):
 			cmd = bytearray(4) # Data array 
 			cmd[0], cmd[1] = ord('A'),ord('w')
 			cmd[2], cmd[3] = self.split_signed_int_2byte(value)
-			cmd_crc = self.addcrcCheckSum(cmd)
-			self.sendData(cmd_crc)
-			print("Current set to {}".format(value))
+			self.enqueue(self.addcrcCheckSum(cmd), 0, 'current', coalesce = True)
 
 	def sendProperty(self, prop, value):
 
@@ -224,19 +310,17 @@ class optotune_lens:
 			# High to Low bytes
 			cmd[4], cmd[5], cmd[6], cmd[7] = self.split_int_4byte(int(1000*value)) # Since value needs to be sent in mHz
 
-		# print('Sent data without crc bytes: {}'.format(cmd))
-		cmd_crc = self.addcrcCheckSum(cmd)
-		# print('Sent data with crc bytes: {}'.format(cmd_crc))
-		self.sendData(cmd_crc)
-		print("Set {} to {}".format(prop, value))
+		self.enqueue(self.addcrcCheckSum(cmd), 0, prop)
 	
-	def calculate_crc(self, data):
+	@staticmethod
+	def calculate_crc(data):
 		crc_sum = 0
 		for ii in range(len(data)):
-			crc_sum = self.crc_16_update(crc_sum, data[ii])
+			crc_sum = optotune_lens.crc_16_update(crc_sum, data[ii])
 		return crc_sum # crc checksum over all data elements
 
-	def crc_16_update(self, crc, a):
+	@staticmethod
+	def crc_16_update(crc, a):
 		crc ^= a
 		for ii in range(8):
 			if (crc & 1):
@@ -257,5 +341,112 @@ class optotune_lens:
 
 		return data_new
 
+class optotune_lens_Simulation(optotune_lens):
+	# same commands and I/O thread as optotune_lens, talking to a simulated lens driver through a simulated serial link
+
+	def __init__(self, freq = 0, amp = 0, offset = 0):
+		self._init_state(freq, amp, offset)
+		self.serialconn = Serial_Simulation(baudrate=OptotuneLens.BAUDRATE,latency_s=OptotuneLensSimulation.LATENCY_S,timeout=OptotuneLens.RESPONSE_TIMEOUT_S)
+		self.lens_driver_simulation = LensDriver_Simulation(self.serialconn,self.current_to_code_scalling_factor)
+		self.lensConnected = True
+		print('Simulated lens driver connected')
+		self._start_io_thread()
+
+	def close(self):
+		optotune_lens.close(self)
+		self.lens_driver_simulation.close()
+
+class LensDriver_Simulation():
+	# Optotune driver side of the link: answers the handshake, mode and current read commands (rejecting
+	# commands with a wrong CRC), and models the focal power as a first order response to the driven current
+
+	def __init__(self, serial, current_to_code_scalling_factor):
+		self.serial = serial
+		self.current_to_code_scalling_factor = current_to_code_scalling_factor
+		self.mode = 'S'
+		self.current_code = 0
+		self.upper_code = 0
+		self.lower_code = 0
+		self.frequency_Hz = 0
+		self.t_mode = time.time()
+		self.focal_current_mA = 0
+		self.t_focal_update = time.time()
+		self.n_commands_received = 0
+		self.n_crc_errors = 0
+		self.lock = threading.Lock()
+		self.stop_signal_received = False
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def close(self):
+		self.stop_signal_received = True
+		self.thread.join()
+
+	def run(self):
+		while not self.stop_signal_received:
+			for data in self.serial.mcu_read():
+				self.process_command(data)
+			self.update_focal_current()
+			time.sleep(0.0002)
+
+	def process_command(self, data):
+		if data == b'Start':
+			self.serial.mcu_write(b'Ready\r\n')
+			return
+		if optotune_lens.calculate_crc(data) != 0:
+			self.n_crc_errors = self.n_crc_errors + 1
+			return
+		self.n_commands_received = self.n_commands_received + 1
+		with self.lock:
+			if data[:2] == b'Mw':
+				self.mode = chr(data[2])
+				self.t_mode = time.time()
+				self.reply(data[0:1] + data[2:4])
+			elif data[:2] == b'Aw':
+				self.current_code = self.to_signed(data[2], data[3])
+			elif data[:2] == b'Ar':
+				code = int(round(self.get_current_mA()/self.current_to_code_scalling_factor)) % 65536
+				self.reply(bytes([ord('A'), code >> 8, code % 256]))
+			elif data[:2] == b'Pw':
+				if data[2] == ord('U'):
+					self.upper_code = self.to_signed(data[4], data[5])
+				elif data[2] == ord('L'):
+					self.lower_code = self.to_signed(data[4], data[5])
+				elif data[2] == ord('F'):
+					self.frequency_Hz = int.from_bytes(data[4:8], 'big')/1000
+
+	def reply(self, data):
+		# CRC low byte first
+		crc_sum = optotune_lens.calculate_crc(data)
+		self.serial.mcu_write(bytes(data) + bytes([crc_sum % 256, crc_sum >> 8]) + b'\r\n')
+
+	def to_signed(self, high, low):
+		value = (high << 8) + low
+		return value - 65536 if value > 32767 else value
+
+	def get_current_mA(self, t = None):
+		# current driven by the driver at time t
+		if t is None:
+			t = time.time()
+		if self.mode == 'D':
+			code = self.current_code
+		elif self.mode == 'S':
+			code = self.lower_code + (self.upper_code - self.lower_code)*(1 - np.cos(2*np.pi*self.frequency_Hz*(t - self.t_mode)))/2
+		else:
+			code = 0
+		return code*self.current_to_code_scalling_factor
+
+	def update_focal_current(self):
+		t = time.time()
+		with self.lock:
+			alpha = 1 - np.exp(-(t - self.t_focal_update)/(OptotuneLensSimulation.RESPONSE_TIME_MS/1000))
+			self.focal_current_mA = self.focal_current_mA + alpha*(self.get_current_mA(t) - self.focal_current_mA)
+		self.t_focal_update = t
+
+	def get_focal_current_mA(self):
+		# current equivalent of the focal power of the lens (lags the driven current)
+		return self.focal_current_mA
+
 # For future, need to add this so one can switch between these two liquid lenses
 # class varioptic_lens:
\ No newline at end of file
@@ -0,0 +1,209 @@
+import os
+import csv
+import time
+import threading
+import numpy as np
+import cv2
+from datetime import datetime
+
+from control._def import *
+
+# motor axis -> (in-plane axis 0, in-plane axis 1, focus axis) of the simulated scene
+if TRACKING_CONFIG == 'XY_Z':
+    SCENE_AXES_MOTOR_INDEX = (0,1,2)
+else:
+    # XZ_Y and XTheta_Y: in-plane axis 1 is driven by motor y, the focus axis by motor z
+    # (for XTheta_Y the theta stage is approximated as a linear axis)
+    SCENE_AXES_MOTOR_INDEX = (0,2,1)
+
+class OrganismTrajectories():
+    '''
+    Stochastic 3D trajectories (in mm, lab frame). The velocity of each organism is an
+    Ornstein-Uhlenbeck process (persistent random walk) on top of a constant drift.
+    The state is advanced to the requested time, so one instance can be shared by the
+    cameras that image the same scene.
+    '''
+    def __init__(self, n_organisms = SimulatedScene.N_ORGANISMS, speed_um_s = SimulatedScene.SPEED_UM_S, persistence_time_s = SimulatedScene.PERSISTENCE_TIME_S,
+        drift_um_s = SimulatedScene.DRIFT_UM_S, initial_spread_um = SimulatedScene.INITIAL_SPREAD_UM, seed = SimulatedScene.SEED):
+        self.rng = np.random.default_rng(seed)
+        self.n_organisms = n_organisms
+        self.speed_mm_s = speed_um_s/1000
+        self.persistence_time_s = persistence_time_s
+        self.drift_mm_s = np.array(drift_um_s,dtype=float)/1000
+        self.position = self.rng.normal(0,initial_spread_um/1000,(n_organisms,3))
+        self.position[:,2] = 0 # start in focus
+        self.velocity = self.rng.normal(0,self.speed_mm_s,(n_organisms,3))
+        self.timestamp = None
+        self.lock = threading.Lock()
+
+    def get_state(self, timestamp):
+        with self.lock:
+            if self.timestamp is None:
+                self.timestamp = timestamp
+            dt = timestamp - self.timestamp
+            if dt > 0:
+                # exact update of the OU process
+                decay = np.exp(-dt/self.persistence_time_s)
+                self.velocity = self.velocity*decay + self.speed_mm_s*np.sqrt(1-decay**2)*self.rng.standard_normal((self.n_organisms,3))
+                self.position = self.position + (self.velocity + self.drift_mm_s)*dt
+                self.timestamp = timestamp
+            return self.position.copy(), self.velocity + self.drift_mm_s
+
+class SceneSimulation():
+    '''
+    Renders the view of a simulated camera: textured organisms from OrganismTrajectories seen
+    relative to the stage position read from the (simulated) microcontroller, with motion blur,
+    focus blur tied to the focus-axis offset, illumination drift and sensor noise.
+    Frames are rendered into a small pool of preallocated buffers: a frame is overwritten N_BUFFERS renders later,
+    so consumers that hold on to it (e.g. the image saver queue) keep a copy.
+    '''
+    def __init__(self, width, height, microcontroller = None, trajectories = None, pixel_size_um = None, NA = None, flip_image = None,
+        imaging_channel = TRACKING, log_ground_truth = SimulatedScene.LOG_GROUND_TRUTH):
+        self.width = width
+        self.height = height
+        self.microcontroller = microcontroller
+        self.trajectories = trajectories if trajectories is not None else OrganismTrajectories()
+        self.imaging_channel = imaging_channel
+        self.flip_image = flip_image
+        self.exposure_time_s = 0.01
+        self.rng = np.random.default_rng(SimulatedScene.SEED + 1)
+
+        # same fallback as the objective dropdown in LiveControlWidget if DEFAULT_OBJECTIVE is not in OBJECTIVES
+        objective = OBJECTIVES.get(DEFAULT_OBJECTIVE,list(OBJECTIVES.values())[0])
+        if pixel_size_um is None:
+            pixel_size_um = CAMERA_PIXEL_SIZE_UM[CAMERAS[imaging_channel]['sensor']] / ( TUBE_LENS_MM[imaging_channel] / (objective['tube_lens_f_mm']/objective['magnification']) )
+        self.pixel_size_mm = pixel_size_um/1000
+        self.NA = NA if NA is not None else objective['NA']
+
+        # output buffers (reused in turn) and background + noise frames
+        self.buffers = [np.zeros((height,width),dtype=np.uint8) for i in range(SimulatedScene.N_BUFFERS)]
+        self.buffer_index = 0
+        self.noise_margin = 64
+        self.noise_frames = [np.clip(self.rng.normal(SimulatedScene.BACKGROUND,SimulatedScene.NOISE_STD,(height+self.noise_margin,width)),0,255).astype(np.uint8)
+            for i in range(SimulatedScene.N_NOISE_FRAMES)]
+
+        self.sprites = [self._make_sprite() for i in range(self.trajectories.n_organisms)]
+
+        self.stage_position_last = None
+        self.timestamp_last = None
+        self.illumination_random_walk = 0
+
+        self.ground_truth_file = None
+        self.ground_truth_writer = None
+        if log_ground_truth:
+            self._start_ground_truth_log()
+
+    def _make_sprite(self):
+        # elliptical body with a smoothed random texture (gives the trackers something to lock on)
+        length_px = SimulatedScene.ORGANISM_LENGTH_UM/1000/self.pixel_size_mm
+        width_px = SimulatedScene.ORGANISM_WIDTH_UM/1000/self.pixel_size_mm
+        size = int(np.ceil(length_px)) + 4
+        sprite = np.zeros((size,size),dtype=np.float32)
+        cv2.ellipse(sprite,(size//2,size//2),(max(int(length_px/2),1),max(int(width_px/2),1)),self.rng.uniform(0,180),0,360,1.0,-1)
+        texture = cv2.GaussianBlur(self.rng.uniform(0.5,1.0,(size,size)).astype(np.float32),(0,0),max(width_px/10,1))
+        return sprite*texture
+
+    def set_exposure_time(self, exposure_time_ms):
+        self.exposure_time_s = exposure_time_ms/1000
+
+    def get_stage_position_mm(self):
+        if self.microcontroller is None:
+            return np.zeros(3)
+        x_pos, y_pos, z_pos, _ = self.microcontroller.get_pos()
+        position = []
+        for pos, use_encoder, encoder_mm, sign, pitch, fullsteps, microstepping in (
+            (x_pos, USE_ENCODER_X, ENCODER_STEP_SIZE_X_MM*ENCODER_SIGN_X, STAGE_POS_SIGN_X, SCREW_PITCH_X_MM, FULLSTEPS_PER_REV_X, MICROSTEPPING_DEFAULT_X),
+            (y_pos, USE_ENCODER_Y, ENCODER_STEP_SIZE_Y_MM*ENCODER_SIGN_Y, STAGE_POS_SIGN_Y, SCREW_PITCH_Y_MM, FULLSTEPS_PER_REV_Y, MICROSTEPPING_DEFAULT_Y),
+            (z_pos, USE_ENCODER_Z, ENCODER_STEP_SIZE_Z_MM*ENCODER_SIGN_Z, STAGE_POS_SIGN_Z, SCREW_PITCH_Z_MM, FULLSTEPS_PER_REV_Z, MICROSTEPPING_DEFAULT_Z)):
+            if use_encoder:
+                position.append(pos*encoder_mm)
+            else:
+                position.append(pos*sign*pitch/(fullsteps*microstepping))
+        return np.array([position[i] for i in SCENE_AXES_MOTOR_INDEX])
+
+    def render(self, timestamp, frame_ID = None):
+        frame = self.buffers[self.buffer_index]
+        self.buffer_index = (self.buffer_index + 1) % len(self.buffers)
+
+        # illumination drift - slow oscillation plus a random walk
+        self.illumination_random_walk = 0.99*self.illumination_random_walk + 0.002*self.rng.standard_normal()
+        gain = 1 + SimulatedScene.ILLUMINATION_DRIFT_AMPLITUDE*np.sin(2*np.pi*timestamp/SimulatedScene.ILLUMINATION_DRIFT_PERIOD_S) + self.illumination_random_walk
+
+        # background and noise - pick one of the precomputed noise frames at a random offset
+        noise_frame = self.noise_frames[self.rng.integers(len(self.noise_frames))]
+        offset = self.rng.integers(self.noise_margin)
+        cv2.convertScaleAbs(noise_frame[offset:offset+self.height],frame,gain)
+
+        # organisms, relative to the stage
+        position, velocity = self.trajectories.get_state(timestamp)
+        stage_position = self.get_stage_position_mm()
+        if self.stage_position_last is not None and timestamp > self.timestamp_last:
+            stage_velocity = (stage_position - self.stage_position_last)/(timestamp - self.timestamp_last)
+        else:
+            stage_velocity = np.zeros(3)
+        self.stage_position_last = stage_position
+        self.timestamp_last = timestamp
+
+        for i in range(self.trajectories.n_organisms):
+            relative_position = position[i] - stage_position
+            relative_velocity = velocity[i] - stage_velocity
+            x_px = self.width/2 + relative_position[0]/self.pixel_size_mm
+            y_px = self.height/2 + relative_position[1]/self.pixel_size_mm
+            if self.flip_image in ('Horizontal','Both'):
+                x_px = self.width - x_px
+            if self.flip_image in ('Vertical','Both'):
+                y_px = self.height - y_px
+            self._draw_organism(frame,i,x_px,y_px,relative_position[2],relative_velocity[:2]/self.pixel_size_mm,gain)
+            if self.ground_truth_writer is not None:
+                self.ground_truth_writer.writerow([frame_ID,timestamp,i] + list(position[i]) + list(stage_position) + [x_px,y_px])
+
+        return frame
+
+    def _draw_organism(self, frame, i, x_px, y_px, defocus_mm, velocity_px_s, gain):
+        sprite = self.sprites[i]
+        # focus blur: geometric blur radius ~ |dz|*NA, beyond the depth of field
+        defocus_um = max(abs(defocus_mm)*1000 - SimulatedScene.DEPTH_OF_FIELD_UM/2, 0)
+        sigma_px = defocus_um*self.NA/(self.pixel_size_mm*1000)
+        # motion blur: displacement during the exposure
+        blur_vector = velocity_px_s*self.exposure_time_s
+        margin = int(3*sigma_px + np.abs(blur_vector).max()/2) + 2
+        half_size = sprite.shape[0]//2 + margin
+        x0, y0 = int(x_px) - half_size, int(y_px) - half_size
+        x1, y1 = x0 + 2*half_size, y0 + 2*half_size
+        if x1 <= 0 or y1 <= 0 or x0 >= self.width or y0 >= self.height:
+            return
+
+        # render the sprite (sub-pixel position, averaged along the motion path) into a patch
+        patch = np.zeros((2*half_size,2*half_size),dtype=np.float32)
+        n_samples = int(np.clip(np.ceil(np.linalg.norm(blur_vector)/2),1,8))
+        for s in range(n_samples):
+            shift = blur_vector*((s+0.5)/n_samples - 0.5)
+            M = np.float32([[1,0,half_size - sprite.shape[1]/2 + (x_px - int(x_px)) + shift[0]],[0,1,half_size - sprite.shape[0]/2 + (y_px - int(y_px)) + shift[1]]])
+            patch += cv2.warpAffine(sprite,M,(patch.shape[1],patch.shape[0]))
+        patch *= SimulatedScene.ORGANISM_INTENSITY*gain/n_samples
+        if sigma_px > 0.5:
+            if sigma_px > 4:
+                # blur at a lower resolution to keep the cost independent of the defocus
+                factor = sigma_px/2
+                small = cv2.resize(patch,(max(int(patch.shape[1]/factor),1),max(int(patch.shape[0]/factor),1)),interpolation=cv2.INTER_AREA)
+                small = cv2.GaussianBlur(small,(0,0),2)
+                patch = cv2.resize(small,(patch.shape[1],patch.shape[0]),interpolation=cv2.INTER_LINEAR)
+            else:
+                patch = cv2.GaussianBlur(patch,(0,0),sigma_px)
+
+        # add the patch to the frame (clipped to the frame)
+        fx0, fy0, fx1, fy1 = max(x0,0), max(y0,0), min(x1,self.width), min(y1,self.height)
+        patch = patch[fy0-y0:fy1-y0,fx0-x0:fx1-x0]
+        frame[fy0:fy1,fx0:fx1] = cv2.add(frame[fy0:fy1,fx0:fx1],patch.astype(np.uint8))
+
+    def _start_ground_truth_log(self):
+        file_name = 'simulation_ground_truth_' + self.imaging_channel.replace(' ','_') + '_' + datetime.now().strftime('%Y-%m-%d %H-%M-%-S.%f') + '.csv'
+        self.ground_truth_file = open(os.path.join(DEFAULT_SAVE_FOLDER,file_name),'w',newline='')
+        self.ground_truth_writer = csv.writer(self.ground_truth_file)
+        self.ground_truth_writer.writerow(['frame_ID','Time','organism','in_plane_0_mm','in_plane_1_mm','focus_mm','in_plane_0_stage_mm','in_plane_1_stage_mm','focus_stage_mm','x_px','y_px'])
+
+    def close(self):
+        if self.ground_truth_file is not None:
+            self.ground_truth_file.close()
+            self.ground_truth_file = None
+            self.ground_truth_writer = None
@@ -23,7 +23,8 @@ class Tracker_Image(object):
 	SLOTS: update_tracker_type, Connected to: Tracking Widget
 	'''
 
-	def __init__(self):
+	def __init__(self, tracker_type = None):
+		# tracker_type: only build this tracker (None: all of them, the type can be changed later)
 		# Define list of trackers being used(maybe do this as a definition?)
 		# OpenCV tracking suite
 		# self.OPENCV_OBJECT_TRACKERS = {}
@@ -42,16 +43,8 @@ class Tracker_Image(object):
 		
 		# Neural Net based trackers
 		self.NEURALNETTRACKERS = {"daSiamRPN":[]}
-		try:
-			# load net
-			self.net = SiamRPNvot()
-			self.net.load_state_dict(torch.load(join(realpath(dirname(__file__)),'DaSiamRPN','code','SiamRPNOTB.model')))
-			self.net.eval().cuda()
-			print('Finished loading net ...')
-		except Exception as e:
-			print(e)
-			print('No neural net model found ...')
-			print('reverting to default OpenCV tracker')
+		if tracker_type is None or tracker_type in self.NEURALNETTRACKERS:
+			self._load_net()
 
 		# Image Tracker type
 		self.tracker_type = Tracking.DEFAULT_TRACKER
@@ -72,6 +65,18 @@ class Tracker_Image(object):
 		self.searchArea = None
 		self.is_color = None
 		
+	def _load_net(self):
+		try:
+			# load net
+			self.net = SiamRPNvot()
+			self.net.load_state_dict(torch.load(join(realpath(dirname(__file__)),'DaSiamRPN','code','SiamRPNOTB.model')))
+			self.net.eval().cuda()
+			print('Finished loading net ...')
+		except Exception as e:
+			print(e)
+			print('No neural net model found ...')
+			print('reverting to default OpenCV tracker')
+
 	def track(self, image, thresh_image, is_first_frame = False):
 
 		# case 1: initialize the tracker
@@ -133,7 +138,7 @@ class Tracker_Image(object):
 			if(self.is_color == False):
 				image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
 			self.create_tracker() # for a new track, just calling self.tracker.init(image,bbox) is not be sufficient, this line needs to be called
-			self.tracker.init(image, bbox)
+			self.tracker.init(image, tuple(int(v) for v in bbox)) # newer OpenCV versions only accept an integer bbox
 		# Initialize Neural Net based Tracker
 		elif(self.tracker_type in self.NEURALNETTRACKERS.keys()):
 			# Initialize the tracker with this centroid position
@@ -190,6 +195,8 @@ class Tracker_Image(object):
 		self.tracker_type = tracker_type
 		#@@@ Testing
 		print('Image tracker set to {}'.format(self.tracker_type))
+		if(self.tracker_type in self.NEURALNETTRACKERS.keys() and not hasattr(self, 'net')):
+			self._load_net()
 		# Update the actual tracker
 		self.create_tracker()
 
@@ -2,9 +2,12 @@ import platform
 import serial
 import serial.tools.list_ports
 import time
+import threading
 import numpy as np
+from collections import deque
 
 from control._def import *
+from control.microcontroller import Serial_Simulation
 
 # add user to the dialout group to avoid the need to use sudo
 
@@ -21,9 +24,56 @@ class TriggerController():
         self.serial = serial.Serial(controller_ports[0],2000000)
         print('Teensy connected')
 
+        self._init_status()
+        self.thread_read_received_packet = threading.Thread(target=self.read_received_packet, daemon=True)
+        self.thread_read_received_packet.start()
+
+    def _init_status(self):
+        self.rx_buffer = bytearray()
+        self.new_packet_callback_external = None
+        self.terminate_reading_received_packet_thread = False
+        # the status is updated by the reader thread, frames are registered from the camera thread
+        self.lock = threading.Lock()
+        self.device_clock_raw_us = None # micros() of the controller, wraps every 71 min
+        self.device_clock_s = None # unwrapped
+        self.clock_offset_s = None # host time - controller time
+        self.expected_latency_s = TriggerControllerDef.FRAME_LATENCY_S # trigger to frame timestamp, None if not known
+        self.frame_ID_origin_requested = None
+        self.clock_offset_timestamp = None
+        self.n_status_errors = 0
+        self._reset_status()
+
+    def _reset_status(self):
+        # since the start of trigger generation
+        self.trigger_count = 0
+        self.volume_count = 0
+        self.plane = 0 # plane of the last trigger
+        self.last_trigger_timestamp = None # unit: s, time.time() scale
+        self.trigger_interval_s = None # between the planes of a volume
+        # frame verification
+        self.triggers = deque(maxlen=TriggerControllerDef.N_TRIGGERS_KEPT) # (trigger number, volume, plane, timestamp) not yet matched to a frame
+        self.frames = deque() # (frame ID, timestamp) waiting for their trigger
+        self.latency_s = None # from the trigger to the frame timestamp, once validated
+        self.held_matches = [] # (frame ID, timestamp, trigger, missed triggers) matched before the latency is validated
+        self.first_trigger_timestamp = None
+        # frame ID of the camera before the first trigger, None: anchored on the first frame
+        self.frame_ID_origin = self.frame_ID_origin_requested
+        self.frame_ID_origin_requested = None
+        self.last_matched_trigger = 0
+        self.last_verified_frame = None # (frame ID, trigger number, volume, plane)
+        self.n_frames_verified = 0
+        self.n_frames_missed = 0 # triggers without a frame
+        self.n_frames_without_trigger = 0
+
     def close(self):
+        self.terminate_reading_received_packet_thread = True
+        self.thread_read_received_packet.join()
         self.serial.close()
 
+    def set_callback(self,function):
+        # called by the reader thread after each status packet
+        self.new_packet_callback_external = function
+
     def set_number_of_planes_per_volume(self,value):
         cmd = bytearray(self.tx_buffer_length)
         cmd[0] = SET_NUMBER_OF_PLANES_PER_VOLUME
@@ -39,6 +89,16 @@ class TriggerController():
         cmd[3] = value & 0xff
         self.serial.write(cmd)
 
+    def set_frame_ID_origin(self,frame_ID):
+        # frame ID of the triggered camera before the next start_trigger_generation: the frame of trigger n has frame ID frame_ID + n
+        with self.lock:
+            self.frame_ID_origin_requested = frame_ID
+
+    def set_expected_latency(self,value):
+        # expected trigger to frame timestamp latency (exposure + transfer), None to measure it from the first frame
+        with self.lock:
+            self.expected_latency_s = value
+
     def set_frequency_Hz(self,value):
         cmd = bytearray(self.tx_buffer_length)
         cmd[0] = SET_FREQUENCY_HZ
@@ -55,6 +115,8 @@ class TriggerController():
         self.serial.write(cmd)
 
     def start_trigger_generation(self):
+        with self.lock:
+            self._reset_status()
         cmd = bytearray(self.tx_buffer_length)
         cmd[0] = START_TRIGGER_GENERATION
         self.serial.write(cmd)
@@ -67,74 +129,361 @@ class TriggerController():
         print('stop trigger generation')
 
     def read_received_packet(self):
-        # wait to receive data
-        while self.serial.in_waiting==0:
-            pass
-        while self.serial.in_waiting % self.rx_buffer_length != 0:
-            pass
-
-        num_bytes_in_rx_buffer = self.serial.in_waiting
-
-        # get rid of old data
-        if num_bytes_in_rx_buffer > self.rx_buffer_length:
-            # print('getting rid of old data')
-            for i in range(num_bytes_in_rx_buffer-self.rx_buffer_length):
-                self.serial.read()
-        
-        # read the buffer
-        data=[]
-        for i in range(self.rx_buffer_length):
-            data.append(ord(self.serial.read()))
-
-        return data
-
-    def read_received_packet_nowait(self):
-        # wait to receive data
-        if self.serial.in_waiting==0:
-            return None
-        if self.serial.in_waiting % self.rx_buffer_length != 0:
+        while self.terminate_reading_received_packet_thread == False:
+            num_bytes_in_rx_buffer = self.serial.in_waiting
+            if num_bytes_in_rx_buffer == 0:
+                self.check_missed_frames()
+                time.sleep(0.0005)
+                continue
+            self.rx_buffer.extend(self.serial.read(num_bytes_in_rx_buffer))
+            timestamp_received = time.time()
+
+            # parse the status packets
+            '''
+            - header (1 byte)
+            - trigger count since start (4 bytes)
+            - volume count since start (4 bytes)
+            - plane of the last trigger (2 bytes)
+            - time of the last trigger (4 bytes, us of the controller clock)
+            - checksum (1 byte, sum of the other bytes)
+            '''
+            while len(self.rx_buffer) >= TriggerControllerDef.STATUS_LENGTH:
+                msg = self.rx_buffer[:TriggerControllerDef.STATUS_LENGTH]
+                if msg[0] != TriggerControllerDef.STATUS_HEADER or sum(msg[:-1]) % 256 != msg[-1]:
+                    # resynchronize on the next header
+                    self.n_status_errors = self.n_status_errors + 1
+                    del self.rx_buffer[0]
+                    continue
+                del self.rx_buffer[:TriggerControllerDef.STATUS_LENGTH]
+                self._parse_status(msg,timestamp_received)
+
+            with self.lock:
+                self._match_frames()
+            if self.new_packet_callback_external is not None:
+                self.new_packet_callback_external(self)
+
+    def _parse_status(self,msg,timestamp_received):
+        trigger_count = int.from_bytes(msg[1:5],'big')
+        volume_count = int.from_bytes(msg[5:9],'big')
+        plane = int.from_bytes(msg[9:11],'big')
+        timestamp_us = int.from_bytes(msg[11:15],'big')
+        with self.lock:
+            # unwrap the controller clock and map it to the host clock: the offset is the smallest
+            # (receive time - controller time), allowed to drift up by CLOCK_DRIFT_PPM
+            if self.device_clock_s is None:
+                self.device_clock_s = timestamp_us/1e6
+            else:
+                self.device_clock_s = self.device_clock_s + ((timestamp_us - self.device_clock_raw_us) % 2**32)/1e6
+            self.device_clock_raw_us = timestamp_us
+            offset = timestamp_received - self.device_clock_s
+            if self.clock_offset_s is None:
+                self.clock_offset_s = offset
+            else:
+                drift = TriggerControllerDef.CLOCK_DRIFT_PPM*1e-6*(timestamp_received - self.clock_offset_timestamp)
+                self.clock_offset_s = min(offset,self.clock_offset_s + drift)
+            self.clock_offset_timestamp = timestamp_received
+
+            if trigger_count <= self.trigger_count:
+                # status without new trigger (start/stop)
+                return
+            timestamp = self.device_clock_s + self.clock_offset_s
+            if trigger_count == self.trigger_count + 1 and plane > 0 and self.last_trigger_timestamp is not None:
+                self.trigger_interval_s = timestamp - self.last_trigger_timestamp
+            # (if status packets were lost, the frames of the triggers in between count as frames without trigger)
+            self.triggers.append((trigger_count,volume_count,plane,timestamp))
+            if self.first_trigger_timestamp is None:
+                self.first_trigger_timestamp = timestamp
+            self.trigger_count = trigger_count
+            self.volume_count = volume_count
+            self.plane = plane
+            self.last_trigger_timestamp = timestamp
+
+    def register_frame(self,frame_ID,timestamp):
+        # called for every frame of the triggered camera - the frame is matched to its trigger as soon as the trigger is known
+        with self.lock:
+            self.frames.append((frame_ID,timestamp))
+            self._match_frames()
+
+    def _get_match_tolerance_s(self):
+        if self.trigger_interval_s is None:
+            return TriggerControllerDef.MATCH_TOLERANCE_S_DEFAULT
+        return TriggerControllerDef.MATCH_TOLERANCE*self.trigger_interval_s
+
+    def _match_frames(self):
+        # lock held - the frame of trigger n has frame ID frame_ID_origin + n (the camera frame IDs leave a gap for
+        # the frames it dropped); the timestamps detect the triggers the camera missed, and re-anchor the frame IDs
+        tolerance = self._get_match_tolerance_s()
+        while self.frames:
+            frame_ID, timestamp = self.frames[0]
+            if self.first_trigger_timestamp is None:
+                if not self._drop_frame_if_timed_out(frame_ID,timestamp):
+                    return
+                continue
+            if timestamp < self.first_trigger_timestamp - tolerance:
+                # exposed before the first trigger (e.g. in the previous acquisition mode): the next frame ID is the first trigger's
+                self.frames.popleft()
+                self.n_frames_without_trigger = self.n_frames_without_trigger + 1
+                if self.frame_ID_origin is not None:
+                    self.frame_ID_origin = max(self.frame_ID_origin,frame_ID)
+                continue
+            if self.frame_ID_origin is None:
+                # camera frame ID at the start not known: the first frame anchors the frame IDs (on the trigger
+                # closest to the expected latency if known, else on the first trigger), checked by _validate_latency
+                if self.expected_latency_s is None:
+                    trigger = self.triggers[0] if self.triggers else None
+                else:
+                    trigger = self._find_trigger(timestamp - self.expected_latency_s,tolerance)
+                if trigger is None:
+                    if not self._drop_frame_if_timed_out(frame_ID,timestamp):
+                        return
+                    continue
+                self.frame_ID_origin = frame_ID - trigger[0]
+            n = frame_ID - self.frame_ID_origin
+            if n > self.trigger_count:
+                # the trigger has not been received yet
+                if not self._drop_frame_if_timed_out(frame_ID,timestamp):
+                    return
+                continue
+            trigger = next((trigger for trigger in self.triggers if trigger[0] == n),None)
+            latency_s = self._get_latency()
+            if latency_s is not None and (trigger is None or abs(timestamp - trigger[3] - latency_s) > tolerance):
+                # the camera missed a trigger (or its frame IDs jumped): re-anchor the frame IDs on the timestamp
+                if not self.triggers or self.triggers[-1][3] < timestamp - latency_s - tolerance:
+                    if not self._drop_frame_if_timed_out(frame_ID,timestamp):
+                        return
+                    continue
+                trigger = self._find_trigger(timestamp - latency_s,tolerance)
+                if trigger is not None:
+                    self.frame_ID_origin = frame_ID - trigger[0]
+                    print('trigger controller: frame ' + str(frame_ID) + ' is from trigger ' + str(trigger[0]) + ', frame IDs re-anchored')
+            if trigger is None:
+                self.frames.popleft()
+                self.n_frames_without_trigger = self.n_frames_without_trigger + 1
+                print('trigger controller: no trigger for frame ' + str(frame_ID))
+                continue
+            self.frames.popleft()
+            # earlier triggers did not get a frame
+            missed = []
+            while self.triggers[0] is not trigger:
+                missed.append(self.triggers.popleft())
+            self.triggers.popleft()
+            if self.latency_s is None:
+                # held until the latency they give is validated
+                self.held_matches.append((frame_ID,timestamp,trigger,missed))
+                if len(self.held_matches) >= TriggerControllerDef.LATENCY_CHECK_FRAMES:
+                    self._validate_latency()
+            else:
+                self.latency_s = self.latency_s + TriggerControllerDef.LATENCY_SMOOTHING*(timestamp - trigger[3] - self.latency_s)
+                self._on_frame_verified(frame_ID,trigger,missed)
+
+    def _drop_frame_if_timed_out(self,frame_ID,timestamp):
+        # lock held - a frame still without trigger FRAME_TIMEOUT_S after its timestamp is dropped
+        if time.time() - timestamp <= TriggerControllerDef.FRAME_TIMEOUT_S:
+            return False
+        self.frames.popleft()
+        self.n_frames_without_trigger = self.n_frames_without_trigger + 1
+        print('trigger controller: no trigger for frame ' + str(frame_ID))
+        return True
+
+    def _find_trigger(self,timestamp,tolerance):
+        # lock held - the trigger closest to timestamp, if within the tolerance
+        if not self.triggers:
             return None
-        
-        # get rid of old data
-        num_bytes_in_rx_buffer = self.serial.in_waiting
-        if num_bytes_in_rx_buffer > self.rx_buffer_length:
-            # print('getting rid of old data')
-            for i in range(num_bytes_in_rx_buffer-self.rx_buffer_length):
-                self.serial.read()
-        
-        # read the buffer
-        data=[]
-        for i in range(self.rx_buffer_length):
-            data.append(ord(self.serial.read()))
-        return data
-
-class TriggerController_Simulation():
-    def __init__(self,parent=None):
-        pass
+        trigger = min(self.triggers,key=lambda trigger:abs(trigger[3] - timestamp))
+        return trigger if abs(trigger[3] - timestamp) <= tolerance else None
+
+    def _get_latency(self):
+        # lock held - the validated latency, else the latency of the first held match, else the expected latency
+        if self.latency_s is not None:
+            return self.latency_s
+        if self.held_matches:
+            return self.held_matches[0][1] - self.held_matches[0][2][3]
+        return self.expected_latency_s
+
+    def _validate_latency(self):
+        # lock held - frames cannot be timestamped before their trigger, and the latency must agree with the expected
+        # latency if known; otherwise the frame IDs are anchored on the wrong trigger: re-attribute the held frames
+        latency_s = float(np.median([timestamp - trigger[3] for frame_ID, timestamp, trigger, missed in self.held_matches]))
+        interval_s = self.trigger_interval_s
+        shift = 0
+        if interval_s is not None:
+            if self.expected_latency_s is not None:
+                shift = int(round((latency_s - self.expected_latency_s)/interval_s))
+            elif latency_s < -self._get_match_tolerance_s():
+                shift = int(np.floor(latency_s/interval_s))
+        held_matches = self.held_matches
+        self.held_matches = []
+        if shift != 0:
+            # the frame of trigger n is the frame of trigger n + shift
+            self.frame_ID_origin = self.frame_ID_origin - shift
+            print('trigger controller: frames matched ' + str(shift) + ' trigger(s) off, re-attributed')
+            for frame_ID, timestamp, trigger, missed in reversed(held_matches):
+                self.frames.appendleft((frame_ID,timestamp))
+            for frame_ID, timestamp, trigger, missed in reversed(held_matches):
+                self.triggers.appendleft(trigger)
+                self.triggers.extendleft(reversed(missed))
+            return
+        self.latency_s = latency_s
+        for frame_ID, timestamp, trigger, missed in held_matches:
+            self._on_frame_verified(frame_ID,trigger,missed)
+
+    def _on_frame_verified(self,frame_ID,trigger,missed):
+        for missed_trigger in missed:
+            self._on_missed_frame(missed_trigger)
+        self.last_matched_trigger = trigger[0]
+        self.last_verified_frame = (frame_ID,) + trigger[:3]
+        self.n_frames_verified = self.n_frames_verified + 1
+
+    def check_missed_frames(self):
+        # frames whose trigger should have arrived by now, and triggers whose frame should have arrived by now
+        with self.lock:
+            self._match_frames()
+            if self.held_matches and not self.frames and time.time() - self.held_matches[-1][1] > TriggerControllerDef.FRAME_TIMEOUT_S:
+                # fewer frames than LATENCY_CHECK_FRAMES
+                self._validate_latency()
+                self._match_frames()
+            if self.latency_s is None or self.frames:
+                return
+            deadline = time.time() - self.latency_s - self._get_match_tolerance_s() - TriggerControllerDef.FRAME_TIMEOUT_S
+            while self.triggers and self.triggers[0][3] < deadline:
+                self._on_missed_frame(self.triggers.popleft())
+
+    def _on_missed_frame(self,trigger):
+        self.n_frames_missed = self.n_frames_missed + 1
+        self.last_matched_trigger = trigger[0]
+        print('trigger controller: missed frame for trigger ' + str(trigger[0]) + ' (volume ' + str(trigger[1]) + ', plane ' + str(trigger[2]) + ')')
+
+    def get_frame_statistics(self):
+        with self.lock:
+            return {'triggers':self.trigger_count,'volumes':self.volume_count,'frames verified':self.n_frames_verified,
+                'frames missed':self.n_frames_missed,'frames without trigger':self.n_frames_without_trigger,
+                'latency (ms)':None if self.latency_s is None else round(self.latency_s*1000,3)}
+
+class TriggerController_Simulation(TriggerController):
+    '''
+    Same commands and status parsing as TriggerController, talking to a simulated trigger controller
+    (TriggerGeneration_Simulation) through a simulated serial link. Cameras are wired with connect_trigger_input.
+    '''
+    def __init__(self,serial_number=None,latency_s=TriggerControllerSimulationDef.LATENCY_S,baudrate=TriggerControllerSimulationDef.BAUDRATE):
+        self.serial = None
+        self.platform_name = platform.system()
+        self.tx_buffer_length = MicrocontrollerDef.CMD_LENGTH
+        self.rx_buffer_length = MicrocontrollerDef.MSG_LENGTH
+
+        self.serial = Serial_Simulation(baudrate=baudrate,latency_s=latency_s)
+        self.trigger_generation_simulation = TriggerGeneration_Simulation(self.serial)
+        print('connected to simulated trigger controller')
+
+        self._init_status()
+        self.thread_read_received_packet = threading.Thread(target=self.read_received_packet, daemon=True)
+        self.thread_read_received_packet.start()
+
+    def connect_trigger_input(self,callback):
+        # wire a simulated camera's trigger input (callback(timestamp)) to the camera trigger output
+        self.trigger_generation_simulation.trigger_outputs.append(callback)
 
     def close(self):
-        pass
+        self.terminate_reading_received_packet_thread = True
+        self.thread_read_received_packet.join()
+        self.trigger_generation_simulation.close()
+        self.serial.close()
 
-    def read_received_packet(self):
-        pass
+class TriggerGeneration_Simulation():
+    '''
+    Simulated trigger controller firmware: on each rising edge of the liquid lens trigger (every lens period from
+    the start), waits for the phase delay and fires the planes of a volume one period/number of planes apart,
+    sending a status packet after each trigger. The controller clock drifts by CLOCK_DRIFT_PPM.
+    '''
+    def __init__(self,serial,loop_interval_s=TriggerControllerSimulationDef.LOOP_INTERVAL_S):
+        self.serial = serial
+        self.loop_interval_s = loop_interval_s
+        self.rx_buffer = bytearray()
+        self.trigger_outputs = []
 
-    def read_received_packet_nowait(self):
-        return None
+        self.number_of_planes_per_volume = 5
+        self.number_of_volumes_requested = 0 # 0 means infinite
+        self.frequency_Hz = 1
+        self.phase_delay = 0 # 0 to 1 for 0 to 90 degree
+        self.trigger_enabled = False
+        self.trigger_count = 0
+        self.volume_count = 0
+        self.plane = 0
+        self.timestamp_start = None
+        self.timestamp_last_trigger = time.time()
+        self.timestamp_clock_origin = time.time()
 
-    def set_number_of_planes_per_volume(self,value):
-        pass
+        self.terminate_thread = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
-    def set_number_of_requested_volumes(self,value):
-        pass
+    def close(self):
+        self.terminate_thread = True
+        self.thread.join()
 
-    def set_frequency_Hz(self,value):
-        pass
+    def run(self):
+        while self.terminate_thread == False:
+            for data in self.serial.mcu_read():
+                self.rx_buffer.extend(data)
+            # 4-byte commands, as the firmware
+            while len(self.rx_buffer) >= 4:
+                self._execute_command(self.rx_buffer[:4])
+                del self.rx_buffer[:4]
+            if self.trigger_enabled:
+                timestamp = self._get_next_trigger_time()
+                if time.time() >= timestamp:
+                    self._trigger(timestamp)
+            time.sleep(self.loop_interval_s)
 
-    def set_phase_delay(self,value):
-        pass
+    def _execute_command(self,cmd):
+        if cmd[0] == SET_FREQUENCY_HZ:
+            self.frequency_Hz = ((cmd[1] << 8) + cmd[2])/1000
+        elif cmd[0] == SET_PHASE_DELAY:
+            self.phase_delay = ((cmd[1] << 8) + cmd[2])/65535
+        elif cmd[0] == SET_NUMBER_OF_PLANES_PER_VOLUME:
+            self.number_of_planes_per_volume = (cmd[1] << 8) + cmd[2]
+        elif cmd[0] == SET_NUMBER_OF_REQUESTED_VOLUMES:
+            self.number_of_volumes_requested = (cmd[1] << 16) + (cmd[2] << 8) + cmd[3]
+        elif cmd[0] == START_TRIGGER_GENERATION:
+            self.trigger_enabled = self.frequency_Hz > 0
+            self.trigger_count = 0
+            self.volume_count = 0
+            self.plane = 0
+            self.timestamp_start = time.time()
+            self.serial.mcu_write(self._get_status_packet(self.timestamp_start))
+        elif cmd[0] == STOP_TRIGGER_GENERATION:
+            self.trigger_enabled = False
+            self.serial.mcu_write(self._get_status_packet(self.timestamp_last_trigger))
 
-    def start_trigger_generation(self):
-        pass
+    def _get_next_trigger_time(self):
+        # plane self.plane of volume self.volume_count (interval truncated to us, as the firmware)
+        period = 1/self.frequency_Hz
+        interval = int(1e6*period/self.number_of_planes_per_volume)/1e6
+        return self.timestamp_start + self.volume_count*period + (period/4)*self.phase_delay + self.plane*interval
 
-    def stop_trigger_generation(self):
-        pass
\ No newline at end of file
+    def _trigger(self,timestamp):
+        for callback in self.trigger_outputs:
+            callback(timestamp)
+        self.trigger_count = self.trigger_count + 1
+        self.timestamp_last_trigger = timestamp
+        # the volume count includes the volume being triggered
+        self.serial.mcu_write(self._get_status_packet(timestamp,self.volume_count + 1))
+        self.plane = self.plane + 1
+        if self.plane >= self.number_of_planes_per_volume:
+            self.plane = 0
+            self.volume_count = self.volume_count + 1
+            if self.number_of_volumes_requested > 0 and self.volume_count >= self.number_of_volumes_requested:
+                self.trigger_enabled = False
+
+    def _get_status_packet(self,timestamp,volume_count=None):
+        # see TriggerController.read_received_packet
+        if volume_count is None:
+            volume_count = self.volume_count
+        timestamp_us = int((timestamp - self.timestamp_clock_origin)*1e6*(1 + TriggerControllerSimulationDef.CLOCK_DRIFT_PPM*1e-6)) % 2**32
+        msg = bytearray(TriggerControllerDef.STATUS_LENGTH)
+        msg[0] = TriggerControllerDef.STATUS_HEADER
+        msg[1:5] = self.trigger_count.to_bytes(4,'big')
+        msg[5:9] = volume_count.to_bytes(4,'big')
+        msg[9:11] = self.plane.to_bytes(2,'big')
+        msg[11:15] = timestamp_us.to_bytes(4,'big')
+        msg[-1] = sum(msg[:-1]) % 256
+        return msg
@@ -0,0 +1,137 @@
+import numpy as np
+import cv2
+
+from control._def import *
+import control.utils.image_processing as image_processing
+
+class FocusMeasureEngine:
+    '''
+    Focus measure of an image (or of a ROI of it), for the volumetric imaging focus tracking.
+    The ROI is downsampled by `downsampling` with one cv2.resize (INTER_AREA) into a preallocated buffer,
+    and the metric is computed with OpenCV into preallocated float32 buffers (the buffers are cached per ROI shape):
+    'laplacian': mean square of the float32 Laplacian of the downsampled ROI, as mean^2 + std^2 from cv2.meanStdDev
+    (not the value of image_processing.calculate_focus_measure, which squares a 16-bit Laplacian of the full image), 'variance':
+    variance of the intensity, 'normalized_variance': variance/mean (less sensitive to illumination changes),
+    'tenengrad': mean square of the Sobel gradient magnitude.
+    '''
+    METRICS = ('laplacian','variance','normalized_variance','tenengrad')
+
+    def __init__(self, metric = VolumetricFocus.METRIC, downsampling = VolumetricFocus.DOWNSAMPLING, max_cached_shapes = 16):
+        if metric not in self.METRICS:
+            raise ValueError('unknown focus measure ' + str(metric))
+        self.metric = metric
+        self.downsampling = max(int(downsampling), 1)
+        self.max_cached_shapes = max_cached_shapes
+        self.buffers = {} # ROI shape -> (downsampled ROI, derivative buffer 1, derivative buffer 2)
+
+    def _get_buffers(self, shape, dtype):
+        key = (shape, dtype)
+        buffers = self.buffers.get(key)
+        if buffers is None:
+            if len(self.buffers) >= self.max_cached_shapes:
+                # the ROI follows the bounding box - drop the oldest sizes
+                del self.buffers[next(iter(self.buffers))]
+            size = (max(shape[0]//self.downsampling, 1), max(shape[1]//self.downsampling, 1))
+            buffers = (np.empty(size, dtype = dtype), np.empty(size, dtype = np.float32), np.empty(size, dtype = np.float32))
+            self.buffers[key] = buffers
+        return buffers
+
+    def measure(self, image, roi = None):
+        # roi: (x_center, y_center, width, height) in pixels of image, None for the whole image
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        if roi is not None:
+            image = image_processing.crop_roi(image, *roi)
+        if image.size == 0:
+            return 0.0
+        small, buffer1, buffer2 = self._get_buffers(image.shape, image.dtype)
+        if self.downsampling > 1:
+            cv2.resize(image, (small.shape[1], small.shape[0]), dst = small, interpolation = cv2.INTER_AREA)
+        else:
+            small = image
+        if self.metric == 'laplacian':
+            cv2.Laplacian(small, cv2.CV_32F, dst = buffer1)
+            return self._mean_square(buffer1)
+        if self.metric == 'tenengrad':
+            cv2.Sobel(small, cv2.CV_32F, 1, 0, dst = buffer1, ksize = 3)
+            cv2.Sobel(small, cv2.CV_32F, 0, 1, dst = buffer2, ksize = 3)
+            return self._mean_square(buffer1) + self._mean_square(buffer2)
+        mean, std = cv2.meanStdDev(small)
+        variance = float(std[0,0])**2
+        if self.metric == 'normalized_variance':
+            return variance/float(mean[0,0]) if mean[0,0] > 0 else 0.0
+        return variance
+
+    def _mean_square(self, data):
+        # mean(data^2) = mean^2 + std^2, without a squared temporary
+        mean, std = cv2.meanStdDev(data)
+        return float(mean[0,0])**2 + float(std[0,0])**2
+
+class IncrementalFocusFit:
+    '''
+    Fit of the focus measure vs plane position, updated as the planes arrive (running sums of the
+    least-squares normal equations, so each plane costs O(1) and the peak can be read at any time).
+    'parabola': focus measure = a + b*z + c*z^2; 'gaussian': parabola fit of log(focus measure), weighted by
+    the focus measure squared (so that the planes far from focus, where the log is noisy, count less);
+    'centroid': focus-measure weighted mean of z (the original defocus estimate).
+    The peak is -b/(2c), provided the fitted curve has a maximum (c < 0).
+    '''
+    MODELS = ('gaussian','parabola','centroid')
+
+    def __init__(self, model = VolumetricFocus.FIT_MODEL):
+        if model not in self.MODELS:
+            raise ValueError('unknown focus fit model ' + str(model))
+        self.model = model
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.z_min = None
+        self.z_max = None
+        self.sum_w_z = np.zeros(5) # sum of w*z^k, k = 0..4
+        self.sum_w_y_z = np.zeros(3) # sum of w*y*z^k, k = 0..2 (y: focus measure, or its log for 'gaussian')
+
+    def add(self, z, focus_measure):
+        if self.model == 'gaussian':
+            if focus_measure <= 0:
+                return
+            weight = focus_measure**2
+            y = np.log(focus_measure)
+        else:
+            weight = 1.0
+            y = focus_measure
+        powers = z**np.arange(5)
+        self.sum_w_z += weight*powers
+        self.sum_w_y_z += weight*y*powers[:3]
+        self.n += 1
+        self.z_min = z if self.z_min is None else min(self.z_min, z)
+        self.z_max = z if self.z_max is None else max(self.z_max, z)
+
+    def get_peak(self):
+        # z of the maximum of the fit, None if there is not (yet) one
+        if self.model == 'centroid':
+            # sum_w_z[0] counts the planes, sum_w_y_z[0] and [1] are the sums of y and y*z
+            if self.n == 0 or self.sum_w_y_z[0] <= 0:
+                return None
+            return float(self.sum_w_y_z[1]/self.sum_w_y_z[0])
+        if self.n < 3:
+            return None
+        s = self.sum_w_z
+        A = np.array([[s[0],s[1],s[2]],[s[1],s[2],s[3]],[s[2],s[3],s[4]]])
+        try:
+            a, b, c = np.linalg.solve(A, self.sum_w_y_z)
+        except np.linalg.LinAlgError:
+            return None
+        if not c < 0:
+            return None
+        return float(-b/(2*c))
+
+    def is_peak_bracketed(self, margin):
+        # the peak is inside the planes acquired so far, with margin on both sides
+        # (never for 'centroid', which is biased toward the planes acquired so far)
+        if self.model == 'centroid':
+            return False
+        peak = self.get_peak()
+        if peak is None:
+            return False
+        return self.z_min + margin <= peak <= self.z_max - margin
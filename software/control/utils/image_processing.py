@@ -47,6 +47,20 @@ def threshold_image_gray(image_gray, LOWER, UPPER):
 def bgr2gray(image_BGR):
     return cv2.cvtColor(image_BGR,cv2.COLOR_BGR2GRAY)
 
+def crop_roi(image, x_center, y_center, width, height, flipud = False, fliplr = False):
+    # ROI of the flipped image (flipud/fliplr), without flipping the whole image - returns a view
+    image_height, image_width = image.shape[0], image.shape[1]
+    if flipud:
+        y_center = image_height - 1 - y_center
+    if fliplr:
+        x_center = image_width - 1 - x_center
+    image_roi = image[max(int(y_center - height/2),0):max(min(int(y_center + height/2),image_height),0), max(int(x_center - width/2),0):max(min(int(x_center + width/2),image_width),0)]
+    if flipud:
+        image_roi = np.flipud(image_roi)
+    if fliplr:
+        image_roi = np.fliplr(image_roi)
+    return image_roi
+
 def crop(image,center,imSize): #center is the vector [x,y]
     imH,imW,*rest=image.shape  #image.shape:[nb of row -->height,nb of column --> Width]
     xmin = max(10,center[0] - int(imSize))
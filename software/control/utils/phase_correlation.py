@@ -0,0 +1,153 @@
+import numpy as np
+import scipy.fft
+
+from control._def import *
+
+class PDAFShiftEstimator:
+    '''
+    Shift between the two PDAF images along the PDAF shift axis, by phase correlation.
+    method 'projection': the images are projected onto the shift axis (the defocus shift is along one
+    axis) and correlated in 1D; '2d': full 2D correlation, with the peak searched in a band of
+    +/- perpendicular_search_px around the shift axis. The cross-power spectrum is divided by its
+    magnitude to the power whitening (1: phase correlation, 0: cross-correlation). The apodization
+    windows and the zero-padded FFT input buffers are cached per ROI shape. The window of image2 is
+    then moved with the estimated shift and the correlation repeated (up to n_iterations), so that the
+    window does not pull the estimate toward zero; the sub-pixel peak position is refined with a
+    parabola through the peak and its two neighbours.
+    Returns (shift, error) with the conventions of skimage.registration.phase_cross_correlation
+    (the shift that registers image2 with image1), error = sqrt(1 - r^2) where r is the correlation
+    coefficient of the two (windowed) images at the integer shift.
+    '''
+    def __init__(self, shift_axis = PDAF_SHIFT_AXIS, method = PDAFShiftEstimation.METHOD, max_shift_ratio = PDAFShiftEstimation.MAX_SHIFT_RATIO,
+        perpendicular_search_px = PDAFShiftEstimation.PERPENDICULAR_SEARCH_PX, whitening = PDAFShiftEstimation.WHITENING,
+        n_iterations = PDAFShiftEstimation.N_ITERATIONS, max_cached_shapes = PDAFShiftEstimation.MAX_CACHED_SHAPES):
+        self.axis = 1 if shift_axis == 'X' else 0
+        self.method = method
+        self.max_shift_ratio = max_shift_ratio # max |shift| as a fraction of the ROI size along the shift axis
+        self.perpendicular_search_px = perpendicular_search_px
+        self.whitening = whitening
+        self.n_iterations = n_iterations
+        self.max_cached_shapes = max_cached_shapes
+        self.workspaces = {} # (method, shape) -> (padded window along the shift axis, window across, FFT buffer 1, FFT buffer 2)
+
+    def _get_workspace(self, shape):
+        key = (self.method, shape)
+        workspace = self.workspaces.get(key)
+        if workspace is None:
+            if len(self.workspaces) >= self.max_cached_shapes:
+                # the ROI follows the bounding box - drop the oldest sizes
+                del self.workspaces[next(iter(self.workspaces))]
+            n = shape[self.axis]
+            # zeros on both sides, so that the window can be moved by up to n
+            window_padded = np.zeros(3*n, dtype = np.float32)
+            window_padded[n:2*n] = np.hanning(n)
+            if self.method == 'projection':
+                window_across = None
+                # zero padding to twice the length, so that the correlation does not wrap around
+                size = (scipy.fft.next_fast_len(2*n, real = True),)
+            else:
+                window_across = np.hanning(shape[1 - self.axis]).astype(np.float32)
+                size = (scipy.fft.next_fast_len(shape[0], real = True), scipy.fft.next_fast_len(shape[1], real = True))
+            workspace = (window_padded, window_across, np.zeros(size, dtype = np.float32), np.zeros(size, dtype = np.float32))
+            self.workspaces[key] = workspace
+        return workspace
+
+    def _get_window(self, workspace, offset):
+        # apodization window moved by offset pixels along the shift axis
+        window_padded, window_across = workspace[0], workspace[1]
+        n = len(window_padded)//3
+        offset = int(np.clip(offset, -n, n))
+        window = window_padded[n - offset:2*n - offset]
+        if window_across is None:
+            return window
+        return np.outer(window, window_across) if self.axis == 0 else np.outer(window_across, window)
+
+    def _reduce(self, image):
+        # mean-subtracted projection onto the shift axis ('projection') or image ('2d')
+        if self.method == 'projection':
+            data = image.mean(axis = 1 - self.axis, dtype = np.float32)
+        else:
+            data = image.astype(np.float32)
+        return data - data.mean()
+
+    def _transform(self, data, window, buffer):
+        data = data*window
+        buffer[tuple(slice(0,n) for n in data.shape)] = data
+        return data, scipy.fft.rfftn(buffer)
+
+    def estimate(self, image1, image2):
+        if image1.shape != image2.shape:
+            raise ValueError('the two images must have the same shape')
+        workspace = self._get_workspace(image1.shape)
+        buffer1, buffer2 = workspace[2], workspace[3]
+        axis = 0 if self.method == 'projection' else self.axis
+        data1, spectrum1 = self._transform(self._reduce(image1), self._get_window(workspace, 0), buffer1)
+        reduced2 = self._reduce(image2)
+        max_shift = max(int(data1.shape[axis]*self.max_shift_ratio), 1)
+        offset = 0
+        for iteration in range(self.n_iterations):
+            data2, spectrum2 = self._transform(reduced2, self._get_window(workspace, offset), buffer2)
+            shift, integer_shifts = self._find_peak(spectrum1, spectrum2, buffer1.shape, max_shift)
+            # the content of image2 is displaced by -shift - move the window of image2 with it
+            if -integer_shifts[axis] == offset:
+                break
+            offset = -integer_shifts[axis]
+        return shift, self._compute_error(data1, data2, integer_shifts)
+
+    def _find_peak(self, spectrum1, spectrum2, size, max_shift):
+        # (partially whitened) phase correlation
+        cross_power = spectrum1*np.conj(spectrum2)
+        if self.whitening > 0:
+            magnitude = np.abs(cross_power)
+            if self.whitening == 0.5:
+                magnitude = np.sqrt(magnitude)
+            elif self.whitening != 1:
+                magnitude = np.power(magnitude, self.whitening)
+            cross_power /= np.maximum(magnitude, 100*np.finfo(np.float32).eps)
+        correlation = scipy.fft.irfftn(cross_power, s = size)
+
+        # restrict the search to the plausible shifts (shift k is at index k mod size)
+        if self.method == 'projection':
+            candidates = np.r_[0:max_shift+1, -max_shift:0]
+            shift_index = candidates[np.argmax(correlation[candidates])]
+            shift = float(shift_index) + self._refine(correlation, shift_index)
+            return shift, (int(shift_index),)
+        size_axis = correlation.shape[self.axis]
+        size_across = correlation.shape[1 - self.axis]
+        candidates = np.r_[0:max_shift+1, -max_shift:0] % size_axis
+        across = np.r_[0:self.perpendicular_search_px+1, -self.perpendicular_search_px:0] % size_across
+        band = correlation[np.ix_(candidates, across)] if self.axis == 0 else correlation[np.ix_(across, candidates)].T
+        i, j = np.unravel_index(np.argmax(band), band.shape)
+        peak = [candidates[i], across[j]] if self.axis == 0 else [across[j], candidates[i]]
+        integer_shifts = tuple(int(p) if p <= correlation.shape[d]//2 else int(p) - correlation.shape[d] for d, p in enumerate(peak))
+        profile = correlation[:, peak[1]] if self.axis == 0 else correlation[peak[0], :]
+        shift = integer_shifts[self.axis] + self._refine(profile, peak[self.axis])
+        return shift, integer_shifts
+
+    def _refine(self, correlation, index):
+        # vertex of the parabola through the peak and its neighbours (circular indexing)
+        size = len(correlation)
+        y0 = correlation[(index - 1) % size]
+        y1 = correlation[index % size]
+        y2 = correlation[(index + 1) % size]
+        denominator = y0 - 2*y1 + y2
+        if denominator >= 0:
+            return 0.0
+        return float(np.clip(0.5*(y0 - y2)/denominator, -0.5, 0.5))
+
+    def _compute_error(self, data1, data2, integer_shifts):
+        # correlation coefficient over the overlap of image1 and the shifted image2
+        slices1 = []
+        slices2 = []
+        for k, n in zip(integer_shifts, data1.shape):
+            k = int(np.clip(k, -n + 1, n - 1))
+            slices1.append(slice(max(k,0), n + min(k,0)))
+            slices2.append(slice(max(-k,0), n + min(-k,0)))
+        a = data1[tuple(slices1)]
+        b = data2[tuple(slices2)]
+        energy = np.sqrt(np.sum(a*a)*np.sum(b*b))
+        if energy == 0:
+            return 1.0
+        r = np.sum(a*b)/energy
+        r = max(r, 0) # anti-correlated images do not match
+        return float(np.sqrt(max(1 - r*r, 0)))
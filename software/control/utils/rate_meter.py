@@ -0,0 +1,65 @@
+import time
+import math
+
+from control._def import *
+
+class RateMeter:
+    '''
+    Event rate from a time-weighted exponential moving average of the inter-event interval
+    (monotonic clock, O(1) per event, no allocation). Also tracks the interval jitter (standard
+    deviation) and, with detect_drops, the number of missing events (intervals longer than
+    drop_factor times the expected interval, which is the averaged interval unless set).
+    tick() returns True at most once per publish interval, when the values should be published.
+    '''
+    def __init__(self, tau_s = RateMeasurement.TAU_S, publish_interval_s = RateMeasurement.PUBLISH_INTERVAL_S,
+        detect_drops = False, drop_factor = RateMeasurement.DROP_FACTOR, expected_interval_s = None):
+        self.tau_s = tau_s
+        self.publish_interval_s = publish_interval_s
+        self.detect_drops = detect_drops
+        self.drop_factor = drop_factor
+        self.expected_interval_s = expected_interval_s
+        self.reset()
+
+    def reset(self):
+        self.timestamp_last = None
+        self.timestamp_last_publish = 0
+        self.interval_mean = None # unit: s
+        self.interval_var = 0 # unit: s^2
+        self.n_events = 0
+        self.n_dropped = 0
+
+    def set_expected_rate(self, rate):
+        self.expected_interval_s = 1.0/rate if rate is not None and rate > 0 else None
+
+    def tick(self, timestamp = None):
+        timestamp = time.perf_counter() if timestamp is None else timestamp
+        self.n_events = self.n_events + 1
+        if self.timestamp_last is not None:
+            dt = timestamp - self.timestamp_last
+            if self.interval_mean is None:
+                self.interval_mean = dt
+            else:
+                if self.detect_drops:
+                    expected = self.expected_interval_s if self.expected_interval_s is not None else self.interval_mean
+                    if expected > 0 and dt > self.drop_factor*expected:
+                        self.n_dropped = self.n_dropped + max(int(round(dt/expected)) - 1,1)
+                # the weight of an interval grows with its length, so that the average covers ~tau_s whatever the rate
+                alpha = 1 - math.exp(-dt/self.tau_s)
+                deviation = dt - self.interval_mean
+                self.interval_mean = self.interval_mean + alpha*deviation
+                self.interval_var = (1 - alpha)*(self.interval_var + alpha*deviation*deviation)
+        self.timestamp_last = timestamp
+        if timestamp - self.timestamp_last_publish >= self.publish_interval_s:
+            self.timestamp_last_publish = timestamp
+            return True
+        return False
+
+    def get_rate(self, timestamp = None):
+        # events/s; decays when the events stop
+        if self.interval_mean is None or self.interval_mean <= 0:
+            return 0
+        timestamp = time.perf_counter() if timestamp is None else timestamp
+        return 1.0/max(self.interval_mean, timestamp - self.timestamp_last)
+
+    def get_jitter_ms(self):
+        return 1000*math.sqrt(self.interval_var)
@@ -0,0 +1,96 @@
+import time
+from threading import Thread, Lock
+
+from control._def import *
+from control.utils.rate_meter import RateMeter
+
+class TriggerScheduler:
+    '''
+    Calls function() at a fixed rate from a dedicated thread. The deadlines are absolute
+    (t0 + n*period on the monotonic time.perf_counter clock), so that errors do not accumulate:
+    the thread sleeps until busy_wait_s before each deadline and spins for the rest. Deadlines
+    that have already passed when a call returns are skipped (counted in n_skipped) rather than
+    fired back to back. The achieved rate and period jitter are measured at the trigger times;
+    on_statistics(fps, jitter_ms, lateness_max_ms, n_skipped) is called once per publish interval.
+    '''
+    def __init__(self, function, fps, busy_wait_s = TriggerScheduling.BUSY_WAIT_S, on_statistics = None):
+        self.function = function
+        self.period = 1.0/fps
+        self.period_changed = False
+        self.busy_wait_s = busy_wait_s
+        self.on_statistics = on_statistics
+        self.lock = Lock()
+        self.thread = None
+        self.stop_signal_received = False
+        self.rate_meter = RateMeter()
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.rate_meter.reset()
+        self.n_triggers = 0
+        self.n_skipped = 0
+        self.lateness_max = 0 # unit: s, max delay of a trigger after its deadline since the last publish
+
+    def is_running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_signal_received = False
+        self.reset_statistics()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_signal_received = True
+        self.thread.join()
+        self.thread = None
+
+    def set_fps(self, fps):
+        # takes effect at the next deadline, counted from the last trigger
+        with self.lock:
+            self.period = 1.0/fps
+            self.period_changed = True
+
+    def run(self):
+        with self.lock:
+            period = self.period
+            self.period_changed = False
+        t0 = time.perf_counter()
+        n = 0
+        while self.stop_signal_received == False:
+            deadline = t0 + n*period
+            remaining = deadline - time.perf_counter()
+            if remaining > self.busy_wait_s:
+                # sleep in short steps so that stop() returns quickly at low rates
+                time.sleep(min(remaining - self.busy_wait_s, TriggerScheduling.MAX_SLEEP_S))
+                continue
+            while time.perf_counter() < deadline:
+                pass
+            timestamp = time.perf_counter()
+            try:
+                self.function()
+            except Exception as e:
+                print('trigger error: ' + str(e))
+            self.n_triggers = self.n_triggers + 1
+            self.lateness_max = max(self.lateness_max, timestamp - deadline)
+            if self.rate_meter.tick(timestamp):
+                if self.on_statistics is not None:
+                    self.on_statistics(self.rate_meter.get_rate(timestamp), self.rate_meter.get_jitter_ms(), 1000*self.lateness_max, self.n_skipped)
+                self.lateness_max = 0
+            with self.lock:
+                if self.period_changed:
+                    # new rate: restart the deadlines from this trigger
+                    period = self.period
+                    self.period_changed = False
+                    t0 = deadline
+                    n = 0
+            n = n + 1
+            # skip the deadlines missed while the trigger function ran
+            n_missed = int((time.perf_counter() - (t0 + n*period))/period)
+            if n_missed > 0:
+                self.n_skipped = self.n_skipped + n_missed
+                n = n + n_missed
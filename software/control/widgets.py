@@ -83,6 +83,25 @@ class CameraSettingsWidget(QFrame):
 		self.actual_streamFPS.setNumDigits(4)
 		self.actual_streamFPS.display(0.0)
 
+		# inter-frame jitter and dropped frames
+		self.actual_jitter = QLCDNumber()
+		self.actual_jitter.setNumDigits(4)
+		self.actual_jitter.display(0.0)
+		self.actual_dropped = QLCDNumber()
+		self.actual_dropped.setNumDigits(6)
+		self.actual_dropped.display(0)
+
+		# achieved trigger rate, trigger period jitter and skipped triggers
+		self.actual_triggerFPS = QLCDNumber()
+		self.actual_triggerFPS.setNumDigits(4)
+		self.actual_triggerFPS.display(0.0)
+		self.actual_trigger_jitter = QLCDNumber()
+		self.actual_trigger_jitter.setNumDigits(4)
+		self.actual_trigger_jitter.display(0.0)
+		self.actual_trigger_skipped = QLCDNumber()
+		self.actual_trigger_skipped.setNumDigits(6)
+		self.actual_trigger_skipped.display(0)
+
 		# connection
 		self.btn_Preset.clicked.connect(self.load_preset)
 		self.entry_exposureTime.valueChanged.connect(self.camera.set_exposure_time)
@@ -91,6 +110,7 @@ class CameraSettingsWidget(QFrame):
 		self.entry_analogGain_Preset.valueChanged.connect(self.liveController.set_analog_gain_bfdf_preset)
 		self.entry_triggerFPS.valueChanged.connect(self.liveController.set_trigger_fps)
 		self.dropdown_triggerMode.currentIndexChanged.connect(self.update_trigger_mode)
+		self.liveController.signal_trigger_statistics.connect(self.update_trigger_statistics)
 
 		# Sub-blocks layout
 		grid_ctrl = QGridLayout()
@@ -111,6 +131,16 @@ class CameraSettingsWidget(QFrame):
 		trigger_fps_layout.addWidget(self.entry_triggerFPS, 0,1)
 		trigger_fps_layout.addWidget(QLabel('Actual'),0,2)
 		trigger_fps_layout.addWidget(self.actual_streamFPS, 0,3)
+		trigger_fps_layout.addWidget(QLabel('Jitter (ms)'),1,0)
+		trigger_fps_layout.addWidget(self.actual_jitter, 1,1)
+		trigger_fps_layout.addWidget(QLabel('Dropped'),1,2)
+		trigger_fps_layout.addWidget(self.actual_dropped, 1,3)
+		trigger_fps_layout.addWidget(QLabel('Triggers/s'),2,0)
+		trigger_fps_layout.addWidget(self.actual_triggerFPS, 2,1)
+		trigger_fps_layout.addWidget(QLabel('Trigger jitter (ms)'),2,2)
+		trigger_fps_layout.addWidget(self.actual_trigger_jitter, 2,3)
+		trigger_fps_layout.addWidget(QLabel('Skipped triggers'),3,0)
+		trigger_fps_layout.addWidget(self.actual_trigger_skipped, 3,1)
 		trigger_fps_group.setLayout(trigger_fps_layout)
 
 		triggerMode_layout = QHBoxLayout()
@@ -142,6 +172,120 @@ class CameraSettingsWidget(QFrame):
 	def update_stream_fps(self, value):
 		self.actual_streamFPS.display(value)
 
+	# Slot connected to signal from streamHandler.
+	def update_frame_statistics(self, jitter_ms, n_dropped):
+		self.actual_jitter.display(round(jitter_ms,2))
+		self.actual_dropped.display(n_dropped)
+
+	# Slot connected to signal from liveController (trigger scheduler).
+	def update_trigger_statistics(self, fps, jitter_ms, n_skipped):
+		self.actual_triggerFPS.display(fps)
+		self.actual_trigger_jitter.display(round(jitter_ms,3))
+		self.actual_trigger_skipped.display(n_skipped)
+
+class SynchronizedAcquisitionWidget(QFrame):
+	'''
+	Live acquisition of the synchronized cameras from one hardware trigger, and the pairing statistics.
+	'''
+	def __init__(self, synchronizedLiveController, framePairer, liveController, main=None, *args, **kwargs):
+
+		super().__init__(*args, **kwargs)
+		self.synchronizedLiveController = synchronizedLiveController
+		self.framePairer = framePairer
+		self.liveController = liveController
+		self.channels_live_before = []
+
+		self.add_components()
+		self.setFrameStyle(QFrame.Panel | QFrame.Raised)
+
+	def add_components(self):
+		self.btn_live = QPushButton('Synchronized Live (' + ', '.join(self.framePairer.channels) + ')')
+		self.btn_live.setCheckable(True)
+		self.btn_live.setChecked(False)
+		self.btn_live.setDefault(False)
+
+		self.entry_triggerFPS = QDoubleSpinBox()
+		self.entry_triggerFPS.setMinimum(FPS['trigger_software']['min']) 
+		self.entry_triggerFPS.setMaximum(FPS['trigger_software']['max']) 
+		self.entry_triggerFPS.setSingleStep(1)
+		self.entry_triggerFPS.setValue(self.synchronizedLiveController.fps_trigger)
+
+		self.entry_tolerance = QDoubleSpinBox()
+		self.entry_tolerance.setMinimum(0.1) 
+		self.entry_tolerance.setMaximum(1000) 
+		self.entry_tolerance.setSingleStep(1)
+		self.entry_tolerance.setValue(self.framePairer.timestamp_tolerance_ms)
+
+		self.actual_pairFPS = QLCDNumber()
+		self.actual_pairFPS.setNumDigits(4)
+		self.actual_pairFPS.display(0.0)
+		self.actual_paired = QLCDNumber()
+		self.actual_paired.setNumDigits(7)
+		self.actual_paired.display(0)
+		self.actual_unpaired = QLCDNumber()
+		self.actual_unpaired.setNumDigits(6)
+		self.actual_unpaired.display(0)
+		self.actual_mismatched = QLCDNumber()
+		self.actual_mismatched.setNumDigits(6)
+		self.actual_mismatched.display(0)
+		self.actual_triggerFPS = QLCDNumber()
+		self.actual_triggerFPS.setNumDigits(4)
+		self.actual_triggerFPS.display(0.0)
+		self.actual_trigger_jitter = QLCDNumber()
+		self.actual_trigger_jitter.setNumDigits(4)
+		self.actual_trigger_jitter.display(0.0)
+
+		# connection
+		self.btn_live.clicked.connect(self.toggle_live)
+		self.entry_triggerFPS.valueChanged.connect(self.synchronizedLiveController.set_trigger_fps)
+		self.entry_tolerance.valueChanged.connect(self.framePairer.set_timestamp_tolerance_ms)
+		self.synchronizedLiveController.signal_trigger_statistics.connect(self.update_trigger_statistics)
+
+		grid = QGridLayout()
+		grid.addWidget(self.btn_live,0,0,1,4)
+		grid.addWidget(QLabel('Trigger FPS'),1,0)
+		grid.addWidget(self.entry_triggerFPS,1,1)
+		grid.addWidget(QLabel('Tolerance (ms)'),1,2)
+		grid.addWidget(self.entry_tolerance,1,3)
+		grid.addWidget(QLabel('Pairs/s'),2,0)
+		grid.addWidget(self.actual_pairFPS,2,1)
+		grid.addWidget(QLabel('Paired'),2,2)
+		grid.addWidget(self.actual_paired,2,3)
+		grid.addWidget(QLabel('Unpaired frames'),3,0)
+		grid.addWidget(self.actual_unpaired,3,1)
+		grid.addWidget(QLabel('Mismatched'),3,2)
+		grid.addWidget(self.actual_mismatched,3,3)
+		grid.addWidget(QLabel('Triggers/s'),4,0)
+		grid.addWidget(self.actual_triggerFPS,4,1)
+		grid.addWidget(QLabel('Trigger jitter (ms)'),4,2)
+		grid.addWidget(self.actual_trigger_jitter,4,3)
+		grid.setRowStretch(grid.rowCount(), 1)
+		self.setLayout(grid)
+
+	def toggle_live(self, pressed):
+		if pressed:
+			# the synchronized cameras are triggered by the synchronized live controller only
+			self.channels_live_before = [key for key in self.framePairer.channels if self.liveController[key].is_live]
+			for key in self.channels_live_before:
+				self.liveController[key].stop_live()
+			self.synchronizedLiveController.start_live()
+		else:
+			self.synchronizedLiveController.stop_live()
+			for key in self.channels_live_before:
+				self.liveController[key].start_live()
+
+	# Slot connected to signal from framePairer.
+	def update_pairing_statistics(self, fps, n_paired, n_unpaired, n_mismatched):
+		self.actual_pairFPS.display(fps)
+		self.actual_paired.display(n_paired)
+		self.actual_unpaired.display(n_unpaired)
+		self.actual_mismatched.display(n_mismatched)
+
+	# Slot connected to signal from synchronizedLiveController (trigger scheduler).
+	def update_trigger_statistics(self, fps, jitter_ms, n_skipped):
+		self.actual_triggerFPS.display(fps)
+		self.actual_trigger_jitter.display(round(jitter_ms,3))
+
 class LiveControlWidget(QFrame):
 	'''
 	Widget controls salient microscopy parameters such as:
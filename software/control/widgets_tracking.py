@@ -17,6 +17,7 @@ from pyqtgraph.dockarea.Dock import DockLabel
 
 from control._def import *
 from control.utils import rangeslider as rangeslider
+import control.latency_tracing as latency_tracing
 
 class TrackingControllerWidget(QFrame):
 	'''
@@ -735,11 +736,12 @@ class NavigationWidget(QFrame):
 		self.label_z_limit_pos.setText('+inf')
 
 class PID_Group_Widget(QFrame):
-	def __init__(self, trackingController):
+	def __init__(self, trackingController, pidAutoTuningController = None):
 		super().__init__()
 		# self.setTitle('PID settings')
 		self.setFrameStyle(QFrame.Panel | QFrame.Raised)
 		self.trackingController = trackingController
+		self.pidAutoTuningController = pidAutoTuningController
 		self.add_components()
 
 	def add_components(self):
@@ -754,6 +756,33 @@ class PID_Group_Widget(QFrame):
 		layout.addWidget(self.PID_widget_y,1,1,1,16)
 		layout.addWidget(QLabel('Z'),2,0,1,1)
 		layout.addWidget(self.PID_widget_z,2,1,1,16)
+
+		if self.pidAutoTuningController is not None:
+			self.dropdown_autotuning_axis = QComboBox()
+			self.dropdown_autotuning_axis.addItems(['X','Y','Z'])
+			self.dropdown_autotuning_rule = QComboBox()
+			self.dropdown_autotuning_rule.addItems(['Tyreus-Luyben','Ziegler-Nichols'])
+			self.dropdown_autotuning_rule.setCurrentText(PID_autotuning.RULE)
+			self.btn_autotune = QPushButton('Auto-tune')
+			self.btn_autotune.setDefault(False)
+			self.btn_load_saved_gains = QPushButton('Load saved')
+			self.btn_load_saved_gains.setDefault(False)
+			self.label_autotuning_status = QLabel('')
+
+			autotuning_layout = QHBoxLayout()
+			autotuning_layout.addWidget(self.dropdown_autotuning_axis)
+			autotuning_layout.addWidget(self.dropdown_autotuning_rule)
+			autotuning_layout.addWidget(self.btn_autotune)
+			autotuning_layout.addWidget(self.btn_load_saved_gains)
+			autotuning_layout.addWidget(self.label_autotuning_status)
+			layout.addLayout(autotuning_layout,3,0,1,17)
+
+			self.dropdown_autotuning_rule.currentTextChanged.connect(self.pidAutoTuningController.set_rule)
+			self.btn_autotune.clicked.connect(self.start_autotuning)
+			self.btn_load_saved_gains.clicked.connect(self.load_saved_gains)
+			self.pidAutoTuningController.signal_tuning_finished.connect(self.set_gains)
+			self.pidAutoTuningController.signal_tuning_status.connect(self.label_autotuning_status.setText)
+
 		self.setLayout(layout)
 
 		# Connections
@@ -770,6 +799,22 @@ class PID_Group_Widget(QFrame):
 		self.PID_widget_z.spinboxI.valueChanged.connect(self.trackingController.pid_controller_z.update_I)
 		self.PID_widget_z.spinboxD.valueChanged.connect(self.trackingController.pid_controller_z.update_D)
 
+	def start_autotuning(self):
+		self.pidAutoTuningController.start_tuning(self.dropdown_autotuning_axis.currentText())
+
+	def load_saved_gains(self):
+		for axis in ['X','Y','Z']:
+			gains = self.pidAutoTuningController.get_saved_gains(axis)
+			if gains is not None:
+				self.set_gains(axis,*gains)
+
+	# slot connected to signal_tuning_finished; setting the spinboxes updates the PID controllers
+	def set_gains(self, axis, P, I, D):
+		PID_widget = {'X':self.PID_widget_x, 'Y':self.PID_widget_y, 'Z':self.PID_widget_z}[axis]
+		PID_widget.spinboxP.setValue(P)
+		PID_widget.spinboxI.setValue(I)
+		PID_widget.spinboxD.setValue(D)
+
 class PID_Widget(QFrame):
 	
 	def __init__(self,name,Pmax=2,Dmax=1,Imax=1):
@@ -868,9 +913,10 @@ class PID_Widget(QFrame):
 		self.hsliderD.setValue(int(value*100))
 
 class PDAFControllerWidget(QFrame):
-	def __init__(self, PDAFController, main=None, *args, **kwargs):
+	def __init__(self, PDAFController, calibrationController = None, main=None, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.PDAFController = PDAFController
+		self.calibrationController = calibrationController
 		self.add_components()
 		self.setFrameStyle(QFrame.Panel | QFrame.Raised)
 
@@ -898,8 +944,9 @@ class PDAFControllerWidget(QFrame):
 		self.entry_ROI_ratio_height.setValue(PDAF.ROI_ratio_height_default)
 
 		self.entry_shift_to_distance_um = QDoubleSpinBox()
-		self.entry_shift_to_distance_um.setMinimum(-10) 
-		self.entry_shift_to_distance_um.setMaximum(10) 
+		self.entry_shift_to_distance_um.setMinimum(-1000) 
+		self.entry_shift_to_distance_um.setMaximum(1000) 
+		self.entry_shift_to_distance_um.setDecimals(3)
 		self.entry_shift_to_distance_um.setSingleStep(0.1)
 		self.entry_shift_to_distance_um.setValue(PDAF.shift_to_distance_um_default)
 
@@ -933,6 +980,12 @@ class PDAFControllerWidget(QFrame):
 		self.display_defocus_um.setNumDigits(4)
 		self.display_error = QLCDNumber()
 		self.display_error.setNumDigits(4)
+		self.display_processing_time_ms = QLCDNumber()
+		self.display_processing_time_ms.setNumDigits(4)
+		self.display_skip_rate = QLCDNumber()
+		self.display_skip_rate.setNumDigits(4)
+		self.display_processing_fps = QLCDNumber()
+		self.display_processing_fps.setNumDigits(4)
 		
 		grid_line0 = QGridLayout()
 		grid_line0.addWidget(QLabel('X Crop Offset'), 0,0)
@@ -949,6 +1002,12 @@ class PDAFControllerWidget(QFrame):
 		grid_line0.addWidget(self.display_defocus_um, 3,1,1,1)
 		grid_line0.addWidget(QLabel('Error'), 3,2,1,1)
 		grid_line0.addWidget(self.display_error, 3,3,1,1)
+		grid_line0.addWidget(QLabel('Processing Time (ms)'), 4,0,1,1)
+		grid_line0.addWidget(self.display_processing_time_ms, 4,1,1,1)
+		grid_line0.addWidget(QLabel('Skipped Pairs (%)'), 4,2,1,1)
+		grid_line0.addWidget(self.display_skip_rate, 4,3,1,1)
+		grid_line0.addWidget(QLabel('Pairs/s'), 5,0,1,1)
+		grid_line0.addWidget(self.display_processing_fps, 5,1,1,1)
 
 		self.grid = QGridLayout()
 		self.grid.addLayout(grid_line0,0,0)
@@ -963,6 +1022,41 @@ class PDAFControllerWidget(QFrame):
 		vbox.addLayout(self.grid)
 		vbox.addStretch()
 		vbox.addLayout(self.grid2)
+
+		if self.calibrationController is not None:
+			# automated calibration: z sweep around the current (in focus) position
+			self.entry_calibration_z_range_um = QDoubleSpinBox()
+			self.entry_calibration_z_range_um.setMinimum(1)
+			self.entry_calibration_z_range_um.setMaximum(2000)
+			self.entry_calibration_z_range_um.setSingleStep(10)
+			self.entry_calibration_z_range_um.setValue(PDAFCalibration.Z_RANGE_UM)
+			self.entry_calibration_NZ = QSpinBox()
+			self.entry_calibration_NZ.setMinimum(3)
+			self.entry_calibration_NZ.setMaximum(200)
+			self.entry_calibration_NZ.setValue(PDAFCalibration.N_Z)
+			self.btn_calibrate = QPushButton('Calibrate')
+			self.btn_calibrate.setDefault(False)
+			self.btn_load_saved_calibration = QPushButton('Load saved')
+			self.btn_load_saved_calibration.setDefault(False)
+			self.label_calibration_status = QLabel('')
+
+			self.grid3 = QGridLayout()
+			self.grid3.addWidget(QLabel('calibration z range (um)'),0,0)
+			self.grid3.addWidget(self.entry_calibration_z_range_um,0,1)
+			self.grid3.addWidget(QLabel('Nz'),0,2)
+			self.grid3.addWidget(self.entry_calibration_NZ,0,3)
+			self.grid3.addWidget(self.btn_calibrate,1,0,1,2)
+			self.grid3.addWidget(self.btn_load_saved_calibration,1,2,1,2)
+			self.grid3.addWidget(self.label_calibration_status,2,0,1,4)
+			vbox.addLayout(self.grid3)
+
+			self.entry_calibration_z_range_um.valueChanged.connect(self.calibrationController.set_calibration_z_range_um)
+			self.entry_calibration_NZ.valueChanged.connect(self.calibrationController.set_calibration_NZ)
+			self.btn_calibrate.clicked.connect(self.calibrationController.start_calibration)
+			self.btn_load_saved_calibration.clicked.connect(self.load_saved_calibration)
+			self.calibrationController.signal_calibration_status.connect(self.label_calibration_status.setText)
+			self.calibrationController.signal_calibration_finished.connect(self.set_calibration)
+
 		self.setLayout(vbox)
 
 		# self.btn_enable_calculation.clicked.connect(self.PDAFController.enable_caculation)
@@ -971,17 +1065,38 @@ class PDAFControllerWidget(QFrame):
 		self.entry_y_offset.valueChanged.connect(self.PDAFController.set_y_offset)
 		self.entry_ROI_ratio_width.valueChanged.connect(self.PDAFController.set_ROI_ratio_width)
 		self.entry_ROI_ratio_height.valueChanged.connect(self.PDAFController.set_ROI_ratio_height)
-		self.entry_shift_to_distance_um.valueChanged.connect(self.PDAFController.set_ROI_ratio_height)
+		self.entry_shift_to_distance_um.valueChanged.connect(self.PDAFController.set_shift_to_distance_um)
 
 		self.btn_enable_calculation.clicked.connect(self.enable_caculation)
 		self.btn_enable_tracking.clicked.connect(self.enable_tracking)
 
 		self.PDAFController.signal_defocus_um_display.connect(self.display_defocus_um.display)
 		self.PDAFController.signal_error.connect(self.display_error.display)
+		self.PDAFController.signal_processing_statistics.connect(self.update_processing_statistics)
 
 		self.entry_tracking_range_min_um.valueChanged.connect(self.PDAFController.set_defocus_um_for_enable_tracking_min)
 		self.entry_tracking_range_max_um.valueChanged.connect(self.PDAFController.set_defocus_um_for_enable_tracking_max)
 
+	def load_saved_calibration(self):
+		objective = self.PDAFController.internal_state.data['Objective']
+		calibration = self.calibrationController.get_saved_calibration(objective)
+		if calibration is None:
+			self.label_calibration_status.setText('no saved calibration for ' + str(objective))
+			return
+		self.set_calibration(*calibration)
+		self.label_calibration_status.setText('loaded the calibration of ' + str(objective))
+
+	# setting the spinboxes updates the PDAF controller
+	def set_calibration(self, shift_to_distance_um, x_offset, y_offset):
+		self.entry_shift_to_distance_um.setValue(shift_to_distance_um)
+		self.entry_x_offset.setValue(x_offset)
+		self.entry_y_offset.setValue(y_offset)
+
+	def update_processing_statistics(self,processing_time_ms,skip_rate,fps):
+		self.display_processing_time_ms.display(round(processing_time_ms,1))
+		self.display_skip_rate.display(round(skip_rate))
+		self.display_processing_fps.display(round(fps,1))
+
 	def enable_caculation(self,pressed):
 		if pressed:
 			self.PDAFController.enable_caculation(True)
@@ -999,4 +1114,56 @@ class PDAFControllerWidget(QFrame):
 			self.PDAFController.enable_tracking(True)
 		else:
 			self.PDAFController.enable_tracking(False)
-			
\ No newline at end of file
+			
+class LatencyWidget(QFrame):
+	'''
+	Percentile latencies of the tracking pipeline stages (relative to the camera callback),
+	from the ring of the LatencyTracer; the ring can be written to a csv file
+	'''
+	def __init__(self, latencyTracer, main=None, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.latencyTracer = latencyTracer
+		self.add_components()
+		self.setFrameStyle(QFrame.Panel | QFrame.Raised)
+
+		self.timer_update = QTimer()
+		self.timer_update.setInterval(LatencyTracing.DISPLAY_UPDATE_INTERVAL_MS)
+		self.timer_update.timeout.connect(self.update_display)
+		self.timer_update.start()
+
+	def add_components(self):
+		self.stages = latency_tracing.STAGES[1:]
+		self.table = QTableWidget(len(self.stages),len(LatencyTracing.PERCENTILES)+1)
+		self.table.setHorizontalHeaderLabels(['p' + str(p) + ' (ms)' for p in LatencyTracing.PERCENTILES] + ['frames'])
+		self.table.setVerticalHeaderLabels(self.stages)
+		self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+
+		self.btn_reset = QPushButton('Reset')
+		self.btn_dump = QPushButton('Save Trace')
+
+		hbox = QHBoxLayout()
+		hbox.addWidget(self.btn_reset)
+		hbox.addWidget(self.btn_dump)
+
+		vbox = QVBoxLayout()
+		vbox.addWidget(self.table)
+		vbox.addLayout(hbox)
+		self.setLayout(vbox)
+
+		self.btn_reset.clicked.connect(self.latencyTracer.reset)
+		self.btn_dump.clicked.connect(self.dump)
+
+	def update_display(self):
+		if self.isVisible() == False:
+			return
+		percentiles = self.latencyTracer.get_percentiles()
+		for i, stage in enumerate(self.stages):
+			values, n = percentiles[stage]
+			for j, value in enumerate(values):
+				self.table.setItem(i,j,QTableWidgetItem('-' if np.isnan(value) else '{:.2f}'.format(value)))
+			self.table.setItem(i,len(values),QTableWidgetItem(str(n)))
+
+	def dump(self):
+		path, _ = QFileDialog.getSaveFileName(None, 'Save latency trace', 'latency_trace.csv', 'CSV (*.csv)')
+		if path:
+			self.latencyTracer.dump(path)
@@ -132,6 +132,17 @@ class VolumetricImagingWidget(QFrame):
         grid1.addWidget(QLabel('Focus Offset'),8,2,1,1)
         grid1.addWidget(self.entry_focus_offset,8,3,1,1)
 
+        self.checkbox_lens_focus_tracking = QCheckBox('Focus with Liquid Lens')
+        self.checkbox_lens_focus_tracking.setChecked(LensFocus.ENABLED)
+        self.checkbox_lens_focus_tracking.stateChanged.connect(lambda state:self.volumetricImagingController.enable_lens_focus_tracking(state == Qt.Checked))
+        grid1.addWidget(self.checkbox_lens_focus_tracking,9,0,1,2)
+
+        self.display_lens_offset = QLCDNumber()
+        self.display_lens_offset.setNumDigits(5)
+        self.volumetricImagingController.signal_lens_offset.connect(self.display_lens_offset.display)
+        grid1.addWidget(QLabel('Lens Offset (mA)'),9,2,1,1)
+        grid1.addWidget(self.display_lens_offset,9,3,1,1)
+
         grid2 = QGridLayout()
         # self.grid2.addWidget(QLabel('tracking range min (um)'),0,0)
         # self.grid2.addWidget(self.entry_tracking_range_min_um,0,1)
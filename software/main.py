@@ -18,6 +18,8 @@ import control.gui_tracking as gui
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--simulation", help="Run the GUI with simulated image streams.", action = 'store_true')
+parser.add_argument("--replay", help="Run the GUI with image streams replayed from a recorded experiment folder or a video file.", default = None)
+parser.add_argument("--as_fast_as_possible", help="Replay without following the recorded timestamps.", action = 'store_true')
 args = parser.parse_args()
 
 if __name__ == "__main__":
@@ -25,7 +27,9 @@ if __name__ == "__main__":
 	app = QApplication([])
 	
 	# Main GUI window
-	if(args.simulation):
+	if(args.replay is not None):
+		win = gui.GUI(replay_path = args.replay, replay_realtime = not args.as_fast_as_possible)
+	elif(args.simulation):
 		win = gui.GUI(simulation = True)
 	else:
 		win = gui.GUI()
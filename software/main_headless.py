@@ -0,0 +1,98 @@
+# headless tracking - no Qt event loop
+import os 
+import sys
+import time
+import argparse
+
+from control._def import *
+import control.core_headless as core_headless
+import control.camera as camera_Daheng
+import control.microcontroller as microcontroller
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--simulation", help="Track in simulated image streams.", action = 'store_true')
+parser.add_argument("--replay", help="Track in image streams replayed from a recorded experiment folder or a video file.", default = None)
+parser.add_argument("--as_fast_as_possible", help="Replay without following the recorded timestamps.", action = 'store_true')
+parser.add_argument("--duration", help="Duration of the run in seconds (default: until the track is lost or Ctrl+C).", type = float, default = None)
+parser.add_argument("--save_dir", help="Record the track (and images) to this folder.", default = None)
+parser.add_argument("--experiment_ID", help="Experiment ID used for the recording folder.", default = 'headless')
+parser.add_argument("--no_images", help="Only record the track data.", action = 'store_true')
+parser.add_argument("--roi", help="Initialize the tracker with this bounding box (x y w h, working resolution) instead of thresholding.", type = int, nargs = 4, default = None)
+parser.add_argument("--tracker", help="Image tracker (default: " + Tracking.DEFAULT_TRACKER + ").", default = Tracking.DEFAULT_TRACKER)
+parser.add_argument("--no_stage_tracking", help="Track in the image only, do not move the stage.", action = 'store_true')
+parser.add_argument("--latency_trace", help="Write the per-frame latency trace (csv) to this file at exit.", default = None)
+args = parser.parse_args()
+
+if __name__ == "__main__":
+
+	imaging_channels = CAMERAS.keys()
+	trigger_mode = TriggerMode.SOFTWARE
+	rotate_flip = {}
+	if args.replay is not None:
+		import control.camera_replay as camera_replay
+		mcu = microcontroller.Microcontroller_Simulation()
+		cameras = {TRACKING:camera_replay.Camera(args.replay, imaging_channel = TRACKING, realtime = not args.as_fast_as_possible, color = CAMERAS[TRACKING]['is_color'])}
+		# recorded images are already rotated and flipped
+		rotate_flip[TRACKING] = (0,None)
+		trigger_mode = TriggerMode.CONTINUOUS
+	elif args.simulation:
+		import control.scene_simulation as scene_simulation
+		mcu = microcontroller.Microcontroller_Simulation()
+		trajectories = scene_simulation.OrganismTrajectories()
+		cameras = {}
+		for key in imaging_channels:
+			width, height = CAMERAS[key]['px_format']
+			scene = scene_simulation.SceneSimulation(width, height, microcontroller = mcu, trajectories = trajectories, 
+				flip_image = CAMERAS[key]['flip image'], imaging_channel = key, log_ground_truth = SimulatedScene.LOG_GROUND_TRUTH and key == TRACKING)
+			cameras[key] = camera_Daheng.Camera_Simulation(width = width, height = height, scene = scene)
+	else:
+		cameras = {}
+		for key in imaging_channels:
+			if(CAMERAS[key]['make']=='TIS'):
+				import control.camera_TIS as camera_TIS
+				cameras[key] = camera_TIS.Camera(serial=CAMERAS[key]['serial'], width = CAMERAS[key]['px_format'][0], 
+					height = CAMERAS[key]['px_format'][1], framerate = CAMERAS[key]['fps'], color = CAMERAS[key]['is_color'])
+			elif (CAMERAS[key]['make']=='Daheng'):
+				cameras[key] = camera_Daheng.Camera(sn = CAMERAS[key]['serial'])
+			cameras[key].open()
+		mcu = microcontroller.Microcontroller(version=CONTROLLER_VERSION)
+
+	engine = core_headless.TrackingEngine(cameras, mcu, trigger_mode = trigger_mode, rotate_flip = rotate_flip)
+	engine.trackingCore.tracker_image.update_tracker_type(args.tracker)
+	if args.roi is not None:
+		engine.trackingCore.tracker_image.update_init_method('roi')
+		engine.trackingCore.tracker_image.set_roi_bbox(args.roi)
+	else:
+		engine.trackingCore.tracker_image.update_init_method('threshold')
+	engine.set_stage_tracking(not args.no_stage_tracking)
+	engine.trackingCore.add_callback('tracking_fps',lambda fps: print('tracking fps: ' + str(fps) + ', X = ' + str(engine.internal_state.data['X']) + ' mm'))
+
+	engine.start()
+	if args.save_dir is not None:
+		os.makedirs(args.save_dir, exist_ok = True)
+		engine.start_recording(args.save_dir, args.experiment_ID, channels = [] if args.no_images else None)
+	else:
+		engine.start_tracking()
+
+	timestamp_start = time.time()
+	try:
+		while args.duration is None or time.time() - timestamp_start < args.duration:
+			if engine.track_flag == False:
+				print('track lost')
+				break
+			time.sleep(0.1)
+	except KeyboardInterrupt:
+		pass
+	engine.close()
+
+	scheduler = engine.trigger_scheduler
+	if engine.trigger_mode != TriggerMode.CONTINUOUS:
+		print('trigger: ' + str(scheduler.n_triggers) + ' triggers, {:.1f} fps, period jitter {:.3f} ms, '.format(scheduler.rate_meter.get_rate(scheduler.rate_meter.timestamp_last),scheduler.rate_meter.get_jitter_ms()) + str(scheduler.n_skipped) + ' skipped')
+
+	if engine.latencyTracer is not None:
+		for stage, (values, n) in engine.latencyTracer.get_percentiles().items():
+			print('latency ' + stage + ' (ms, p' + '/p'.join(str(p) for p in LatencyTracing.PERCENTILES) + '): ' + ' / '.join('{:.2f}'.format(v) for v in values) + ' (' + str(n) + ' frames)')
+		if args.latency_trace is not None:
+			engine.latencyTracer.dump(args.latency_trace)
+
+	sys.exit()
@@ -0,0 +1,34 @@
+# re-run tracking on recorded experiments
+import os 
+import sys
+import argparse
+
+from control._def import *
+import control.core_retracking as core_retracking
+
+parser = argparse.ArgumentParser(description = "Re-track recorded experiments. Results are written to <experiment>/<output_folder>/track###.csv.")
+parser.add_argument("experiments", help="Experiment folders (containing track###.csv, metadata.csv and the image folders).", nargs = '+')
+parser.add_argument("--tracker", help="Image tracker.", choices = list(core_retracking.TRACKER_TYPES.keys()), default = 'threshold')
+parser.add_argument("--init_method", help="Tracker initialization.", choices = Tracking.INIT_METHODS, default = 'threshold')
+parser.add_argument("--roi", help="Bounding box for the roi initialization (x y w h, working resolution).", type = int, nargs = 4, default = None)
+parser.add_argument("--channel", help="Imaging channel to track (default: " + TRACKING + ").", default = TRACKING)
+parser.add_argument("--working_resolution", help="Image scaling used for tracking.", type = float, default = WORKING_RES_DEFAULT)
+parser.add_argument("--threshold", help="Lower and upper gray level thresholds.", type = int, nargs = 2, default = [100,255])
+parser.add_argument("--invert", help="Invert the thresholded image.", action = 'store_true')
+parser.add_argument("--output_folder", help="Name of the output folder in each experiment.", default = 'retracked')
+parser.add_argument("--workers", help="Number of worker processes (default: number of CPUs). Use 1 for daSiamRPN on a single GPU.", type = int, default = None)
+parser.add_argument("--maxtasksperchild", help="Restart the worker processes after this many tracks.", type = int, default = None)
+args = parser.parse_args()
+
+if __name__ == "__main__":
+
+	if args.init_method == 'roi' and args.roi is None:
+		print('--roi is required for the roi initialization')
+		sys.exit(1)
+
+	parameters = core_retracking.RetrackingParameters(tracker = args.tracker, init_method = args.init_method, roi_bbox = args.roi, 
+		imaging_channel = args.channel, working_resolution_scaling = args.working_resolution, threshold_lower = args.threshold[0], 
+		threshold_upper = args.threshold[1], invert = args.invert, output_folder = args.output_folder)
+	core_retracking.retrack_experiments(args.experiments, parameters, n_workers = args.workers, maxtasksperchild = args.maxtasksperchild)
+
+	sys.exit()